@@ -0,0 +1,341 @@
+""" load_test.py
+
+A load generator for a running id mapping service, for example the docker compose stack.
+
+Creates two namespaces, seeds them with mappings, and then runs a weighted mix of requests at
+each of a series of concurrency levels, reporting the throughput, error rate, and latency
+percentiles for each level as JSON. Compare runs with different gunicorn `workers` and
+`worker_class` settings to size the service.
+
+Requires the python library `requests` to be installed.
+
+The requests are made with a token for a local user that is a system administrator. Use the
+wrapper shell script, `run_load_test.sh`, to start the containers, create the user, and run the
+load test:
+
+sh container_test/run_load_test.sh --concurrency 1,8,32 --duration 30
+
+Or run against an existing service:
+
+python container_test/load_test.py --url http://localhost:8080 --user myname --token <token>
+
+Run with `--help` for all the options.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import requests
+
+OPERATIONS = ("put", "get", "get_filter", "get_separate", "namespace")
+DEFAULT_MIX = "put:1,get:4,get_filter:2,get_separate:2,namespace:1"
+SEED_BATCH = 5000
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    """Parse an operation mix like `put:1,get:4` into a dict of operation to weight."""
+    ret = {}
+    for part in mix.split(","):
+        op, _, weight = part.strip().partition(":")
+        if op not in OPERATIONS:
+            raise ValueError(f"Unknown operation {op}, expected one of {', '.join(OPERATIONS)}")
+        try:
+            ret[op] = int(weight) if weight else 1
+        except ValueError:
+            raise ValueError(f"Illegal weight for operation {op}: {weight}")
+        if ret[op] < 0:
+            raise ValueError(f"Illegal weight for operation {op}: {weight}")
+    if not sum(ret.values()):
+        raise ValueError("At least one operation must have a weight greater than 0")
+    return ret
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    """Get a percentile of a sorted list of values with the nearest rank method."""
+    return sorted_values[max(math.ceil(pct / 100 * len(sorted_values)) - 1, 0)]
+
+
+def summarize_latencies(latencies: list[float]) -> dict[str, float]:
+    """Summarize latencies in seconds as milliseconds."""
+    if not latencies:
+        return {}
+    s = sorted(latencies)
+    return {
+        "mean_ms": round(sum(s) / len(s) * 1000, 2),
+        "p50_ms": round(percentile(s, 50) * 1000, 2),
+        "p90_ms": round(percentile(s, 90) * 1000, 2),
+        "p99_ms": round(percentile(s, 99) * 1000, 2),
+        "max_ms": round(s[-1] * 1000, 2),
+    }
+
+
+class LoadTest:
+    """Drives a mix of requests against the id mapping service."""
+
+    def __init__(self, url: str, user: str, token: str, args) -> None:
+        self.url = url.rstrip("/")
+        self.user = user
+        self.auth = {"Authorization": f"local {token}"}
+        self.batch_size = args.batch_size
+        self.seed_ids = args.seed_ids
+        self.timeout = args.timeout
+        mix = parse_mix(args.mix)
+        self.ops = [op for op in mix if mix[op]]
+        self.weights = [mix[op] for op in self.ops]
+        run = args.run_id or str(int(time.time()))
+        self.admin_ns = f"load_{run}_admin"
+        self.other_ns = f"load_{run}_other"
+        self._local = threading.local()
+        self._counter = 0
+        self._counter_lock = threading.Lock()
+
+    def _session(self) -> requests.Session:
+        # sessions aren't thread safe, so each thread gets its own connection pool
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        return self._session().request(
+            method, self.url + path, timeout=self.timeout, **kwargs
+        )
+
+    def _check(self, resp: requests.Response) -> None:
+        if resp.status_code >= 300:
+            raise ValueError(f"{resp.request.method} {resp.url} failed: {resp.text}")
+
+    def setup(self) -> None:
+        """Create the namespaces and seed mappings between them."""
+        for ns in (self.admin_ns, self.other_ns):
+            self._check(self._request("PUT", f"/api/v1/namespace/{ns}", headers=self.auth))
+            self._check(self._request(
+                "PUT", f"/api/v1/namespace/{ns}/user/local/{self.user}", headers=self.auth))
+        for start in range(0, self.seed_ids, SEED_BATCH):
+            ids = range(start, min(start + SEED_BATCH, self.seed_ids))
+            self._check(self._request(
+                "PUT",
+                f"/api/v1/mapping/{self.admin_ns}/{self.other_ns}",
+                headers=self.auth,
+                json={f"a{i}": f"o{i}" for i in ids},
+            ))
+
+    def _seeded(self, prefix: str, rand: random.Random) -> list[str]:
+        return [f"{prefix}{rand.randrange(self.seed_ids)}" for _ in range(self.batch_size)]
+
+    def _new_mappings(self) -> dict[str, str]:
+        with self._counter_lock:
+            self._counter += 1
+            n = self._counter
+        return {f"n{n}_{i}": f"m{n}_{i}" for i in range(self.batch_size)}
+
+    def _run_op(self, op: str, rand: random.Random) -> requests.Response:
+        if op == "put":
+            return self._request(
+                "PUT",
+                f"/api/v1/mapping/{self.admin_ns}/{self.other_ns}",
+                headers=self.auth,
+                json=self._new_mappings(),
+            )
+        if op == "get":
+            return self._request(
+                "GET", f"/api/v1/mapping/{self.admin_ns}/",
+                json={"ids": self._seeded("a", rand)})
+        if op == "get_filter":
+            return self._request(
+                "GET", f"/api/v1/mapping/{self.admin_ns}/",
+                params={"namespace_filter": self.other_ns},
+                json={"ids": self._seeded("a", rand)})
+        if op == "get_separate":
+            return self._request(
+                "GET", f"/api/v1/mapping/{self.other_ns}/?separate",
+                json={"ids": self._seeded("o", rand)})
+        return self._request("GET", f"/api/v1/namespace/{self.admin_ns}")
+
+    def _worker(self, worker: int, deadline: float, record: Callable[[str, float, Any], None]):
+        rand = random.Random(worker)
+        while time.monotonic() < deadline:
+            op = rand.choices(self.ops, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                resp = self._run_op(op, rand)
+                error = None if resp.status_code < 300 else resp.status_code
+            except requests.RequestException as e:
+                error = type(e).__name__
+            record(op, time.perf_counter() - start, error)
+
+    def run_level(self, concurrency: int, duration: float, warmup: float) -> dict[str, Any]:
+        """
+        Run the request mix with a number of concurrent clients and summarize the results.
+        Requests during the warmup period are not included in the results.
+        """
+        lock = threading.Lock()
+        results: list[tuple[str, float, Any]] = []
+        start = time.monotonic()
+        measure_from = start + warmup
+        deadline = measure_from + duration
+
+        def record(op, latency, error):
+            if time.monotonic() >= measure_from:
+                with lock:
+                    results.append((op, latency, error))
+
+        with ThreadPoolExecutor(max_workers=concurrency) as ex:
+            futures = [ex.submit(self._worker, w, deadline, record) for w in range(concurrency)]
+            for f in futures:
+                f.result()
+        elapsed = time.monotonic() - measure_from
+        return summarize_level(concurrency, elapsed, results)
+
+
+def summarize_level(
+    concurrency: int, elapsed: float, results: list[tuple[str, float, Any]]
+) -> dict[str, Any]:
+    """Summarize the results of a concurrency level."""
+    errors: dict[str, int] = {}
+    for _, _, err in results:
+        if err is not None:
+            errors[str(err)] = errors.get(str(err), 0) + 1
+    ops = {}
+    for op in OPERATIONS:
+        lat = [r[1] for r in results if r[0] == op]
+        if lat:
+            ops[op] = {
+                "requests": len(lat),
+                "errors": sum(1 for r in results if r[0] == op and r[2] is not None),
+                **summarize_latencies(lat),
+            }
+    error_count = sum(errors.values())
+    return {
+        "concurrency": concurrency,
+        "duration_sec": round(elapsed, 2),
+        "requests": len(results),
+        "requests_per_sec": round(len(results) / elapsed, 2),
+        "errors": error_count,
+        "error_rate": round(error_count / len(results), 4) if results else 0,
+        "error_types": errors,
+        **summarize_latencies([r[1] for r in results]),
+        "operations": ops,
+    }
+
+
+def wait_for_service(url: str, attempts: int = 30) -> dict[str, Any]:
+    for attempt in range(attempts):
+        try:
+            res = requests.get(url, timeout=5)
+            res.raise_for_status()
+            return res.json()
+        except requests.RequestException as e:
+            if attempt == attempts - 1:
+                raise
+            print(f"Waiting for the id mapping service at {url}: {e}", file=sys.stderr)
+            time.sleep(2)
+    raise ValueError("attempts must be at least 1")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Generate load against a running id mapping service."
+    )
+    parser.add_argument("--url", default="http://localhost:8080", help="the service URL")
+    parser.add_argument(
+        "--user", default=os.environ.get("USER"),
+        help="a local system administrator. Default the USER environment variable")
+    parser.add_argument(
+        "--token",
+        help="the user's token. Default the second line of the ID_MAPPER_OUTPUT environment "
+        + "variable, which holds the output of the id_mapper --create command")
+    parser.add_argument(
+        "--concurrency", default="1,4,16,32",
+        help="a comma separated list of the numbers of concurrent clients to run in turn")
+    parser.add_argument(
+        "--duration", type=float, default=30, help="the seconds to measure each level for")
+    parser.add_argument(
+        "--warmup", type=float, default=5,
+        help="the seconds to run each level for before measuring")
+    parser.add_argument(
+        "--mix", default=DEFAULT_MIX,
+        help="the weighted operation mix. Operations are put (bulk mapping creation), get "
+        + "(mapping lookups), get_filter (lookups with a namespace_filter), get_separate "
+        + "(reverse lookups with separate), and namespace (namespace reads)")
+    parser.add_argument(
+        "--batch-size", type=int, default=100, help="the number of IDs per mapping request")
+    parser.add_argument(
+        "--seed-ids", type=int, default=10000,
+        help="the number of mappings to create before the test")
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="the request timeout in seconds")
+    parser.add_argument(
+        "--run-id", help="a suffix for the namespace names. Default the current time")
+    parser.add_argument(
+        "--label",
+        help="a free text label for the run included in the output, e.g. 'gevent x 17'")
+    parser.add_argument("--output", help="the file for the JSON results. Default stdout")
+    args = parser.parse_args(argv)
+    try:
+        parse_mix(args.mix)
+        args.concurrency = [int(c) for c in args.concurrency.split(",")]
+    except ValueError as e:
+        parser.error(str(e))
+    if min(args.concurrency) < 1:
+        parser.error("concurrency levels must be at least 1")
+    if not 1 <= args.batch_size <= 1000:
+        parser.error("--batch-size must be between 1 and 1000")
+    if args.seed_ids < 1:
+        parser.error("--seed-ids must be at least 1")
+    if args.duration <= 0 or args.warmup < 0:
+        parser.error("--duration must be positive and --warmup must not be negative")
+    if not args.token and os.environ.get("ID_MAPPER_OUTPUT"):
+        args.token = os.environ["ID_MAPPER_OUTPUT"].split("\n")[1]
+    if not args.user or not args.token:
+        parser.error("a user and token are required")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    root = wait_for_service(args.url)
+    lt = LoadTest(args.url, args.user, args.token, args)
+    print(f"Seeding {args.seed_ids} mappings in {lt.admin_ns} and {lt.other_ns}",
+          file=sys.stderr)
+    lt.setup()
+    levels = []
+    for c in args.concurrency:
+        res = lt.run_level(c, args.duration, args.warmup)
+        levels.append(res)
+        print(
+            f"concurrency {c:>4}: {res['requests_per_sec']:>9} req/s, "
+            + f"error rate {res['error_rate']:.2%}, p50 {res.get('p50_ms')} ms, "
+            + f"p99 {res.get('p99_ms')} ms",
+            file=sys.stderr,
+        )
+    out = {
+        "time": int(time.time() * 1000),
+        "label": args.label,
+        "url": args.url,
+        "service_version": root.get("version"),
+        "service_commit": root.get("gitcommithash"),
+        "mix": parse_mix(args.mix),
+        "batch_size": args.batch_size,
+        "seed_ids": args.seed_ids,
+        "duration_sec": args.duration,
+        "warmup_sec": args.warmup,
+        "levels": levels,
+    }
+    text = json.dumps(out, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
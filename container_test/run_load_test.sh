@@ -0,0 +1,32 @@
+#!/usr/bin/env bash
+#
+# Script to run the python load_test.py load generator against the id mapping service running
+# in docker containers. Builds and starts the id mapping service and mongo docker containers,
+# creates an admin user, runs the load test with any arguments passed to this script, and
+# stops the containers.
+#
+# The gunicorn worker count and class can be set with the workers and worker_class environment
+# variables, e.g.
+#
+# workers=4 worker_class=sync sh container_test/run_load_test.sh --label "sync x 4"
+
+# build and start the containers
+docker compose up -d --build
+compose_up_exit_code=$?
+if [ $compose_up_exit_code -ne 0 ]; then
+    echo "Error: docker-compose up -d --build command failed with exit code $compose_up_exit_code."
+    exit $compose_up_exit_code
+fi
+
+export USER=loadtester
+# create user loadtester with token
+export ID_MAPPER_OUTPUT=$(docker exec id_mapper_container /bin/sh ./id_mapper --user $USER --create)
+# set user loadtester's admin state to true
+docker exec id_mapper_container /bin/sh ./id_mapper --user $USER --admin true
+
+current_dir="$( dirname -- "$( readlink -f -- "$0"; )"; )"
+python "$current_dir"/load_test.py "$@"
+exit_code=$?
+
+docker compose down
+exit $exit_code
@@ -10,9 +10,14 @@ from jgikbase.idmapping.core.user_lookup import (
     LookupInitializationError,
 )
 from pymongo.mongo_client import MongoClient
+from pymongo import read_preferences
 from jgikbase.idmapping.storage.mongo.id_mapping_mongo_storage import (
     IDMappingMongoStorage,
+    MongoCommandCounter,
 )
+from jgikbase.idmapping.storage.mongo.mongo_cache import MongoCache
+from jgikbase.idmapping.storage.sqlite.id_mapping_sqlite_storage import IDMappingSQLiteStorage
+from pymongo.database import Database
 from pymongo.errors import ConnectionFailure
 from jgikbase.idmapping.core.mapper import IDMapper
 from pathlib import Path
@@ -24,6 +29,19 @@ from typing import Dict, Set, Optional  # @UnusedImport pydev
 from typing import cast
 
 
+# the pymongo read preferences for each read preference mode in the configuration
+_READ_PREFERENCES = {
+    "primaryPreferred": read_preferences.PrimaryPreferred,
+    "secondary": read_preferences.Secondary,
+    "secondaryPreferred": read_preferences.SecondaryPreferred,
+    "nearest": read_preferences.Nearest,
+}
+
+# the collections for the shared user lookup caches
+_COL_USER_CACHE = "cache_user"
+_COL_VALID_CACHE = "cache_user_valid"
+
+
 class IDMappingBuildException(Exception):
     """Thrown when the build fails."""
 
@@ -80,8 +98,41 @@ class IDMappingBuilder:
         """
         return self._set_cfg(cfgpath)
 
+    def build_storage(self, cfgpath: Optional[Path] = None) -> IDMappingStorage:
+        """
+        Build the storage system.
+
+        :param cfgpath: the the path to the build configuration file. The configuration is memoized
+            and used in any future builds, and any other configurations are ignored.
+        :raises IDMappingBuildException: if a build error occurs.
+        """
+        self._set_cfg(cfgpath)
+        return self._build_storage()
+
     def _build_storage(self) -> IDMappingStorage:
         if not hasattr(self, "_storage"):
+            if self.cfg.storage_type == "sqlite":
+                self._storage: IDMappingStorage = IDMappingSQLiteStorage(
+                    cast(Path, self.cfg.sqlite_path))
+            else:
+                self._storage = IDMappingMongoStorage(
+                    self._get_db(),
+                    covered_index=self.cfg.mongo_covered_index,
+                    sharded=self.cfg.mongo_sharded,
+                    mapping_read_preference=self._get_read_preference(
+                        self.cfg.mongo_read_preference_mappings),
+                    namespace_read_preference=self._get_read_preference(
+                        self.cfg.mongo_read_preference_namespaces),
+                )
+        return self._storage
+
+    def _get_read_preference(self, mode: str) -> Optional[read_preferences._ServerMode]:
+        if mode not in _READ_PREFERENCES:
+            return None  # primary, the client default
+        return _READ_PREFERENCES[mode](max_staleness=self.cfg.mongo_max_staleness_sec)
+
+    def _get_db(self) -> Database:
+        if not hasattr(self, "_db"):
             if self.cfg.mongo_user:
                 # NOTE this is currently only tested manually.
                 client: MongoClient = MongoClient(
@@ -90,19 +141,35 @@ class IDMappingBuilder:
                     username=self.cfg.mongo_user,
                     password=self.cfg.mongo_pwd,
                     retryWrites=self.cfg.mongo_retrywrites,
+                    event_listeners=[MongoCommandCounter()],
                 )
             else:
                 client = MongoClient(
-                    self.cfg.mongo_host, retryWrites=self.cfg.mongo_retrywrites
+                    self.cfg.mongo_host,
+                    retryWrites=self.cfg.mongo_retrywrites,
+                    event_listeners=[MongoCommandCounter()],
                 )
             try:
                 # The ismaster command is cheap and does not require auth.
                 client.admin.command("ismaster")
             except ConnectionFailure as e:
                 raise IDMappingBuildException("Connection to database failed") from e
-            db = client[self.cfg.mongo_db]  # type: ignore
-            self._storage: IDMappingStorage = IDMappingMongoStorage(db)
-        return self._storage
+            self._db: Database = client[self.cfg.mongo_db]  # type: ignore
+        return self._db
+
+    def _build_user_lookup_set(self, lookups: Set[UserLookup]) -> UserLookupSet:
+        user_cache = None
+        valid_cache = None
+        if self.cfg.user_cache_shared:
+            # use the UserLookupSet default expiration times
+            user_cache = MongoCache(self._get_db()[_COL_USER_CACHE], 300)
+            valid_cache = MongoCache(self._get_db()[_COL_VALID_CACHE], 3600)
+        return UserLookupSet(
+            lookups,
+            cache_negative_expiration=self.cfg.user_cache_negative_ttl,
+            user_cache=user_cache,
+            valid_cache=valid_cache,
+        )
 
     def build_id_mapping_system(self, cfgpath: Optional[Path] = None) -> IDMapper:
         """
@@ -116,11 +183,19 @@ class IDMappingBuilder:
         lookups: Set[UserLookup] = set()
         for asID in cfg.auth_enabled:
             if asID == LocalUserLookup.LOCAL:
-                lookups.add(self.build_local_user_lookup(cfgpath))
+                lookups.add(
+                    LocalUserLookup(
+                        self._build_storage(),
+                        refresh_interval=cfg.local_user_refresh_interval,
+                    )
+                )
             else:
                 lookups.add(self.build_user_lookup(asID, *cfg.lookup_configs[asID]))
         return IDMapper(
-            UserLookupSet(lookups), cfg.auth_admin_enabled, self._build_storage()
+            self._build_user_lookup_set(lookups),
+            cfg.auth_admin_enabled,
+            self._build_storage(),
+            namespace_cache_expiration=cfg.namespace_cache_ttl,
         )
 
     def build_user_lookup(
@@ -11,6 +11,8 @@ from pathlib import Path
 from jgikbase.idmapping.builder import IDMappingBuilder
 from jgikbase.idmapping.core.user_lookup import LocalUserLookup
 from jgikbase.idmapping.core.user import Username
+from jgikbase.idmapping.core.object_id import NamespaceID
+from jgikbase.idmapping.core.mapping_loader import MappingLoader, LoadProgress
 
 # TODO CLI integration tests. Not super important IMO.
 
@@ -26,6 +28,12 @@ class IDMappingCLI:
     _CREATE = '--create'
     _NEW_TOKEN = '--new-token'  # nosec
     _ADMIN = '--admin'
+    _UPDATE_SCHEMA = '--update-schema'
+    _LOAD = '--load-mappings'
+    _REBUILD_COUNTS = '--rebuild-mapping-counts'
+    _ADMIN_NS = '--admin-ns'
+    _OTHER_NS = '--other-ns'
+    _START_OFFSET = '--start-offset'
 
     _TRUE = 'true'
     _FALSE = 'false'
@@ -63,6 +71,12 @@ class IDMappingCLI:
         a = self._parse_args()
         if not self._check_inputs(a):
             return 1
+        if a.update_schema:
+            return self._update_schema(Path(a.config), a.verbose)
+        if a.load_mappings:
+            return self._load_mappings(a)
+        if a.rebuild_mapping_counts:
+            return self._rebuild_mapping_counts(Path(a.config), a.workers, a.verbose)
         try:
             luh = self._builder.build_local_user_lookup(Path(a.config))
         except Exception as e:
@@ -79,9 +93,14 @@ class IDMappingCLI:
         return self._admin(luh, u, a.admin, a.verbose)
 
     def _check_inputs(self, args):
-        if sum((args.list_users, bool(args.user))) != 1:
-            self._stderr.write('Exactly one of {} or {} must be specified.\n'.format(
-                self._LIST, self._USER))
+        if sum((args.list_users, bool(args.user), args.update_schema, bool(args.load_mappings),
+                args.rebuild_mapping_counts)) != 1:
+            self._stderr.write('Exactly one of {}, {}, {}, {}, or {} must be specified.\n'.format(
+                self._LIST, self._USER, self._UPDATE_SCHEMA, self._LOAD, self._REBUILD_COUNTS))
+            return False
+        if args.load_mappings and not (args.admin_ns and args.other_ns):
+            self._stderr.write('{} and {} are required with {}.\n'.format(
+                self._ADMIN_NS, self._OTHER_NS, self._LOAD))
             return False
         if args.user:
             if sum((args.create, bool(args.admin), args.new_token)) != 1:
@@ -99,6 +118,58 @@ class IDMappingCLI:
                 return False
         return True
 
+    def _update_schema(self, cfgpath: Path, verbose):
+        try:
+            cfg = self._builder.get_cfg(cfgpath)
+            if not cfg.mongo_covered_index and not cfg.mongo_sharded:
+                self._stderr.write('No schema updates are enabled in the configuration.\n')
+                return 1
+            updated = self._builder.build_storage(cfgpath).update_schema()
+        except Exception as e:
+            self._handle_error(e, verbose)
+            return 1
+        self._stdout.write('Updated the database schema.\n' if updated else
+                           'The database schema is already up to date.\n')
+        return 0
+
+    def _load_mappings(self, args: argparse.Namespace) -> int:
+        last: List[LoadProgress] = []
+
+        def report(prog: LoadProgress):
+            last[:] = [prog]
+            self._stdout.write(self._format_progress(prog))
+
+        try:
+            loader = MappingLoader(self._builder.build_storage(Path(args.config)),
+                                   chunk_size=args.chunk_size, writers=args.writers)
+            with open(args.load_mappings, 'rb') as f:
+                prog = loader.load(f, NamespaceID(args.admin_ns), NamespaceID(args.other_ns),
+                                   file_format=args.format, start_offset=args.start_offset,
+                                   progress=report)
+        except Exception as e:
+            self._handle_error(e, args.verbose)
+            if last:
+                self._stderr.write('Resume the load with {} {}\n'.format(
+                    self._START_OFFSET, last[0].offset))
+            return 1
+        self._stdout.write('Load complete. ' + self._format_progress(prog))
+        return 0
+
+    def _rebuild_mapping_counts(self, cfgpath: Path, workers: int, verbose) -> int:
+        try:
+            pairs = self._builder.build_storage(cfgpath).rebuild_mapping_counts(workers)
+        except Exception as e:
+            self._handle_error(e, verbose)
+            return 1
+        self._stdout.write('Rebuilt the mapping counts for {} namespace pairs.\n'.format(pairs))
+        return 0
+
+    def _format_progress(self, prog: LoadProgress) -> str:
+        rate = prog.lines / prog.elapsed if prog.elapsed > 0 else 0
+        return ('Processed {} lines, {} mappings created, {} already existed, {:.0f} lines/s, ' +
+                'offset {}\n').format(
+                    prog.lines, prog.created, prog.existing, rate, prog.offset)
+
     def _list_users(self, local_user_handler: LocalUserLookup, verbose):
         try:
             users = local_user_handler.get_users()
@@ -168,13 +239,46 @@ class IDMappingCLI:
         parser.add_argument(self._ADMIN, help=(
             "Set whether the user is an admin ('{}') or not ('{}'). Any other values are " +
             'not permitted. Requires the {} option.').format(self._TRUE, self._FALSE, self._USER))
+        parser.add_argument(self._UPDATE_SCHEMA, action='store_true',
+                            help='Update the database schema to the version enabled in the ' +
+                            'configuration. Servers may continue running during the update. ' +
+                            'All other arguments are ignored.')
+        parser.add_argument(self._LOAD, metavar='FILE',
+                            help=('Load mappings from a file directly into the database. ' +
+                                  'Requires the {} and {} options. Other than the options ' +
+                                  'below, all other arguments are ignored.').format(
+                                      self._ADMIN_NS, self._OTHER_NS))
+        parser.add_argument(self._ADMIN_NS,
+                            help='The administrative namespace for the mappings to load.')
+        parser.add_argument(self._OTHER_NS,
+                            help='The non-administrative namespace for the mappings to load.')
+        parser.add_argument('--format', choices=MappingLoader.FORMATS,
+                            default=MappingLoader.TSV,
+                            help=("The format of the mapping file. Lines in 'tsv' files " +
+                                  "contain the administrative ID and the other ID separated " +
+                                  "by a tab. Lines in 'ndjson' files are JSON objects with " +
+                                  "'admin' and 'other' keys."))
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='The number of mappings to write to the database at once.')
+        parser.add_argument('--writers', type=int, default=1,
+                            help='The number of chunks to write to the database concurrently.')
+        parser.add_argument(self._START_OFFSET, type=int, default=0,
+                            help='The byte offset in the file at which to start loading. ' +
+                            'Used to resume a load from the offset in the progress output.')
+        parser.add_argument(self._REBUILD_COUNTS, action='store_true',
+                            help='Recalculate the mapping counts for each pair of namespaces ' +
+                            'from the mappings. Mapping writes fail or wait until the ' +
+                            'rebuild is complete. Other than the option below, all other ' +
+                            'arguments are ignored.')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='The number of namespaces to count concurrently.')
         parser.add_argument('--config', default='./deploy.cfg',
                             help='The location of the configuration file.')
         parser.add_argument('--verbose', action='store_true', help='Print stack trace on error.')
         return parser.parse_args(self._args)
 
     def _handle_error(self, exception, verbose=False):
-        self._stderr.write('Error: {}\n'.format(exception.args[0]))
+        self._stderr.write('Error: {}\n'.format(exception))
         if verbose:
             self._stderr.write(traceback.format_exc() + '\n')
 
@@ -20,35 +20,120 @@ class IDMappingConfigError(Exception):
     pass
 
 
+STORAGE_TYPES = ("mongo", "sqlite")
+""" The storage systems for the ID mapping data. """
+
+READ_PREFERENCES = ("primary", "primaryPreferred", "secondary", "secondaryPreferred", "nearest")
+""" The MongoDB read preference modes. """
+
+# the minimum max staleness allowed by MongoDB.
+_MIN_MAX_STALENESS_SEC = 90
+
+
 class KBaseConfig:
     """
     Loads a configuration from a standard KBase-style deploy.cfg file (an ini file with only
     one section.) The configuration is contained in the `idmapping` section of the config file.
 
     The keys are:
-    mongo-host
-    mongo-db
+    storage-type (optional)
+    sqlite-path (required if storage-type is sqlite)
+    mongo-host (required if storage-type is mongo)
+    mongo-db (required if storage-type is mongo)
     mongo-user (optional)
     mongo-pwd (optional)
     mongo-retrywrites (optional)
+    mongo-covered-index (optional)
+    mongo-sharded (optional)
+    mongo-read-preference-mappings (optional)
+    mongo-read-preference-namespaces (optional)
+    mongo-max-staleness-sec (optional)
     authentication-enabled (optional)
     authentication-admin-enabled (optional)
     keys specific to each authentication source. See the example deploy.cfg file in this repo
     or the class variables.
     dont-trust-x-ip-headers (optional)
-
-    The last key instructs the server to ignore the X-Real-IP and X-Forwarded-For
-    headers if set to the string 'true'.
-
-    :ivar mongo_host: the host of the MongoDB instance, including the port.
-    :ivar mongo_db: the MongoDB database to use for the ID mapping service.
+    namespace-cache-ttl (optional)
+    user-cache-negative-ttl (optional)
+    user-cache-shared (optional)
+    local-user-refresh-interval (optional)
+    profile-dir (optional)
+    profile-sample-rate (optional)
+    profile-max-size-mb (optional)
+
+    The storage-type key selects the storage system, one of :data:`STORAGE_TYPES`. The default is
+    mongo. The sqlite storage system keeps the data in an embedded SQLite database file at the
+    path given by the sqlite-path key and is intended for single host deployments. The mongo-*
+    keys are ignored when it is used, and user-cache-shared may not be enabled.
+
+    The dont-trust-x-ip-headers key instructs the server to ignore the X-Real-IP and
+    X-Forwarded-For headers if set to the string 'true'.
+
+    The mongo-covered-index key enables the v2 database schema, in which mapping queries in both
+    directions are covered by an index, if set to the string 'true'.
+
+    The mongo-sharded key declares that the MongoDB database is in a sharded cluster if set to
+    the string 'true'. The mapping collections are then sharded so that mapping lookups are
+    routed to a single shard.
+
+    The mongo-read-preference-mappings and mongo-read-preference-namespaces keys set the MongoDB
+    read preference mode, one of :data:`READ_PREFERENCES`, for mapping lookups and namespace
+    listings respectively. The default is primary. Reads used for authorization always use
+    the primary. The mongo-max-staleness-sec key sets the maximum replication lag, in seconds,
+    of secondaries used for those reads. It must be at least 90; -1 or a missing key sets no
+    maximum.
+
+    The namespace-cache-ttl key sets the lifetime, in seconds, of namespace data cached in the
+    server. A value less than 1 or a missing key disables the cache.
+
+    The user-cache-negative-ttl key sets the lifetime, in seconds, of cached negative user lookup
+    results, i.e. invalid tokens and users that do not exist. A value less than 1 or a missing
+    key disables negative caching.
+
+    The user-cache-shared key causes user lookup results to be cached in the MongoDB database,
+    where they are shared between server processes, if set to the string 'true'.
+
+    The local-user-refresh-interval key causes the server to hold all local users in memory and
+    sets the maximum time, in seconds, between checks for changes to the local users. A value
+    less than 1 or a missing key disables holding the users in memory.
+
+    The profile-dir key enables request profiling and sets the directory where profiles are
+    written. The profile-sample-rate key sets the fraction, between 0 and 1, of requests that are
+    profiled; the default is 0, in which case only requests from system administrators that ask
+    to be profiled are profiled. The profile-max-size-mb key sets the maximum total size of the
+    profiles in the directory in megabytes; the default is 100.
+
+    :ivar storage_type: the storage system to use, one of :data:`STORAGE_TYPES`.
+    :ivar sqlite_path: the path to the SQLite database file, or None if the storage system is
+        not sqlite.
+    :ivar mongo_host: the host of the MongoDB instance, including the port, or None if the
+        storage system is not mongo.
+    :ivar mongo_db: the MongoDB database to use for the ID mapping service, or None if the
+        storage system is not mongo.
     :ivar mongo_user: the username to use with MongoDB, if any.
     :ivar mongo_pwd: the password to use with MongoDB, if any.
     :ivar mongo_retrywrites: whether to enable retryWrites parameter with MongoDB.
+    :ivar mongo_covered_index: whether to enable the MongoDB covering index for mapping queries.
+    :ivar mongo_sharded: whether the MongoDB database is in a sharded cluster.
+    :ivar mongo_read_preference_mappings: the MongoDB read preference mode for mapping lookups.
+    :ivar mongo_read_preference_namespaces: the MongoDB read preference mode for namespace
+        listings.
+    :ivar mongo_max_staleness_sec: the maximum replication lag of secondaries used for reads in
+        seconds, or -1 for no maximum.
     :ivar auth_enabled: the set of authentication sources that are enabled.
     :ivar auth_admin_enabled: the set of authentication sources that are trusted to define
         system administrators.
     :ivar ignore_ip_headers: True if the X-Real-IP and X-Forwarded-For headers should be ignored.
+    :ivar namespace_cache_ttl: the lifetime of cached namespace data in seconds.
+    :ivar user_cache_negative_ttl: the lifetime of cached negative user lookup results in
+        seconds.
+    :ivar user_cache_shared: whether to cache user lookup results in the MongoDB database.
+    :ivar local_user_refresh_interval: the maximum time between checks for changes to the local
+        users held in memory in seconds.
+    :ivar profile_dir: the directory where request profiles are written, or None if profiling
+        is disabled.
+    :ivar profile_sample_rate: the fraction of requests to profile.
+    :ivar profile_max_size_mb: the maximum total size of the request profiles in megabytes.
     :ivar lookup_configs: the configurations for the user lookup instances. This is a dict
         of :class:`jgikbase.idmapping.core.user.AuthsourceID` to the configuration for the lookup
         instance for that authsource. The configuration is a tuple where the first entry is a
@@ -72,6 +157,12 @@ class KBaseConfig:
 
     _TEMP_KEY_CFG_FILE = "temp-key-config-file"
 
+    KEY_STORAGE_TYPE = "storage-type"
+    """ The key corresponding to the value containing the storage system type. """
+
+    KEY_SQLITE_PATH = "sqlite-path"
+    """ The key corresponding to the value containing the path to the SQLite database file. """
+
     KEY_MONGO_HOST = "mongo-host"
     """ The key corresponding to the value containing the MongoDB host. """
 
@@ -87,6 +178,32 @@ class KBaseConfig:
     KEY_MONGO_RETRYWRITES = "mongo-retrywrites"
     """ The key corresponding to the value containing the MongoDB retrywrites. """
 
+    KEY_MONGO_COVERED_INDEX = "mongo-covered-index"
+    """
+    The key corresponding to the value containing a boolean designating whether the covering
+    index for mapping queries should be enabled.
+    """
+
+    KEY_MONGO_SHARDED = "mongo-sharded"
+    """
+    The key corresponding to the value containing a boolean designating whether the MongoDB
+    database is in a sharded cluster.
+    """
+
+    KEY_MONGO_READ_PREFERENCE_MAPPINGS = "mongo-read-preference-mappings"
+    """ The key corresponding to the value containing the read preference for mapping lookups. """
+
+    KEY_MONGO_READ_PREFERENCE_NAMESPACES = "mongo-read-preference-namespaces"
+    """
+    The key corresponding to the value containing the read preference for namespace listings.
+    """
+
+    KEY_MONGO_MAX_STALENESS_SEC = "mongo-max-staleness-sec"
+    """
+    The key corresponding to the value containing the maximum replication lag of secondaries used
+    for reads.
+    """
+
     KEY_AUTH_ENABLED = "authentication-enabled"
     """
     The key corresponding to the value containing a comma separated list of authentication sources
@@ -104,6 +221,42 @@ class KBaseConfig:
     The key corresponding to the value containing a boolean designating whether the X-Real_IP
     and X-Forwarded-For headers should be ignored. """
 
+    KEY_NAMESPACE_CACHE_TTL = "namespace-cache-ttl"
+    """
+    The key corresponding to the value containing the lifetime of cached namespace data in
+    seconds.
+    """
+
+    KEY_USER_CACHE_NEGATIVE_TTL = "user-cache-negative-ttl"
+    """
+    The key corresponding to the value containing the lifetime of cached negative user lookup
+    results in seconds.
+    """
+
+    KEY_USER_CACHE_SHARED = "user-cache-shared"
+    """
+    The key corresponding to the value containing a boolean designating whether user lookup
+    results should be cached in the MongoDB database.
+    """
+
+    KEY_LOCAL_USER_REFRESH_INTERVAL = "local-user-refresh-interval"
+    """
+    The key corresponding to the value containing the maximum time between checks for changes
+    to the local users held in memory in seconds.
+    """
+
+    KEY_PROFILE_DIR = "profile-dir"
+    """ The key corresponding to the value containing the directory for request profiles. """
+
+    KEY_PROFILE_SAMPLE_RATE = "profile-sample-rate"
+    """ The key corresponding to the value containing the fraction of requests to profile. """
+
+    KEY_PROFILE_MAX_SIZE_MB = "profile-max-size-mb"
+    """
+    The key corresponding to the value containing the maximum total size of the request profiles
+    in megabytes.
+    """
+
     AUTH_PREFIX = "auth-source-"
     """ The prefix for keys for specific authentication sources. """
 
@@ -133,12 +286,37 @@ class KBaseConfig:
             cfgfile = self._get_cfg_from_env()
         cfg = self._get_cfg(cfgfile)
         self.ignore_ip_headers = self._TRUE == cfg.get(self.KEY_IGNORE_IP_HEADERS)
-        self.mongo_host = self._get_string(self.KEY_MONGO_HOST, cfg)
-        self.mongo_db = self._get_string(self.KEY_MONGO_DB, cfg)
+        self.storage_type = self._get_choice(
+            self.KEY_STORAGE_TYPE, cfg, STORAGE_TYPES)
+        sqlite = self.storage_type == "sqlite"
+        sqlite_path = self._get_string(self.KEY_SQLITE_PATH, cfg, sqlite)
+        self.sqlite_path = Path(sqlite_path) if sqlite and sqlite_path else None
+        self.mongo_host = self._get_string(self.KEY_MONGO_HOST, cfg, not sqlite)
+        self.mongo_db = self._get_string(self.KEY_MONGO_DB, cfg, not sqlite)
         self.mongo_user = self._get_string(self.KEY_MONGO_USER, cfg, False)
         mongo_pwd = self._get_string(self.KEY_MONGO_PWD, cfg, False)
         mongo_retrywrites_value = self._get_string(self.KEY_MONGO_RETRYWRITES, cfg, False)
         self.mongo_retrywrites = self._TRUE == mongo_retrywrites_value
+        self.mongo_covered_index = self._TRUE == self._get_string(
+            self.KEY_MONGO_COVERED_INDEX, cfg, False)
+        self.mongo_sharded = self._TRUE == self._get_string(self.KEY_MONGO_SHARDED, cfg, False)
+        self.mongo_read_preference_mappings = self._get_choice(
+            self.KEY_MONGO_READ_PREFERENCE_MAPPINGS, cfg, READ_PREFERENCES)
+        self.mongo_read_preference_namespaces = self._get_choice(
+            self.KEY_MONGO_READ_PREFERENCE_NAMESPACES, cfg, READ_PREFERENCES)
+        self.mongo_max_staleness_sec = self._get_int(self.KEY_MONGO_MAX_STALENESS_SEC, cfg, -1)
+        if (self.mongo_max_staleness_sec != -1 and
+                self.mongo_max_staleness_sec < _MIN_MAX_STALENESS_SEC):
+            raise IDMappingConfigError(
+                "Parameter {} in configuration file {}, section {}, must be -1 or at least {}: {}"
+                .format(
+                    self.KEY_MONGO_MAX_STALENESS_SEC,
+                    cfg[self._TEMP_KEY_CFG_FILE],
+                    self.CFG_SEC,
+                    _MIN_MAX_STALENESS_SEC,
+                    self.mongo_max_staleness_sec,
+                )
+            )
         if bool(self.mongo_user) ^ bool(mongo_pwd):  # xor
             mongo_pwd = None
             raise IDMappingConfigError(
@@ -158,6 +336,48 @@ class KBaseConfig:
             self.KEY_AUTH_ADMIN_ENABLED, cfg
         )
         self.lookup_configs = self._get_lookup_configs(cfg)
+        self.namespace_cache_ttl = self._get_int(self.KEY_NAMESPACE_CACHE_TTL, cfg, 0)
+        self.user_cache_negative_ttl = self._get_int(self.KEY_USER_CACHE_NEGATIVE_TTL, cfg, 0)
+        self.user_cache_shared = self._TRUE == self._get_string(
+            self.KEY_USER_CACHE_SHARED, cfg, False
+        )
+        if sqlite and self.user_cache_shared:
+            raise IDMappingConfigError(
+                ("Parameter {} in configuration file {}, section {}, cannot be enabled with the "
+                 + "{} {}").format(
+                    self.KEY_USER_CACHE_SHARED,
+                    cfg[self._TEMP_KEY_CFG_FILE],
+                    self.CFG_SEC,
+                    self.storage_type,
+                    self.KEY_STORAGE_TYPE,
+                )
+            )
+        self.local_user_refresh_interval = self._get_int(
+            self.KEY_LOCAL_USER_REFRESH_INTERVAL, cfg, 0
+        )
+        profile_dir = self._get_string(self.KEY_PROFILE_DIR, cfg, False)
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.profile_sample_rate = self._get_float(self.KEY_PROFILE_SAMPLE_RATE, cfg, 0)
+        if not 0 <= self.profile_sample_rate <= 1:
+            raise IDMappingConfigError(
+                "Parameter {} in configuration file {}, section {}, must be between 0 and 1: {}"
+                .format(
+                    self.KEY_PROFILE_SAMPLE_RATE,
+                    cfg[self._TEMP_KEY_CFG_FILE],
+                    self.CFG_SEC,
+                    self.profile_sample_rate,
+                )
+            )
+        self.profile_max_size_mb = self._get_int(self.KEY_PROFILE_MAX_SIZE_MB, cfg, 100)
+        if self.profile_max_size_mb < 1:
+            raise IDMappingConfigError(
+                "Parameter {} in configuration file {}, section {}, must be at least 1: {}".format(
+                    self.KEY_PROFILE_MAX_SIZE_MB,
+                    cfg[self._TEMP_KEY_CFG_FILE],
+                    self.CFG_SEC,
+                    self.profile_max_size_mb,
+                )
+            )
 
     def _get_cfg(self, cfgfile: Path) -> Dict[str, str]:
         if not cfgfile.is_file():
@@ -209,6 +429,51 @@ class KBaseConfig:
         else:
             return None
 
+    def _get_int(self, param_name: str, config: Dict[str, str], default: int) -> int:
+        s = self._get_string(param_name, config, False)
+        if not s:
+            return default
+        try:
+            return int(s)
+        except ValueError as e:
+            raise IDMappingConfigError(
+                "Parameter {} in configuration file {}, section {}, is not an integer: {}".format(
+                    param_name, config[self._TEMP_KEY_CFG_FILE], self.CFG_SEC, s
+                )
+            ) from e
+
+    def _get_float(self, param_name: str, config: Dict[str, str], default: float) -> float:
+        s = self._get_string(param_name, config, False)
+        if not s:
+            return default
+        try:
+            return float(s)
+        except ValueError as e:
+            raise IDMappingConfigError(
+                "Parameter {} in configuration file {}, section {}, is not a number: {}".format(
+                    param_name, config[self._TEMP_KEY_CFG_FILE], self.CFG_SEC, s
+                )
+            ) from e
+
+    def _get_choice(
+        self, param_name: str, config: Dict[str, str], choices: Tuple[str, ...]
+    ) -> str:
+        # the first choice is the default
+        s = self._get_string(param_name, config, False)
+        if not s:
+            return choices[0]
+        if s not in choices:
+            raise IDMappingConfigError(
+                "Parameter {} in configuration file {}, section {}, must be one of {}: {}".format(
+                    param_name,
+                    config[self._TEMP_KEY_CFG_FILE],
+                    self.CFG_SEC,
+                    ", ".join(choices),
+                    s,
+                )
+            )
+        return s
+
     def _get_authsource_ids(
         self, param_name: str, config: Dict[str, str]
     ) -> Set[AuthsourceID]:
@@ -0,0 +1,78 @@
+"""
+Caches for user lookup results.
+"""
+
+from abc import ABCMeta as _ABCMeta, abstractmethod as _abstractmethod
+from jgikbase.idmapping.core.arg_check import not_none
+from typing import Any, Callable, Optional
+from cacheout.lru import LRUCache
+import time
+
+
+class Cache:  # pragma: no cover
+    """
+    An interface for a key value cache with per entry expiration times.
+
+    Keys are strings. Values may be str, int, float, bool, or lists and dicts of those types, so
+    that implementations that share the cache between processes can serialize them. None is not
+    a legal value.
+    """
+
+    __metaclass__ = _ABCMeta
+
+    @_abstractmethod
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Get a value from the cache.
+
+        :param key: the key for the value.
+        :raises TypeError: if the key is None.
+        :returns: the value, or None if the key is not in the cache or has expired.
+        """
+        raise NotImplementedError()
+
+    @_abstractmethod
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Add a value to the cache, replacing any existing value.
+
+        :param key: the key for the value.
+        :param value: the value.
+        :param ttl: the lifetime of the value in seconds. If None, the cache's default lifetime
+            is used.
+        :raises TypeError: if the key or value is None.
+        """
+        raise NotImplementedError()
+
+
+class InProcessCache(Cache):
+    """
+    A :class:`Cache` held in the memory of the current process. The least recently used entries
+    are discarded when the cache is full.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10000,
+        default_ttl: float = 300,
+        timer: Optional[Callable[[], float]] = None,
+    ) -> None:
+        """
+        Create the cache.
+
+        :param max_size: the maximum number of entries in the cache.
+        :param default_ttl: the default lifetime of an entry in seconds.
+        :param timer: the timer used for cache expiration. Defaults to time.time.
+        """
+        self._cache = LRUCache(
+            timer=time.time if not timer else timer, maxsize=max_size, ttl=default_ttl
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        not_none(key, "key")
+        return self._cache.get(key)
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        not_none(key, "key")
+        not_none(value, "value")
+        self._cache.set(key, value, ttl=ttl)
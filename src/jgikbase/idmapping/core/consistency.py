@@ -0,0 +1,80 @@
+"""
+Per-request read-your-writes consistency tokens.
+
+Storage systems that serve lookups from replicas may return results that don't yet include
+recent writes. To let a client read its own writes, a storage system records an opaque token
+after a write with :func:`set_write_token`, which the service returns to the client. The client
+sends the token with later lookups, and the service makes it available to the storage system
+via :func:`get_read_token`, which then ensures the lookups see at least the state as of the
+write.
+
+The service starts a context at the start of each request with :func:`start_request`. Outside
+of a request the functions do nothing.
+"""
+
+from contextvars import ContextVar
+from typing import Optional
+
+
+class ConsistencyContext:
+    """
+    The consistency tokens for a request.
+
+    :ivar read_token: the token sent by the client, if any.
+    :ivar write_token: the token for the last write in the request, if any.
+    """
+
+    def __init__(self, read_token: Optional[str] = None) -> None:
+        """
+        Create the context.
+
+        :param read_token: the token sent by the client, if any.
+        """
+        self.read_token = read_token
+        self.write_token: Optional[str] = None
+
+
+_current: ContextVar[Optional[ConsistencyContext]] = ContextVar(
+    "consistency_context", default=None
+)
+
+
+def start_request(read_token: Optional[str] = None) -> ConsistencyContext:
+    """
+    Start a consistency context for the current request, replacing any existing context.
+
+    :param read_token: the token sent by the client, if any.
+    :returns: the new context.
+    """
+    ctx = ConsistencyContext(read_token)
+    _current.set(ctx)
+    return ctx
+
+
+def stop_request() -> None:
+    """
+    Remove the consistency context for the current request, if any.
+    """
+    _current.set(None)
+
+
+def get_read_token() -> Optional[str]:
+    """
+    Get the consistency token sent by the client for the current request.
+
+    :returns: the token, or None if there is no token or no current request.
+    """
+    ctx = _current.get()
+    return ctx.read_token if ctx else None
+
+
+def set_write_token(token: str) -> None:
+    """
+    Record the consistency token for a write in the current request. Does nothing outside
+    of a request.
+
+    :param token: the token.
+    """
+    ctx = _current.get()
+    if ctx:
+        ctx.write_token = token
@@ -4,11 +4,16 @@ The core ID mapping code.
 
 from jgikbase.idmapping.storage.id_mapping_storage import IDMappingStorage
 from jgikbase.idmapping.core.user_lookup import UserLookupSet
-from typing import Set, cast, Tuple, Iterable, Optional
+from jgikbase.idmapping.core.namespace_cache import NamespaceCache
+from typing import Set, cast, Tuple, Iterable, Optional, List, Dict, Iterator
 from jgikbase.idmapping.core.arg_check import not_none, no_Nones_in_iterable
 from jgikbase.idmapping.core.object_id import NamespaceID, Namespace, ObjectID
 from jgikbase.idmapping.core.user import User, AuthsourceID
-from jgikbase.idmapping.core.errors import NoSuchUserError, UnauthorizedError
+from jgikbase.idmapping.core.errors import (
+    NoSuchUserError,
+    UnauthorizedError,
+    IllegalParameterError,
+)
 from jgikbase.idmapping.core.tokens import Token
 import logging
 
@@ -17,6 +22,20 @@ def _log(msg, *args):
     logging.getLogger(__name__).info(msg, *args)
 
 
+def _prefix_end(prefix: str) -> Optional[str]:
+    # The smallest string that sorts after every string starting with the prefix, or None if
+    # there isn't one. Code point order matches the binary UTF-8 order used by the storage
+    # systems.
+    chars = list(prefix)
+    while chars:
+        c = ord(chars.pop()) + 1
+        if c == 0xD800:  # surrogates can't be encoded
+            c = 0xE000
+        if c <= 0x10FFFF:
+            return "".join(chars) + chr(c)
+    return None
+
+
 class IDMapper:
     """
     The core ID Mapping class. Allows for creating namespaces, administrating namespaces, and
@@ -28,6 +47,7 @@ class IDMapper:
         user_lookup: UserLookupSet,
         admin_authsources: Set[AuthsourceID],
         storage: IDMappingStorage,
+        namespace_cache_expiration: int = 0,
     ) -> None:
         """
         Create the mapper.
@@ -37,11 +57,14 @@ class IDMapper:
         :param admin_authsources: the set of auth sources that are valid system admin sources.
             The admin state returned by other auth sources will be ignored.
         :param storage: the mapping storage system.
+        :param namespace_cache_expiration: the lifetime of cached namespace data in seconds.
+            If less than 1, namespaces are not cached.
         """
         not_none(user_lookup, "user_lookup")
         no_Nones_in_iterable(admin_authsources, "admin_authsources")
         not_none(storage, "storage")
         self._storage = storage
+        self._namespaces = NamespaceCache(storage, cache_expiration=namespace_cache_expiration)
         self._lookup = user_lookup
         self._admin_authsources = admin_authsources
 
@@ -68,6 +91,24 @@ class IDMapper:
             )
         return user
 
+    def is_sys_admin(self, authsource_id: AuthsourceID, token: Token) -> bool:
+        """
+        Check whether a user is a system administrator.
+
+        :param authsource_id: The authentication source to be used to look up the user token.
+        :param token: the user's token.
+        :raises TypeError: if any of the arguments are None.
+        :raises NoSuchAuthsourceError: if there's no handler for the provided authsource.
+        :raises InvalidTokenError: if the token is invalid.
+        :returns: True if the user is a system administrator.
+        """
+        not_none(authsource_id, "authsource_id")
+        not_none(token, "token")
+        if authsource_id not in self._admin_authsources:
+            return False
+        _, admin = self._lookup.get_user(authsource_id, token)
+        return admin
+
     def create_namespace(
         self, authsource_id: AuthsourceID, token: Token, namespace_id: NamespaceID
     ) -> None:
@@ -86,6 +127,7 @@ class IDMapper:
         not_none(namespace_id, "namespace_id")
         admin = self._check_sys_admin(authsource_id, token)
         self._storage.create_namespace(namespace_id)
+        self._namespaces.invalidate()
         _log(
             "Admin %s/%s created namespace %s",
             admin.authsource_id.id,
@@ -132,6 +174,7 @@ class IDMapper:
         admin = self._check_sys_admin(authsource_id, token)
         self._check_valid_user(user)
         self._storage.add_user_to_namespace(namespace_id, user)
+        self._namespaces.invalidate()
         _log(
             "Admin %s/%s added user %s/%s to namespace %s",
             admin.authsource_id.id,
@@ -141,6 +184,50 @@ class IDMapper:
             namespace_id.id,
         )
 
+    def add_users_to_namespace(
+        self,
+        authsource_id: AuthsourceID,
+        token: Token,
+        namespace_id: NamespaceID,
+        users: Set[User],
+    ) -> None:
+        """
+        Add users to a namespace. The users are validated with at most one call to each
+        user handler and added in one storage operation. Users that already administrate the
+        namespace are ignored.
+
+        :param authsource_id: The authentication source to be used to look up the user token.
+        :param token: the user's token.
+        :param namespace_id: the namespace to modify.
+        :param users: the users.
+        :raises TypeError: if any of the arguments are None or users contains None.
+        :raises NoSuchAuthsourceError: if there's no handler for the provided authsource ID or
+            a user's authsource.
+        :raises NoSuchNamespaceError: if the namespace does not exist.
+        :raises NoSuchUserError: if any of the users are invalid according to the appropriate
+            user handler.
+        :raises InvalidTokenError: if the token is invalid.
+        :raises UnauthorizedError: if the user is not a system administrator.
+        """
+        not_none(namespace_id, "namespace_id")
+        no_Nones_in_iterable(users, "users")
+        admin = self._check_sys_admin(authsource_id, token)
+        valid = self._lookup.are_valid_users(users)
+        invalid = sorted(
+            u.authsource_id.id + "/" + u.username.name for u in users if not valid[u]
+        )
+        if invalid:
+            raise NoSuchUserError(", ".join(invalid))
+        self._storage.add_users_to_namespace(namespace_id, users)
+        self._namespaces.invalidate()
+        _log(
+            "Admin %s/%s added users %s to namespace %s",
+            admin.authsource_id.id,
+            admin.username.name,
+            ", ".join(sorted(u.authsource_id.id + "/" + u.username.name for u in users)),
+            namespace_id.id,
+        )
+
     def remove_user_from_namespace(
         self,
         authsource_id: AuthsourceID,
@@ -166,6 +253,7 @@ class IDMapper:
         not_none(user, "user")
         admin = self._check_sys_admin(authsource_id, token)
         self._storage.remove_user_from_namespace(namespace_id, user)
+        self._namespaces.invalidate()
         _log(
             "Admin %s/%s removed user %s/%s from namespace %s",
             admin.authsource_id.id,
@@ -180,7 +268,7 @@ class IDMapper:
         :raises UnauthorizedError: if the user is not authorized to administrate the namespace.
         :raises NoSuchNamespaceError: if the namespace does not exist.
         """
-        self._check_authed_for_ns(user, self._storage.get_namespace(namespace_id))
+        self._check_authed_for_ns(user, self._namespaces.get_namespace(namespace_id))
 
     def _check_authed_for_ns(self, user: User, ns: Namespace) -> None:
         """
@@ -221,6 +309,7 @@ class IDMapper:
         user, _ = self._lookup.get_user(authsource_id, token)
         self._check_authed_for_ns_get(user, namespace_id)
         self._storage.set_namespace_publicly_mappable(namespace_id, publicly_mappable)
+        self._namespaces.invalidate()
         _log(
             "User %s/%s set namespace %s public map property to %s",
             user.authsource_id.id,
@@ -254,7 +343,7 @@ class IDMapper:
             raise TypeError(
                 "If token or authsource_id is specified, both must be specified"
             )
-        ns = self._storage.get_namespace(namespace_id)
+        ns = self._namespaces.get_namespace(namespace_id)
         if token:
             authsource_id = cast(
                 AuthsourceID, authsource_id
@@ -271,9 +360,9 @@ class IDMapper:
         :returns: A 2-tuple of sets of namespace IDs. The first set is publicly mappable, the
             second set is not.
         """
-        # could make a more efficient storage method if this proves to be slow
-        # since we're pulling back user data we don't need
-        nss = self._storage.get_namespaces()
+        # the user lists aren't needed, so the storage system can skip them and may read from
+        # a replica
+        nss = self._namespaces.get_namespaces(include_users=False)
         public = set()
         private = set()
         for ns in nss:
@@ -311,9 +400,9 @@ class IDMapper:
         not_none(administrative_oid, "administrative_oid")
         not_none(oid, "oid")
         user, _ = self._lookup.get_user(authsource_id, token)
-        adminns = self._storage.get_namespace(administrative_oid.namespace_id)
+        adminns = self._namespaces.get_namespace(administrative_oid.namespace_id)
         self._check_authed_for_ns(user, adminns)
-        ns = self._storage.get_namespace(oid.namespace_id)
+        ns = self._namespaces.get_namespace(oid.namespace_id)
         if not ns.is_publicly_mappable:
             self._check_authed_for_ns(user, ns)
         self._storage.add_mapping(administrative_oid, oid)
@@ -357,9 +446,9 @@ class IDMapper:
         not_none(administrative_oid, "administrative_oid")
         not_none(oid, "oid")
         user, _ = self._lookup.get_user(authsource_id, token)
-        adminns = self._storage.get_namespace(administrative_oid.namespace_id)
+        adminns = self._namespaces.get_namespace(administrative_oid.namespace_id)
         self._check_authed_for_ns(user, adminns)
-        self._storage.get_namespace(oid.namespace_id)  # check for existence
+        self._namespaces.get_namespace(oid.namespace_id)  # check for existence
         self._storage.remove_mapping(administrative_oid, oid)
         # this might be too much of a performance hit. If so, push the bulk operations down to
         # this level and do... what exactly? Log 10000 entries?
@@ -374,6 +463,117 @@ class IDMapper:
             oid.id,
         )
 
+    def _to_oid_pairs(
+        self,
+        administrative_namespace_id: NamespaceID,
+        namespace_id: NamespaceID,
+        id_pairs: Iterable[Tuple[str, str]],
+    ) -> List[Tuple[ObjectID, ObjectID]]:
+        not_none(administrative_namespace_id, "administrative_namespace_id")
+        not_none(namespace_id, "namespace_id")
+        no_Nones_in_iterable(id_pairs, "id_pairs")
+        return [
+            (ObjectID(administrative_namespace_id, aid), ObjectID(namespace_id, id_))
+            for aid, id_ in id_pairs
+        ]
+
+    def create_mappings(
+        self,
+        authsource_id: AuthsourceID,
+        token: Token,
+        administrative_namespace_id: NamespaceID,
+        namespace_id: NamespaceID,
+        id_pairs: Iterable[Tuple[str, str]],
+    ) -> Tuple[int, int]:
+        """
+        Create mappings in bulk. The user must be an administrator of the administrative
+        namespace and an administrator of the other namespace if it is not publicly mappable.
+        The user and namespaces are looked up and checked once for the entire batch.
+
+        :param authsource_id: the authsource of the provided token.
+        :param token: the user's token.
+        :param administrative_namespace_id: the administrative namespace.
+        :param namespace_id: the other namespace.
+        :param id_pairs: the mappings to create as tuples of the administrative ID and the
+            other ID.
+        :returns: a tuple of the number of mappings created and the number of mappings that
+            already existed.
+
+        :raises TypeError: if any of the arguments are None or id_pairs contains None.
+        :raises MissingParameterError: if any of the IDs are None or whitespace only.
+        :raises IllegalParameterError: if any of the IDs are illegal.
+        :raises NoSuchAuthsourceError: if there's no handler for the provided authsource.
+        :raises InvalidTokenError: if the token is invalid.
+        :raises NoSuchNamespaceError: if either of the namespaces do not exist.
+        :raises UnauthorizedError: if the user is not authorized to administrate either of
+            the namespaces.
+        """
+        not_none(token, "token")
+        pairs = self._to_oid_pairs(administrative_namespace_id, namespace_id, id_pairs)
+        user, _ = self._lookup.get_user(authsource_id, token)
+        adminns = self._namespaces.get_namespace(administrative_namespace_id)
+        self._check_authed_for_ns(user, adminns)
+        ns = self._namespaces.get_namespace(namespace_id)
+        if not ns.is_publicly_mappable:
+            self._check_authed_for_ns(user, ns)
+        created, existing = self._storage.add_mappings(pairs)
+        _log(
+            "User %s/%s created %s mappings %s <---> %s, %s already existed",
+            user.authsource_id.id,
+            user.username.name,
+            created,
+            administrative_namespace_id.id,
+            namespace_id.id,
+            existing,
+        )
+        return created, existing
+
+    def remove_mappings(
+        self,
+        authsource_id: AuthsourceID,
+        token: Token,
+        administrative_namespace_id: NamespaceID,
+        namespace_id: NamespaceID,
+        id_pairs: Iterable[Tuple[str, str]],
+    ) -> int:
+        """
+        Delete mappings in bulk. The user must be an administrator of the administrative
+        namespace. The user and namespaces are looked up and checked once for the entire batch.
+
+        :param authsource_id: the authsource of the provided token.
+        :param token: the user's token.
+        :param administrative_namespace_id: the administrative namespace.
+        :param namespace_id: the other namespace.
+        :param id_pairs: the mappings to remove as tuples of the administrative ID and the
+            other ID.
+        :returns: the number of mappings removed.
+
+        :raises TypeError: if any of the arguments are None or id_pairs contains None.
+        :raises MissingParameterError: if any of the IDs are None or whitespace only.
+        :raises IllegalParameterError: if any of the IDs are illegal.
+        :raises NoSuchAuthsourceError: if there's no handler for the provided authsource.
+        :raises InvalidTokenError: if the token is invalid.
+        :raises NoSuchNamespaceError: if either of the namespaces do not exist.
+        :raises UnauthorizedError: if the user is not authorized to administrate the
+            administrative namespace.
+        """
+        not_none(token, "token")
+        pairs = self._to_oid_pairs(administrative_namespace_id, namespace_id, id_pairs)
+        user, _ = self._lookup.get_user(authsource_id, token)
+        adminns = self._namespaces.get_namespace(administrative_namespace_id)
+        self._check_authed_for_ns(user, adminns)
+        self._namespaces.get_namespace(namespace_id)  # check for existence
+        removed = self._storage.remove_mappings(pairs)
+        _log(
+            "User %s/%s removed %s mappings %s <---> %s",
+            user.authsource_id.id,
+            user.username.name,
+            removed,
+            administrative_namespace_id.id,
+            namespace_id.id,
+        )
+        return removed
+
     def get_mappings(
         self, oid: ObjectID, ns_filter: Optional[Iterable[NamespaceID]] = None
     ) -> Tuple[Set[ObjectID], Set[ObjectID]]:
@@ -396,5 +596,170 @@ class IDMapper:
         if ns_filter:
             no_Nones_in_iterable(ns_filter, "ns_filter")
             check.extend(ns_filter)
-        self._storage.get_namespaces(check)  # check for existence
+        self._namespaces.get_namespaces(check)  # check for existence
         return self._storage.find_mappings(oid, ns_filter=ns_filter)
+
+    def get_mappings_bulk(
+        self,
+        namespace_id: NamespaceID,
+        ids: Iterable[str],
+        ns_filter: Optional[Iterable[NamespaceID]] = None,
+    ) -> Dict[str, Tuple[Set[ObjectID], Set[ObjectID]]]:
+        """
+        Find mappings given a namespace and a set of ids in that namespace. The namespaces are
+        checked for existence once for the entire set of ids.
+
+        If an id does not exist, no results will be returned for that id.
+
+        :param namespace_id: the namespace of the ids.
+        :param ids: the ids to match against.
+        :param ns_filter: a list of namespaces with which to filter the results. Only results in
+            these namespaces will be returned.
+        :returns: a mapping of each provided id to a tuple of sets of object IDs. The first set
+            in the tuple contains mappings where the id is the administrative ID, and the second
+            set contains the remainder of the mappings.
+        :raise TypeError: if the namespace ID or ids are None, or ids or the filter contain None.
+        :raise MissingParameterError: if any of the ids are whitespace only.
+        :raise IllegalParameterError: if any of the ids are illegal.
+        :raise NoSuchNamespaceError: if any of the namespaces do not exist.
+        """
+        not_none(namespace_id, "namespace_id")
+        no_Nones_in_iterable(ids, "ids")
+        for id_ in ids:
+            ObjectID(namespace_id, id_)  # check the id is legal
+        check = [namespace_id]
+        if ns_filter:
+            no_Nones_in_iterable(ns_filter, "ns_filter")
+            check.extend(ns_filter)
+        self._namespaces.get_namespaces(check)  # check for existence
+        return self._storage.find_mappings_bulk(namespace_id, ids, ns_filter=ns_filter)
+
+    def get_mappings_in_range(
+        self,
+        namespace_id: NamespaceID,
+        start: str,
+        end: Optional[str] = None,
+        ns_filter: Optional[Iterable[NamespaceID]] = None,
+        limit: int = 100,
+        after: Optional[str] = None,
+    ) -> Tuple[Dict[str, Tuple[Set[ObjectID], Set[ObjectID]]], bool]:
+        """
+        Find mappings for the ids in a namespace that fall within a range, in id order. Only ids
+        with mappings are returned.
+
+        :param namespace_id: the namespace of the ids.
+        :param start: the start of the range, inclusive.
+        :param end: the end of the range, exclusive. If None, the range is unbounded.
+        :param ns_filter: a list of namespaces with which to filter the results. Only results in
+            these namespaces will be returned.
+        :param limit: the maximum number of ids to return.
+        :param after: if provided, only ids after this id are returned. Pass the last id
+            returned to get the next ids in the range.
+        :returns: a tuple of a mapping of each id found to a tuple of sets of object IDs, ordered
+            by id, and whether there are more ids in the range. The first set in the tuple
+            contains mappings where the id is the administrative ID, and the second set
+            contains the remainder of the mappings.
+        :raise TypeError: if the namespace ID or start are None, or the filter contains None.
+        :raise MissingParameterError: if start, end, or after are whitespace only.
+        :raise IllegalParameterError: if start, end, or after are illegal, or the limit is less
+            than 1.
+        :raise NoSuchNamespaceError: if any of the namespaces do not exist.
+        """
+        not_none(namespace_id, "namespace_id")
+        not_none(start, "start")
+        # check the ids are legal
+        for id_ in [start, end, after]:
+            if id_ is not None:
+                ObjectID(namespace_id, id_)
+        if limit < 1:
+            raise IllegalParameterError("limit must be at least 1")
+        check = [namespace_id]
+        if ns_filter:
+            no_Nones_in_iterable(ns_filter, "ns_filter")
+            check.extend(ns_filter)
+        self._namespaces.get_namespaces(check)  # check for existence
+        return self._storage.find_mappings_range(
+            namespace_id, start, end, ns_filter=ns_filter, limit=limit, after=after
+        )
+
+    def get_mappings_with_prefix(
+        self,
+        namespace_id: NamespaceID,
+        prefix: str,
+        ns_filter: Optional[Iterable[NamespaceID]] = None,
+        limit: int = 100,
+        after: Optional[str] = None,
+    ) -> Tuple[Dict[str, Tuple[Set[ObjectID], Set[ObjectID]]], bool]:
+        """
+        Find mappings for the ids in a namespace that start with a prefix, in id order. See
+        :meth:`get_mappings_in_range`.
+
+        :param namespace_id: the namespace of the ids.
+        :param prefix: the prefix of the ids.
+        :param ns_filter: a list of namespaces with which to filter the results. Only results in
+            these namespaces will be returned.
+        :param limit: the maximum number of ids to return.
+        :param after: if provided, only ids after this id are returned.
+        :returns: the mappings and whether there are more ids with the prefix.
+        :raise TypeError: if the namespace ID or prefix are None, or the filter contains None.
+        :raise MissingParameterError: if the prefix or after are whitespace only.
+        :raise IllegalParameterError: if the prefix or after are illegal, or the limit is less
+            than 1.
+        :raise NoSuchNamespaceError: if any of the namespaces do not exist.
+        """
+        not_none(prefix, "prefix")
+        return self.get_mappings_in_range(
+            namespace_id, prefix, _prefix_end(prefix), ns_filter, limit, after
+        )
+
+    def iter_mappings(
+        self,
+        administrative_namespace_id: NamespaceID,
+        namespace_id: NamespaceID,
+        after: Optional[Tuple[str, str]] = None,
+    ) -> Iterator[Tuple[str, str]]:
+        """
+        Iterate over all the mappings from an administrative namespace to another namespace,
+        ordered by the administrative ID and then the other ID. The mappings are streamed from
+        the storage system, so this method is suitable for exporting very large numbers of
+        mappings.
+
+        :param administrative_namespace_id: the namespace of the administrative IDs.
+        :param namespace_id: the namespace of the other IDs.
+        :param after: an (administrative ID, other ID) tuple. If provided, only mappings that
+            sort after this tuple are returned.
+        :returns: an iterator over (administrative ID, other ID) tuples.
+        :raise TypeError: if either namespace ID is None, or after contains None.
+        :raise MissingParameterError: if any of the ids in after are whitespace only.
+        :raise IllegalParameterError: if any of the ids in after are illegal.
+        :raise NoSuchNamespaceError: if either of the namespaces does not exist.
+        """
+        not_none(administrative_namespace_id, "administrative_namespace_id")
+        not_none(namespace_id, "namespace_id")
+        if after:
+            no_Nones_in_iterable(after, "after")
+            admin_id, other_id = after
+            # check the ids are legal
+            ObjectID(administrative_namespace_id, admin_id)
+            ObjectID(namespace_id, other_id)
+        # the namespaces may be the same
+        self._namespaces.get_namespaces({administrative_namespace_id, namespace_id})
+        return self._storage.iter_mappings(administrative_namespace_id, namespace_id, after)
+
+    def get_mapping_counts(
+        self, namespace_id: NamespaceID
+    ) -> Tuple[Dict[NamespaceID, int], Dict[NamespaceID, int]]:
+        """
+        Get the number of mappings between a namespace and each of the other namespaces.
+
+        :param namespace_id: the namespace.
+        :returns: a 2-tuple of dicts of namespace ID to the number of mappings. The first dict
+            contains the mappings where the namespace is the administrative namespace, keyed by
+            the other namespace. The second dict contains the mappings where the namespace is
+            not the administrative namespace, keyed by the administrative namespace.
+        :raise TypeError: if the namespace ID is None.
+        :raise NoSuchNamespaceError: if the namespace does not exist.
+        """
+        not_none(namespace_id, "namespace_id")
+        self._namespaces.get_namespace(namespace_id)
+        return self._storage.get_mapping_counts(namespace_id)
@@ -0,0 +1,229 @@
+"""
+Code for loading large numbers of mappings from files directly into a storage system.
+"""
+
+from jgikbase.idmapping.storage.id_mapping_storage import IDMappingStorage
+from jgikbase.idmapping.core.arg_check import not_none
+from jgikbase.idmapping.core.object_id import NamespaceID, ObjectID
+from jgikbase.idmapping.core.errors import (
+    IllegalParameterError,
+    IDMappingError,
+    MissingParameterError,
+)
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import deque
+from typing import BinaryIO, Callable, Deque, List, Optional, Tuple
+import json
+import time
+
+
+class LoadProgress:
+    """
+    The progress of a mapping load.
+
+    :ivar lines: the number of lines processed, including blank lines.
+    :ivar created: the number of mappings created.
+    :ivar existing: the number of mappings that already existed.
+    :ivar offset: the byte offset in the file up to which all mappings have been written. A load
+        may be resumed from this offset.
+    :ivar elapsed: the time since the load started in seconds.
+    """
+
+    def __init__(self, lines: int, created: int, existing: int, offset: int, elapsed: float
+                 ) -> None:
+        self.lines = lines
+        self.created = created
+        self.existing = existing
+        self.offset = offset
+        self.elapsed = elapsed
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return (self.lines, self.created, self.existing, self.offset, self.elapsed) == (
+                other.lines, other.created, other.existing, other.offset, other.elapsed)
+        return False
+
+    def __repr__(self):
+        return 'LoadProgress(lines={}, created={}, existing={}, offset={}, elapsed={})'.format(
+            self.lines, self.created, self.existing, self.offset, self.elapsed)
+
+
+class MappingLoader:
+    """
+    Loads mappings from a file into a storage system in fixed size chunks. The file is streamed,
+    so memory use is bounded by the chunk size and the number of writers rather than the size
+    of the file.
+
+    No authorization is performed - the loader is intended for use by system administrators with
+    direct access to the storage system.
+
+    Two file formats are supported:
+
+    * TSV - each line contains the administrative ID and the other ID separated by a tab.
+    * NDJSON - each line is a JSON object with the administrative ID in the `admin` key and the
+      other ID in the `other` key. This is the format produced by the mapping export endpoint.
+
+    Blank lines are ignored. Leading and trailing whitespace is stripped from IDs, as in the API.
+    """
+
+    TSV = 'tsv'
+    """ The tab separated values file format. """
+
+    NDJSON = 'ndjson'
+    """ The newline delimited JSON file format. """
+
+    FORMATS = (TSV, NDJSON)
+    """ The supported file formats. """
+
+    def __init__(
+            self,
+            storage: IDMappingStorage,
+            chunk_size: int = 10000,
+            writers: int = 1,
+            timer: Optional[Callable[[], float]] = None
+            ) -> None:
+        """
+        Create the loader.
+
+        :param storage: the storage system in which to store the mappings.
+        :param chunk_size: the number of mappings to write to the storage system in each call.
+        :param writers: the number of chunks to write to the storage system concurrently.
+        :param timer: the timer used for progress reporting. Defaults to time.time.
+        :raises TypeError: if the storage system is None.
+        :raises ValueError: if the chunk size or number of writers is less than 1.
+        """
+        not_none(storage, 'storage')
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1')
+        if writers < 1:
+            raise ValueError('writers must be at least 1')
+        self._storage = storage
+        self._chunk_size = chunk_size
+        self._writers = writers
+        self._timer = time.time if not timer else timer
+
+    def load(
+            self,
+            infile: BinaryIO,
+            administrative_namespace_id: NamespaceID,
+            namespace_id: NamespaceID,
+            file_format: str = TSV,
+            start_offset: int = 0,
+            progress: Optional[Callable[[LoadProgress], None]] = None
+            ) -> LoadProgress:
+        """
+        Load mappings from a file.
+
+        Chunks are written in parallel if more than one writer is configured, but progress is
+        only reported for chunks when all the previous chunks have been written, so the offset
+        in the progress is always safe to resume from. Loading mappings is idempotent, so
+        reloading mappings that were written after the reported offset is harmless.
+
+        :param infile: the file, opened in binary mode.
+        :param administrative_namespace_id: the namespace of the administrative IDs.
+        :param namespace_id: the namespace of the other IDs.
+        :param file_format: the format of the file, one of :attr:`FORMATS`.
+        :param start_offset: the byte offset in the file at which to start loading.
+        :param progress: a function to call with the load progress after each chunk is written.
+        :returns: the final progress of the load.
+        :raises TypeError: if the file or either namespace ID is None.
+        :raises ValueError: if the file format is not supported or the start offset is negative.
+        :raises NoSuchNamespaceError: if either namespace does not exist.
+        :raises IllegalParameterError: if a line in the file cannot be parsed or contains an
+            illegal ID. Line numbers in the error are counted from the start offset.
+        :raises MissingParameterError: if a line in the file is missing an ID.
+        :raises IDMappingStorageError: if an error occurs writing to the storage system.
+        """
+        not_none(infile, 'infile')
+        not_none(administrative_namespace_id, 'administrative_namespace_id')
+        not_none(namespace_id, 'namespace_id')
+        if file_format not in self.FORMATS:
+            raise ValueError('Unsupported file format: ' + str(file_format))
+        if start_offset < 0:
+            raise ValueError('start_offset must be at least 0')
+        # check the namespaces exist. They may be the same
+        self._storage.get_namespaces({administrative_namespace_id, namespace_id})
+        parse = self._parse_tsv if file_format == self.TSV else self._parse_ndjson
+
+        start = self._timer()
+        prog = LoadProgress(0, 0, 0, start_offset, 0)
+        # (write future, the offset after the last line of the chunk, lines in the chunk)
+        pending: Deque[Tuple[Future, int, int]] = deque()
+
+        def complete_oldest():
+            nonlocal prog
+            fut, end_offset, lines = pending.popleft()
+            created, existing = fut.result()
+            prog = LoadProgress(prog.lines + lines, prog.created + created,
+                                prog.existing + existing, end_offset, self._timer() - start)
+            if progress:
+                progress(prog)
+
+        infile.seek(start_offset)
+        offset = start_offset
+        lineno = 0
+        lines = 0  # lines in the current chunk
+        chunk: List[Tuple[ObjectID, ObjectID]] = []
+        with ThreadPoolExecutor(max_workers=self._writers) as ex:
+            try:
+                for line in infile:
+                    lineno += 1
+                    lines += 1
+                    sline = line.strip()
+                    if sline:
+                        try:
+                            admin_id, other_id = parse(sline)
+                            chunk.append((ObjectID(administrative_namespace_id, admin_id),
+                                          ObjectID(namespace_id, other_id)))
+                        except IDMappingError as e:
+                            raise type(e)('Line {} at byte offset {}: {}'.format(  # type: ignore
+                                lineno, offset, e.message)) from e
+                    offset += len(line)
+                    if len(chunk) >= self._chunk_size:
+                        if len(pending) >= self._writers:
+                            complete_oldest()
+                        pending.append((ex.submit(self._storage.add_mappings, chunk),
+                                        offset, lines))
+                        chunk = []
+                        lines = 0
+                if chunk or lines:
+                    pending.append((ex.submit(self._storage.add_mappings, chunk), offset, lines))
+                while pending:
+                    complete_oldest()
+            finally:
+                # don't wait for chunks after an error that won't be reported
+                for fut, _, _ in pending:
+                    fut.cancel()
+        return prog
+
+    def _parse_tsv(self, line: bytes) -> Tuple[str, str]:
+        try:
+            ids = line.decode('utf-8').split('\t')
+        except UnicodeDecodeError as e:
+            raise IllegalParameterError('Invalid UTF-8: ' + str(e)) from e
+        if len(ids) != 2:
+            raise IllegalParameterError('Expected 2 tab separated IDs, got {}'.format(len(ids)))
+        return self._strip_ids(ids[0], ids[1])
+
+    def _parse_ndjson(self, line: bytes) -> Tuple[str, str]:
+        try:
+            m = json.loads(line)
+        except ValueError as e:
+            raise IllegalParameterError('Invalid JSON: ' + str(e)) from e
+        if not isinstance(m, dict):
+            raise IllegalParameterError('Expected JSON object')
+        admin_id = m.get('admin')
+        other_id = m.get('other')
+        if not isinstance(admin_id, str) or not isinstance(other_id, str):
+            raise IllegalParameterError('Expected string IDs at /admin and /other')
+        return self._strip_ids(admin_id, other_id)
+
+    def _strip_ids(self, admin_id: str, other_id: str) -> Tuple[str, str]:
+        # strips the IDs in the same way as the API
+        admin_id = admin_id.strip()
+        other_id = other_id.strip()
+        if not admin_id:
+            raise MissingParameterError('Whitespace only administrative ID')
+        if not other_id:
+            raise MissingParameterError('Whitespace only ID')
+        return admin_id, other_id
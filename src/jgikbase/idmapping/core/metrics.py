@@ -0,0 +1,118 @@
+"""
+Prometheus metrics for the ID mapping service.
+
+The metrics are registered in the default prometheus_client registry. When the service runs in
+multiple processes, as it does under gunicorn, set the ``PROMETHEUS_MULTIPROC_DIR`` environment
+variable to an empty, writable directory before the server starts so that the metrics from all
+the processes are aggregated by :func:`generate_metrics`.
+"""
+
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+from jgikbase.idmapping.core import request_timing
+from typing import Any, Callable, Tuple, TypeVar, cast
+import functools
+import os
+
+MULTIPROCESS_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+""" The environment variable that enables aggregation of metrics from multiple processes. """
+
+_COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, float("inf"))
+
+REQUEST_LATENCY = Histogram(
+    "idmapping_request_duration_seconds",
+    "Time taken to respond to a request.",
+    ["method", "route", "status"],
+)
+""" Request latency, labeled by method, route pattern, and response status. """
+
+USER_CACHE = Counter(
+    "idmapping_user_lookup_cache",
+    "User lookup cache hits and misses.",
+    ["authsource", "cache", "result"],
+)
+"""
+User lookup cache accesses, labeled by authsource, cache (``token`` or ``user``), and result
+(``hit`` or ``miss``).
+"""
+
+USER_LOOKUP_LATENCY = Histogram(
+    "idmapping_user_lookup_duration_seconds",
+    "Time taken to look up user information from an authentication source.",
+    ["authsource", "operation"],
+)
+""" Latency of calls to authentication sources, labeled by authsource and operation. """
+
+STORAGE_LATENCY = Histogram(
+    "idmapping_storage_operation_duration_seconds",
+    "Time taken by storage system operations.",
+    ["operation"],
+)
+""" Storage system operation latency, labeled by operation. """
+
+STORAGE_DOCUMENTS = Histogram(
+    "idmapping_storage_documents_returned",
+    "Number of documents returned by storage system reads.",
+    ["operation"],
+    buckets=_COUNT_BUCKETS,
+)
+""" The number of documents returned by storage system reads, labeled by operation. """
+
+MAPPING_BATCH_SIZE = Histogram(
+    "idmapping_mapping_batch_size",
+    "Number of IDs in mapping requests.",
+    ["operation"],
+    buckets=_COUNT_BUCKETS,
+)
+""" The number of IDs in mapping requests, labeled by operation. """
+
+_F = TypeVar("_F", bound=Callable[..., Any])
+
+# the request timing categories for storage operations. Other operations aren't categorized.
+_STORAGE_TIMING_CATEGORIES = {
+    "get_namespace": request_timing.NAMESPACE_READ,
+    "get_namespaces": request_timing.NAMESPACE_READ,
+    "get_namespace_version": request_timing.NAMESPACE_READ,
+    "find_mappings": request_timing.MAPPING_QUERY,
+    "find_mappings_bulk": request_timing.MAPPING_QUERY,
+    "add_mapping": request_timing.MAPPING_WRITE,
+    "add_mappings": request_timing.MAPPING_WRITE,
+    "remove_mapping": request_timing.MAPPING_WRITE,
+    "remove_mappings": request_timing.MAPPING_WRITE,
+}
+
+
+def timed_storage_operation(fn: _F) -> _F:
+    """
+    A decorator that records the latency of a storage system method in :data:`STORAGE_LATENCY`.
+    The operation label is the name of the method.
+
+    Namespace reads and mapping queries and writes are also added to the current request's
+    timing breakdown - see :mod:`jgikbase.idmapping.core.request_timing`.
+    """
+    hist = STORAGE_LATENCY.labels(fn.__name__)
+    category = _STORAGE_TIMING_CATEGORIES.get(fn.__name__)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with hist.time(), request_timing.timed(category):
+            return fn(*args, **kwargs)
+
+    return cast(_F, wrapper)
+
+
+def generate_metrics() -> Tuple[bytes, str]:
+    """
+    Generate the current metrics in the Prometheus text exposition format.
+
+    If the ``PROMETHEUS_MULTIPROC_DIR`` environment variable is set, the metrics are aggregated
+    from all the processes that write to the directory.
+
+    :returns: a tuple of the metrics and their content type.
+    """
+    registry = REGISTRY
+    if os.environ.get(MULTIPROCESS_DIR_ENV):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
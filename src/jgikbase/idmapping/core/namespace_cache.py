@@ -0,0 +1,127 @@
+"""
+A cache for namespace data.
+"""
+
+from jgikbase.idmapping.storage.id_mapping_storage import IDMappingStorage
+from jgikbase.idmapping.core.arg_check import not_none, no_Nones_in_iterable
+from jgikbase.idmapping.core.object_id import NamespaceID, Namespace
+from typing import Dict, Set, Iterable, Optional, Callable, Tuple
+import time
+
+
+class NamespaceCache:
+    """
+    An in-process cache for namespaces that sits in front of a storage system.
+
+    Namespaces are few and rarely change, so the cache holds all of them and reloads them in
+    one storage call when they expire or change. Changes made by other processes are detected
+    via the storage system's namespace version, which is checked at most once per version check
+    interval. Changes made via this process should be followed by a call to
+    :meth:`invalidate`.
+    """
+
+    def __init__(
+        self,
+        storage: IDMappingStorage,
+        cache_expiration: int = 0,
+        version_check_interval: float = 1,
+        cache_timer: Optional[Callable[[], float]] = None,
+    ) -> None:
+        """
+        Create the cache.
+
+        :param storage: the storage system containing the namespaces.
+        :param cache_expiration: the maximum lifetime of the cached namespaces in seconds. If
+            less than 1, caching is disabled and all requests go directly to the storage system.
+        :param version_check_interval: the minimum time between checks of the storage system's
+            namespace version in seconds. This is the longest time that a change made by another
+            process may go unnoticed.
+        :param cache_timer: the timer used for cache expiration. Defaults to time.time.
+        """
+        not_none(storage, "storage")
+        self._storage = storage
+        self._expiration = cache_expiration
+        self._check_interval = version_check_interval
+        self._timer = time.time if not cache_timer else cache_timer
+        # (namespaces, namespace version, load time, last version check time)
+        # kept as one tuple so replacing the cache contents is a single assignment
+        self._cache: Optional[Tuple[Dict[NamespaceID, Namespace], int, float, float]] = None
+
+    def invalidate(self) -> None:
+        """
+        Clear the cache. The namespaces will be reloaded from the storage system on the next
+        request.
+        """
+        self._cache = None
+
+    def _get_all(self) -> Dict[NamespaceID, Namespace]:
+        now = self._timer()
+        cache = self._cache
+        newver = None
+        if cache:
+            nss, ver, loaded, checked = cache
+            if now - loaded < self._expiration:
+                if now - checked < self._check_interval:
+                    return nss
+                newver = self._storage.get_namespace_version()
+                if newver == ver:
+                    self._cache = (nss, ver, loaded, now)
+                    return nss
+        # get the version before the namespaces so a concurrent change causes a reload next
+        # time rather than being missed
+        if newver is None:
+            newver = self._storage.get_namespace_version()
+        ver = newver
+        nss = {ns.namespace_id: ns for ns in self._storage.get_namespaces()}
+        self._cache = (nss, ver, now, now)
+        return nss
+
+    def get_namespace(self, namespace_id: NamespaceID) -> Namespace:
+        """
+        Get a particular namespace.
+
+        :param namespace_id: the id of the namespace to get.
+        :raises TypeError: if the namespace ID is None.
+        :raises NoSuchNamespaceError: if the namespace does not exist.
+        """
+        not_none(namespace_id, "namespace_id")
+        if self._expiration < 1:
+            return self._storage.get_namespace(namespace_id)
+        nss = self._get_all()
+        if namespace_id in nss:
+            return nss[namespace_id]
+        # the namespace may have been created since the last version check, so go to the
+        # storage system, which will throw an error if it really doesn't exist.
+        ns = self._storage.get_namespace(namespace_id)
+        self.invalidate()
+        return ns
+
+    def get_namespaces(
+        self, nids: Optional[Iterable[NamespaceID]] = None, include_users: bool = True
+    ) -> Set[Namespace]:
+        """
+        Get namespaces.
+
+        :param nids: specific namespaces to get. By default all namespaces are returned.
+        :param include_users: False if the namespace user lists are not needed. The namespaces
+            may then be read from a replica, so they must not be used for authorization. Cached
+            namespaces always include their user lists.
+        :raises TypeError: if nids contains None.
+        :raises NoSuchNamespaceError: if any of the namespaces in the nids parameter do not
+            exist.
+        """
+        if self._expiration < 1:
+            if not include_users:
+                return self._storage.get_namespaces(nids, include_users=False)
+            return self._storage.get_namespaces(nids) if nids else self._storage.get_namespaces()
+        if nids:
+            no_Nones_in_iterable(nids, "nids")
+        nss = self._get_all()
+        if not nids:
+            return set(nss.values())
+        if all(nid in nss for nid in nids):
+            return {nss[nid] for nid in nids}
+        # as for get_namespace
+        ret = self._storage.get_namespaces(nids)
+        self.invalidate()
+        return ret
@@ -0,0 +1,155 @@
+"""
+Per-request timing breakdowns.
+
+The service starts a :class:`RequestTimer` at the start of each request with
+:func:`start_request_timer`. Code in any layer can then add the time spent in a block to a
+category with :func:`timed` and count calls with :func:`count` without having access to the
+request. Outside of a request both functions do nothing.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, Optional
+import time
+
+AUTH = "auth"
+""" Time spent looking up users and tokens. """
+
+NAMESPACE_READ = "namespace_read"
+""" Time spent reading namespaces from the storage system. """
+
+MAPPING_QUERY = "mapping_query"
+""" Time spent querying mappings in the storage system. """
+
+MAPPING_WRITE = "mapping_write"
+""" Time spent writing mappings to the storage system. """
+
+SERIALIZE = "serialize"
+""" Time spent serializing responses. """
+
+CATEGORIES = (AUTH, NAMESPACE_READ, MAPPING_QUERY, MAPPING_WRITE, SERIALIZE)
+""" The timing categories. """
+
+MONGO_CALLS = "mongo_calls"
+""" The number of MongoDB commands sent, i.e. round trips to the database. """
+
+AUTH_CALLS = "auth_calls"
+""" The number of calls to authentication sources that weren't served from a cache. """
+
+COUNTERS = (MONGO_CALLS, AUTH_CALLS)
+""" The call counters. """
+
+_current: ContextVar[Optional["RequestTimer"]] = ContextVar("request_timer", default=None)
+
+
+class RequestTimer:
+    """
+    Accumulates the time spent in each timing category and the call counts for a request.
+
+    Time in nested blocks of the same category is only counted once.
+    """
+
+    def __init__(self, timer: Optional[Callable[[], float]] = None) -> None:
+        """
+        Create the timer.
+
+        :param timer: the timer used to measure elapsed time. Defaults to time.perf_counter.
+        """
+        self._timer = time.perf_counter if not timer else timer
+        self._start = self._timer()
+        self._times = {c: 0.0 for c in CATEGORIES}
+        self._counts = {c: 0 for c in COUNTERS}
+        self._active: Dict[str, int] = {}
+
+    @contextmanager
+    def timed(self, category: str) -> Iterator[None]:
+        """
+        Add the time spent in a with block to a category.
+
+        :param category: the category, one of :data:`CATEGORIES`.
+        """
+        if category not in self._times:
+            raise ValueError("Unknown timing category: " + str(category))
+        depth = self._active.get(category, 0)
+        self._active[category] = depth + 1
+        start = self._timer() if not depth else 0.0
+        try:
+            yield
+        finally:
+            self._active[category] = depth
+            if not depth:
+                self._times[category] += self._timer() - start
+
+    def count(self, counter: str, n: int = 1) -> None:
+        """
+        Increment a call counter.
+
+        :param counter: the counter, one of :data:`COUNTERS`.
+        :param n: the amount by which to increment the counter.
+        """
+        if counter not in self._counts:
+            raise ValueError("Unknown call counter: " + str(counter))
+        self._counts[counter] += n
+
+    def to_dict(self) -> Dict[str, float]:
+        """
+        Get the timing breakdown. Times are in milliseconds and have a ``_ms`` suffix. The
+        ``total_ms`` key contains the time since the timer was created.
+        """
+        ret: Dict[str, float] = {"total_ms": self._ms(self._timer() - self._start)}
+        for c in CATEGORIES:
+            ret[c + "_ms"] = self._ms(self._times[c])
+        ret.update(self._counts)
+        return ret
+
+    @staticmethod
+    def _ms(seconds):
+        return round(seconds * 1000, 3)
+
+
+def start_request_timer(timer: Optional[Callable[[], float]] = None) -> RequestTimer:
+    """
+    Start a timer for the current request, replacing any existing timer.
+
+    :param timer: the timer used to measure elapsed time. Defaults to time.perf_counter.
+    :returns: the new request timer.
+    """
+    rt = RequestTimer(timer)
+    _current.set(rt)
+    return rt
+
+
+def stop_request_timer() -> None:
+    """
+    Remove the timer for the current request, if any.
+    """
+    _current.set(None)
+
+
+@contextmanager
+def timed(category: Optional[str]) -> Iterator[None]:
+    """
+    Add the time spent in a with block to a category of the current request's timer. Does
+    nothing if there is no current timer or the category is None.
+
+    :param category: the category, one of :data:`CATEGORIES`.
+    """
+    rt = _current.get()
+    if not rt or not category:
+        yield
+    else:
+        with rt.timed(category):
+            yield
+
+
+def count(counter: str, n: int = 1) -> None:
+    """
+    Increment a call counter of the current request's timer. Does nothing if there is no current
+    timer.
+
+    :param counter: the counter, one of :data:`COUNTERS`.
+    :param n: the amount by which to increment the counter.
+    """
+    rt = _current.get()
+    if rt:
+        rt.count(counter, n)
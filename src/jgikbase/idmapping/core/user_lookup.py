@@ -1,13 +1,17 @@
 from abc import ABCMeta as _ABCMeta, abstractmethod as _abstractmethod
-from jgikbase.idmapping.core.tokens import Token
+from jgikbase.idmapping.core.tokens import Token, HashedToken
 from jgikbase.idmapping.core.user import User, AuthsourceID, Username
 from jgikbase.idmapping.storage.id_mapping_storage import IDMappingStorage
 from jgikbase.idmapping.core.arg_check import not_none, no_Nones_in_iterable
 from jgikbase.idmapping.core import tokens
-from typing import Dict, Tuple, Optional, Set, Callable
-from jgikbase.idmapping.core.errors import NoSuchAuthsourceError
+from jgikbase.idmapping.core.cache import Cache, InProcessCache
+from jgikbase.idmapping.core.metrics import USER_CACHE, USER_LOOKUP_LATENCY
+from jgikbase.idmapping.core import request_timing
+from typing import Dict, Tuple, Optional, Set, Callable, Iterable, Any
+from jgikbase.idmapping.core.errors import NoSuchAuthsourceError, InvalidTokenError
+from concurrent.futures import Future
+import threading
 import time
-from cacheout.lru import LRUCache
 
 
 class UserLookup:  # pragma: no cover
@@ -58,6 +62,35 @@ class UserLookup:  # pragma: no cover
         """
         raise NotImplementedError()
 
+    def are_valid_users(
+        self, usernames: Set[Username]
+    ) -> Tuple[Dict[Username, bool], Optional[int], Optional[int]]:
+        """
+        Check if usernames are valid, which implies the users exist.
+
+        The default implementation calls :meth:`is_valid_user` for each username. Implementations
+        that can check many users at once should override this method.
+
+        :param usernames: the usernames to check.
+        :raises TypeError: if the argument is None or contains None.
+        :returns: a tuple of 1) a mapping of username to a boolean describing whether the user
+            exists or not, 2) a unix epoch timestamp in seconds providing an absolute limit for
+            the cache lifetime of the results, and 3) a relative cache expiration time in
+            seconds. If both 2) and 3) are None, the process implementing the cache must make its
+            own decisions regarding the cache lifetime.
+        """
+        no_Nones_in_iterable(usernames, "usernames")
+        ret = {}
+        epochs = []
+        rels = []
+        for u in usernames:
+            ret[u], epoch, rel = self.is_valid_user(u)
+            if epoch:
+                epochs.append(epoch)
+            if rel:
+                rels.append(rel)
+        return ret, min(epochs) if epochs else None, min(rels) if rels else None
+
 
 class UserLookupSet:
     """
@@ -71,11 +104,16 @@ class UserLookupSet:
         cache_max_size: int = 10000,
         cache_user_expiration: int = 300,
         cache_is_valid_expiration: int = 3600,
+        cache_negative_expiration: int = 0,
+        single_flight: bool = True,
+        user_cache: Optional[Cache] = None,
+        valid_cache: Optional[Cache] = None,
     ) -> None:
         """
         Create the handler set.
 
-        The cache_* parameters are mainly provided for testing purposes.
+        The cache_timer, cache_max_size, cache_user_expiration, and cache_is_valid_expiration
+        parameters are mainly provided for testing purposes.
 
         :param user_lookup: the set of user lookup instances to query when looking up user names
             from tokens or checking that a provided user name is valid.
@@ -86,18 +124,36 @@ class UserLookupSet:
             seconds. This time can be overridden by a user handler on a per token basis.
         :param cache_is_valid_expiration: the default expiration time for the  username ->
             validity cache. This time can be overridden by a user handler on a per user basis.
+        :param cache_negative_expiration: the expiration time in seconds for negative results,
+            e.g. invalid tokens and users that do not exist. Negative results are not cached if
+            the time is less than 1.
+        :param single_flight: True to make concurrent lookups of the same uncached token or
+            user share a single call to the user handler.
+        :param user_cache: the cache for the token -> user cache. Tokens are hashed before
+            being used as cache keys. Defaults to an in-process cache created with the
+            cache_timer, cache_max_size, and cache_user_expiration parameters.
+        :param valid_cache: the cache for the username -> validity cache. Defaults to an
+            in-process cache created with the cache_timer, cache_max_size, and
+            cache_is_valid_expiration parameters.
         """
         no_Nones_in_iterable(user_lookup, "user_lookup")
         self._lookup = {lookup.get_authsource_id(): lookup for lookup in user_lookup}
         self._cache_timer = time.time if not cache_timer else cache_timer
-        self._user_cache = LRUCache(
-            timer=self._cache_timer, maxsize=cache_max_size, ttl=cache_user_expiration
-        )
-        self._valid_cache = LRUCache(
-            timer=self._cache_timer,
-            maxsize=cache_max_size,
-            ttl=cache_is_valid_expiration,
-        )
+        if not user_cache:
+            user_cache = InProcessCache(
+                cache_max_size, cache_user_expiration, self._cache_timer
+            )
+        if not valid_cache:
+            valid_cache = InProcessCache(
+                cache_max_size, cache_is_valid_expiration, self._cache_timer
+            )
+        self._user_cache = user_cache
+        self._valid_cache = valid_cache
+        self._negative_ttl = cache_negative_expiration
+        self._single_flight = single_flight
+        # key -> future for the result of the in flight lookup
+        self._in_flight: Dict[str, Future] = {}
+        self._in_flight_lock = threading.Lock()
 
     def _check_authsource_id(self, authsource_id: AuthsourceID) -> None:
         """
@@ -116,6 +172,70 @@ class UserLookupSet:
             return rel
         return min(epoch - self._cache_timer(), rel)
 
+    # Cache values are limited to simple types so that caches can be shared between processes.
+    # The token cache stores [authsource, username, admin] for valid tokens and the error
+    # message for invalid tokens. The validity cache stores a boolean.
+
+    @staticmethod
+    def _token_key(authsource_id: AuthsourceID, token: Token) -> str:
+        # don't store tokens in shared caches
+        return "t:{}:{}".format(authsource_id.id, token.get_hashed_token().token_hash)
+
+    @staticmethod
+    def _user_key(user: User) -> str:
+        return "u:{}:{}".format(user.authsource_id.id, user.username.name)
+
+    @staticmethod
+    def _count_cache(authsource_id: AuthsourceID, cache: str, cacheres: Any) -> None:
+        USER_CACHE.labels(authsource_id.id, cache, "miss" if cacheres is None else "hit").inc()
+
+    def _call_once(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        Call fn, or if a call with the same key is already in progress in another thread, wait
+        for and return the result of that call. If that call fails, a copy of its exception,
+        chained to the original, is raised.
+        """
+        if not self._single_flight:
+            return fn()
+        with self._in_flight_lock:
+            fut = self._in_flight.get(key)
+            owner = fut is None
+            if owner:
+                fut = Future()
+                self._in_flight[key] = fut
+        if not owner:
+            # don't raise the original exception, as every thread would add to its traceback
+            err = fut.exception()  # type: ignore[union-attr]
+            if err:
+                raise self._copy_exception(err) from err
+            return fut.result()  # type: ignore[union-attr]
+        try:
+            res = fn()
+            fut.set_result(res)  # type: ignore[union-attr]
+            return res
+        except BaseException as e:
+            fut.set_exception(e)  # type: ignore[union-attr]
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+
+    @staticmethod
+    def _copy_exception(err: BaseException) -> BaseException:
+        # the constructor isn't called as the arguments differ between exception classes
+        copy = type(err).__new__(type(err), *err.args)
+        if isinstance(err, OSError) and isinstance(copy, OSError):
+            # sets the error number and message, which aren't in the instance dict
+            OSError.__init__(copy, *err.args)
+            if err.filename is not None:
+                copy.filename = err.filename
+            if err.filename2 is not None:
+                copy.filename2 = err.filename2
+        else:
+            BaseException.__init__(copy, *err.args)
+        copy.__dict__.update(getattr(err, "__dict__", {}))
+        return copy
+
     def get_user(self, authsource_id: AuthsourceID, token: Token) -> Tuple[User, bool]:
         """
         Get a user given the user's token.
@@ -130,13 +250,38 @@ class UserLookupSet:
         """
         not_none(token, "token")
         self._check_authsource_id(authsource_id)
-        # None default causes a key error
-        cacheres = self._user_cache.get((authsource_id, token), default=False)
-        if cacheres:
-            return cacheres
-        user, admin, epoch, rel = self._lookup[authsource_id].get_user(token)
+        with request_timing.timed(request_timing.AUTH):
+            key = self._token_key(authsource_id, token)
+            cacheres = self._user_cache.get(key)
+            self._count_cache(authsource_id, "token", cacheres)
+            if cacheres is not None:
+                return self._from_cached_user(cacheres)
+            return self._call_once(key, lambda: self._lookup_user(key, authsource_id, token))
+
+    def _from_cached_user(self, cacheres):
+        if isinstance(cacheres, str):
+            # a negative result, the string is the error message
+            raise InvalidTokenError(cacheres)
+        authsource, name, admin = cacheres
+        return (User(AuthsourceID(authsource), Username(name)), admin)
+
+    def _lookup_user(self, key, authsource_id, token):
+        # another thread may have completed the lookup since the last check
+        cacheres = self._user_cache.get(key)
+        if cacheres is not None:
+            return self._from_cached_user(cacheres)
+        request_timing.count(request_timing.AUTH_CALLS)
+        try:
+            with USER_LOOKUP_LATENCY.labels(authsource_id.id, "get_user").time():
+                user, admin, epoch, rel = self._lookup[authsource_id].get_user(token)
+        except InvalidTokenError as e:
+            if self._negative_ttl > 0:
+                self._user_cache.set(key, e.message or "", ttl=self._negative_ttl)
+            raise
         self._user_cache.set(
-            (authsource_id, token), (user, admin), ttl=self._calc_ttl(epoch, rel)
+            key,
+            [user.authsource_id.id, user.username.name, admin],
+            ttl=self._calc_ttl(epoch, rel),
         )
         return (user, admin)
 
@@ -149,16 +294,66 @@ class UserLookupSet:
         """
         not_none(user, "user")
         self._check_authsource_id(user.authsource_id)
-        # None default causes a key error
-        exists = self._valid_cache.get(user, default=False)
-        if not exists:
+        with request_timing.timed(request_timing.AUTH):
+            key = self._user_key(user)
+            exists = self._valid_cache.get(key)
+            self._count_cache(user.authsource_id, "user", exists)
+            if exists is not None:
+                return exists
+            return self._call_once(key, lambda: self._lookup_valid_user(key, user))
+
+    def _lookup_valid_user(self, key, user):
+        # another thread may have completed the lookup since the last check
+        exists = self._valid_cache.get(key)
+        if exists is not None:
+            return exists
+        request_timing.count(request_timing.AUTH_CALLS)
+        with USER_LOOKUP_LATENCY.labels(user.authsource_id.id, "is_valid_user").time():
             exists, epoch, rel = self._lookup[user.authsource_id].is_valid_user(
                 user.username
             )
-            if exists:
-                self._valid_cache.set(user, True, ttl=self._calc_ttl(epoch, rel))
+        self._cache_validity(key, exists, self._calc_ttl(epoch, rel))
         return exists
 
+    def _cache_validity(self, key, exists, ttl):
+        if exists:
+            self._valid_cache.set(key, True, ttl=ttl)
+        elif self._negative_ttl > 0:
+            self._valid_cache.set(key, False, ttl=self._negative_ttl)
+
+    def are_valid_users(self, users: Iterable[User]) -> Dict[User, bool]:
+        """
+        Check whether users exist. Users that are not in the cache are checked with one call
+        per authsource.
+
+        :param users: the users to check.
+        :raises TypeError: if users is None or contains None.
+        :raises NoSuchAuthsourceError: if there's no handler for a user's authsource.
+        :returns: a mapping of user to a boolean describing whether the user exists.
+        """
+        no_Nones_in_iterable(users, "users")
+        with request_timing.timed(request_timing.AUTH):
+            ret = {}
+            misses: Dict[AuthsourceID, Set[Username]] = {}
+            for u in users:
+                self._check_authsource_id(u.authsource_id)
+                exists = self._valid_cache.get(self._user_key(u))
+                self._count_cache(u.authsource_id, "user", exists)
+                if exists is not None:
+                    ret[u] = exists
+                else:
+                    misses.setdefault(u.authsource_id, set()).add(u.username)
+            for authsource_id, usernames in misses.items():
+                request_timing.count(request_timing.AUTH_CALLS)
+                with USER_LOOKUP_LATENCY.labels(authsource_id.id, "are_valid_users").time():
+                    res, epoch, rel = self._lookup[authsource_id].are_valid_users(usernames)
+                ttl = self._calc_ttl(epoch, rel)
+                for username in usernames:
+                    user = User(authsource_id, username)
+                    ret[user] = res[username]
+                    self._cache_validity(self._user_key(user), res[username], ttl)
+            return ret
+
 
 class LocalUserLookup(UserLookup):
     """
@@ -169,27 +364,89 @@ class LocalUserLookup(UserLookup):
     LOCAL = AuthsourceID("local")
     """ The ID of the authentication source for local users. """
 
-    def __init__(self, storage: IDMappingStorage) -> None:
+    def __init__(
+        self,
+        storage: IDMappingStorage,
+        refresh_interval: int = 0,
+        timer: Optional[Callable[[], float]] = None,
+    ) -> None:
         """
         Create a local user handler.
 
         :param storage: the storage system in which users are stored.
+        :param refresh_interval: if greater than 0, all the users are loaded into memory when
+            the handler is created and lookups are served from memory. The storage system's
+            user version is checked at most once per interval, in seconds, and the users are
+            reloaded if it has changed. Only one lookup at a time checks and reloads the users;
+            concurrent lookups use the current users in the meantime.
+            Lookups of tokens and users that are not in memory fall back to the storage system.
+            The interval is also returned as the cache lifetime for looked up users, so that
+            token changes take effect within approximately two intervals.
+        :param timer: the timer used for refreshing the users. Defaults to time.time.
         """
         not_none(storage, "storage")
         self._store = storage
+        self._refresh_interval = refresh_interval
+        self._timer = time.time if not timer else timer
+        # (hashed token -> (username, admin), usernames, user version, last version check time)
+        # kept as one tuple so replacing the index is a single assignment
+        self._index: Optional[
+            Tuple[Dict[HashedToken, Tuple[Username, bool]], Set[Username], int, float]
+        ] = None
+        self._refresh_lock = threading.Lock()
+        if refresh_interval > 0:
+            self._index = self._load_index(self._timer())
 
     def get_authsource_id(self) -> AuthsourceID:
         return self.LOCAL
 
+    def _load_index(self, now: float, ver: Optional[int] = None):
+        # get the version before the users so a concurrent change causes a reload next
+        # time rather than being missed
+        if ver is None:
+            ver = self._store.get_users_version()
+        users = self._store.get_users_by_token()
+        return (users, {u for u, _ in users.values()}, ver, now)
+
+    def _get_index(self):
+        now = self._timer()
+        index = self._index
+        if now - index[3] < self._refresh_interval:
+            return index
+        # only one request checks and reloads the users, the others keep using the current
+        # index rather than all reloading the users at once
+        if not self._refresh_lock.acquire(blocking=False):
+            return index
+        try:
+            index = self._index
+            if now - index[3] < self._refresh_interval:
+                return index  # refreshed by another request in the meantime
+            ver = self._store.get_users_version()
+            if ver == index[2]:
+                index = (index[0], index[1], ver, now)
+            else:
+                index = self._load_index(now, ver)
+            self._index = index
+            return index
+        finally:
+            self._refresh_lock.release()
+
     def get_user(self, token: Token) -> Tuple[User, bool, Optional[int], Optional[int]]:
         not_none(token, "token")
+        if self._refresh_interval > 0:
+            res = self._get_index()[0].get(token.get_hashed_token())
+            if res:
+                return (User(self.LOCAL, res[0]), res[1], None, self._refresh_interval)
         username, admin = self._store.get_user(token.get_hashed_token())
-        return (User(self.LOCAL, username), admin, None, 300)
+        rel = self._refresh_interval if self._refresh_interval > 0 else 300
+        return (User(self.LOCAL, username), admin, None, rel)
 
     def is_valid_user(
         self, username: Username
     ) -> Tuple[bool, Optional[int], Optional[int]]:
         not_none(username, "username")
+        if self._refresh_interval > 0 and username in self._get_index()[1]:
+            return (True, None, 3600)
         return (self._store.user_exists(username), None, 3600)
 
     def create_user(self, username: Username) -> Token:
@@ -0,0 +1,119 @@
+"""
+JSON encoding and decoding for the service.
+
+Request bodies and responses for bulk mapping operations can contain thousands of IDs, and
+encoding and decoding them with the standard library is a significant part of the cost of a
+request. If the optional orjson package is installed it is used instead. Otherwise the standard
+library is used.
+
+Both providers produce the same results and, for invalid input, the same errors: orjson's
+decode errors are replaced by the error the standard library reports for the same input.
+"""
+
+from abc import abstractmethod as _abstractmethod  # pragma: no cover
+from abc import ABCMeta as _ABCMeta  # pragma: no cover
+from typing import Any, List, Union
+import json
+
+try:
+    import orjson
+    _HAS_ORJSON = True
+except ImportError:  # pragma: no cover
+    # tested manually
+    _HAS_ORJSON = False
+
+
+class JSONProvider:  # pragma: no cover
+    """
+    An encoder and decoder for JSON.
+
+    :ivar name: the name of the provider.
+    """
+    __metaclass__ = _ABCMeta
+
+    name: str
+
+    @_abstractmethod
+    def loads(self, data: Union[bytes, str]) -> Any:
+        """
+        Decode JSON.
+
+        :param data: the JSON to decode.
+        :returns: the decoded object.
+        :raises json.decoder.JSONDecodeError: if the JSON is invalid.
+        """
+        raise NotImplementedError()
+
+    @_abstractmethod
+    def dumps(self, obj: Any) -> bytes:
+        """
+        Encode an object as compact JSON.
+
+        :param obj: the object to encode.
+        :returns: the UTF-8 encoded JSON.
+        """
+        raise NotImplementedError()
+
+
+class StdlibJSONProvider(JSONProvider):
+    """ A JSON provider based on the standard library json module. """
+
+    name = "stdlib"
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return json.loads(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+
+class OrjsonJSONProvider(JSONProvider):
+    """ A JSON provider based on the orjson package. """
+
+    name = "orjson"
+
+    def __init__(self) -> None:
+        """
+        Create the provider.
+
+        :raises ValueError: if orjson is not installed.
+        """
+        if not _HAS_ORJSON:
+            raise ValueError("orjson is not installed")  # pragma: no cover
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # invalid JSON is rare, so parse it again with the standard library to get the same
+            # error message. This also accepts the few inputs the standard library allows but
+            # orjson doesn't, like integers larger than 64 bits and NaN.
+            return json.loads(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # e.g. integers larger than 64 bits
+            return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def available_providers() -> List[JSONProvider]:
+    """
+    Get the JSON providers that are available in this environment, fastest first.
+
+    :returns: a list of the providers.
+    """
+    ret: List[JSONProvider] = [StdlibJSONProvider()]
+    if _HAS_ORJSON:
+        ret.insert(0, OrjsonJSONProvider())
+    return ret
+
+
+def get_json_provider() -> JSONProvider:
+    """
+    Get the fastest JSON provider available in this environment.
+
+    :returns: the provider.
+    """
+    return available_providers()[0]
@@ -14,19 +14,29 @@ from jgikbase.idmapping.core.errors import (
 from jgikbase.idmapping.core.user import AuthsourceID, User, Username
 from jgikbase.idmapping.core.tokens import Token
 from jgikbase.idmapping.core.object_id import NamespaceID, ObjectID
+from jgikbase.idmapping.core import request_timing
+from jgikbase.idmapping.core import consistency
+from jgikbase.idmapping.service.profiler import RequestProfiler
+from jgikbase.idmapping.service import mapping_formats
+from jgikbase.idmapping.service.json_provider import JSONProvider, get_json_provider
+from jgikbase.idmapping.core.metrics import (
+    REQUEST_LATENCY,
+    MAPPING_BATCH_SIZE,
+    generate_metrics,
+)
 from http.client import (
     responses,
 )  # @UnresolvedImport dunno why pydev cries here, it's stdlib
 import flask
 from flask import g as flask_req_global
-from typing import List, Tuple, Optional, Set, Dict, IO
+from typing import List, Tuple, Optional, Set, IO, Iterator
 import traceback
 from werkzeug.exceptions import MethodNotAllowed, NotFound
-from operator import itemgetter
 import json
 from json.decoder import JSONDecodeError
 import random
 import time
+from urllib.parse import quote
 import logging
 from logging import StreamHandler, Formatter
 
@@ -47,21 +57,45 @@ except ImportError:  # pragma: no cover
 # Set up a blueprint later if necessary
 # Not sure what's worth doing here for documentation. Swagger at some point ideally.
 
-# The bulk methods are currently implemented soley in the API layer. This keeps things simple
-# and required less work. Push the bulk implementation further down in the stack as necessitated
-# by peformance needs.
+# The bulk mapping create and remove methods are implemented in the core and storage layers so
+# that a request authorizes once and writes the whole batch in one storage call.
 
 
 _APP = "ID_MAPPER"
 _IGNORE_IP_HEADERS = "IGNORE_IP_HEADERS"
+_PROFILER = "PROFILER"
+_JSON = "JSON_PROVIDER"
 
 _X_REAL_IP = "X-Real-IP"
 _X_FORWARDED_FOR = "X-Forwarded-For"
 _USER_AGENT = "User-Agent"
 
+# system administrators can send this header with any value to profile a request.
+_PROFILE_HEADER = "X-IDMapping-Profile"
+
+# mapping writes return a token in this header when mapping lookups may be served by database
+# replicas. Clients send it with lookups to read their own writes.
+_CONSISTENCY_TOKEN_HEADER = "X-IDMapping-Consistency-Token"
+
 _TRUE = "true"
 _FALSE = "false"
 
+# the number of mappings per chunk written to the response when exporting mappings.
+_EXPORT_CHUNK_SIZE = 1000
+
+# the maximum number of ids in a mapping lookup.
+_MAX_LOOKUP_IDS = 1000
+
+# the maximum number of users in a request to add users to a namespace.
+_MAX_NAMESPACE_USERS = 1000
+
+# the default number of ids returned by a prefix or range mapping lookup.
+_DEFAULT_RANGE_LIMIT = 100
+
+# prefix and range lookups return the last id, URL encoded, in this header if there are more ids
+# in the range.
+_NEXT_AFTER_HEADER = "X-IDMapping-Next-After"
+
 
 def epoch_ms():
     return int(round(time.time() * 1000))
@@ -79,8 +113,24 @@ def get_ip_address(request, ignore_ip_headers):
     return request.remote_addr.strip()
 
 
-def _log(msg, *args):
-    logging.getLogger(__name__).info(msg, *args)
+def _log(msg, *args, **kwargs):
+    logging.getLogger(__name__).info(msg, *args, **kwargs)
+
+
+def _json_provider() -> JSONProvider:
+    return flask.current_app.config[_JSON]
+
+
+def _jsonify(obj):
+    with request_timing.timed(request_timing.SERIALIZE):
+        return flask.Response(
+            _json_provider().dumps(obj) + b"\n", mimetype=mapping_formats.JSON
+        )
+
+
+def _load_json(request):
+    # flask has a built in get_json() method but the errors it throws suck.
+    return _json_provider().loads(request.get_data())
 
 
 def _format_exception(err):
@@ -107,7 +157,7 @@ def _format_error(
     if errtype:
         errjson["appcode"] = errtype.error_code
         errjson["apperror"] = errtype.error_type
-    return (flask.jsonify({"error": errjson}), httpcode)
+    return (_jsonify({"error": errjson}), httpcode)
 
 
 def format_ip_headers(request, ignore_ip_headers):
@@ -144,43 +194,101 @@ def _get_auth(request, required=True) -> Tuple[Optional[AuthsourceID], Optional[
     return AuthsourceID(auth[0]), Token(auth[1])
 
 
+def _profile_requested(request, mapper) -> bool:
+    if not request.headers.get(_PROFILE_HEADER):
+        return False
+    try:
+        authsource, token = _get_auth(request)
+        return mapper.is_sys_admin(authsource, token)
+    except IDMappingError:
+        # if the endpoint requires authentication the request will fail later
+        return False
+    except Exception as e:
+        # e.g. the auth service or the storage system is unavailable. Profiling is optional, so
+        # don't fail requests that would otherwise succeed.
+        _log("Not profiling request, admin check failed: %s", e)
+        return False
+
+
 def _users_to_jsonable(users: List[User]) -> List[str]:
     return sorted([u.authsource_id.id + "/" + u.username.name for u in users])
 
 
 def _objids_to_jsonable(oids: Set[ObjectID]):
-    return sorted(
-        [{"ns": o.namespace_id.id, "id": o.id} for o in oids],
-        key=itemgetter("ns", "id"),
-    )
-
-
-def _get_object_id_dict_from_json(request) -> Dict[str, str]:
-    # flask has a built in get_json() method but the errors it throws suck.
-    ids = json.loads(request.get_data())
+    # sorting tuples is much cheaper than sorting dicts with a key function
+    return [
+        {"ns": ns, "id": id_} for ns, id_ in sorted((o.namespace_id.id, o.id) for o in oids)
+    ]
+
+
+def _export_mappings_ndjson(
+    mappings: Iterator[Tuple[str, str]], json_provider: JSONProvider
+) -> Iterator[bytes]:
+    chunk = []
+    try:
+        for admin_id, other_id in mappings:
+            chunk.append(json_provider.dumps({"admin": admin_id, "other": other_id}) + b"\n")
+            if len(chunk) >= _EXPORT_CHUNK_SIZE:
+                yield b"".join(chunk)
+                chunk = []
+        if chunk:
+            yield b"".join(chunk)
+    except Exception as e:
+        # the status code has already been sent, so all we can do is log the error and
+        # abort the response. Clients resume from the last complete line.
+        _log_exception(e)
+        raise
+
+
+def _get_object_id_pairs_from_json(request) -> List[Tuple[str, str]]:
+    # validates and strips the input in a single pass, returning (key, value) pairs.
+    ids = _load_json(request)
     if not isinstance(ids, dict):
         raise IllegalParameterError("Expected JSON mapping in request body")
     if not ids:
         raise MissingParameterError("No ids supplied")
-    for id_ in ids:
+    ret = []
+    for id_, val in ids.items():
         # json keys must be strings
-        if not id_.strip():
+        key = id_.strip()
+        if not key:
             raise MissingParameterError("whitespace only key in input JSON")
-        val = ids[id_]
         if not isinstance(val, str):
             raise IllegalParameterError(
                 "value for key {} in input JSON is not string: {}".format(id_, val)
             )
-        if not val.strip():
+        stripped = val.strip()
+        if not stripped:
             raise MissingParameterError(
                 "value for key {} in input JSON is whitespace only".format(id_)
             )
-    return ids
+        ret.append((key, stripped))
+    return ret
+
+
+def _get_users_from_json(request) -> Set[User]:
+    body = _load_json(request)
+    if not isinstance(body, dict):
+        raise IllegalParameterError("Expected JSON mapping in request body")
+    users = body.get("users")
+    if not isinstance(users, list):
+        raise IllegalParameterError("Expected list at /users in request body")
+    if not users:
+        raise MissingParameterError("No users supplied")
+    ret = set()
+    for u in users:
+        if not isinstance(u, str) or len(u.split("/")) != 2:
+            raise IllegalParameterError(
+                "Expected user in the format <authsource>/<username>: {}".format(u)
+            )
+        authsource, name = u.split("/")
+        ret.add(User(AuthsourceID(authsource.strip()), Username(name.strip())))
+    return ret
 
 
 def _get_object_id_list_from_json(request) -> List[str]:
-    # flask has a built in get_json() method but the errors it throws suck.
-    body = json.loads(request.get_data())
+    # validates and strips the input in a single pass.
+    body = _load_json(request)
     if not isinstance(body, dict):
         raise IllegalParameterError("Expected JSON mapping in request body")
     ids = body.get("ids")
@@ -188,10 +296,38 @@ def _get_object_id_list_from_json(request) -> List[str]:
         raise IllegalParameterError("Expected list at /ids in request body")
     if not ids:
         raise MissingParameterError("No ids supplied")
+    ret = []
     for id_ in ids:
-        if not id_ or not id_.strip():
+        stripped = id_.strip() if id_ else None
+        if not stripped:
             raise MissingParameterError("null or whitespace-only id in list")
-    return ids
+        ret.append(stripped)
+    return ret
+
+
+def _find_mappings_range(mapper, namespace_id: NamespaceID, ns_filter: List[NamespaceID]):
+    # finds mappings for a prefix or range lookup given in the request query parameters.
+    args = {k: v.strip() for k, v in request.args.items()}
+    prefix = args.get("prefix")
+    start = args.get("start")
+    if prefix is not None and start is not None:
+        raise IllegalParameterError("Only one of prefix and start may be provided")
+    if prefix is not None and "end" in args:
+        raise IllegalParameterError("end may only be provided with start")
+    limit = _DEFAULT_RANGE_LIMIT
+    if args.get("limit"):
+        try:
+            limit = int(args["limit"])
+        except ValueError as e:
+            raise IllegalParameterError("limit must be an integer") from e
+    if limit > _MAX_LOOKUP_IDS:
+        raise IllegalParameterError(
+            "A maximum of {} ids are allowed".format(_MAX_LOOKUP_IDS))
+    if prefix is not None:
+        return mapper.get_mappings_with_prefix(
+            namespace_id, prefix, ns_filter, limit, args.get("after"))
+    return mapper.get_mappings_in_range(
+        namespace_id, start, args.get("end"), ns_filter, limit, args.get("after"))
 
 
 class JSONFlaskLogFormatter(Formatter):
@@ -216,6 +352,9 @@ class JSONFlaskLogFormatter(Formatter):
             log["ip"] = flask_req_global.ip
             log["method"] = flask_req_global.method
             log["callid"] = flask_req_global.req_id
+        timing = getattr(record, "timing", None)
+        if timing:
+            log["timing"] = timing
         return json.dumps(log)
 
 
@@ -230,36 +369,79 @@ def _configure_loggers(logstream: Optional[IO[str]] = None):
 
 
 def create_app(
-    builder: IDMappingBuilder = IDMappingBuilder(), logstream: Optional[IO[str]] = None
+    builder: IDMappingBuilder = IDMappingBuilder(),
+    logstream: Optional[IO[str]] = None,
+    json_provider: Optional[JSONProvider] = None,
 ):
-    """Create the flask app."""
+    """
+    Create the flask app.
+
+    :param builder: the builder for the ID mapping system.
+    :param logstream: the stream to which logs are written. Defaults to stderr.
+    :param json_provider: the provider to use to encode and decode JSON. Defaults to the
+        fastest provider available.
+    """
     _configure_loggers(logstream)
     app = Flask(__name__)
     app.url_map.strict_slashes = False  # otherwise GET /loc/ won't match GET /loc
     app.config[_APP] = builder.build_id_mapping_system()
-    app.config[_IGNORE_IP_HEADERS] = builder.get_cfg().ignore_ip_headers
+    cfg = builder.get_cfg()
+    app.config[_IGNORE_IP_HEADERS] = cfg.ignore_ip_headers
+    app.config[_PROFILER] = None
+    app.config[_JSON] = json_provider if json_provider else get_json_provider()
+    if cfg.profile_dir:
+        app.config[_PROFILER] = RequestProfiler(
+            cfg.profile_dir, cfg.profile_sample_rate, cfg.profile_max_size_mb * 1024 * 1024
+        )
 
     @app.before_request
     def preprocess_request():
+        flask_req_global.start = time.perf_counter()
+        flask_req_global.timer = request_timing.start_request_timer()
+        token = request.headers.get(_CONSISTENCY_TOKEN_HEADER)
+        flask_req_global.consistency = consistency.start_request(
+            token.strip() if token and token.strip() else None
+        )
         # bandit doesn't like random for crypo purposes, but we're not doing that here
         flask_req_global.req_id = str(random.randrange(10000000000000000)).zfill(16)  # nosec
         flask_req_global.method = request.method
         flask_req_global.ip = get_ip_address(request, app.config[_IGNORE_IP_HEADERS])
+        profiler = app.config[_PROFILER]
+        if profiler and (profiler.sample() or _profile_requested(request, app.config[_APP])):
+            flask_req_global.profile = profiler.start()
         iph = format_ip_headers(request, app.config[_IGNORE_IP_HEADERS])
         if iph:
             _log(iph)
 
     @app.after_request
     def postprocess_request(response):
+        # use the route pattern rather than the path to keep the number of label values bounded
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        REQUEST_LATENCY.labels(request.method, route, response.status_code).observe(
+            time.perf_counter() - flask_req_global.start
+        )
         _log(
             "%s %s %s %s",
             request.method,
             request.path,
             response.status_code,
             request.headers.get(_USER_AGENT),
+            extra={"timing": flask_req_global.timer.to_dict()},
         )
+        write_token = flask_req_global.consistency.write_token
+        if write_token:
+            response.headers[_CONSISTENCY_TOKEN_HEADER] = write_token
         return response
 
+    @app.teardown_request
+    def teardown_request(err):
+        request_timing.stop_request_timer()
+        consistency.stop_request()
+        profile = flask_req_global.get("profile")
+        if profile:
+            path = app.config[_PROFILER].finish(profile, flask_req_global.req_id)
+            _log("Wrote profile to %s", path)
+
     ###########
     # Endpoints
     ###########
@@ -268,7 +450,7 @@ def create_app(
     def root():
         """Get information about the service."""
         # TODO ROOT add paths and a configurable contact email at some point.
-        return flask.jsonify(
+        return _jsonify(
             {
                 "service": "ID Mapping Service",
                 "version": VERSION,
@@ -277,6 +459,12 @@ def create_app(
             }
         )
 
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        """Get the service metrics in the Prometheus text format."""
+        data, content_type = generate_metrics()
+        return flask.Response(data, content_type=content_type)
+
     @app.route("/api/v1/namespace/<namespace>", methods=["PUT", "POST"])
     def create_namespace(namespace):
         """Create a namespace."""
@@ -298,6 +486,19 @@ def create_app(
         )
         return ("", 204)
 
+    @app.route("/api/v1/namespace/<namespace>/users", methods=["PUT"])
+    def add_users_to_namespace(namespace):
+        """Add users to a namespace."""
+        admin_authsource, token = _get_auth(request)
+        users = _get_users_from_json(request)
+        if len(users) > _MAX_NAMESPACE_USERS:
+            raise IllegalParameterError(
+                "A maximum of {} users are allowed".format(_MAX_NAMESPACE_USERS))
+        app.config[_APP].add_users_to_namespace(
+            admin_authsource, token, NamespaceID(namespace), users
+        )
+        return ("", 204)
+
     @app.route(
         "/api/v1/namespace/<namespace>/user/<authsource>/<user>", methods=["DELETE"]
     )
@@ -336,7 +537,7 @@ def create_app(
         """Get a namespace."""
         authsource, token = _get_auth(request, False)
         ns = app.config[_APP].get_namespace(NamespaceID(namespace), authsource, token)
-        return flask.jsonify(
+        return _jsonify(
             {
                 "namespace": ns.namespace_id.id,
                 "publicly_mappable": ns.is_publicly_mappable,
@@ -344,11 +545,23 @@ def create_app(
             }
         )
 
+    @app.route("/api/v1/namespace/<namespace>/stats", methods=["GET"])
+    def get_namespace_stats(namespace):
+        """Get the number of mappings between a namespace and the other namespaces."""
+        admin, other = app.config[_APP].get_mapping_counts(NamespaceID(namespace))
+        return _jsonify(
+            {
+                "namespace": namespace,
+                "admin": {ns.id: admin[ns] for ns in sorted(admin, key=lambda ns: ns.id)},
+                "other": {ns.id: other[ns] for ns in sorted(other, key=lambda ns: ns.id)},
+            }
+        )
+
     @app.route("/api/v1/namespace", methods=["GET"])
     def get_namespaces():
         """Get all namespaces."""
         public, private = app.config[_APP].get_namespaces()
-        return flask.jsonify(
+        return _jsonify(
             {
                 "publicly_mappable": sorted([ns.id for ns in public]),
                 "privately_mappable": sorted([ns.id for ns in private]),
@@ -359,32 +572,34 @@ def create_app(
     def create_mapping(admin_ns, other_ns):
         """Create a mapping."""
         authsource, token = _get_auth(request)
-        ids = _get_object_id_dict_from_json(request)
+        ids = _get_object_id_pairs_from_json(request)
+        MAPPING_BATCH_SIZE.labels("create").observe(len(ids))
         if len(ids) > 10000:
             raise IllegalParameterError("A maximum of 10000 ids are allowed")
-        for id_ in ids:
-            app.config[_APP].create_mapping(
-                authsource,
-                token,
-                ObjectID(NamespaceID(admin_ns), id_.strip()),
-                ObjectID(NamespaceID(other_ns), ids[id_].strip()),
-            )
+        app.config[_APP].create_mappings(
+            authsource,
+            token,
+            NamespaceID(admin_ns),
+            NamespaceID(other_ns),
+            ids,
+        )
         return ("", 204)
 
     @app.route("/api/v1/mapping/<admin_ns>/<other_ns>", methods=["DELETE"])
     def remove_mapping(admin_ns, other_ns):
         """Remove a mapping."""
         authsource, token = _get_auth(request)
-        ids = _get_object_id_dict_from_json(request)
+        ids = _get_object_id_pairs_from_json(request)
+        MAPPING_BATCH_SIZE.labels("remove").observe(len(ids))
         if len(ids) > 10000:
             raise IllegalParameterError("A maximum of 10000 ids are allowed")
-        for id_ in ids:
-            app.config[_APP].remove_mapping(
-                authsource,
-                token,
-                ObjectID(NamespaceID(admin_ns), id_.strip()),
-                ObjectID(NamespaceID(other_ns), ids[id_].strip()),
-            )
+        app.config[_APP].remove_mappings(
+            authsource,
+            token,
+            NamespaceID(admin_ns),
+            NamespaceID(other_ns),
+            ids,
+        )
         return ("", 204)
 
     @app.route("/api/v1/mapping/<ns>/", methods=["GET"])
@@ -396,24 +611,75 @@ def create_app(
             ns_filter = [NamespaceID(n.strip()) for n in ns_filter.split(",")]
         else:
             ns_filter = []
-        ids = _get_object_id_list_from_json(request)
-        if len(ids) > 1000:
-            raise IllegalParameterError("A maximum of 1000 ids are allowed")
+        media_type = request.accept_mimetypes.best_match(
+            mapping_formats.MEDIA_TYPES, default=mapping_formats.JSON
+        )
+        next_after = None
+        if "prefix" in request.args or "start" in request.args:
+            # the ids are found by the lookup, in order, rather than provided in the body
+            mappings, more = _find_mappings_range(app.config[_APP], NamespaceID(ns), ns_filter)
+            ids = list(mappings)
+            if more:
+                next_after = ids[-1]
+        else:
+            ids = _get_object_id_list_from_json(request)
+            MAPPING_BATCH_SIZE.labels("get").observe(len(ids))
+            if len(ids) > _MAX_LOOKUP_IDS:
+                raise IllegalParameterError(
+                    "A maximum of {} ids are allowed".format(_MAX_LOOKUP_IDS))
+            mappings = app.config[_APP].get_mappings_bulk(NamespaceID(ns), ids, ns_filter)
         ret = {}
-        for id_ in ids:
-            id_ = id_.strip()
-            a, o = app.config[_APP].get_mappings(
-                ObjectID(NamespaceID(ns), id_), ns_filter
+        if media_type != mapping_formats.JSON:
+            with request_timing.timed(request_timing.SERIALIZE):
+                columnar = mapping_formats.to_columnar(
+                    dict.fromkeys(ids),  # remove duplicates but keep the order
+                    mappings,
+                    separate is not None,
+                    request.args.get("sort") is not None,
+                )
+                resp = flask.Response(
+                    mapping_formats.encode(columnar, media_type, _json_provider()),
+                    mimetype=media_type,
+                )
+        else:
+            for id_ in ids:
+                a, o = mappings[id_]
+                if separate is not None:  # empty string if in query with no value
+                    ret[id_] = {
+                        "admin": _objids_to_jsonable(a),
+                        "other": _objids_to_jsonable(o),
+                    }
+                else:
+                    a.update(o)
+                    ret[id_] = {"mappings": _objids_to_jsonable(a)}
+            resp = _jsonify(ret)
+        if next_after is not None:
+            resp.headers[_NEXT_AFTER_HEADER] = quote(next_after, safe="")
+        resp.vary.add("Accept")
+        return resp
+
+    @app.route("/api/v1/mapping/<admin_ns>/<other_ns>", methods=["GET"])
+    def export_mappings(admin_ns, other_ns):
+        """
+        Stream all the mappings between two namespaces as newline delimited JSON, ordered by
+        the administrative ID and then the other ID.
+        """
+        after_admin = request.args.get("after_admin")
+        after_other = request.args.get("after_other")
+        if bool(after_admin) ^ bool(after_other):  # xor
+            raise MissingParameterError(
+                "Both or neither of after_admin and after_other must be provided"
             )
-            if separate is not None:  # empty string if in query with no value
-                ret[id_] = {
-                    "admin": _objids_to_jsonable(a),
-                    "other": _objids_to_jsonable(o),
-                }
-            else:
-                a.update(o)
-                ret[id_] = {"mappings": _objids_to_jsonable(a)}
-        return flask.jsonify(ret)
+        after = (after_admin.strip(), after_other.strip()) if after_admin else None
+        mappings = app.config[_APP].iter_mappings(
+            NamespaceID(admin_ns), NamespaceID(other_ns), after
+        )
+        return flask.Response(
+            flask.stream_with_context(
+                _export_mappings_ndjson(mappings, app.config[_JSON])
+            ),
+            mimetype="application/x-ndjson",
+        )
 
     ################
     # error handlers
@@ -0,0 +1,102 @@
+"""
+Compact response formats for mapping lookups.
+
+The default JSON response for a mapping lookup repeats the namespace for every object ID. The
+columnar format instead lists each namespace once in a table and returns the mappings as
+parallel arrays, with one entry per mapping:
+
+* ``index`` - the index of the requested ID in ``ids``.
+* ``ns`` - the index of the mapped ID's namespace in ``namespaces``.
+* ``id`` - the mapped ID.
+
+The columnar format is available as JSON or, more compactly, as MessagePack.
+"""
+
+from jgikbase.idmapping.core.object_id import ObjectID
+from jgikbase.idmapping.service.json_provider import JSONProvider, StdlibJSONProvider
+from typing import Any, Dict, Iterable, List, Set, Tuple
+import msgpack
+
+JSON = "application/json"
+""" The media type for the default JSON format. """
+
+COLUMNAR_JSON = "application/vnd.kbase.idmapping.columnar+json"
+""" The media type for the columnar format encoded as JSON. """
+
+MSGPACK = "application/msgpack"
+""" The media type for the columnar format encoded as MessagePack. """
+
+MSGPACK_LEGACY = "application/x-msgpack"
+""" A commonly used alternative media type for MessagePack. """
+
+MEDIA_TYPES = (JSON, COLUMNAR_JSON, MSGPACK, MSGPACK_LEGACY)
+""" The media types available for mapping lookups, the default first. """
+
+
+def _columns(
+    oidsets: Iterable[Set[ObjectID]], namespaces: Dict[str, int], sort: bool
+) -> Dict[str, List]:
+    index: List[int] = []
+    ns: List[int] = []
+    ids: List[str] = []
+    for i, oids in enumerate(oidsets):
+        pairs: Iterable[Tuple[str, str]] = [(o.namespace_id.id, o.id) for o in oids]
+        if sort:
+            pairs = sorted(pairs)
+        for n, id_ in pairs:
+            index.append(i)
+            # setdefault assigns the next index to namespaces that haven't been seen yet
+            ns.append(namespaces.setdefault(n, len(namespaces)))
+            ids.append(id_)
+    return {"index": index, "ns": ns, "id": ids}
+
+
+def to_columnar(
+    ids: Iterable[str],
+    mappings: Dict[str, Tuple[Set[ObjectID], Set[ObjectID]]],
+    separate: bool = False,
+    sort: bool = False,
+) -> Dict[str, Any]:
+    """
+    Convert the results of a mapping lookup to the columnar format.
+
+    :param ids: the requested IDs, in the order they should appear in the response.
+    :param mappings: the mappings for each ID, as returned by
+        :meth:`jgikbase.idmapping.core.mapper.IDMapper.get_mappings_bulk`.
+    :param separate: True to return the mappings where the requested ID is the administrative
+        ID separately, under the ``admin`` key, from the other mappings, under the ``other``
+        key. Otherwise all the mappings are returned under the ``mappings`` key.
+    :param sort: True to sort the mappings for each ID by namespace and then ID. Otherwise
+        the order of the mappings for each ID is arbitrary.
+    :returns: the columnar representation of the mappings.
+    """
+    ids = list(ids)
+    namespaces: Dict[str, int] = {}
+    ret: Dict[str, Any] = {"ids": ids, "namespaces": []}
+    if separate:
+        ret["admin"] = _columns((mappings[i][0] for i in ids), namespaces, sort)
+        ret["other"] = _columns((mappings[i][1] for i in ids), namespaces, sort)
+    else:
+        ret["mappings"] = _columns(
+            (mappings[i][0] | mappings[i][1] for i in ids), namespaces, sort)
+    # dicts are ordered, so the keys are in index order
+    ret["namespaces"] = list(namespaces)
+    return ret
+
+
+def encode(
+    obj: Any, media_type: str, json_provider: JSONProvider = StdlibJSONProvider()
+) -> bytes:
+    """
+    Encode a response body in the format for a media type.
+
+    :param obj: the object to encode.
+    :param media_type: the media type, one of :data:`MEDIA_TYPES`.
+    :param json_provider: the provider to use to encode JSON.
+    :returns: the encoded object.
+    """
+    if media_type in (MSGPACK, MSGPACK_LEGACY):
+        return msgpack.packb(obj, use_bin_type=True)
+    if media_type in (JSON, COLUMNAR_JSON):
+        return json_provider.dumps(obj)
+    raise ValueError("Unsupported media type: " + str(media_type))
@@ -0,0 +1,118 @@
+"""
+A request profiler for the ID mapping service.
+"""
+
+from jgikbase.idmapping.core.arg_check import not_none
+from pathlib import Path
+from typing import Callable, Optional
+import cProfile
+import random
+import threading
+import time
+
+
+class RequestProfiler:
+    """
+    Profiles requests with cProfile and writes the results to a directory in the pstats format,
+    one file per request, named with the time and the call ID of the request. When the total
+    size of the files in the directory exceeds the maximum size, the oldest files are deleted.
+
+    Only one request at a time is profiled per process, since a profiler only sees the thread
+    it was started in and multiple profilers can't run in the same thread. Under gevent, work
+    from other requests running concurrently in the same thread is included in the profile.
+
+    The profiles can be examined with the pstats module or a viewer such as snakeviz.
+    """
+
+    SUFFIX = ".prof"
+    """ The file name suffix for profiles. """
+
+    def __init__(
+        self,
+        directory: Path,
+        sample_rate: float = 0,
+        max_size: int = 100 * 1024 * 1024,
+        rand: Optional[Callable[[], float]] = None,
+        timer: Optional[Callable[[], float]] = None,
+    ) -> None:
+        """
+        Create the profiler. The directory is created if it does not exist.
+
+        :param directory: the directory where profiles are written.
+        :param sample_rate: the fraction of requests to profile, between 0 and 1.
+        :param max_size: the maximum total size of the profiles in the directory in bytes.
+        :param rand: a function returning a random number between 0 and 1, used for sampling
+            requests. Defaults to random.random.
+        :param timer: the timer used to name the profile files. Defaults to time.time.
+        :raises TypeError: if the directory is None.
+        :raises ValueError: if the sample rate is not between 0 and 1 or the maximum size is less
+            than 1.
+        """
+        not_none(directory, "directory")
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("sample_rate must be between 0 and 1")
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self._dir = directory
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._rate = sample_rate
+        self._max_size = max_size
+        # bandit doesn't like random for crypo purposes, but we're not doing that here
+        self._rand = random.random if not rand else rand  # nosec
+        self._timer = time.time if not timer else timer
+        self._lock = threading.Lock()
+        self._active = False
+
+    def sample(self) -> bool:
+        """
+        Decide whether a request should be profiled based on the sample rate.
+        """
+        return self._rate > 0 and self._rand() < self._rate
+
+    def start(self) -> Optional[cProfile.Profile]:
+        """
+        Start profiling a request.
+
+        :returns: the profile, or None if another request is already being profiled.
+        """
+        with self._lock:
+            if self._active:
+                return None
+            self._active = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile: cProfile.Profile, callid: str) -> Path:
+        """
+        Stop profiling a request, write the profile, and delete old profiles if the maximum
+        size of the directory is exceeded.
+
+        :param profile: the profile returned from :meth:`start`.
+        :param callid: the call ID of the request.
+        :returns: the path to the profile file.
+        """
+        not_none(profile, "profile")
+        not_none(callid, "callid")
+        try:
+            profile.disable()
+        finally:
+            with self._lock:
+                self._active = False
+        path = self._dir / "{}-{}{}".format(int(self._timer() * 1000), callid, self.SUFFIX)
+        profile.dump_stats(str(path))
+        self._rotate()
+        return path
+
+    def _rotate(self):
+        # file names start with the time, so sorting by name sorts by age. The newest file is
+        # always kept.
+        files = sorted(self._dir.glob("*" + self.SUFFIX), reverse=True)
+        total = 0
+        for i, f in enumerate(files):
+            try:
+                total += f.stat().st_size
+                if i > 0 and total > self._max_size:
+                    f.unlink()
+            except FileNotFoundError:
+                pass  # deleted by another process
@@ -12,7 +12,7 @@ from jgikbase.idmapping.core.tokens import HashedToken  # pragma: no cover
 from jgikbase.idmapping.core.object_id import Namespace  # pragma: no cover
 from typing import Iterable, Set, Tuple  # pragma: no cover
 from jgikbase.idmapping.core.object_id import ObjectID  # pragma: no cover
-from typing import Dict, Optional
+from typing import Dict, Optional, Iterator
 
 
 class IDMappingStorage:  # pragma: no cover
@@ -22,6 +22,18 @@ class IDMappingStorage:  # pragma: no cover
 
     __metaclass__ = _ABCMeta
 
+    @_abstractmethod
+    def update_schema(self) -> bool:
+        """
+        Update the storage system schema to the most recent version enabled for the storage
+        system. The update may take a long time for large data sets, but the storage system
+        remains usable by other processes while the update runs.
+
+        :returns: True if the schema was updated, False if no update was necessary.
+        :raises IDMappingStorageError: if an unexpected error occurs.
+        """
+        raise NotImplementedError()
+
     @_abstractmethod
     def create_local_user(self, username: Username, token: HashedToken) -> None:
         """
@@ -88,6 +100,28 @@ class IDMappingStorage:  # pragma: no cover
         """
         raise NotImplementedError()
 
+    @_abstractmethod
+    def get_users_by_token(self) -> Dict[HashedToken, Tuple[Username, bool]]:
+        """
+        Get all the users in the system, keyed by their hashed tokens.
+
+        :raises IDMappingStorageError: if an unexpected error occurs.
+        :returns: a mapping of hashed token to a tuple of the username and a boolean denoting
+            whether the user is an admin or not.
+        """
+        raise NotImplementedError()
+
+    @_abstractmethod
+    def get_users_version(self) -> int:
+        """
+        Get the current version of the user data. The version changes whenever a user is
+        created or a user's token or admin state is altered, and so can be used to cheaply check
+        whether cached user data is stale.
+
+        :raises IDMappingStorageError: if an unexpected error occurs.
+        """
+        raise NotImplementedError()
+
     @_abstractmethod
     def user_exists(self, username: Username) -> bool:
         """
@@ -125,6 +159,21 @@ class IDMappingStorage:  # pragma: no cover
         """
         raise NotImplementedError()
 
+    @_abstractmethod
+    def add_users_to_namespace(
+        self, namespace_id: NamespaceID, admin_users: Set[User]
+    ) -> None:
+        """
+        Add users to a namespace, giving them administration rights, in one operation. Users
+        that already administrate the namespace are ignored.
+
+        :param namespace_id: the namespace to modify.
+        :param admin_users: the users.
+        :raises TypeError: if any of the arguments are None or admin_users contains None.
+        :raises NoSuchNamespaceError: if the namespace does not exist.
+        """
+        raise NotImplementedError()
+
     @_abstractmethod
     def remove_user_from_namespace(
         self, namespace_id: NamespaceID, admin_user: User
@@ -156,11 +205,16 @@ class IDMappingStorage:  # pragma: no cover
         raise NotImplementedError()
 
     @_abstractmethod
-    def get_namespaces(self, nids: Optional[Iterable[NamespaceID]] = None) -> Set[Namespace]:
+    def get_namespaces(
+        self, nids: Optional[Iterable[NamespaceID]] = None, include_users: bool = True
+    ) -> Set[Namespace]:
         """
         Get all the namespaces in the system.
 
         :param ids: specific namespaces to get. By default all namespaces are returned.
+        :param include_users: False to return the namespaces without their user lists. The
+            storage system may then read the namespaces from a replica that lags behind the
+            primary, so the namespaces must not be used for authorization.
         :raises TypeError: if nids contains None.
         :raises NoSuchNamespaceError: if any of the namespaces in the nids parameter do not
             exist
@@ -178,6 +232,17 @@ class IDMappingStorage:  # pragma: no cover
         """
         raise NotImplementedError()
 
+    @_abstractmethod
+    def get_namespace_version(self) -> int:
+        """
+        Get the current version of the namespace data. The version changes whenever a namespace
+        is created or altered, and so can be used to cheaply check whether cached namespace data
+        is stale.
+
+        :raises IDMappingStorageError: if an unexpected error occurs.
+        """
+        raise NotImplementedError()
+
     @_abstractmethod
     def add_mapping(self, primary_OID: ObjectID, secondary_OID: ObjectID) -> None:
         """
@@ -204,6 +269,35 @@ class IDMappingStorage:  # pragma: no cover
         """
         raise NotImplementedError()
 
+    @_abstractmethod
+    def add_mappings(self, mappings: Iterable[Tuple[ObjectID, ObjectID]]) -> Tuple[int, int]:
+        """
+        Create mappings from one namespace to another in bulk.
+        Note that this method does NOT check for the existence of the namespaces.
+        Mappings that already exist are ignored.
+
+        :param mappings: the mappings to create as tuples of the primary namespace/ID
+            combination and the secondary namespace/ID combination.
+        :returns: a tuple of the number of mappings created and the number of mappings that
+            already existed.
+        :raise TypeError: if mappings is None or any of the object IDs are None.
+        :raise IDMappingStorageError: if an unexpected error occurs.
+        """
+        raise NotImplementedError()
+
+    @_abstractmethod
+    def remove_mappings(self, mappings: Iterable[Tuple[ObjectID, ObjectID]]) -> int:
+        """
+        Remove mappings from one namespace to another in bulk. Returns the number of mappings
+        removed.
+
+        :param mappings: the mappings to remove as tuples of the primary namespace/ID
+            combination and the secondary namespace/ID combination.
+        :raise TypeError: if mappings is None or any of the object IDs are None.
+        :raise IDMappingStorageError: if an unexpected error occurs.
+        """
+        raise NotImplementedError()
+
     @_abstractmethod
     def find_mappings(
         self, oid: ObjectID, ns_filter: Optional[Iterable[NamespaceID]] = None
@@ -223,3 +317,128 @@ class IDMappingStorage:  # pragma: no cover
         :raise TypeError: if the object ID is None or the filter contains None.
         """
         raise NotImplementedError()
+
+    @_abstractmethod
+    def find_mappings_bulk(
+        self,
+        namespace_id: NamespaceID,
+        ids: Iterable[str],
+        ns_filter: Optional[Iterable[NamespaceID]] = None,
+    ) -> Dict[str, Tuple[Set[ObjectID], Set[ObjectID]]]:
+        """
+        Find mappings given a namespace and a set of ids in that namespace.
+
+        If the namespace or an id does not exist, no results will be returned for that id.
+        The namespaces in the filter are ignored if they do not exist.
+
+        :param namespace_id: the namespace of the ids.
+        :param ids: the ids to match against.
+        :param ns_filter: a list of namespaces with which to filter the results. Only results in
+            these namespaces will be returned.
+        :returns: a mapping of each provided id to a tuple of sets of object IDs. The first set
+            in the tuple contains mappings where the id is the primary ID, and the second set
+            contains mappings where the id is the secondary ID.
+        :raise TypeError: if the namespace ID or ids are None, or ids or the filter contain None.
+        """
+        raise NotImplementedError()
+
+    @_abstractmethod
+    def find_mappings_range(
+        self,
+        namespace_id: NamespaceID,
+        start: str,
+        end: Optional[str] = None,
+        ns_filter: Optional[Iterable[NamespaceID]] = None,
+        limit: int = 1000,
+        after: Optional[str] = None,
+    ) -> Tuple[Dict[str, Tuple[Set[ObjectID], Set[ObjectID]]], bool]:
+        """
+        Find mappings for the ids in a namespace that fall within a range, in id order. IDs are
+        compared by their unicode code points. Only ids with mappings are returned.
+
+        The range is found with an index range scan, so the cost of this method depends on the
+        number of mappings returned rather than the number of mappings in the namespace.
+
+        :param namespace_id: the namespace of the ids.
+        :param start: the start of the range, inclusive.
+        :param end: the end of the range, exclusive. If None, the range is unbounded.
+        :param ns_filter: a list of namespaces with which to filter the results. Only results in
+            these namespaces will be returned.
+        :param limit: the maximum number of ids to return.
+        :param after: if provided, only ids after this id are returned. Pass the last id
+            returned to get the next ids in the range.
+        :returns: a tuple of a mapping of each id found to a tuple of sets of object IDs, ordered
+            by id, and whether there are more ids in the range. The first set in the tuple
+            contains mappings where the id is the primary ID, and the second set contains
+            mappings where the id is the secondary ID.
+        :raise TypeError: if the namespace ID or start are None, or the filter contains None.
+        :raise ValueError: if the limit is less than 1.
+        :raise IDMappingStorageError: if an unexpected error occurs.
+        """
+        raise NotImplementedError()
+
+    @_abstractmethod
+    def iter_mappings(
+        self,
+        primary_namespace_id: NamespaceID,
+        secondary_namespace_id: NamespaceID,
+        after: Optional[Tuple[str, str]] = None,
+    ) -> Iterator[Tuple[str, str]]:
+        """
+        Iterate over all the mappings from one namespace to another, ordered by the primary ID
+        and then the secondary ID. The mappings are not loaded into memory as a whole, so this
+        method is suitable for very large numbers of mappings.
+
+        If either namespace does not exist, no results will be returned.
+
+        :param primary_namespace_id: the namespace of the primary IDs.
+        :param secondary_namespace_id: the namespace of the secondary IDs.
+        :param after: a (primary ID, secondary ID) tuple. If provided, only mappings that sort
+            after this tuple are returned. Pass the last mapping returned to resume an
+            interrupted iteration.
+        :returns: an iterator over (primary ID, secondary ID) tuples.
+        :raise TypeError: if either namespace ID is None, or after contains None.
+        :raise IDMappingStorageError: if an unexpected error occurs. Note that this error may be
+            thrown during iteration.
+        """
+        raise NotImplementedError()
+
+    @_abstractmethod
+    def get_mapping_counts(
+        self, namespace_id: NamespaceID
+    ) -> Tuple[Dict[NamespaceID, int], Dict[NamespaceID, int]]:
+        """
+        Get the number of mappings between a namespace and each of the other namespaces. The
+        counts are maintained as mappings are added and removed, so the cost of this method
+        depends on the number of namespaces rather than the number of mappings.
+
+        If the namespace does not exist, no results will be returned.
+
+        :param namespace_id: the namespace.
+        :returns: a 2-tuple of dicts of namespace ID to the number of mappings. The first dict
+            contains the mappings where the namespace is the primary namespace, keyed by the
+            secondary namespace. The second dict contains the mappings where the namespace is
+            the secondary namespace, keyed by the primary namespace. Namespaces with no
+            mappings are omitted.
+        :raise TypeError: if the namespace ID is None.
+        :raise IDMappingStorageError: if an unexpected error occurs.
+        """
+        raise NotImplementedError()
+
+    @_abstractmethod
+    def rebuild_mapping_counts(self, workers: int = 1) -> int:
+        """
+        Recalculate the mapping counts returned by :meth:`get_mapping_counts` from the mappings.
+        Used to repair the counts if they drift from the mappings, for example if a write
+        failed partway, or to initialize them for mappings added by a version of the storage
+        system that didn't maintain them.
+
+        Mapping writes that overlap the rebuild would be lost from the counts, so
+        implementations block or refuse mapping writes until the rebuild is complete.
+
+        :param workers: the number of namespaces to count concurrently.
+        :returns: the number of pairs of namespaces with mappings.
+        :raise ValueError: if workers is less than 1.
+        :raise IDMappingStorageError: if an unexpected error occurs.
+        """
+        raise NotImplementedError()
@@ -9,13 +9,37 @@ from jgikbase.idmapping.core.tokens import HashedToken
 from jgikbase.idmapping.core.user import User, AuthsourceID, Username
 from pymongo.database import Database
 from jgikbase.idmapping.core.arg_check import not_none, no_Nones_in_iterable
-from pymongo.errors import DuplicateKeyError, PyMongoError
+from jgikbase.idmapping.core.metrics import timed_storage_operation, STORAGE_DOCUMENTS
+from jgikbase.idmapping.core import request_timing
+from jgikbase.idmapping.core import consistency
+from pymongo.errors import (
+    DuplicateKeyError,
+    PyMongoError,
+    BulkWriteError,
+    CursorNotFound,
+    OperationFailure,
+)
+from pymongo.operations import InsertOne, DeleteOne, UpdateOne
+from pymongo.monitoring import CommandListener
+from pymongo.read_preferences import _ServerMode, Primary
+from pymongo.client_session import ClientSession
+from bson.son import SON
+from bson.timestamp import Timestamp
+from bson.errors import BSONError
+import bson
+import base64
+import binascii
+from contextlib import contextmanager
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import re
+import time
 from jgikbase.idmapping.storage.errors import (
     IDMappingStorageError,
     StorageInitException,
 )
 from jgikbase.idmapping.core.errors import (
+    IllegalParameterError,
     NoSuchUserError,
     UserExistsError,
     InvalidTokenError,
@@ -30,6 +54,8 @@ from typing import (
     Any,
     List,
     Optional,
+    Iterator,
+    Generator,
 )  # @UnusedImport pydev gets confused here
 from jgikbase.idmapping.core.object_id import NamespaceID, Namespace, ObjectID
 
@@ -46,7 +72,16 @@ from jgikbase.idmapping.core.object_id import NamespaceID, Namespace, ObjectID
 # the schema version collection
 _COL_CONFIG = "config"
 # the current version of the database schema.
-_SCHEMA_VERSION = 1
+# v1: the initial schema.
+# v2: the index for 'backwards' mapping queries includes the primary namespace and ID, so that
+#     queries in both directions are covered by an index. The mapping documents are unchanged.
+_SCHEMA_VERSION = 2
+# the schema versions the code can work with. Which of these is used for a new database is
+# determined by whether the covering index is enabled.
+_COMPATIBLE_SCHEMA_VERSIONS = {1, 2}
+# the schema versions that can be updated while servers are running. Servers may start while
+# the database is being updated from one of these versions.
+_ONLINE_UPDATE_SCHEMA_VERSIONS = {1}
 # the key for the schema document used to ensure a singleton.
 _FLD_SCHEMA_KEY = "schema"
 # the value for the schema key.
@@ -55,11 +90,31 @@ _SCHEMA_VALUE = "schema"
 _FLD_SCHEMA_UPDATE = "inupdate"
 # the version of the schema. Value is _SCHEMA_VERSION.
 _FLD_SCHEMA_VERSION = "schemaver"
+# the version of the namespace data, incremented on every namespace change. Value is an integer,
+# and a missing value is equivalent to 0.
+_FLD_NS_VERSION = "nsver"
+# the version of the user data, incremented on every local user change. Value is an integer,
+# and a missing value is equivalent to 0.
+_FLD_USERS_VERSION = "usersver"
+# whether the reverse mapping collection contains all the mappings and can serve 'backwards'
+# queries. Value is a boolean, and a missing value is equivalent to False.
+_FLD_REVERSE_COLLECTION = "revmap"
+# whether the mapping counts are being rebuilt, during which mapping writes are refused. Value is
+# a boolean, and a missing value is equivalent to False.
+_FLD_COUNT_REBUILD = "countrebuild"
+
+# how long, in seconds, a mapping count rebuild waits after refusing mapping writes for writes
+# that were already in progress to finish.
+_COUNT_REBUILD_DRAIN_SEC = 30
 
 # database collections
 _COL_USERS = "users"
 _COL_NAMESPACES = "ns"
 _COL_MAPPINGS = "map"
+# a copy of the mappings for 'backwards' queries on sharded clusters. See _SHARD_KEYS.
+_COL_REVERSE_MAPPINGS = "revmap"
+# the number of mappings between each pair of namespaces, updated with every mapping write.
+_COL_MAPPING_COUNTS = "mapcount"
 
 # user collection fields
 _FLD_AUTHSOURCE = "auth"
@@ -74,12 +129,44 @@ _FLD_USERS = "users"
 _FLD_AUTHSOURCE = "auth"
 _FLD_NAME = "name"
 
+# mapping count collection fields. The namespace fields are the mapping collection fields.
+_FLD_COUNT = "count"
+
+# the Mongo error code for a duplicate key
+_DUPLICATE_KEY_CODE = 11000
+
+# the Mongo error code for invalid command options, e.g. a read concern afterClusterTime later
+# than the database's cluster time
+_ERR_INVALID_OPTIONS = 72
+
+# the maximum amount, in seconds, that a consistency token's operation time may be ahead of the
+# server clock
+_MAX_CLOCK_SKEW_SEC = 60
+
 # mapping collection fields:
 _FLD_PRIMARY_NS = "pnsid"
 _FLD_SECONDARY_NS = "snsid"
 _FLD_PRIMARY_ID = "pid"
 _FLD_SECONDARY_ID = "sid"
 
+# the unique index for mappings, which also serves 'forwards' queries.
+_MAPPING_INDEX = [
+    (_FLD_PRIMARY_NS, 1),
+    (_FLD_PRIMARY_ID, 1),
+    (_FLD_SECONDARY_NS, 1),
+    (_FLD_SECONDARY_ID, 1),
+]
+
+# the index for iterating over the mappings between a pair of namespaces. The unique index
+# would scan all the mappings for the primary namespace, as the primary IDs precede the
+# secondary namespace.
+_EXPORT_INDEX = [
+    (_FLD_PRIMARY_NS, 1),
+    (_FLD_SECONDARY_NS, 1),
+    (_FLD_PRIMARY_ID, 1),
+    (_FLD_SECONDARY_ID, 1),
+]
+
 _INDEXES = {
     _COL_USERS: [
         {
@@ -90,23 +177,60 @@ _INDEXES = {
     ],
     _COL_NAMESPACES: [{"idx": _FLD_NS_ID, "kw": {"unique": True}}],
     _COL_MAPPINGS: [
-        {
-            "idx": [
-                (_FLD_PRIMARY_NS, 1),
-                (_FLD_PRIMARY_ID, 1),
-                (_FLD_SECONDARY_NS, 1),
-                (_FLD_SECONDARY_ID, 1),
-            ],
-            "kw": {"unique": True},
-        },
-        # index for 'backwards' queries
-        # could improve performance by including the primary IDs for covered
-        # queries. Not sure if that's worth the index size increase.
-        {"idx": [(_FLD_SECONDARY_NS, 1), (_FLD_SECONDARY_ID, 1)], "kw": {}},
+        {"idx": _MAPPING_INDEX, "kw": {"unique": True}},
+        {"idx": _EXPORT_INDEX, "kw": {}},
     ],
     _COL_CONFIG: [{"idx": _FLD_SCHEMA_KEY, "kw": {"unique": True}}],
+    _COL_MAPPING_COUNTS: [
+        {"idx": [(_FLD_PRIMARY_NS, 1), (_FLD_SECONDARY_NS, 1)], "kw": {"unique": True}},
+        {"idx": [(_FLD_SECONDARY_NS, 1), (_FLD_PRIMARY_NS, 1)], "kw": {}},
+    ],
 }
 
+# index for 'backwards' queries by schema version. The v2 index includes the primary IDs for
+# covered queries at the cost of a larger index.
+_REVERSE_INDEXES = {
+    1: [(_FLD_SECONDARY_NS, 1), (_FLD_SECONDARY_ID, 1)],
+    2: [
+        (_FLD_SECONDARY_NS, 1),
+        (_FLD_SECONDARY_ID, 1),
+        (_FLD_PRIMARY_NS, 1),
+        (_FLD_PRIMARY_ID, 1),
+    ],
+}
+
+
+# index for the reverse mapping collection, which is unique and covers 'backwards' queries.
+_REVERSE_MAPPING_INDEX = _REVERSE_INDEXES[2]
+
+# Shard keys for the mapping collections on sharded clusters. Both mapping collections are
+# sharded on the namespace and ID they're queried by, so that mapping lookups are routed to
+# a single shard rather than broadcast to every shard. This is why 'backwards' queries use the
+# reverse mapping collection, which is written along with the mapping collection, rather than
+# the reverse index on the mapping collection. The unique indexes on both collections are
+# prefixed by the shard key, as MongoDB requires.
+_SHARD_KEYS = {
+    _COL_MAPPINGS: [(_FLD_PRIMARY_NS, 1), (_FLD_PRIMARY_ID, 1)],
+    _COL_REVERSE_MAPPINGS: [(_FLD_SECONDARY_NS, 1), (_FLD_SECONDARY_ID, 1)],
+}
+
+
+class MongoCommandCounter(CommandListener):
+    """
+    A pymongo command listener that counts the commands sent to MongoDB - in other words, the
+    database round trips - in the current request's timing breakdown. Register the listener
+    with the ``event_listeners`` argument of the MongoClient.
+    """
+
+    def started(self, event):
+        request_timing.count(request_timing.MONGO_CALLS)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
 
 class IDMappingMongoStorage(_IDMappingStorage):
     """
@@ -115,18 +239,59 @@ class IDMappingMongoStorage(_IDMappingStorage):
     See that class for method documentation.
     """
 
-    def __init__(self, db: Database) -> None:
+    def __init__(
+        self,
+        db: Database,
+        covered_index: bool = False,
+        sharded: bool = False,
+        mapping_read_preference: Optional[_ServerMode] = None,
+        namespace_read_preference: Optional[_ServerMode] = None,
+    ) -> None:
         """
         Create a ID mapping storage system.
 
         :param db: the MongoDB database in which to store the mappings and other data.
+        :param covered_index: True to create new databases with the v2 schema, where mapping
+            queries in both directions are covered by an index. Existing v1 databases can be
+            updated to v2 with :meth:`update_schema`.
+        :param sharded: True if the database is in a sharded cluster. The mapping collections
+            are sharded with the shard keys the storage system requires if they are not already
+            sharded, and mappings are also written to a reverse mapping collection sharded on
+            the secondary namespace and ID. For existing databases the reverse mapping
+            collection must be built with :meth:`update_schema` before it's used for queries.
+            All the servers using a database must agree on whether it is sharded.
+        :param mapping_read_preference: the read preference for mapping lookups. Defaults to
+            the read preference of the database. If the read preference allows reading from
+            secondaries, mapping writes record a consistency token in the current request's
+            :mod:`jgikbase.idmapping.core.consistency` context, and lookups read at least the
+            data as of the token sent with the request, if any.
+        :param namespace_read_preference: the read preference for listing namespaces without
+            their user lists. Defaults to the read preference of the database. All other reads,
+            including reads of namespaces with their user lists, which are used for
+            authorization, use the read preference of the database.
         :raises StorageInitException: if the storage system could not be initialized properly.
         :raises TypeError: if the Mongo database is None.
         """
         not_none(db, "db")
         self._db = db
+        self._covered_index = covered_index
+        self._sharded = sharded
+        self._mapping_db = db
+        self._namespace_db = db
+        if mapping_read_preference:
+            self._mapping_db = db.with_options(read_preference=mapping_read_preference)
+        if namespace_read_preference:
+            self._namespace_db = db.with_options(read_preference=namespace_read_preference)
+        # sessions are only needed for read your writes consistency if lookups may be served by
+        # secondaries
+        self._causal = not isinstance(self._mapping_db.read_preference, Primary)
         self._ensure_indexes()
-        self._check_schema()  # MUST happen after ensuring indexes
+        self._schemaver = self._check_schema()  # MUST happen after ensuring indexes
+        self._ensure_reverse_index(self._schemaver)
+        if sharded:
+            self._ensure_reverse_collection_index()
+            self._shard_collections()
+        self._reverse_collection = self._check_reverse_collection()
 
     def _ensure_indexes(self):
         try:
@@ -136,16 +301,131 @@ class IDMappingMongoStorage(_IDMappingStorage):
         except PyMongoError as e:
             raise StorageInitException("Failed to create index: " + str(e)) from e
 
+    def _ensure_reverse_index(self, schemaver):
+        try:
+            self._db[_COL_MAPPINGS].create_index(_REVERSE_INDEXES[schemaver])
+        except PyMongoError as e:
+            raise StorageInitException("Failed to create index: " + str(e)) from e
+
+    @contextmanager
+    def _write_session(self) -> Generator[Optional[ClientSession], None, None]:
+        # a session for a mapping write that records the consistency token for the write
+        if not self._causal:
+            yield None
+            return
+        with self._db.client.start_session(causal_consistency=True) as s:
+            yield s
+            if s.operation_time:  # None for standalone servers
+                consistency.set_write_token(self._to_consistency_token(s))
+
+    @contextmanager
+    def _read_session(self) -> Generator[Optional[ClientSession], None, None]:
+        # a session for a mapping lookup that reads at least the data as of the request's
+        # consistency token
+        token = consistency.get_read_token() if self._causal else None
+        if not token:
+            yield None
+            return
+        optime = self._from_consistency_token(token)
+        with self._db.client.start_session(causal_consistency=True) as s:
+            # The token is supplied by the client and is not authenticated, so only the
+            # operation time is used. The cluster time gossiped to the database is always one
+            # the server received from the database itself.
+            s.advance_operation_time(optime)
+            try:
+                yield s
+            except OperationFailure as e:
+                if e.code == _ERR_INVALID_OPTIONS:
+                    # e.g. the operation time is later than the database's cluster time
+                    raise IllegalParameterError(
+                        "Consistency token rejected by the database") from e
+                raise
+
+    @staticmethod
+    def _to_consistency_token(session: ClientSession) -> str:
+        doc = {"op": session.operation_time}
+        return base64.urlsafe_b64encode(bson.encode(doc)).decode()
+
+    @staticmethod
+    def _from_consistency_token(token: str) -> Timestamp:
+        try:
+            doc = bson.decode(base64.urlsafe_b64decode(token.encode()))
+        except (BSONError, binascii.Error, ValueError) as e:
+            raise IllegalParameterError("Invalid consistency token") from e
+        optime = doc.get("op")
+        # tokens are only issued for writes that have happened, so reject times in the future,
+        # allowing for clock skew between the database and the server
+        if not isinstance(optime, Timestamp) or optime.time > time.time() + _MAX_CLOCK_SKEW_SEC:
+            raise IllegalParameterError("Invalid consistency token")
+        return optime
+
+    def _ensure_reverse_collection_index(self):
+        try:
+            self._db[_COL_REVERSE_MAPPINGS].create_index(_REVERSE_MAPPING_INDEX, unique=True)
+        except PyMongoError as e:
+            raise StorageInitException("Failed to create index: " + str(e)) from e
+
+    def _shard_collections(self):
+        client = self._db.client
+        try:
+            if client.admin.command("ismaster").get("msg") != "isdbgrid":
+                raise StorageInitException(
+                    "Sharding is enabled but the database is not a sharded cluster")
+            for col, key in _SHARD_KEYS.items():
+                fullname = self._db.name + "." + col
+                coldoc = client["config"]["collections"].find_one({"_id": fullname})
+                if coldoc and not coldoc.get("dropped"):
+                    if list(coldoc["key"].items()) != key:
+                        raise StorageInitException(
+                            "Collection {} is sharded on {} but the shard key must be {}"
+                            .format(fullname, dict(coldoc["key"]), dict(key)))
+                else:
+                    # a no-op for MongoDB 6 and later, where sharding is always enabled
+                    client.admin.command("enableSharding", self._db.name)
+                    client.admin.command("shardCollection", fullname, key=SON(key))
+        except PyMongoError as e:
+            raise StorageInitException("Failed to shard collections: " + str(e)) from e
+
+    def _check_reverse_collection(self) -> bool:
+        # returns whether 'backwards' queries use the reverse mapping collection.
+        col = self._db[_COL_CONFIG]
+        try:
+            cfgdoc = col.find_one({_FLD_SCHEMA_KEY: _SCHEMA_VALUE}) or {}
+            if cfgdoc.get(_FLD_REVERSE_COLLECTION):
+                if not self._sharded:
+                    # otherwise this server's writes would be missing from the reverse
+                    # mapping collection
+                    raise StorageInitException(
+                        "The database uses a reverse mapping collection for a sharded "
+                        + "cluster, but sharding is not enabled"
+                    )
+                return True
+            if not self._sharded:
+                return False
+            if self._db[_COL_MAPPINGS].find_one({}, {"_id": 1}) is None:
+                # nothing to copy, so the reverse mapping collection is complete
+                col.update_one(
+                    {_FLD_SCHEMA_KEY: _SCHEMA_VALUE}, {"$set": {_FLD_REVERSE_COLLECTION: True}}
+                )
+                return True
+            return False
+        except PyMongoError as e:
+            raise StorageInitException(
+                "Connection to database failed: " + str(e)
+            ) from e
+
     def _check_schema(self):
         col = self._db[_COL_CONFIG]
+        schemaver = _SCHEMA_VERSION if self._covered_index else 1
         try:
             col.insert_one(
                 {
                     _FLD_SCHEMA_KEY: _SCHEMA_VALUE,
                     _FLD_SCHEMA_UPDATE: False,
-                    _FLD_SCHEMA_VERSION: _SCHEMA_VERSION,
+                    _FLD_SCHEMA_VERSION: schemaver,
                 }
             )
+            return schemaver
         except DuplicateKeyError:
             # ok, the schema version document is already there, this isn't the first time this
             # database as been used. Now check the document is ok.
@@ -156,24 +436,96 @@ class IDMappingMongoStorage(_IDMappingStorage):
                     + "This should not happen, something is very wrong."
                 )
             cfgdoc = col.find_one({_FLD_SCHEMA_KEY: _SCHEMA_VALUE})
-            if cfgdoc[_FLD_SCHEMA_VERSION] != _SCHEMA_VERSION:
+            if cfgdoc[_FLD_SCHEMA_VERSION] not in _COMPATIBLE_SCHEMA_VERSIONS:
                 raise StorageInitException(
                     "Incompatible database schema. Server is v{}, DB is v{}".format(
                         _SCHEMA_VERSION, cfgdoc[_FLD_SCHEMA_VERSION]
                     )
                 )
-            if cfgdoc[_FLD_SCHEMA_UPDATE]:
+            if (cfgdoc[_FLD_SCHEMA_UPDATE] and
+                    cfgdoc[_FLD_SCHEMA_VERSION] not in _ONLINE_UPDATE_SCHEMA_VERSIONS):
                 raise StorageInitException(
                     "The database is in the middle of an update from "
                     + "v{} of the schema. Aborting startup.".format(
                         cfgdoc[_FLD_SCHEMA_VERSION]
                     )
                 )
+            return cfgdoc[_FLD_SCHEMA_VERSION]
         except PyMongoError as e:
             raise StorageInitException(
                 "Connection to database failed: " + str(e)
             ) from e
 
+    def update_schema(self) -> bool:
+        updated = self._update_covered_index() if self._covered_index else False
+        if self._sharded:
+            updated = self._build_reverse_collection() or updated
+        return updated
+
+    def _build_reverse_collection(self) -> bool:
+        col = self._db[_COL_CONFIG]
+        try:
+            cfgdoc = col.find_one({_FLD_SCHEMA_KEY: _SCHEMA_VALUE}) or {}
+            if cfgdoc.get(_FLD_REVERSE_COLLECTION):
+                return False
+            # Servers with sharding enabled write to the reverse mapping collection while it's
+            # being built, so existing documents are kept. The copy runs on the server and
+            # is idempotent, so a failed build can be rerun.
+            self._db[_COL_MAPPINGS].aggregate([
+                {"$project": {
+                    "_id": 0,
+                    _FLD_PRIMARY_NS: 1,
+                    _FLD_PRIMARY_ID: 1,
+                    _FLD_SECONDARY_NS: 1,
+                    _FLD_SECONDARY_ID: 1,
+                }},
+                {"$merge": {
+                    "into": _COL_REVERSE_MAPPINGS,
+                    "on": [f for f, _ in _REVERSE_MAPPING_INDEX],
+                    "whenMatched": "keepExisting",
+                    "whenNotMatched": "insert",
+                }},
+            ])
+            col.update_one(
+                {_FLD_SCHEMA_KEY: _SCHEMA_VALUE}, {"$set": {_FLD_REVERSE_COLLECTION: True}}
+            )
+            return True
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
+
+    def _update_covered_index(self) -> bool:
+        col = self._db[_COL_CONFIG]
+        try:
+            # Claim the update. If a previous update failed part way through the flag is already
+            # set and the update is resumed - all of the steps are idempotent.
+            res = col.update_one(
+                {_FLD_SCHEMA_KEY: _SCHEMA_VALUE, _FLD_SCHEMA_VERSION: 1},
+                {"$set": {_FLD_SCHEMA_UPDATE: True}},
+            )
+            if res.matched_count == 1:
+                # Index builds only hold an exclusive lock at the start and end of the build
+                # (MongoDB 4.2+), so reads and writes continue while the index is built.
+                self._db[_COL_MAPPINGS].create_index(_REVERSE_INDEXES[2])
+                col.update_one(
+                    {_FLD_SCHEMA_KEY: _SCHEMA_VALUE},
+                    {"$set": {_FLD_SCHEMA_VERSION: 2, _FLD_SCHEMA_UPDATE: False}},
+                )
+            # the new index is a superset of the old index, so the old index can be dropped
+            # once the new index is in place. Done even if the schema was already updated in
+            # case a previous update failed before dropping the index.
+            mapcol = self._db[_COL_MAPPINGS]
+            for name, info in mapcol.index_information().items():
+                if list(info["key"]) == _REVERSE_INDEXES[1]:
+                    mapcol.drop_index(name)
+            return res.matched_count == 1
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
+
+    @timed_storage_operation
     def create_local_user(self, username: Username, token: HashedToken) -> None:
         not_none(username, "username")
         not_none(token, "token")
@@ -185,6 +537,7 @@ class IDMappingMongoStorage(_IDMappingStorage):
                     _FLD_ADMIN: False,
                 }
             )
+            self._increment_version(_FLD_USERS_VERSION)
         except DuplicateKeyError as e:
             coll, index = self._get_duplicate_location(e)
             if coll == _COL_USERS:
@@ -201,6 +554,7 @@ class IDMappingMongoStorage(_IDMappingStorage):
                 "Connection to database failed: " + str(e)
             ) from e
 
+    @timed_storage_operation
     def set_local_user_as_admin(self, username: Username, admin: bool) -> None:
         not_none(username, "username")
         admin = True if admin else False  # more readable than admin and True
@@ -212,6 +566,8 @@ class IDMappingMongoStorage(_IDMappingStorage):
                 res.matched_count != 1
             ):  # don't care if user was updated or not, just found
                 raise NoSuchUserError(username.name)
+            if res.modified_count:
+                self._increment_version(_FLD_USERS_VERSION)
         except PyMongoError as e:
             raise IDMappingStorageError(
                 "Connection to database failed: " + str(e)
@@ -246,6 +602,7 @@ class IDMappingMongoStorage(_IDMappingStorage):
                 "unable to parse duplicate key error: " + e.args[0].split("dup key")[0]
             )
 
+    @timed_storage_operation
     def update_local_user_token(self, username: Username, token: HashedToken) -> None:
         not_none(username, "username")
         not_none(token, "token")
@@ -257,6 +614,7 @@ class IDMappingMongoStorage(_IDMappingStorage):
                 res.matched_count != 1
             ):  # don't care if user was updated or not, just found
                 raise NoSuchUserError(username.name)
+            self._increment_version(_FLD_USERS_VERSION)
         except DuplicateKeyError:
             # since only the token can cause a duplicate key error here, we assume something
             # crazy isn't going and just raise that exception
@@ -266,6 +624,7 @@ class IDMappingMongoStorage(_IDMappingStorage):
                 "Connection to database failed: " + str(e)
             ) from e
 
+    @timed_storage_operation
     def get_user(self, token: HashedToken) -> Tuple[Username, bool]:
         not_none(token, "token")
         try:
@@ -281,15 +640,38 @@ class IDMappingMongoStorage(_IDMappingStorage):
             raise InvalidTokenError()
         return (Username(userdoc[_FLD_USER]), userdoc[_FLD_ADMIN])
 
+    @timed_storage_operation
     def get_users(self) -> Dict[Username, bool]:
         try:
             userdocs = self._db[_COL_USERS].find({}, {_FLD_TOKEN: 0})
-            return {Username(u[_FLD_USER]): u[_FLD_ADMIN] for u in userdocs}
+            users = {Username(u[_FLD_USER]): u[_FLD_ADMIN] for u in userdocs}
         except PyMongoError as e:
             raise IDMappingStorageError(
                 "Connection to database failed: " + str(e)
             ) from e
+        STORAGE_DOCUMENTS.labels("get_users").observe(len(users))
+        return users
 
+    @timed_storage_operation
+    def get_users_by_token(self) -> Dict[HashedToken, Tuple[Username, bool]]:
+        try:
+            userdocs = self._db[_COL_USERS].find({})
+            users = {
+                HashedToken(u[_FLD_TOKEN]): (Username(u[_FLD_USER]), u[_FLD_ADMIN])
+                for u in userdocs
+            }
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
+        STORAGE_DOCUMENTS.labels("get_users_by_token").observe(len(users))
+        return users
+
+    @timed_storage_operation
+    def get_users_version(self) -> int:
+        return self._get_version(_FLD_USERS_VERSION)
+
+    @timed_storage_operation
     def user_exists(self, username: Username) -> bool:
         not_none(username, "username")
         try:
@@ -299,12 +681,14 @@ class IDMappingMongoStorage(_IDMappingStorage):
                 "Connection to database failed: " + str(e)
             ) from e
 
+    @timed_storage_operation
     def create_namespace(self, namespace_id: NamespaceID) -> None:
         not_none(namespace_id, "namespace_id")
         try:
             self._db[_COL_NAMESPACES].insert_one(
                 {_FLD_NS_ID: namespace_id.id, _FLD_PUB_MAP: False, _FLD_USERS: []}
             )
+            self._increment_namespace_version()
         except DuplicateKeyError:
             raise NamespaceExistsError(namespace_id.id)
         except PyMongoError as e:
@@ -312,6 +696,32 @@ class IDMappingMongoStorage(_IDMappingStorage):
                 "Connection to database failed: " + str(e)
             ) from e
 
+    def _increment_namespace_version(self):
+        self._increment_version(_FLD_NS_VERSION)
+
+    def _increment_version(self, field):
+        # the config document is guaranteed to exist after startup
+        self._db[_COL_CONFIG].update_one(
+            {_FLD_SCHEMA_KEY: _SCHEMA_VALUE}, {"$inc": {field: 1}}
+        )
+
+    def _get_version(self, field):
+        try:
+            cfgdoc = self._db[_COL_CONFIG].find_one(
+                {_FLD_SCHEMA_KEY: _SCHEMA_VALUE}, {field: 1}
+            )
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
+        # the config document is guaranteed to exist after startup
+        return cfgdoc.get(field, 0)
+
+    @timed_storage_operation
+    def get_namespace_version(self) -> int:
+        return self._get_version(_FLD_NS_VERSION)
+
+    @timed_storage_operation
     def get_namespace(self, namespace_id: NamespaceID) -> Namespace:
         not_none(namespace_id, "namespace_id")
         try:
@@ -331,16 +741,42 @@ class IDMappingMongoStorage(_IDMappingStorage):
             for u in userdocs
         }
 
+    @timed_storage_operation
     def add_user_to_namespace(
         self, namespace_id: NamespaceID, admin_user: User
     ) -> None:
         self._modify_namespace_users(True, namespace_id, admin_user)
 
+    @timed_storage_operation
     def remove_user_from_namespace(
         self, namespace_id: NamespaceID, admin_user: User
     ) -> None:
         self._modify_namespace_users(False, namespace_id, admin_user)
 
+    @timed_storage_operation
+    def add_users_to_namespace(
+        self, namespace_id: NamespaceID, admin_users: Set[User]
+    ) -> None:
+        not_none(namespace_id, "namespace_id")
+        no_Nones_in_iterable(admin_users, "admin_users")
+        users = [
+            {_FLD_AUTHSOURCE: u.authsource_id.id, _FLD_NAME: u.username.name}
+            for u in admin_users
+        ]
+        try:
+            res = self._db[_COL_NAMESPACES].update_one(
+                {_FLD_NS_ID: namespace_id.id},
+                {"$addToSet": {_FLD_USERS: {"$each": users}}},
+            )
+            if res.matched_count != 1:
+                raise NoSuchNamespaceError(namespace_id.id)
+            if res.modified_count:
+                self._increment_namespace_version()
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
+
     def _modify_namespace_users(self, add: bool, namespace_id, admin_user):
         """
         :param add: True to add the user to the namespace, False to remove.
@@ -375,11 +811,13 @@ class IDMappingMongoStorage(_IDMappingStorage):
                         namespace_id.id,
                     )
                 )
+            self._increment_namespace_version()
         except PyMongoError as e:
             raise IDMappingStorageError(
                 "Connection to database failed: " + str(e)
             ) from e
 
+    @timed_storage_operation
     def set_namespace_publicly_mappable(
         self, namespace_id: NamespaceID, publicly_mappable: bool
     ) -> None:
@@ -391,12 +829,17 @@ class IDMappingMongoStorage(_IDMappingStorage):
             )
             if res.matched_count != 1:  # don't care if modified or not
                 raise NoSuchNamespaceError(namespace_id.id)
+            if res.modified_count == 1:
+                self._increment_namespace_version()
         except PyMongoError as e:
             raise IDMappingStorageError(
                 "Connection to database failed: " + str(e)
             ) from e
 
-    def get_namespaces(self, nids: Optional[Iterable[NamespaceID]] = None) -> Set[Namespace]:
+    @timed_storage_operation
+    def get_namespaces(
+        self, nids: Optional[Iterable[NamespaceID]] = None, include_users: bool = True
+    ) -> Set[Namespace]:
         query = {}
         nidstr: List[str] = []
         if nids:
@@ -404,33 +847,43 @@ class IDMappingMongoStorage(_IDMappingStorage):
             nidstr = [nid.id for nid in nids]
             query[_FLD_NS_ID] = {"$in": nidstr}
         try:
-            nsdocs = self._db[_COL_NAMESPACES].find(query)
+            if include_users:
+                nsdocs = self._db[_COL_NAMESPACES].find(query)
+            else:
+                nsdocs = self._namespace_db[_COL_NAMESPACES].find(query, {_FLD_USERS: 0})
             nsobjs = {self._to_ns(nsdoc) for nsdoc in nsdocs}
-            if nidstr and len(nsobjs) != len(nidstr):
-                missing = set(nidstr) - {ns.namespace_id.id for ns in nsobjs}
-                raise NoSuchNamespaceError(str(sorted(missing)))
-            return nsobjs
         except PyMongoError as e:
             raise IDMappingStorageError(
                 "Connection to database failed: " + str(e)
             ) from e
+        STORAGE_DOCUMENTS.labels("get_namespaces").observe(len(nsobjs))
+        if nidstr and len(nsobjs) != len(set(nidstr)):
+            missing = set(nidstr) - {ns.namespace_id.id for ns in nsobjs}
+            raise NoSuchNamespaceError(str(sorted(missing)))
+        return nsobjs
 
     def _to_ns(self, nsdoc):
         return Namespace(
             NamespaceID(nsdoc[_FLD_NS_ID]),
             nsdoc[_FLD_PUB_MAP],
-            self._to_user_set(nsdoc[_FLD_USERS]),
+            self._to_user_set(nsdoc.get(_FLD_USERS, [])),
         )
 
+    @timed_storage_operation
     def add_mapping(self, primary_OID: ObjectID, secondary_OID: ObjectID) -> None:
         not_none(primary_OID, "primary_OID")
         not_none(secondary_OID, "secondary_OID")
+        doc = self.to_mapping_mongo_doc(primary_OID, secondary_OID)
         try:
-            self._db[_COL_MAPPINGS].insert_one(
-                self.to_mapping_mongo_doc(primary_OID, secondary_OID)
-            )
-        except DuplicateKeyError:
-            pass  # don't care, record is already there
+            with self._write_session() as s:
+                self._check_mapping_writes_allowed(s)
+                try:
+                    self._db[_COL_MAPPINGS].insert_one(dict(doc), session=s)
+                except DuplicateKeyError:
+                    pass  # don't care, record is already there
+                else:
+                    self._update_mapping_counts(self._count_pairs([doc]), s)
+                self._add_reverse_mappings([doc], s)
         except PyMongoError as e:
             raise IDMappingStorageError(
                 "Connection to database failed: " + str(e)
@@ -444,19 +897,160 @@ class IDMappingMongoStorage(_IDMappingStorage):
             _FLD_SECONDARY_ID: secondary_OID.id,
         }
 
+    @timed_storage_operation
     def remove_mapping(self, primary_OID: ObjectID, secondary_OID: ObjectID) -> bool:
         not_none(primary_OID, "primary_OID")
         not_none(secondary_OID, "secondary_OID")
+        doc = self.to_mapping_mongo_doc(primary_OID, secondary_OID)
         try:
-            res = self._db[_COL_MAPPINGS].delete_one(
-                self.to_mapping_mongo_doc(primary_OID, secondary_OID)
-            )
+            with self._write_session() as s:
+                self._check_mapping_writes_allowed(s)
+                res = self._db[_COL_MAPPINGS].delete_one(doc, session=s)
+                if res.deleted_count:
+                    self._update_mapping_counts(self._count_pairs([doc], -1), s)
+                self._remove_reverse_mappings([doc], s)
             return res.deleted_count == 1
         except PyMongoError as e:
             raise IDMappingStorageError(
                 "Connection to database failed: " + str(e)
             ) from e
 
+    def _to_mapping_docs(self, mappings: Iterable[Tuple[ObjectID, ObjectID]]):
+        not_none(mappings, "mappings")
+        docs = []
+        for m in mappings:
+            not_none(m, "mapping")
+            primary_OID, secondary_OID = m
+            not_none(primary_OID, "primary_OID")
+            not_none(secondary_OID, "secondary_OID")
+            docs.append(self.to_mapping_mongo_doc(primary_OID, secondary_OID))
+        return docs
+
+    @timed_storage_operation
+    def add_mappings(self, mappings: Iterable[Tuple[ObjectID, ObjectID]]) -> Tuple[int, int]:
+        docs = self._to_mapping_docs(mappings)
+        if not docs:
+            return 0, 0
+        try:
+            with self._write_session() as s:
+                self._check_mapping_writes_allowed(s)
+                try:
+                    # unordered so that a duplicate doesn't stop the rest of the batch. The
+                    # driver splits the operations into batches of the server's max write batch
+                    # size.
+                    res = self._db[_COL_MAPPINGS].bulk_write(
+                        [InsertOne(dict(d)) for d in docs], ordered=False, session=s
+                    )
+                    ret = res.inserted_count, 0
+                    inserted = docs
+                except BulkWriteError as e:
+                    ret = self._handle_duplicate_mappings(e)
+                    # the error indexes are relative to the full list of operations
+                    dupes = {err["index"] for err in e.details["writeErrors"]}
+                    inserted = [d for i, d in enumerate(docs) if i not in dupes]
+                self._update_mapping_counts(self._count_pairs(inserted), s)
+                self._add_reverse_mappings(docs, s)
+            return ret
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
+
+    def _handle_duplicate_mappings(self, e: BulkWriteError) -> Tuple[int, int]:
+        # duplicate keys just mean the mapping is already there, anything else is a problem
+        errs = e.details.get("writeErrors", [])
+        for err in errs:
+            if err.get("code") != _DUPLICATE_KEY_CODE:
+                raise IDMappingStorageError(
+                    "Bulk mapping write failed: " + err.get("errmsg", "unknown error")
+                ) from e
+        if e.details.get("writeConcernErrors"):
+            raise IDMappingStorageError(
+                "Bulk mapping write failed: "
+                + e.details["writeConcernErrors"][0].get("errmsg", "unknown error")
+            ) from e
+        return e.details["nInserted"], len(errs)
+
+    # The mapping counts are updated after the mapping collection is written. If the update
+    # fails, or the server stops before the update, the counts drift from the mappings and
+    # must be repaired with rebuild_mapping_counts(), which refuses mapping writes while it runs
+    # so that no updates are lost.
+
+    def _check_mapping_writes_allowed(self, session):
+        # the config document is guaranteed to exist after startup
+        cfgdoc = self._db[_COL_CONFIG].find_one(
+            {_FLD_SCHEMA_KEY: _SCHEMA_VALUE}, {_FLD_COUNT_REBUILD: 1}, session=session
+        )
+        if cfgdoc.get(_FLD_COUNT_REBUILD):
+            raise IDMappingStorageError(
+                "Mapping writes are disabled while the mapping counts are rebuilt. If no "
+                + "rebuild is running, a rebuild was interrupted and must be run again")
+
+    @staticmethod
+    def _count_pairs(docs: List[Dict[str, str]], sign: int = 1) -> Dict[Tuple[str, str], int]:
+        counts = Counter((d[_FLD_PRIMARY_NS], d[_FLD_SECONDARY_NS]) for d in docs)
+        return {pair: sign * count for pair, count in counts.items()}
+
+    def _update_mapping_counts(self, counts: Dict[Tuple[str, str], int], session):
+        ops = [
+            UpdateOne(
+                {_FLD_PRIMARY_NS: pnsid, _FLD_SECONDARY_NS: snsid},
+                {"$inc": {_FLD_COUNT: count}},
+                upsert=True,
+            )
+            for (pnsid, snsid), count in counts.items() if count
+        ]
+        if ops:
+            self._db[_COL_MAPPING_COUNTS].bulk_write(ops, ordered=False, session=session)
+
+    # The reverse mapping collection is written after the mapping collection. If the write
+    # fails, retrying the addition or removal repairs the reverse mapping collection.
+
+    def _add_reverse_mappings(self, docs: List[Dict[str, str]], session):
+        if not self._sharded:
+            return
+        try:
+            self._db[_COL_REVERSE_MAPPINGS].bulk_write(
+                [InsertOne(dict(d)) for d in docs], ordered=False, session=session
+            )
+        except BulkWriteError as e:
+            self._handle_duplicate_mappings(e)
+
+    def _remove_reverse_mappings(self, docs: List[Dict[str, str]], session):
+        if self._sharded:
+            self._db[_COL_REVERSE_MAPPINGS].bulk_write(
+                [DeleteOne(d) for d in docs], ordered=False, session=session
+            )
+
+    @timed_storage_operation
+    def remove_mappings(self, mappings: Iterable[Tuple[ObjectID, ObjectID]]) -> int:
+        docs = self._to_mapping_docs(mappings)
+        if not docs:
+            return 0
+        # The bulk write result only has the total number of mappings removed, so write each
+        # pair of namespaces separately to know how much to decrement its count. Removals are
+        # almost always between a single pair of namespaces.
+        bypair: Dict[Tuple[str, str], List[Dict[str, str]]] = {}
+        for d in docs:
+            bypair.setdefault((d[_FLD_PRIMARY_NS], d[_FLD_SECONDARY_NS]), []).append(d)
+        try:
+            with self._write_session() as s:
+                self._check_mapping_writes_allowed(s)
+                removed: Dict[Tuple[str, str], int] = {}
+                for pair, pairdocs in bypair.items():
+                    res = self._db[_COL_MAPPINGS].bulk_write(
+                        [DeleteOne(d) for d in pairdocs], ordered=False, session=s
+                    )
+                    removed[pair] = -res.deleted_count
+                self._update_mapping_counts(removed, s)
+                self._remove_reverse_mappings(docs, s)
+            return -sum(removed.values())
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
+
+    @timed_storage_operation
     def find_mappings(
         self, oid: ObjectID, ns_filter: Optional[Iterable[NamespaceID]] = None
     ) -> Tuple[Set[ObjectID], Set[ObjectID]]:
@@ -476,23 +1070,340 @@ class IDMappingMongoStorage(_IDMappingStorage):
             primary_query[_FLD_SECONDARY_NS] = {"$in": fil}
             secondary_query[_FLD_PRIMARY_NS] = {"$in": fil}
         try:
-            mappings = self._db[_COL_MAPPINGS].find(
-                primary_query, {_FLD_PRIMARY_NS: 0, _FLD_PRIMARY_ID: 0}
-            )
-            primary = {
-                ObjectID(NamespaceID(m[_FLD_SECONDARY_NS]), m[_FLD_SECONDARY_ID])
-                for m in mappings
-            }
-            mappings = self._db[_COL_MAPPINGS].find(
-                secondary_query, {_FLD_SECONDARY_NS: 0, _FLD_SECONDARY_ID: 0}
-            )
-            secondary = {
-                ObjectID(NamespaceID(m[_FLD_PRIMARY_NS]), m[_FLD_PRIMARY_ID])
-                for m in mappings
-            }
-            return primary, secondary
-            # nothing to check here. As long as the op doesn't fail we're good
+            with self._read_session() as s:
+                # the projections only include indexed fields so the queries are covered
+                mappings = self._find_mappings(
+                    primary_query,
+                    {"_id": 0, _FLD_SECONDARY_NS: 1, _FLD_SECONDARY_ID: 1},
+                    bool(ns_filter),
+                    True,
+                    s,
+                )
+                primary = {
+                    ObjectID(NamespaceID(m[_FLD_SECONDARY_NS]), m[_FLD_SECONDARY_ID])
+                    for m in mappings
+                }
+                mappings = self._find_mappings(
+                    secondary_query,
+                    {"_id": 0, _FLD_PRIMARY_NS: 1, _FLD_PRIMARY_ID: 1},
+                    bool(ns_filter),
+                    False,
+                    s,
+                )
+                secondary = {
+                    ObjectID(NamespaceID(m[_FLD_PRIMARY_NS]), m[_FLD_PRIMARY_ID])
+                    for m in mappings
+                }
+                # nothing to check here. As long as the op doesn't fail we're good
         except PyMongoError as e:
             raise IDMappingStorageError(
                 "Connection to database failed: " + str(e)
             ) from e
+        STORAGE_DOCUMENTS.labels("find_mappings").observe(len(primary) + len(secondary))
+        return primary, secondary
+
+    @timed_storage_operation
+    def find_mappings_bulk(
+        self,
+        namespace_id: NamespaceID,
+        ids: Iterable[str],
+        ns_filter: Optional[Iterable[NamespaceID]] = None,
+    ) -> Dict[str, Tuple[Set[ObjectID], Set[ObjectID]]]:
+        not_none(namespace_id, "namespace_id")
+        no_Nones_in_iterable(ids, "ids")
+        ret: Dict[str, Tuple[Set[ObjectID], Set[ObjectID]]] = {
+            id_: (set(), set()) for id_ in ids
+        }
+        if not ret:
+            return ret
+        idlist = list(ret)
+        # one $in query per direction, each of which is served by a compound index
+        primary_query: Dict[str, Any] = {
+            _FLD_PRIMARY_NS: namespace_id.id,
+            _FLD_PRIMARY_ID: {"$in": idlist},
+        }
+        secondary_query: Dict[str, Any] = {
+            _FLD_SECONDARY_NS: namespace_id.id,
+            _FLD_SECONDARY_ID: {"$in": idlist},
+        }
+        if ns_filter:
+            no_Nones_in_iterable(ns_filter, "ns_filter")
+            fil = [ns.id for ns in ns_filter]
+            primary_query[_FLD_SECONDARY_NS] = {"$in": fil}
+            secondary_query[_FLD_PRIMARY_NS] = {"$in": fil}
+        try:
+            with self._read_session() as s:
+                mappings = self._find_mappings(
+                    primary_query,
+                    {"_id": 0, _FLD_PRIMARY_ID: 1, _FLD_SECONDARY_NS: 1, _FLD_SECONDARY_ID: 1},
+                    bool(ns_filter),
+                    True,
+                    s,
+                )
+                docs = 0
+                for m in mappings:
+                    docs += 1
+                    ret[m[_FLD_PRIMARY_ID]][0].add(
+                        ObjectID(NamespaceID(m[_FLD_SECONDARY_NS]), m[_FLD_SECONDARY_ID])
+                    )
+                mappings = self._find_mappings(
+                    secondary_query,
+                    {"_id": 0, _FLD_SECONDARY_ID: 1, _FLD_PRIMARY_NS: 1, _FLD_PRIMARY_ID: 1},
+                    bool(ns_filter),
+                    False,
+                    s,
+                )
+                for m in mappings:
+                    docs += 1
+                    ret[m[_FLD_SECONDARY_ID]][1].add(
+                        ObjectID(NamespaceID(m[_FLD_PRIMARY_NS]), m[_FLD_PRIMARY_ID])
+                    )
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
+        STORAGE_DOCUMENTS.labels("find_mappings_bulk").observe(docs)
+        return ret
+
+    @timed_storage_operation
+    def find_mappings_range(
+        self,
+        namespace_id: NamespaceID,
+        start: str,
+        end: Optional[str] = None,
+        ns_filter: Optional[Iterable[NamespaceID]] = None,
+        limit: int = 1000,
+        after: Optional[str] = None,
+    ) -> Tuple[Dict[str, Tuple[Set[ObjectID], Set[ObjectID]]], bool]:
+        not_none(namespace_id, "namespace_id")
+        not_none(start, "start")
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        # Range operators on the ID, never a regex, so the bounds on the ID in the index are
+        # always anchored at both ends.
+        if after is not None and after >= start:
+            idrange = {"$gt": after}
+        else:
+            idrange = {"$gte": start}
+        if end is not None:
+            idrange["$lt"] = end
+        primary_query: Dict[str, Any] = {
+            _FLD_PRIMARY_NS: namespace_id.id,
+            _FLD_PRIMARY_ID: idrange,
+        }
+        secondary_query: Dict[str, Any] = {
+            _FLD_SECONDARY_NS: namespace_id.id,
+            _FLD_SECONDARY_ID: idrange,
+        }
+        if ns_filter:
+            no_Nones_in_iterable(ns_filter, "ns_filter")
+            fil = [ns.id for ns in ns_filter]
+            primary_query[_FLD_SECONDARY_NS] = {"$in": fil}
+            secondary_query[_FLD_PRIMARY_NS] = {"$in": fil}
+        try:
+            with self._read_session() as s:
+                primary, pmore = self._find_mappings_range(primary_query, True, limit, s)
+                secondary, smore = self._find_mappings_range(secondary_query, False, limit, s)
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
+        # Each direction returned its first ids in the range, so the first ids of the union
+        # have all their mappings. Python's string ordering matches Mongo's binary string
+        # ordering.
+        ids = sorted(primary.keys() | secondary.keys())
+        ret = {id_: (primary.get(id_, set()), secondary.get(id_, set())) for id_ in ids[:limit]}
+        STORAGE_DOCUMENTS.labels("find_mappings_range").observe(
+            sum(len(p) + len(s) for p, s in ret.values()))
+        return ret, pmore or smore or len(ids) > limit
+
+    def _find_mappings_range(
+        self,
+        query: Dict[str, Any],
+        forwards: bool,
+        limit: int,
+        session: Optional[ClientSession],
+    ) -> Tuple[Dict[str, Set[ObjectID]], bool]:
+        # returns the mappings for the first limit IDs in the range and whether there are more
+        if forwards:
+            idfld, nsfld, oidfld = _FLD_PRIMARY_ID, _FLD_SECONDARY_NS, _FLD_SECONDARY_ID
+            sort = [(_FLD_PRIMARY_NS, 1), (_FLD_PRIMARY_ID, 1)]
+        else:
+            idfld, nsfld, oidfld = _FLD_SECONDARY_ID, _FLD_PRIMARY_NS, _FLD_PRIMARY_ID
+            sort = [(_FLD_SECONDARY_NS, 1), (_FLD_SECONDARY_ID, 1)]
+        # The sort is the prefix of the index, so the index is walked in order from the start
+        # of the range without a blocking sort, and the query stops reading at the first ID
+        # past the limit. The index is hinted as for filtered lookups.
+        cur = self._find_mappings(
+            query, {"_id": 0, idfld: 1, nsfld: 1, oidfld: 1}, True, forwards, session
+        ).sort(sort).batch_size(limit + 1)
+        ret: Dict[str, Set[ObjectID]] = {}
+        try:
+            for m in cur:
+                id_ = m[idfld]
+                if id_ not in ret:
+                    if len(ret) == limit:
+                        return ret, True
+                    ret[id_] = set()
+                ret[id_].add(ObjectID(NamespaceID(m[nsfld]), m[oidfld]))
+        finally:
+            cur.close()
+        return ret, False
+
+    def _find_mappings(self, query, projection, filtered, forwards, session):
+        if not forwards and self._reverse_collection:
+            cur = self._mapping_db[_COL_REVERSE_MAPPINGS].find(
+                query, projection, session=session)
+            if filtered:
+                cur.hint(_REVERSE_MAPPING_INDEX)
+            return cur
+        cur = self._mapping_db[_COL_MAPPINGS].find(query, projection, session=session)
+        # Pin namespace filtered queries to an index with the filtered namespace in the key,
+        # so the filter narrows the index bounds and only the matching mappings are read.
+        # Otherwise the query planner may choose, and cache, the other mapping index with the
+        # filtered namespaces as the leading bounds, which reads every mapping in the filtered
+        # namespaces. The v1 reverse index doesn't include the primary namespace, so filtered
+        # 'backwards' queries on a v1 database read every mapping for the ID. The v2 index is
+        # never dropped, so it's safe to hint.
+        if filtered and forwards:
+            cur.hint(_MAPPING_INDEX)
+        elif filtered and self._schemaver == 2:
+            cur.hint(_REVERSE_INDEXES[2])
+        return cur
+
+    def iter_mappings(
+        self,
+        primary_namespace_id: NamespaceID,
+        secondary_namespace_id: NamespaceID,
+        after: Optional[Tuple[str, str]] = None,
+    ) -> Iterator[Tuple[str, str]]:
+        not_none(primary_namespace_id, "primary_namespace_id")
+        not_none(secondary_namespace_id, "secondary_namespace_id")
+        if after:
+            no_Nones_in_iterable(after, "after")
+        # check the arguments now rather than when the caller starts iterating
+        return self._iter_mappings(
+            primary_namespace_id.id, secondary_namespace_id.id, tuple(after) if after else None
+        )
+
+    def _iter_mappings(self, pnsid, snsid, after):
+        # The sort matches the export index, and the namespaces are fixed, so the query walks
+        # only the mappings between the namespaces in index order without a blocking sort and is
+        # covered by the index.
+        sort = _EXPORT_INDEX
+        while True:
+            query = {_FLD_PRIMARY_NS: pnsid, _FLD_SECONDARY_NS: snsid}
+            if after:
+                query[_FLD_PRIMARY_ID] = {"$gte": after[0]}
+            try:
+                cur = self._mapping_db[_COL_MAPPINGS].find(
+                    query, {"_id": 0, _FLD_PRIMARY_ID: 1, _FLD_SECONDARY_ID: 1}, sort=sort
+                ).hint(_EXPORT_INDEX)
+                for m in cur:
+                    mapping = (m[_FLD_PRIMARY_ID], m[_FLD_SECONDARY_ID])
+                    # skips the mappings for the 'after' primary ID that were already returned.
+                    # Mongo's binary string ordering matches python's string ordering.
+                    if after and mapping <= after:
+                        continue
+                    after = mapping
+                    yield mapping
+                return
+            except CursorNotFound:
+                # the server killed the idle cursor, probably due to a slow consumer. Resume
+                # from the last mapping returned.
+                continue
+            except PyMongoError as e:
+                raise IDMappingStorageError(
+                    "Connection to database failed: " + str(e)
+                ) from e
+
+    @timed_storage_operation
+    def get_mapping_counts(
+        self, namespace_id: NamespaceID
+    ) -> Tuple[Dict[NamespaceID, int], Dict[NamespaceID, int]]:
+        not_none(namespace_id, "namespace_id")
+        col = self._mapping_db[_COL_MAPPING_COUNTS]
+        proj = {"_id": 0, _FLD_PRIMARY_NS: 1, _FLD_SECONDARY_NS: 1, _FLD_COUNT: 1}
+        try:
+            with self._read_session() as s:
+                primary = {
+                    NamespaceID(d[_FLD_SECONDARY_NS]): d[_FLD_COUNT]
+                    for d in col.find(
+                        {_FLD_PRIMARY_NS: namespace_id.id, _FLD_COUNT: {"$gt": 0}}, proj,
+                        session=s)
+                }
+                secondary = {
+                    NamespaceID(d[_FLD_PRIMARY_NS]): d[_FLD_COUNT]
+                    for d in col.find(
+                        {_FLD_SECONDARY_NS: namespace_id.id, _FLD_COUNT: {"$gt": 0}}, proj,
+                        session=s)
+                }
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
+        return primary, secondary
+
+    def rebuild_mapping_counts(self, workers: int = 1) -> int:
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        try:
+            # Writes don't update the mappings and counts atomically, so the counts can only be
+            # rebuilt correctly if there are no writes. Refuse writes, and wait for writes that
+            # passed the check to finish. If the rebuild process dies, writes stay refused
+            # until a rebuild completes.
+            self._set_count_rebuild(True)
+            try:
+                time.sleep(_COUNT_REBUILD_DRAIN_SEC)
+                counts = self._replace_mapping_counts(workers)
+            finally:
+                self._set_count_rebuild(False)
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
+        return len(counts)
+
+    def _replace_mapping_counts(self, workers: int) -> Dict[Tuple[str, str], int]:
+        # distinct walks the unique mapping index rather than the mappings
+        pnsids = self._db[_COL_MAPPINGS].distinct(_FLD_PRIMARY_NS)
+        # each worker counts the mappings for one primary namespace at a time, which is an
+        # index bounded scan of the unique mapping index
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            counts: Dict[Tuple[str, str], int] = {}
+            for c in ex.map(self._count_mappings, pnsids):
+                counts.update(c)
+        col = self._db[_COL_MAPPING_COUNTS]
+        if counts:
+            col.bulk_write(
+                [
+                    UpdateOne(
+                        {_FLD_PRIMARY_NS: pnsid, _FLD_SECONDARY_NS: snsid},
+                        {"$set": {_FLD_COUNT: count}},
+                        upsert=True,
+                    )
+                    for (pnsid, snsid), count in counts.items()
+                ],
+                ordered=False,
+            )
+        stale = [
+            DeleteOne({"_id": d["_id"]})
+            for d in col.find({})
+            if (d[_FLD_PRIMARY_NS], d[_FLD_SECONDARY_NS]) not in counts
+        ]
+        if stale:
+            col.bulk_write(stale, ordered=False)
+        return counts
+
+    def _set_count_rebuild(self, rebuild: bool):
+        # the config document is guaranteed to exist after startup
+        self._db[_COL_CONFIG].update_one(
+            {_FLD_SCHEMA_KEY: _SCHEMA_VALUE}, {"$set": {_FLD_COUNT_REBUILD: rebuild}}
+        )
+
+    def _count_mappings(self, pnsid: str) -> Dict[Tuple[str, str], int]:
+        res = self._db[_COL_MAPPINGS].aggregate([
+            {"$match": {_FLD_PRIMARY_NS: pnsid}},
+            {"$group": {"_id": "$" + _FLD_SECONDARY_NS, _FLD_COUNT: {"$sum": 1}}},
+        ])
+        return {(pnsid, d["_id"]): d[_FLD_COUNT] for d in res}
@@ -0,0 +1,87 @@
+"""
+A cache backed by a MongoDB collection, allowing cached data to be shared between server
+processes and to survive server restarts.
+"""
+
+from jgikbase.idmapping.core.cache import Cache
+from jgikbase.idmapping.core.arg_check import not_none
+from jgikbase.idmapping.storage.errors import IDMappingStorageError
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional
+import time
+
+# the value of the cache entry.
+_FLD_VALUE = "v"
+# the expiration date of the cache entry.
+_FLD_EXPIRES = "exp"
+
+
+class MongoCache(Cache):
+    """
+    A :class:`jgikbase.idmapping.core.cache.Cache` stored in a MongoDB collection. The key is
+    stored as the document ID.
+
+    Expired entries are removed by a MongoDB TTL index. Since the TTL monitor only runs
+    periodically, expired entries are also filtered out when reading.
+
+    Entries are not evicted based on the size of the cache.
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        default_ttl: float = 300,
+        timer: Optional[Callable[[], float]] = None,
+    ) -> None:
+        """
+        Create the cache.
+
+        :param collection: the MongoDB collection in which to store the cache. The collection
+            should not be used for any other purpose.
+        :param default_ttl: the default lifetime of an entry in seconds.
+        :param timer: the timer used for cache expiration. Defaults to time.time.
+        :raises TypeError: if the collection is None.
+        :raises IDMappingStorageError: if an error occurs while creating the TTL index.
+        """
+        not_none(collection, "collection")
+        self._col = collection
+        self._default_ttl = default_ttl
+        self._timer = time.time if not timer else timer
+        try:
+            self._col.create_index(_FLD_EXPIRES, expireAfterSeconds=0)
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
+
+    def _date(self, offset: float = 0) -> datetime:
+        return datetime.fromtimestamp(self._timer() + offset, tz=timezone.utc)
+
+    def get(self, key: str) -> Optional[Any]:
+        not_none(key, "key")
+        try:
+            doc = self._col.find_one(
+                {"_id": key, _FLD_EXPIRES: {"$gt": self._date()}}, {_FLD_VALUE: 1}
+            )
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
+        return doc[_FLD_VALUE] if doc else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        not_none(key, "key")
+        not_none(value, "value")
+        ttl = self._default_ttl if ttl is None else ttl
+        try:
+            self._col.replace_one(
+                {"_id": key},
+                {_FLD_VALUE: value, _FLD_EXPIRES: self._date(ttl)},
+                upsert=True,
+            )
+        except PyMongoError as e:
+            raise IDMappingStorageError(
+                "Connection to database failed: " + str(e)
+            ) from e
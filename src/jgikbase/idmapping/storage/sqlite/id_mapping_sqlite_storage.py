@@ -0,0 +1,732 @@
+"""
+An embedded SQLite based storage system for ID mapping.
+"""
+
+from jgikbase.idmapping.storage.id_mapping_storage import (
+    IDMappingStorage as _IDMappingStorage,
+)
+from jgikbase.idmapping.core.tokens import HashedToken
+from jgikbase.idmapping.core.user import User, AuthsourceID, Username
+from jgikbase.idmapping.core.arg_check import not_none, no_Nones_in_iterable
+from jgikbase.idmapping.core.metrics import timed_storage_operation, STORAGE_DOCUMENTS
+from jgikbase.idmapping.storage.errors import (
+    IDMappingStorageError,
+    StorageInitException,
+)
+from jgikbase.idmapping.core.errors import (
+    NoSuchUserError,
+    UserExistsError,
+    InvalidTokenError,
+    NamespaceExistsError,
+    NoSuchNamespaceError,
+)
+from jgikbase.idmapping.core.object_id import NamespaceID, Namespace, ObjectID
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    Set,
+    Iterable,
+    Tuple,
+    Dict,
+    List,
+    Optional,
+    Iterator,
+    Generator,
+)  # @UnusedImport pydev gets confused here
+import functools
+import json
+import sqlite3
+import threading
+
+# the current version of the database schema.
+# v1: the initial schema.
+_SCHEMA_VERSION = 1
+# the schema versions the code can work with.
+_COMPATIBLE_SCHEMA_VERSIONS = {1}
+# the value of the key for the single row in the config table.
+_SCHEMA_VALUE = "schema"
+
+# upserts require SQLite 3.24.
+_MIN_SQLITE_VERSION = (3, 24, 0)
+
+# the default time to wait, in seconds, for another connection, possibly in another process, to
+# release its lock on the database. SQLite calls block the whole process, including every other
+# greenlet in a gevent worker, so the wait is kept short.
+_LOCK_TIMEOUT_SEC = 1
+# the time to wait for the lock when starting up, before the server handles any requests.
+_INIT_LOCK_TIMEOUT_SEC = 30
+
+# the number of mappings read per query by iter_mappings.
+_ITER_PAGE_SIZE = 10000
+
+# The mapping, namespace user, and count tables are WITHOUT ROWID tables, which are stored in a
+# b-tree ordered by the primary key, so the primary key covers every query on the table. The
+# reverse mapping index includes every column, so 'backwards' mapping queries are also covered.
+# Namespace filters are on the third column of both mapping indexes, so filtered lookups only
+# read the matching mappings.
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS config ("
+    + "schema TEXT PRIMARY KEY, schemaver INTEGER NOT NULL, inupdate INTEGER NOT NULL, "
+    + "nsver INTEGER NOT NULL DEFAULT 0, usersver INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS users ("
+    + "user TEXT PRIMARY KEY, hshtkn TEXT NOT NULL UNIQUE, admin INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS ns (nsid TEXT PRIMARY KEY, pubmap INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS nsusers ("
+    + "nsid TEXT NOT NULL, auth TEXT NOT NULL, name TEXT NOT NULL, "
+    + "PRIMARY KEY (nsid, auth, name)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS map ("
+    + "pnsid TEXT NOT NULL, pid TEXT NOT NULL, snsid TEXT NOT NULL, sid TEXT NOT NULL, "
+    + "PRIMARY KEY (pnsid, pid, snsid, sid)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS map_reverse ON map (snsid, sid, pnsid, pid)",
+    "CREATE TABLE IF NOT EXISTS mapcount ("
+    + "pnsid TEXT NOT NULL, snsid TEXT NOT NULL, count INTEGER NOT NULL, "
+    + "PRIMARY KEY (pnsid, snsid)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS mapcount_reverse ON mapcount (snsid, pnsid, count)",
+]
+
+# All the statements are constants with parameters, so each is prepared once per connection and
+# then reused from the connection's statement cache. Lists of values, such as IDs and namespace
+# filters, are passed as a single JSON array parameter and expanded with json_each() for the
+# same reason.
+
+_SELECT_CONFIG = "SELECT schemaver, inupdate FROM config WHERE schema = ?"
+_INSERT_CONFIG = "INSERT INTO config (schema, schemaver, inupdate) VALUES (?, ?, 0)"
+_SELECT_NS_VERSION = "SELECT nsver FROM config WHERE schema = ?"
+_SELECT_USERS_VERSION = "SELECT usersver FROM config WHERE schema = ?"
+_INC_NS_VERSION = "UPDATE config SET nsver = nsver + 1 WHERE schema = ?"
+_INC_USERS_VERSION = "UPDATE config SET usersver = usersver + 1 WHERE schema = ?"
+
+_INSERT_USER = "INSERT INTO users (user, hshtkn, admin) VALUES (?, ?, 0)"
+_SET_USER_ADMIN = "UPDATE users SET admin = ? WHERE user = ? AND admin != ?"
+_SET_USER_TOKEN = "UPDATE users SET hshtkn = ? WHERE user = ?"
+_SELECT_USER_EXISTS = "SELECT 1 FROM users WHERE user = ?"
+_SELECT_USER_BY_TOKEN = "SELECT user, admin FROM users WHERE hshtkn = ?"
+_SELECT_USERS = "SELECT user, hshtkn, admin FROM users"
+
+_INSERT_NS = "INSERT INTO ns (nsid, pubmap) VALUES (?, 0)"
+_SET_NS_PUBMAP = "UPDATE ns SET pubmap = ? WHERE nsid = ? AND pubmap != ?"
+_SELECT_NS = "SELECT nsid, pubmap FROM ns WHERE nsid = ?"
+_SELECT_NS_LIST = "SELECT nsid, pubmap FROM ns WHERE nsid IN (SELECT value FROM json_each(?))"
+_SELECT_NS_ALL = "SELECT nsid, pubmap FROM ns"
+_INSERT_NS_USER = "INSERT OR IGNORE INTO nsusers (nsid, auth, name) VALUES (?, ?, ?)"
+_DELETE_NS_USER = "DELETE FROM nsusers WHERE nsid = ? AND auth = ? AND name = ?"
+_SELECT_NS_USERS = "SELECT nsid, auth, name FROM nsusers WHERE nsid = ?"
+_SELECT_NS_USERS_LIST = (
+    "SELECT nsid, auth, name FROM nsusers WHERE nsid IN (SELECT value FROM json_each(?))")
+_SELECT_NS_USERS_ALL = "SELECT nsid, auth, name FROM nsusers"
+
+_INSERT_MAPPING = "INSERT OR IGNORE INTO map (pnsid, pid, snsid, sid) VALUES (?, ?, ?, ?)"
+_DELETE_MAPPING = "DELETE FROM map WHERE pnsid = ? AND pid = ? AND snsid = ? AND sid = ?"
+_ITER_MAPPINGS = (
+    "SELECT pid, sid FROM map WHERE pnsid = ? AND snsid = ? ORDER BY pid, sid LIMIT ?")
+_ITER_MAPPINGS_AFTER = (
+    "SELECT pid, sid FROM map WHERE pnsid = ? AND snsid = ? AND (pid, snsid, sid) > (?, ?, ?) "
+    + "ORDER BY pid, sid LIMIT ?")
+# Walks the mapping primary key from one primary namespace to the next rather than reading
+# every mapping.
+
+_INC_MAPPING_COUNT = (
+    "INSERT INTO mapcount (pnsid, snsid, count) VALUES (?, ?, ?) "
+    + "ON CONFLICT (pnsid, snsid) DO UPDATE SET count = count + excluded.count")
+_SELECT_COUNTS_PRIMARY = "SELECT snsid, count FROM mapcount WHERE pnsid = ? AND count > 0"
+_SELECT_COUNTS_SECONDARY = "SELECT pnsid, count FROM mapcount WHERE snsid = ? AND count > 0"
+_DELETE_MAPPING_COUNTS = "DELETE FROM mapcount"
+_INSERT_MAPPING_COUNTS = (
+    "INSERT INTO mapcount (pnsid, snsid, count) "
+    + "SELECT pnsid, snsid, COUNT(*) FROM map GROUP BY pnsid, snsid")
+
+# The columns for mapping queries in each direction: the namespace and ID queried, the
+# namespace and ID returned, and the index. 'Backwards' queries are pinned to the reverse index,
+# as the query planner might otherwise choose the primary key with the filtered namespaces
+# as the leading bounds once the database has been analyzed.
+_DIRECTIONS = {
+    True: ("pnsid", "pid", "snsid", "sid", ""),
+    False: ("snsid", "sid", "pnsid", "pid", " INDEXED BY map_reverse"),
+}
+
+# conditions on the queried ID for mapping queries.
+_ID_EQUALS = "{id} = ?"
+_ID_IN_LIST = "{id} IN (SELECT value FROM json_each(?))"
+
+
+@functools.lru_cache(maxsize=None)
+def _mapping_query(
+    forwards: bool, id_condition: str, filtered: bool, ordered: bool = False
+) -> str:
+    """
+    Build a query for mappings in one direction. The query returns the queried ID and the
+    namespace and ID it's mapped to, and its parameters are the queried namespace, the
+    parameters of the ID condition, and the namespace filter, if any.
+
+    :param forwards: True to query primary IDs, False to query secondary IDs.
+    :param id_condition: the condition on the queried ID, with an {id} placeholder for the
+        column name.
+    :param filtered: True to filter the results by namespace.
+    :param ordered: True to order the results by the queried ID.
+    """
+    ns, id_, otherns, otherid, index = _DIRECTIONS[forwards]
+    sql = "SELECT {id}, {otherns}, {otherid} FROM map{index} WHERE {ns} = ? AND " + id_condition
+    if filtered:
+        sql += " AND {otherns} IN (SELECT value FROM json_each(?))"
+    if ordered:
+        sql += " ORDER BY {id}"
+    # all the values are constants, so there's no possibility of SQL injection
+    return sql.format(id=id_, ns=ns, otherns=otherns, otherid=otherid, index=index)  # nosec
+
+
+class IDMappingSQLiteStorage(_IDMappingStorage):
+    """
+    An embedded SQLite based implementation of
+    :class:`jgikbase.idmapping.storage.id_mapping_storage.IDMappingStorage`.
+    See that class for method documentation.
+
+    The database is a single file, which is opened in write-ahead logging mode so that readers
+    don't block the writer and vice versa. Several processes on the same host may use the
+    database at once, but the file must not be on a network file system.
+
+    Each instance holds one connection to the database, which is shared between threads, so
+    operations in the same process are serialized. SQLite calls don't yield to other greenlets
+    under gevent, so a long running operation stalls the whole server process. Only one
+    connection can write at a time, and a write waiting for another process's write lock fails
+    with an IDMappingStorageError after the lock timeout. Statements are prepared once and
+    reused, and each operation, including bulk writes, runs in a single transaction. Mapping
+    counts are updated in the same transaction as the mappings, and rebuilt from the mappings in
+    a single transaction, so they never drift from the mappings.
+
+    Requires SQLite 3.24 or later with the JSON1 extension.
+    """
+
+    def __init__(self, path: Path, lock_timeout_sec: float = _LOCK_TIMEOUT_SEC) -> None:
+        """
+        Create a ID mapping storage system.
+
+        :param path: the path to the database file. The file is created if it doesn't exist.
+        :param lock_timeout_sec: how long to wait, in seconds, for another connection to
+            release its lock on the database before failing the operation.
+        :raises StorageInitException: if the storage system could not be initialized properly.
+        :raises TypeError: if the path is None.
+        :raises ValueError: if the lock timeout is negative.
+        """
+        not_none(path, "path")
+        if lock_timeout_sec < 0:
+            raise ValueError("lock_timeout_sec cannot be negative")
+        if sqlite3.sqlite_version_info < _MIN_SQLITE_VERSION:
+            raise StorageInitException(
+                "SQLite version {} is required, found {}".format(
+                    ".".join(str(v) for v in _MIN_SQLITE_VERSION), sqlite3.sqlite_version))
+        self._path = path
+        self._lock_timeout = lock_timeout_sec
+        self._lock = threading.Lock()
+        try:
+            self._conn = self._connect()
+            self._set_busy_timeout(max(lock_timeout_sec, _INIT_LOCK_TIMEOUT_SEC))
+            # the journal mode is stored in the database file
+            mode = self._conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            if mode != "wal":
+                raise StorageInitException(
+                    "Could not enable write-ahead logging for database {}, journal mode is {}"
+                    .format(path, mode))
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql in _SCHEMA:
+                    self._conn.execute(sql)
+                self._check_schema()
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+            self._set_busy_timeout(lock_timeout_sec)
+        except sqlite3.Error as e:
+            raise StorageInitException(
+                "Failed to initialize database {}: {}".format(path, e)) from e
+
+    def _connect(self) -> sqlite3.Connection:
+        # The connection is in autocommit mode and transactions are started explicitly.
+        conn = sqlite3.connect(
+            str(self._path),
+            timeout=self._lock_timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        # In WAL mode, NORMAL only syncs at checkpoints. A power failure may lose the most
+        # recent transactions but can't corrupt the database.
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def _set_busy_timeout(self, timeout_sec: float) -> None:
+        # pragma values can't be bound parameters, but the value is an int
+        self._conn.execute("PRAGMA busy_timeout = {}".format(int(timeout_sec * 1000)))  # nosec
+
+    def _check_schema(self):
+        cfg = self._conn.execute(_SELECT_CONFIG, (_SCHEMA_VALUE,)).fetchone()
+        if not cfg:
+            self._conn.execute(_INSERT_CONFIG, (_SCHEMA_VALUE, _SCHEMA_VERSION))
+            return
+        schemaver, inupdate = cfg
+        if schemaver not in _COMPATIBLE_SCHEMA_VERSIONS:
+            raise StorageInitException(
+                "Incompatible database schema. Server is v{}, DB is v{}".format(
+                    _SCHEMA_VERSION, schemaver))
+        if inupdate:
+            raise StorageInitException(
+                "The database is in the middle of an update from "
+                + "v{} of the schema. Aborting startup.".format(schemaver))
+
+    @contextmanager
+    def _transaction(self, write: bool = False) -> Generator[sqlite3.Connection, None, None]:
+        """
+        Run operations in a transaction. Write transactions take the database write lock
+        immediately so that reads in the transaction see the state the writes are based on.
+        """
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+                try:
+                    yield self._conn
+                except BaseException:
+                    self._conn.rollback()
+                    raise
+                self._conn.commit()
+            except sqlite3.Error as e:
+                raise IDMappingStorageError("Database operation failed: " + str(e)) from e
+
+    def update_schema(self) -> bool:
+        # there are no schema updates for SQLite databases yet
+        return False
+
+    @timed_storage_operation
+    def create_local_user(self, username: Username, token: HashedToken) -> None:
+        not_none(username, "username")
+        not_none(token, "token")
+        with self._transaction(True) as c:
+            try:
+                c.execute(_INSERT_USER, (username.name, token.token_hash))
+            except sqlite3.IntegrityError:
+                if c.execute(_SELECT_USER_EXISTS, (username.name,)).fetchone():
+                    raise UserExistsError(username.name)
+                raise ValueError("The provided token already exists in the database")
+            c.execute(_INC_USERS_VERSION, (_SCHEMA_VALUE,))
+
+    @timed_storage_operation
+    def set_local_user_as_admin(self, username: Username, admin: bool) -> None:
+        not_none(username, "username")
+        admin = True if admin else False  # more readable than admin and True
+        with self._transaction(True) as c:
+            if c.execute(_SET_USER_ADMIN, (admin, username.name, admin)).rowcount:
+                c.execute(_INC_USERS_VERSION, (_SCHEMA_VALUE,))
+            elif not c.execute(_SELECT_USER_EXISTS, (username.name,)).fetchone():
+                raise NoSuchUserError(username.name)
+
+    @timed_storage_operation
+    def update_local_user_token(self, username: Username, token: HashedToken) -> None:
+        not_none(username, "username")
+        not_none(token, "token")
+        with self._transaction(True) as c:
+            try:
+                res = c.execute(_SET_USER_TOKEN, (token.token_hash, username.name))
+            except sqlite3.IntegrityError:
+                # only the token can cause a constraint failure here
+                raise ValueError("The provided token already exists in the database")
+            if res.rowcount != 1:
+                raise NoSuchUserError(username.name)
+            c.execute(_INC_USERS_VERSION, (_SCHEMA_VALUE,))
+
+    @timed_storage_operation
+    def get_user(self, token: HashedToken) -> Tuple[Username, bool]:
+        not_none(token, "token")
+        with self._transaction() as c:
+            user = c.execute(_SELECT_USER_BY_TOKEN, (token.token_hash,)).fetchone()
+        if not user:
+            raise InvalidTokenError()
+        return (Username(user[0]), bool(user[1]))
+
+    @timed_storage_operation
+    def get_users(self) -> Dict[Username, bool]:
+        with self._transaction() as c:
+            users = {Username(u): bool(admin) for u, _, admin in c.execute(_SELECT_USERS)}
+        STORAGE_DOCUMENTS.labels("get_users").observe(len(users))
+        return users
+
+    @timed_storage_operation
+    def get_users_by_token(self) -> Dict[HashedToken, Tuple[Username, bool]]:
+        with self._transaction() as c:
+            users = {
+                HashedToken(t): (Username(u), bool(admin))
+                for u, t, admin in c.execute(_SELECT_USERS)
+            }
+        STORAGE_DOCUMENTS.labels("get_users_by_token").observe(len(users))
+        return users
+
+    @timed_storage_operation
+    def get_users_version(self) -> int:
+        return self._get_version(_SELECT_USERS_VERSION)
+
+    @timed_storage_operation
+    def user_exists(self, username: Username) -> bool:
+        not_none(username, "username")
+        with self._transaction() as c:
+            return c.execute(_SELECT_USER_EXISTS, (username.name,)).fetchone() is not None
+
+    def _get_version(self, sql: str) -> int:
+        with self._transaction() as c:
+            # the config row is guaranteed to exist after startup
+            return c.execute(sql, (_SCHEMA_VALUE,)).fetchone()[0]
+
+    @timed_storage_operation
+    def create_namespace(self, namespace_id: NamespaceID) -> None:
+        not_none(namespace_id, "namespace_id")
+        with self._transaction(True) as c:
+            try:
+                c.execute(_INSERT_NS, (namespace_id.id,))
+            except sqlite3.IntegrityError:
+                raise NamespaceExistsError(namespace_id.id)
+            c.execute(_INC_NS_VERSION, (_SCHEMA_VALUE,))
+
+    @timed_storage_operation
+    def get_namespace_version(self) -> int:
+        return self._get_version(_SELECT_NS_VERSION)
+
+    @timed_storage_operation
+    def get_namespace(self, namespace_id: NamespaceID) -> Namespace:
+        not_none(namespace_id, "namespace_id")
+        with self._transaction() as c:
+            ns = c.execute(_SELECT_NS, (namespace_id.id,)).fetchone()
+            if not ns:
+                raise NoSuchNamespaceError(namespace_id.id)
+            users = self._to_user_set(c.execute(_SELECT_NS_USERS, (namespace_id.id,)))
+        return Namespace(namespace_id, bool(ns[1]), users)
+
+    def _to_user_set(self, userrows) -> Set[User]:
+        return {User(AuthsourceID(auth), Username(name)) for _, auth, name in userrows}
+
+    def _check_namespace_exists(self, c: sqlite3.Connection, namespace_id: NamespaceID):
+        if not c.execute(_SELECT_NS, (namespace_id.id,)).fetchone():
+            raise NoSuchNamespaceError(namespace_id.id)
+
+    @timed_storage_operation
+    def add_user_to_namespace(
+        self, namespace_id: NamespaceID, admin_user: User
+    ) -> None:
+        self._modify_namespace_users(True, namespace_id, admin_user)
+
+    @timed_storage_operation
+    def remove_user_from_namespace(
+        self, namespace_id: NamespaceID, admin_user: User
+    ) -> None:
+        self._modify_namespace_users(False, namespace_id, admin_user)
+
+    @timed_storage_operation
+    def add_users_to_namespace(
+        self, namespace_id: NamespaceID, admin_users: Set[User]
+    ) -> None:
+        not_none(namespace_id, "namespace_id")
+        no_Nones_in_iterable(admin_users, "admin_users")
+        users = [(namespace_id.id, u.authsource_id.id, u.username.name) for u in admin_users]
+        with self._transaction(True) as c:
+            self._check_namespace_exists(c, namespace_id)
+            if c.executemany(_INSERT_NS_USER, users).rowcount > 0:
+                c.execute(_INC_NS_VERSION, (_SCHEMA_VALUE,))
+
+    def _modify_namespace_users(self, add: bool, namespace_id, admin_user):
+        """
+        :param add: True to add the user to the namespace, False to remove.
+        """
+        not_none(namespace_id, "namespace_id")
+        not_none(admin_user, "admin_user")
+        user = (namespace_id.id, admin_user.authsource_id.id, admin_user.username.name)
+        with self._transaction(True) as c:
+            self._check_namespace_exists(c, namespace_id)
+            if c.execute(_INSERT_NS_USER if add else _DELETE_NS_USER, user).rowcount != 1:
+                action = "already administrates" if add else "does not administrate"
+                ex = UserExistsError if add else NoSuchUserError
+                raise ex(
+                    "User {}/{} {} namespace {}".format(
+                        admin_user.authsource_id.id,
+                        admin_user.username.name,
+                        action,
+                        namespace_id.id,
+                    )
+                )
+            c.execute(_INC_NS_VERSION, (_SCHEMA_VALUE,))
+
+    @timed_storage_operation
+    def set_namespace_publicly_mappable(
+        self, namespace_id: NamespaceID, publicly_mappable: bool
+    ) -> None:
+        not_none(namespace_id, "namespace_id")
+        pm = True if publicly_mappable else False  # more readable than 'and True'
+        with self._transaction(True) as c:
+            if c.execute(_SET_NS_PUBMAP, (pm, namespace_id.id, pm)).rowcount:
+                c.execute(_INC_NS_VERSION, (_SCHEMA_VALUE,))
+            else:
+                self._check_namespace_exists(c, namespace_id)
+
+    @timed_storage_operation
+    def get_namespaces(
+        self, nids: Optional[Iterable[NamespaceID]] = None, include_users: bool = True
+    ) -> Set[Namespace]:
+        nidstr: List[str] = []
+        if nids:
+            no_Nones_in_iterable(nids, "nids")
+            nidstr = [nid.id for nid in nids]
+        with self._transaction() as c:
+            if nidstr:
+                nsrows = c.execute(_SELECT_NS_LIST, (json.dumps(nidstr),)).fetchall()
+            else:
+                nsrows = c.execute(_SELECT_NS_ALL).fetchall()
+            users: Dict[str, Set[User]] = {nsid: set() for nsid, _ in nsrows}
+            if include_users:
+                if nidstr:
+                    userrows = c.execute(_SELECT_NS_USERS_LIST, (json.dumps(nidstr),))
+                else:
+                    userrows = c.execute(_SELECT_NS_USERS_ALL)
+                for nsid, auth, name in userrows:
+                    users[nsid].add(User(AuthsourceID(auth), Username(name)))
+        nsobjs = {Namespace(NamespaceID(nsid), bool(pm), users[nsid]) for nsid, pm in nsrows}
+        STORAGE_DOCUMENTS.labels("get_namespaces").observe(len(nsobjs))
+        if nidstr and len(nsobjs) != len(set(nidstr)):
+            missing = set(nidstr) - {ns.namespace_id.id for ns in nsobjs}
+            raise NoSuchNamespaceError(str(sorted(missing)))
+        return nsobjs
+
+    @timed_storage_operation
+    def add_mapping(self, primary_OID: ObjectID, secondary_OID: ObjectID) -> None:
+        not_none(primary_OID, "primary_OID")
+        not_none(secondary_OID, "secondary_OID")
+        mapping = self._group_mappings([(primary_OID, secondary_OID)])
+        self._write_mappings(_INSERT_MAPPING, 1, mapping)
+
+    @timed_storage_operation
+    def remove_mapping(self, primary_OID: ObjectID, secondary_OID: ObjectID) -> bool:
+        not_none(primary_OID, "primary_OID")
+        not_none(secondary_OID, "secondary_OID")
+        mapping = self._group_mappings([(primary_OID, secondary_OID)])
+        return self._write_mappings(_DELETE_MAPPING, -1, mapping) == 1
+
+    def _group_mappings(
+        self, mappings: Iterable[Tuple[ObjectID, ObjectID]]
+    ) -> Dict[Tuple[str, str], List[Tuple[str, str, str, str]]]:
+        # groups the mapping rows by pair of namespaces
+        not_none(mappings, "mappings")
+        bypair: Dict[Tuple[str, str], List[Tuple[str, str, str, str]]] = {}
+        for m in mappings:
+            not_none(m, "mapping")
+            primary_OID, secondary_OID = m
+            not_none(primary_OID, "primary_OID")
+            not_none(secondary_OID, "secondary_OID")
+            pair = (primary_OID.namespace_id.id, secondary_OID.namespace_id.id)
+            bypair.setdefault(pair, []).append(
+                (pair[0], primary_OID.id, pair[1], secondary_OID.id))
+        return bypair
+
+    def _write_mappings(
+        self,
+        sql: str,
+        sign: int,
+        bypair: Dict[Tuple[str, str], List[Tuple[str, str, str, str]]],
+    ) -> int:
+        # Returns the number of mappings written. The rows for each pair of namespaces are
+        # written with one statement so that the statement's change count is the amount to
+        # change the pair's mapping count by. Writes are almost always between a single pair of
+        # namespaces.
+        if not bypair:
+            return 0
+        with self._transaction(True) as c:
+            counts = {pair: c.executemany(sql, rows).rowcount for pair, rows in bypair.items()}
+            c.executemany(
+                _INC_MAPPING_COUNT,
+                [(pnsid, snsid, sign * count) for (pnsid, snsid), count in counts.items()
+                 if count])
+        return sum(counts.values())
+
+    @timed_storage_operation
+    def add_mappings(self, mappings: Iterable[Tuple[ObjectID, ObjectID]]) -> Tuple[int, int]:
+        bypair = self._group_mappings(mappings)
+        created = self._write_mappings(_INSERT_MAPPING, 1, bypair)
+        return created, sum(len(rows) for rows in bypair.values()) - created
+
+    @timed_storage_operation
+    def remove_mappings(self, mappings: Iterable[Tuple[ObjectID, ObjectID]]) -> int:
+        return self._write_mappings(_DELETE_MAPPING, -1, self._group_mappings(mappings))
+
+    @staticmethod
+    def _to_filter(ns_filter: Optional[Iterable[NamespaceID]]) -> Optional[str]:
+        if not ns_filter:
+            return None
+        no_Nones_in_iterable(ns_filter, "ns_filter")
+        return json.dumps([ns.id for ns in ns_filter])
+
+    def _find_mappings(
+        self,
+        c: sqlite3.Connection,
+        forwards: bool,
+        id_condition: str,
+        params: List[str],
+        fil: Optional[str],
+        ordered: bool = False,
+    ) -> sqlite3.Cursor:
+        sql = _mapping_query(forwards, id_condition, fil is not None, ordered)
+        return c.execute(sql, params + [fil] if fil else params)
+
+    @timed_storage_operation
+    def find_mappings(
+        self, oid: ObjectID, ns_filter: Optional[Iterable[NamespaceID]] = None
+    ) -> Tuple[Set[ObjectID], Set[ObjectID]]:
+        not_none(oid, "oid")
+        fil = self._to_filter(ns_filter)
+        params = [oid.namespace_id.id, oid.id]
+        with self._transaction() as c:
+            primary = {
+                ObjectID(NamespaceID(ns), id_)
+                for _, ns, id_ in self._find_mappings(c, True, _ID_EQUALS, params, fil)
+            }
+            secondary = {
+                ObjectID(NamespaceID(ns), id_)
+                for _, ns, id_ in self._find_mappings(c, False, _ID_EQUALS, params, fil)
+            }
+        STORAGE_DOCUMENTS.labels("find_mappings").observe(len(primary) + len(secondary))
+        return primary, secondary
+
+    @timed_storage_operation
+    def find_mappings_bulk(
+        self,
+        namespace_id: NamespaceID,
+        ids: Iterable[str],
+        ns_filter: Optional[Iterable[NamespaceID]] = None,
+    ) -> Dict[str, Tuple[Set[ObjectID], Set[ObjectID]]]:
+        not_none(namespace_id, "namespace_id")
+        no_Nones_in_iterable(ids, "ids")
+        ret: Dict[str, Tuple[Set[ObjectID], Set[ObjectID]]] = {
+            id_: (set(), set()) for id_ in ids
+        }
+        if not ret:
+            return ret
+        fil = self._to_filter(ns_filter)
+        # one query per direction, each of which looks up every ID in the index
+        params = [namespace_id.id, json.dumps(list(ret))]
+        docs = 0
+        with self._transaction() as c:
+            for i, forwards in enumerate([True, False]):
+                for id_, ns, otherid in self._find_mappings(
+                        c, forwards, _ID_IN_LIST, params, fil):
+                    docs += 1
+                    ret[id_][i].add(ObjectID(NamespaceID(ns), otherid))
+        STORAGE_DOCUMENTS.labels("find_mappings_bulk").observe(docs)
+        return ret
+
+    @timed_storage_operation
+    def find_mappings_range(
+        self,
+        namespace_id: NamespaceID,
+        start: str,
+        end: Optional[str] = None,
+        ns_filter: Optional[Iterable[NamespaceID]] = None,
+        limit: int = 1000,
+        after: Optional[str] = None,
+    ) -> Tuple[Dict[str, Tuple[Set[ObjectID], Set[ObjectID]]], bool]:
+        not_none(namespace_id, "namespace_id")
+        not_none(start, "start")
+        fil = self._to_filter(ns_filter)
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        # Comparisons on the ID, never LIKE or GLOB, so the range is an index range scan.
+        if after is not None and after >= start:
+            condition, params = "{id} > ?", [namespace_id.id, after]
+        else:
+            condition, params = "{id} >= ?", [namespace_id.id, start]
+        if end is not None:
+            condition += " AND {id} < ?"
+            params.append(end)
+        with self._transaction() as c:
+            primary, pmore = self._find_mappings_range(c, True, condition, params, fil, limit)
+            secondary, smore = self._find_mappings_range(
+                c, False, condition, params, fil, limit)
+        # Each direction returned its first ids in the range, so the first ids of the union
+        # have all their mappings. SQLite's binary string ordering of UTF-8 strings matches
+        # Python's string ordering.
+        ids = sorted(primary.keys() | secondary.keys())
+        ret = {id_: (primary.get(id_, set()), secondary.get(id_, set())) for id_ in ids[:limit]}
+        STORAGE_DOCUMENTS.labels("find_mappings_range").observe(
+            sum(len(p) + len(s) for p, s in ret.values()))
+        return ret, pmore or smore or len(ids) > limit
+
+    def _find_mappings_range(
+        self,
+        c: sqlite3.Connection,
+        forwards: bool,
+        condition: str,
+        params: List[str],
+        fil: Optional[str],
+        limit: int,
+    ) -> Tuple[Dict[str, Set[ObjectID]], bool]:
+        # returns the mappings for the first limit IDs in the range and whether there are more.
+        # The index is walked in order from the start of the range without a sort, and the
+        # query stops reading at the first ID past the limit.
+        cur = self._find_mappings(c, forwards, condition, params, fil, ordered=True)
+        ret: Dict[str, Set[ObjectID]] = {}
+        try:
+            for id_, ns, otherid in cur:
+                if id_ not in ret:
+                    if len(ret) == limit:
+                        return ret, True
+                    ret[id_] = set()
+                ret[id_].add(ObjectID(NamespaceID(ns), otherid))
+        finally:
+            cur.close()
+        return ret, False
+
+    def iter_mappings(
+        self,
+        primary_namespace_id: NamespaceID,
+        secondary_namespace_id: NamespaceID,
+        after: Optional[Tuple[str, str]] = None,
+    ) -> Iterator[Tuple[str, str]]:
+        not_none(primary_namespace_id, "primary_namespace_id")
+        not_none(secondary_namespace_id, "secondary_namespace_id")
+        if after:
+            no_Nones_in_iterable(after, "after")
+        # check the arguments now rather than when the caller starts iterating
+        return self._iter_mappings(
+            primary_namespace_id.id, secondary_namespace_id.id, tuple(after) if after else None
+        )
+
+    def _iter_mappings(self, pnsid, snsid, after):
+        # Reads the mappings a page at a time so that the database isn't locked while the
+        # caller processes the mappings. Each page starts after the last mapping of the previous
+        # page in the primary key.
+        while True:
+            with self._transaction() as c:
+                if after:
+                    rows = c.execute(_ITER_MAPPINGS_AFTER, (
+                        pnsid, snsid, after[0], snsid, after[1], _ITER_PAGE_SIZE)).fetchall()
+                else:
+                    rows = c.execute(_ITER_MAPPINGS, (pnsid, snsid, _ITER_PAGE_SIZE)).fetchall()
+            yield from rows
+            if len(rows) < _ITER_PAGE_SIZE:
+                return
+            after = rows[-1]
+
+    @timed_storage_operation
+    def get_mapping_counts(
+        self, namespace_id: NamespaceID
+    ) -> Tuple[Dict[NamespaceID, int], Dict[NamespaceID, int]]:
+        not_none(namespace_id, "namespace_id")
+        with self._transaction() as c:
+            primary = {
+                NamespaceID(ns): count
+                for ns, count in c.execute(_SELECT_COUNTS_PRIMARY, (namespace_id.id,))
+            }
+            secondary = {
+                NamespaceID(ns): count
+                for ns, count in c.execute(_SELECT_COUNTS_SECONDARY, (namespace_id.id,))
+            }
+        return primary, secondary
+
+    def rebuild_mapping_counts(self, workers: int = 1) -> int:
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        # SQLite allows one writer, so the workers are unused. The mappings are counted and the
+        # counts replaced in one write transaction so that no writes can be lost in between.
+        with self._transaction(True) as c:
+            c.execute(_DELETE_MAPPING_COUNTS)
+            return c.execute(_INSERT_MAPPING_COUNTS).rowcount
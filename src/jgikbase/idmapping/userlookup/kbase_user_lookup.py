@@ -2,12 +2,14 @@
 A ID mapper service user lookup handler for KBase (https://kbase.us) user accounts.
 """
 from jgikbase.idmapping.core.user_lookup import UserLookup, LookupInitializationError
-from jgikbase.idmapping.core.arg_check import not_none
+from jgikbase.idmapping.core.arg_check import not_none, no_Nones_in_iterable
 from jgikbase.idmapping.core.user import AuthsourceID, User, Username
 from jgikbase.idmapping.core.tokens import Token
 import requests
+from requests.adapters import HTTPAdapter
 from jgikbase.idmapping.core.errors import InvalidTokenError
-from typing import Tuple, Optional, Dict
+from typing import Tuple, Optional, Dict, List, Set
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 
@@ -24,7 +26,23 @@ class KBaseUserLookup(UserLookup):
 
     _KBASE = AuthsourceID('kbase')
 
-    def __init__(self, kbase_auth_url: str, kbase_token: Token, kbase_system_admin: str) -> None:
+    # The maximum number of connections kept open to the auth server, and the maximum number of
+    # concurrent background requests. Under gunicorn's gevent workers the background requests
+    # run in greenlets rather than OS threads.
+    _POOL_SIZE = 10
+
+    # The maximum number of users checked per request to the auth server, which keeps the
+    # request URL well within common server and proxy limits.
+    _USERS_PER_REQUEST = 100
+
+    def __init__(
+            self,
+            kbase_auth_url: str,
+            kbase_token: Token,
+            kbase_system_admin: str,
+            connect_timeout: float = 5,
+            read_timeout: float = 30
+            ) -> None:
         '''
         Create the lookup handler.
 
@@ -33,16 +51,31 @@ class KBaseUserLookup(UserLookup):
             user names.
         :param kbase_system_admin: the custom role the user must possess in the KBase auth
             system to be considered an admin of the ID mapping service.
+        :param connect_timeout: the timeout in seconds for connecting to the auth service.
+        :param read_timeout: the timeout in seconds for reading a response from the auth
+            service.
         '''
         not_none(kbase_auth_url, 'kbase_auth_url')
         not_none(kbase_token, 'kbase_token')
         not_none(kbase_system_admin, 'kbase_system_admin')
+        if connect_timeout <= 0:
+            raise ValueError('connect_timeout must be > 0')
+        if read_timeout <= 0:
+            raise ValueError('read_timeout must be > 0')
         if not kbase_auth_url.endswith('/'):
             kbase_auth_url += '/'
         self.auth_url = kbase_auth_url
         self._token = kbase_token
         self._kbase_system_admin = kbase_system_admin
-        r = requests.get(self.auth_url, headers={'Accept': 'application/json'})
+        self._timeout = (connect_timeout, read_timeout)
+        # keep connections to the auth server alive between requests rather than paying for
+        # a new connection and TLS handshake on every cache miss
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self._POOL_SIZE)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self._POOL_SIZE)
+        r = self._get(self.auth_url, headers={'Accept': 'application/json'})
         self._check_error(r)
         missing_keys = {'version', 'gitcommithash', 'servertime'} - r.json().keys()
         if missing_keys:
@@ -57,6 +90,9 @@ class KBaseUserLookup(UserLookup):
     def get_authsource_id(self) -> AuthsourceID:
         return self._KBASE
 
+    def _get(self, url, headers):
+        return self._session.get(url, headers=headers, timeout=self._timeout)
+
     def _check_error(self, r):
         if r.status_code != 200:
             try:
@@ -76,10 +112,15 @@ class KBaseUserLookup(UserLookup):
 
     def get_user(self, token: Token) -> Tuple[User, bool, Optional[int], Optional[int]]:
         not_none(token, 'token')
-        r = requests.get(self.auth_url + 'api/V2/token', headers={'Authorization': token.token})
+        headers = {'Authorization': token.token}
+        # the two requests are independent, so make them concurrently
+        mefut = self._executor.submit(self._get, self.auth_url + 'api/V2/me', headers)
+        r = self._get(self.auth_url + 'api/V2/token', headers)
+        # check the token response first, since if the token is bad the me request will fail
+        # as well
         self._check_error(r)
         tokenres = r.json()
-        r = requests.get(self.auth_url + 'api/V2/me', headers={'Authorization': token.token})
+        r = mefut.result()
         self._check_error(r)
         mres = r.json()
         return (User(self._KBASE, Username(tokenres['user'])),
@@ -89,12 +130,34 @@ class KBaseUserLookup(UserLookup):
 
     def is_valid_user(self, username: Username) -> Tuple[bool, Optional[int], Optional[int]]:
         not_none(username, 'username')
-        r = requests.get(self.auth_url + 'api/V2/users/?list=' + username.name,
-                         headers={'Authorization': self._token.token})
+        r = self._get(self.auth_url + 'api/V2/users/?list=' + username.name,
+                      headers={'Authorization': self._token.token})
         self._check_error(r)
         j = r.json()
         return (len(j) == 1, None, 3600)
 
+    def are_valid_users(
+            self, usernames: Set[Username]
+            ) -> Tuple[Dict[Username, bool], Optional[int], Optional[int]]:
+        no_Nones_in_iterable(usernames, 'usernames')
+        if not usernames:
+            return ({}, None, 3600)
+        names = sorted(u.name for u in usernames)
+        chunks = [names[i:i + self._USERS_PER_REQUEST]
+                  for i in range(0, len(names), self._USERS_PER_REQUEST)]
+        found: Set[str] = set()
+        # the chunks are independent, so check them concurrently
+        for j in self._executor.map(self._get_users, chunks):
+            found.update(j)
+        return ({u: u.name in found for u in usernames}, None, 3600)
+
+    def _get_users(self, names: List[str]) -> Dict[str, str]:
+        # usernames can't contain commas
+        r = self._get(self.auth_url + 'api/V2/users/?list=' + ','.join(names),
+                      headers={'Authorization': self._token.token})
+        self._check_error(r)
+        return r.json()
+
 
 def build_lookup(config: Dict[str, str]) -> UserLookup:
     """
@@ -102,7 +165,9 @@ def build_lookup(config: Dict[str, str]) -> UserLookup:
 
     :params config: A dictionary containing the keys 'url' for the KBase auth server url,
         'token' for a valid KBase token, and 'admin-role' for the KBase auth server custom
-        role the user must possess in order to be an admin of the ID Mapping system.
+        role the user must possess in order to be an admin of the ID Mapping system. The
+        optional keys 'connect-timeout' and 'read-timeout' set the timeouts in seconds for
+        requests to the KBase auth server.
     """
     err = 'kbase user lookup handler requires {} configuration item'
     if 'url' not in config:
@@ -111,4 +176,16 @@ def build_lookup(config: Dict[str, str]) -> UserLookup:
         raise LookupInitializationError(err.format('token'))
     if 'admin-role' not in config:
         raise LookupInitializationError(err.format('admin-role'))
-    return KBaseUserLookup(config['url'], Token(config['token']), config['admin-role'])
+    timeouts = {}
+    for key, arg in (('connect-timeout', 'connect_timeout'), ('read-timeout', 'read_timeout')):
+        if config.get(key, '').strip():
+            try:
+                timeouts[arg] = float(config[key])
+            except ValueError:
+                timeouts[arg] = 0
+            if timeouts[arg] <= 0:
+                raise LookupInitializationError(
+                    'kbase user lookup handler {} configuration item must be a number > 0'
+                    .format(key))
+    return KBaseUserLookup(config['url'], Token(config['token']), config['admin-role'],
+                           **timeouts)
@@ -0,0 +1,406 @@
+"""
+Benchmarks for the storage, mapper, and HTTP layers of the ID mapping service.
+
+The benchmarks start a throwaway MongoDB instance with
+:class:`jgikbase.test.idmapping.mongo_controller.MongoController`, configured with the same test
+configuration file as the tests, and / or create a temporary SQLite database, seed each storage
+system with a synthetic dataset, and report the throughput and latency percentiles for each
+operation as JSON so that runs and storage systems can be compared.
+
+Run with ``make benchmark`` or::
+
+    IDMAP_TEST_FILE=test.cfg PYTHONPATH=src python -m jgikbase.test.idmapping.benchmark.benchmark
+
+Run with ``--help`` for the options.
+"""
+
+from jgikbase.test.idmapping import test_utils
+from jgikbase.test.idmapping.mongo_controller import MongoController
+from jgikbase.test.idmapping.benchmark.dataset import Dataset, DatasetSpec
+from jgikbase.idmapping.builder import IDMappingBuilder
+from jgikbase.idmapping.core.object_id import ObjectID
+from jgikbase.idmapping.core.tokens import generate_token
+from jgikbase.idmapping.core.user import Username
+from jgikbase.idmapping.service.mapper_service import create_app
+from jgikbase.idmapping.service.json_provider import JSONProvider, available_providers
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import argparse
+import json
+import math
+import os
+import platform
+import sqlite3
+import subprocess  # nosec
+import sys
+import tempfile
+import time
+
+_DB_NAME = "idmapping_benchmark"
+_MONGO = "mongo"
+_SQLITE = "sqlite"
+_STORAGE_CHOICES = {_MONGO: [_MONGO], _SQLITE: [_SQLITE], "both": [_MONGO, _SQLITE]}
+_USER = Username("benchmark")
+_WARMUP = 10
+
+
+def percentile(sorted_values: Sequence[float], pct: float) -> float:
+    """
+    Get a percentile of a sorted list of values with the nearest rank method.
+
+    :param sorted_values: the values, sorted in ascending order.
+    :param pct: the percentile, greater than 0 and at most 100.
+    """
+    if not sorted_values:
+        raise ValueError("No values")
+    if not 0 < pct <= 100:
+        raise ValueError("pct must be greater than 0 and at most 100")
+    return sorted_values[math.ceil(pct / 100 * len(sorted_values)) - 1]
+
+
+def summarize(
+    name: str, latencies: List[float], elapsed: float, items_per_op: int = 1
+) -> Dict[str, Any]:
+    """
+    Summarize the latencies of a benchmark.
+
+    :param name: the name of the benchmark.
+    :param latencies: the latency of each operation in seconds.
+    :param elapsed: the total time taken by the operations in seconds.
+    :param items_per_op: the number of items, e.g. IDs, processed by each operation.
+    :returns: the summary as a JSONable dict. Latencies are in milliseconds.
+    """
+    s = sorted(latencies)
+    return {
+        "name": name,
+        "operations": len(s),
+        "items_per_op": items_per_op,
+        "ops_per_sec": round(len(s) / elapsed, 2),
+        "items_per_sec": round(len(s) * items_per_op / elapsed, 2),
+        "mean_ms": round(sum(s) / len(s) * 1000, 3),
+        "p50_ms": round(percentile(s, 50) * 1000, 3),
+        "p99_ms": round(percentile(s, 99) * 1000, 3),
+        "max_ms": round(s[-1] * 1000, 3),
+    }
+
+
+def measure(
+    name: str,
+    fn: Callable[[Any], Any],
+    args: List[Any],
+    warmup: int = _WARMUP,
+    items_per_op: int = 1,
+) -> Dict[str, Any]:
+    """
+    Call a function once per argument and summarize the latencies.
+
+    :param name: the name of the benchmark.
+    :param fn: the function to benchmark.
+    :param args: the arguments for the function, one per call.
+    :param warmup: the number of initial calls that are not measured.
+    :param items_per_op: the number of items, e.g. IDs, processed by each call.
+    :returns: the summary from :func:`summarize`.
+    """
+    for a in args[:warmup]:
+        fn(a)
+    args = args[warmup:]
+    latencies = []
+    start = time.perf_counter()
+    for a in args:
+        s = time.perf_counter()
+        fn(a)
+        latencies.append(time.perf_counter() - s)
+    return summarize(name, latencies, time.perf_counter() - start, items_per_op)
+
+
+def _mongo_cfg(port: int, args) -> List[str]:
+    return [
+        "mongo-host=localhost:{}".format(port),
+        "mongo-db=" + _DB_NAME,
+        "mongo-covered-index={}".format(str(args.covered_index).lower()),
+    ]
+
+
+def _sqlite_cfg(path: Path) -> List[str]:
+    return ["storage-type=" + _SQLITE, "sqlite-path={}".format(path)]
+
+
+def _write_deploy_cfg(path: Path, storage_cfg: List[str], args) -> None:
+    with open(path, "w") as f:
+        f.write("\n".join(["[idmapping]"] + storage_cfg + [
+            "namespace-cache-ttl={}".format(args.namespace_cache_ttl),
+            "local-user-refresh-interval={}".format(args.local_user_refresh_interval),
+            "authentication-enabled=local",
+            "authentication-admin-enabled=local",
+            "dont-trust-x-ip-headers=true",
+            "",
+        ]))
+
+
+def _check(resp, status: int):
+    if resp.status_code != status:
+        raise ValueError("Unexpected response {}: {}".format(resp.status_code, resp.data))
+
+
+def run_json_benchmarks(
+    dataset: Dataset, operations: int, batch_size: int
+) -> List[Dict[str, Any]]:
+    """
+    Benchmark decoding mapping creation request bodies and encoding mapping lookup responses
+    with each of the available JSON providers. No database is required.
+
+    :param dataset: the dataset from which to draw the IDs.
+    :param operations: the number of operations to run per benchmark, including warmup.
+    :param batch_size: the number of IDs per request or response.
+    :returns: the benchmark summaries.
+    """
+    otherns = dataset.namespaces[1].id
+    bodies = [json.dumps({dataset.new_id(): dataset.new_id() for _ in range(batch_size)})
+              .encode() for _ in range(operations)]
+    responses = [
+        {i: {"mappings": [{"ns": otherns, "id": dataset.new_id()}
+                          for _ in range(dataset.spec.mappings_per_id)]}
+         for i in dataset.sample(dataset.admin_ids, batch_size)}
+        for _ in range(operations)]
+    results = []
+    for provider in available_providers():
+        results.append(measure("json.{}.decode_create_body".format(provider.name),
+                               provider.loads, bodies, items_per_op=batch_size))
+        results.append(measure("json.{}.encode_get_response".format(provider.name),
+                               provider.dumps, responses, items_per_op=batch_size))
+    return results
+
+
+def run_benchmarks(
+    builder: IDMappingBuilder,
+    dataset: Dataset,
+    operations: int,
+    batch_size: int,
+    json_provider: Optional[JSONProvider] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Run the benchmarks against a seeded database.
+
+    :param builder: a builder configured to use the database.
+    :param dataset: the dataset in the database.
+    :param operations: the number of operations to run per benchmark, including warmup.
+    :param batch_size: the number of IDs per HTTP request.
+    :param json_provider: the JSON provider for the HTTP layer. Defaults to the fastest provider
+        available.
+    :returns: the benchmark summaries.
+    """
+    storage = builder.build_storage()
+    mapper = builder.build_id_mapping_system()
+    with open(os.devnull, "w") as devnull:
+        cli = create_app(builder, devnull, json_provider).test_client()
+        token = generate_token()
+        storage.create_local_user(_USER, token.get_hashed_token())
+        storage.set_local_user_as_admin(_USER, True)
+        auth = {"Authorization": "local " + token.token}
+        adminns = dataset.admin_namespace
+        for ns in dataset.namespaces:
+            resp = cli.put("/api/v1/namespace/{}/user/local/{}".format(ns.id, _USER.name),
+                           headers=auth)
+            _check(resp, 204)
+
+        admin_oids = [ObjectID(adminns, i) for i in dataset.sample(dataset.admin_ids, operations)]
+        other_oids = dataset.sample(dataset.other_ids, operations)
+        results = []
+
+        def new_mapping(_):
+            return (ObjectID(adminns, dataset.new_id()),
+                    ObjectID(dataset.namespaces[1], dataset.new_id()))
+
+        new_mappings = [new_mapping(i) for i in range(operations)]
+        results.append(measure("storage.add_mapping",
+                               lambda m: storage.add_mapping(m[0], m[1]), new_mappings))
+        results.append(measure("storage.find_mappings", storage.find_mappings, admin_oids))
+        results.append(measure("storage.find_mappings.reverse", storage.find_mappings,
+                               other_oids))
+        results.append(measure("mapper.get_mappings", mapper.get_mappings, admin_oids))
+        results.append(measure("mapper.get_mappings.reverse", mapper.get_mappings, other_oids))
+
+        if dataset.fanin_ids:
+            # reverse lookups for IDs mapped from many namespaces, filtered to one namespace
+            fanin_oids = dataset.sample(dataset.fanin_ids, operations)
+            fanin_filters = [[ns] for ns in dataset.sample(dataset.fanin_namespaces, operations)]
+            results.append(measure("storage.find_mappings.reverse.fanin",
+                                   storage.find_mappings, fanin_oids))
+            results.append(measure("storage.find_mappings.reverse.fanin.filtered",
+                                   lambda a: storage.find_mappings(a[0], a[1]),
+                                   list(zip(fanin_oids, fanin_filters))))
+
+        id_batches = [dataset.sample(dataset.admin_ids, batch_size) for _ in range(operations)]
+
+        def get_mappings(ids):
+            resp = cli.get("/api/v1/mapping/" + adminns.id, json={"ids": ids})
+            _check(resp, 200)
+
+        results.append(measure("http.get_mappings", get_mappings, id_batches,
+                               items_per_op=batch_size))
+
+        if dataset.fanin_ids:
+            def get_filtered_mappings(batch):
+                ns, ids = batch
+                resp = cli.get("/api/v1/mapping/{}?namespace_filter={}".format(
+                    dataset.namespaces[1].id, ns.id), json={"ids": ids})
+                _check(resp, 200)
+
+            fanin_batches = [
+                (ns, [o.id for o in dataset.sample(dataset.fanin_ids, batch_size)])
+                for ns in dataset.sample(dataset.fanin_namespaces, operations)]
+            results.append(measure("http.get_mappings.reverse.fanin.filtered",
+                                   get_filtered_mappings, fanin_batches,
+                                   items_per_op=batch_size))
+
+        def create_mappings(ids):
+            otherns = dataset.namespaces[1].id
+            resp = cli.put("/api/v1/mapping/{}/{}".format(adminns.id, otherns), headers=auth,
+                           json=ids)
+            _check(resp, 204)
+
+        mapping_batches = [{dataset.new_id(): dataset.new_id() for _ in range(batch_size)}
+                           for _ in range(operations)]
+        results.append(measure("http.create_mappings", create_mappings, mapping_batches,
+                               items_per_op=batch_size))
+        return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(  # nosec
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ID mapping service against a throwaway MongoDB instance "
+        + "and / or a temporary SQLite database. The MongoDB executable and temporary "
+        + "directory are read from the test configuration file in the {} environment "
+        .format(test_utils.TEST_FILE_LOC_ENV_KEY) + "variable.")
+    spec = DatasetSpec()
+    parser.add_argument("--namespaces", type=int, default=spec.namespaces,
+                        help="the number of namespaces in the dataset")
+    parser.add_argument("--ids", type=int, default=spec.ids,
+                        help="the number of IDs in the administrative namespace")
+    parser.add_argument("--mappings-per-id", type=int, default=spec.mappings_per_id,
+                        help="the number of mappings per administrative ID")
+    parser.add_argument("--id-length-min", type=int, default=spec.id_length_min,
+                        help="the minimum ID length")
+    parser.add_argument("--id-length-max", type=int, default=spec.id_length_max,
+                        help="the maximum ID length")
+    parser.add_argument("--fanin-namespaces", type=int, default=spec.fanin_namespaces,
+                        help="the number of namespaces mapped to each fan-in ID")
+    parser.add_argument("--fanin-ids", type=int, default=spec.fanin_ids,
+                        help="the number of fan-in IDs, which are used to benchmark "
+                        + "namespace filtered reverse lookups")
+    parser.add_argument("--seed", type=int, default=spec.seed,
+                        help="the random number generator seed")
+    parser.add_argument("--operations", type=int, default=1000,
+                        help="the number of operations per benchmark, including {} warmup "
+                        .format(_WARMUP) + "operations")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="the number of IDs per HTTP request")
+    parser.add_argument("--storage", choices=list(_STORAGE_CHOICES), default=_MONGO,
+                        help="the storage system to benchmark. both runs the storage, mapper, "
+                        + "and HTTP benchmarks against each storage system in turn with the "
+                        + "same dataset")
+    parser.add_argument("--covered-index", action="store_true",
+                        help="use the v2 MongoDB schema with the covering index")
+    parser.add_argument("--namespace-cache-ttl", type=int, default=300,
+                        help="the namespace cache lifetime; 0 disables the cache")
+    parser.add_argument("--local-user-refresh-interval", type=int, default=5,
+                        help="the local user refresh interval; 0 disables the in memory index")
+    providers = [p.name for p in available_providers()]
+    parser.add_argument("--json-provider", choices=providers, default=providers[0],
+                        help="the JSON provider for the HTTP benchmarks. The JSON benchmarks "
+                        + "always run with every available provider")
+    parser.add_argument("--output", help="the file for the JSON results. Default stdout")
+    args = parser.parse_args(argv)
+    if args.operations <= _WARMUP:
+        parser.error("--operations must be greater than {}".format(_WARMUP))
+    if not 1 <= args.batch_size <= 1000:
+        parser.error("--batch-size must be between 1 and 1000")
+    return args
+
+
+def _run_storage_benchmarks(
+    storage: str, cfgpath: Path, spec: DatasetSpec, args
+) -> Dict[str, Any]:
+    builder = IDMappingBuilder()
+    builder.get_cfg(cfgpath)
+    dataset = Dataset(spec)
+    start = time.perf_counter()
+    created = dataset.seed(builder.build_storage())
+    seed_time = time.perf_counter() - start
+
+    provider = {p.name: p for p in available_providers()}[args.json_provider]
+    results = run_benchmarks(builder, dataset, args.operations, args.batch_size, provider)
+    return {
+        "mappings": created,
+        "seed_sec": round(seed_time, 3),
+        "results": [dict(r, storage=storage) for r in results],
+    }
+
+
+def _run_mongo_benchmarks(spec: DatasetSpec, args) -> Dict[str, Any]:
+    mongo = MongoController(test_utils.get_mongo_exe(), test_utils.get_temp_dir(),
+                            test_utils.get_use_wired_tiger())
+    try:
+        cfgpath = mongo.temp_dir / "deploy.cfg"
+        _write_deploy_cfg(cfgpath, _mongo_cfg(mongo.port, args), args)
+        return dict(_run_storage_benchmarks(_MONGO, cfgpath, spec, args),
+                    version=mongo.db_version)
+    finally:
+        mongo.destroy(test_utils.get_delete_temp_files())
+
+
+def _run_sqlite_benchmarks(spec: DatasetSpec, args) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="idmapping_benchmark_") as d:
+        cfgpath = Path(d) / "deploy.cfg"
+        _write_deploy_cfg(cfgpath, _sqlite_cfg(Path(d) / "idmapping.db"), args)
+        return dict(_run_storage_benchmarks(_SQLITE, cfgpath, spec, args),
+                    version=sqlite3.sqlite_version)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    spec = DatasetSpec(args.namespaces, args.ids, args.mappings_per_id, args.id_length_min,
+                       args.id_length_max, args.seed, args.fanin_namespaces, args.fanin_ids)
+    runners = {_MONGO: _run_mongo_benchmarks, _SQLITE: _run_sqlite_benchmarks}
+    storage: Dict[str, Dict[str, Any]] = {}
+    results: List[Dict[str, Any]] = []
+    for s in _STORAGE_CHOICES[args.storage]:
+        storage[s] = runners[s](spec, args)
+        results += storage[s].pop("results")
+    results += run_json_benchmarks(Dataset(spec), args.operations, args.batch_size)
+    out = {
+        "time": int(time.time() * 1000),
+        "git_commit": _git_commit(),
+        "python_version": platform.python_version(),
+        "storage": storage,
+        "config": {
+            "storage": args.storage,
+            "covered_index": args.covered_index,
+            "namespace_cache_ttl": args.namespace_cache_ttl,
+            "local_user_refresh_interval": args.local_user_refresh_interval,
+            "operations": args.operations,
+            "batch_size": args.batch_size,
+            "json_provider": args.json_provider,
+        },
+        "dataset": spec.to_dict(),
+        "results": results,
+    }
+    text = json.dumps(out, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,188 @@
+from pytest import raises
+from unittest.mock import create_autospec
+from jgikbase.idmapping.core.object_id import NamespaceID, ObjectID
+from jgikbase.idmapping.storage.id_mapping_storage import IDMappingStorage
+from jgikbase.idmapping.builder import IDMappingBuilder
+from jgikbase.test.idmapping.benchmark.benchmark import (
+    percentile, summarize, measure, run_json_benchmarks, run_benchmarks, _parse_args,
+    _sqlite_cfg, _write_deploy_cfg)
+from jgikbase.test.idmapping.benchmark.dataset import Dataset, DatasetSpec
+from jgikbase.test.idmapping.test_utils import assert_exception_correct
+
+
+def test_dataset_spec_defaults():
+    assert DatasetSpec().to_dict() == {
+        "namespaces": 4,
+        "ids": 10000,
+        "mappings_per_id": 2,
+        "id_length_min": 8,
+        "id_length_max": 40,
+        "seed": 42,
+        "fanin_namespaces": 100,
+        "fanin_ids": 100,
+    }
+
+
+def test_dataset_spec_fail():
+    fail_dataset_spec({"namespaces": 1}, ValueError("namespaces must be at least 2"))
+    fail_dataset_spec({"ids": 0}, ValueError("ids must be at least 1"))
+    fail_dataset_spec({"mappings_per_id": 0}, ValueError("mappings_per_id must be at least 1"))
+    err = ValueError("id lengths must satisfy 4 <= id_length_min <= id_length_max <= 1000")
+    fail_dataset_spec({"id_length_min": 3}, err)
+    fail_dataset_spec({"id_length_min": 10, "id_length_max": 9}, err)
+    fail_dataset_spec({"id_length_max": 1001}, err)
+    err = ValueError("fanin_namespaces and fanin_ids cannot be negative")
+    fail_dataset_spec({"fanin_namespaces": -1}, err)
+    fail_dataset_spec({"fanin_ids": -1}, err)
+
+
+def fail_dataset_spec(kwargs, expected):
+    with raises(Exception) as got:
+        DatasetSpec(**kwargs)
+    assert_exception_correct(got.value, expected)
+
+
+def test_dataset():
+    d = Dataset(DatasetSpec(namespaces=3, ids=50, mappings_per_id=3, id_length_min=5,
+                            id_length_max=7, seed=3, fanin_namespaces=4, fanin_ids=2))
+    assert d.namespaces == [NamespaceID("bench_ns0"), NamespaceID("bench_ns1"),
+                            NamespaceID("bench_ns2")]
+    assert d.admin_namespace == NamespaceID("bench_ns0")
+    assert len(d.admin_ids) == 50
+    assert len(d.other_ids) == 150
+    assert d.fanin_namespaces == [NamespaceID("bench_fanin{}".format(i)) for i in range(4)]
+    assert len(d.fanin_ids) == 2
+    assert all(o.namespace_id == NamespaceID("bench_ns1") for o in d.fanin_ids)
+    assert len(d.mappings) == 158
+    fanin_mappings = d.mappings[150:]
+    ids = (d.admin_ids + [o.id for o in d.other_ids] + [o.id for o in d.fanin_ids]
+           + [p.id for p, _ in fanin_mappings])
+    assert len(set(ids)) == 210
+    assert all(5 <= len(i) <= 7 for i in ids)
+    assert {o.namespace_id for o in d.other_ids} == set(d.namespaces[1:])
+    for i, (admin, other) in enumerate(d.mappings[:150]):
+        assert admin == ObjectID(d.admin_namespace, d.admin_ids[i // 3])
+        assert other == d.other_ids[i]
+    for i, (primary, secondary) in enumerate(fanin_mappings):
+        assert primary.namespace_id == d.fanin_namespaces[i % 4]
+        assert secondary == d.fanin_ids[i // 4]
+    assert d.new_id() not in ids
+
+
+def test_dataset_no_fanin():
+    d = Dataset(DatasetSpec(ids=5, mappings_per_id=1, fanin_namespaces=0))
+    assert d.fanin_namespaces == []
+    assert d.fanin_ids == []
+    assert len(d.mappings) == 5
+
+
+def test_dataset_is_deterministic():
+    spec = DatasetSpec(ids=100, seed=7)
+    d1 = Dataset(spec)
+    d2 = Dataset(spec)
+    assert d1.mappings == d2.mappings
+    assert d1.sample(d1.admin_ids, 10) == d2.sample(d2.admin_ids, 10)
+    assert d1.new_id() == d2.new_id()
+
+    assert Dataset(DatasetSpec(ids=100, seed=8)).mappings != d1.mappings
+
+
+def test_dataset_seed():
+    d = Dataset(DatasetSpec(namespaces=2, ids=5, mappings_per_id=1, fanin_namespaces=1,
+                            fanin_ids=1))
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    storage.add_mappings.side_effect = [(2, 0), (2, 0), (2, 0)]
+
+    assert d.seed(storage, chunk_size=2) == 6
+
+    assert storage.create_namespace.call_args_list == [
+        ((NamespaceID("bench_ns0"),), {}), ((NamespaceID("bench_ns1"),), {}),
+        ((NamespaceID("bench_fanin0"),), {})]
+    assert storage.add_mappings.call_args_list == [
+        ((d.mappings[0:2],), {}), ((d.mappings[2:4],), {}), ((d.mappings[4:6],), {})]
+
+
+def test_percentile():
+    vals = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    assert percentile(vals, 50) == 5
+    assert percentile(vals, 99) == 10
+    assert percentile(vals, 100) == 10
+    assert percentile(vals, 10) == 1
+    assert percentile(vals, 11) == 2
+    assert percentile([3], 1) == 3
+
+
+def test_percentile_fail():
+    fail_percentile([], 50, ValueError("No values"))
+    err = ValueError("pct must be greater than 0 and at most 100")
+    fail_percentile([1], 0, err)
+    fail_percentile([1], 100.1, err)
+
+
+def fail_percentile(vals, pct, expected):
+    with raises(Exception) as got:
+        percentile(vals, pct)
+    assert_exception_correct(got.value, expected)
+
+
+def test_summarize():
+    assert summarize("op", [0.004, 0.001, 0.003, 0.002], 0.02, items_per_op=10) == {
+        "name": "op",
+        "operations": 4,
+        "items_per_op": 10,
+        "ops_per_sec": 200,
+        "items_per_sec": 2000,
+        "mean_ms": 2.5,
+        "p50_ms": 2,
+        "p99_ms": 4,
+        "max_ms": 4,
+    }
+
+
+def test_measure():
+    calls = []
+    res = measure("op", calls.append, list(range(15)), warmup=5, items_per_op=3)
+
+    assert calls == list(range(15))
+    assert res["name"] == "op"
+    assert res["operations"] == 10
+    assert res["items_per_op"] == 3
+    assert res["ops_per_sec"] > 0
+    assert res["items_per_sec"] > 0
+
+
+def test_run_json_benchmarks():
+    d = Dataset(DatasetSpec(ids=20, fanin_namespaces=0))
+    res = run_json_benchmarks(d, 12, 5)
+
+    assert [r["name"] for r in res] == [
+        "json.orjson.decode_create_body", "json.orjson.encode_get_response",
+        "json.stdlib.decode_create_body", "json.stdlib.encode_get_response"]
+    assert all(r["operations"] == 2 and r["items_per_op"] == 5 for r in res)
+
+
+def test_run_benchmarks_sqlite(tmp_path):
+    args = _parse_args(["--storage", "sqlite", "--namespace-cache-ttl", "0"])
+    assert args.storage == "sqlite"
+    cfgpath = tmp_path / "deploy.cfg"
+    _write_deploy_cfg(cfgpath, _sqlite_cfg(tmp_path / "idmapping.db"), args)
+    builder = IDMappingBuilder()
+    builder.get_cfg(cfgpath)
+    d = Dataset(DatasetSpec(ids=30, fanin_namespaces=3, fanin_ids=5))
+
+    assert d.seed(builder.build_storage()) == 75
+    res = run_benchmarks(builder, d, 12, 5)
+
+    assert [r["name"] for r in res] == [
+        "storage.add_mapping",
+        "storage.find_mappings",
+        "storage.find_mappings.reverse",
+        "mapper.get_mappings",
+        "mapper.get_mappings.reverse",
+        "storage.find_mappings.reverse.fanin",
+        "storage.find_mappings.reverse.fanin.filtered",
+        "http.get_mappings",
+        "http.get_mappings.reverse.fanin.filtered",
+        "http.create_mappings",
+    ]
+    assert all(r["operations"] == 2 for r in res)
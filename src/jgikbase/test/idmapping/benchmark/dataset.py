@@ -0,0 +1,143 @@
+"""
+Synthetic datasets for benchmarking the ID mapping service.
+"""
+
+from jgikbase.idmapping.core.object_id import NamespaceID, ObjectID
+from jgikbase.idmapping.storage.id_mapping_storage import IDMappingStorage
+from typing import Any, Dict, List, Set, Tuple
+import random
+import string
+
+_ID_CHARS = string.ascii_letters + string.digits
+
+
+class DatasetSpec:
+    """
+    The specification for a synthetic dataset.
+
+    The first namespace is the administrative namespace. Each ID in the administrative namespace
+    is mapped to IDs in randomly chosen other namespaces. ID lengths are uniformly distributed
+    between the minimum and maximum length.
+
+    Additionally, a set of fan-in IDs in the second namespace are each mapped from an ID in
+    every one of a set of fan-in namespaces, to exercise reverse lookups for IDs with many
+    mappings.
+
+    :ivar namespaces: the number of namespaces, including the administrative namespace.
+    :ivar ids: the number of IDs in the administrative namespace.
+    :ivar mappings_per_id: the number of mappings for each administrative ID.
+    :ivar id_length_min: the minimum length of an ID.
+    :ivar id_length_max: the maximum length of an ID.
+    :ivar seed: the seed for the random number generator.
+    :ivar fanin_namespaces: the number of fan-in namespaces.
+    :ivar fanin_ids: the number of fan-in IDs.
+    """
+
+    def __init__(
+        self,
+        namespaces: int = 4,
+        ids: int = 10000,
+        mappings_per_id: int = 2,
+        id_length_min: int = 8,
+        id_length_max: int = 40,
+        seed: int = 42,
+        fanin_namespaces: int = 100,
+        fanin_ids: int = 100,
+    ) -> None:
+        if namespaces < 2:
+            raise ValueError("namespaces must be at least 2")
+        if ids < 1:
+            raise ValueError("ids must be at least 1")
+        if mappings_per_id < 1:
+            raise ValueError("mappings_per_id must be at least 1")
+        if not 4 <= id_length_min <= id_length_max <= 1000:
+            raise ValueError(
+                "id lengths must satisfy 4 <= id_length_min <= id_length_max <= 1000")
+        if fanin_namespaces < 0 or fanin_ids < 0:
+            raise ValueError("fanin_namespaces and fanin_ids cannot be negative")
+        self.namespaces = namespaces
+        self.ids = ids
+        self.mappings_per_id = mappings_per_id
+        self.id_length_min = id_length_min
+        self.id_length_max = id_length_max
+        self.seed = seed
+        self.fanin_namespaces = fanin_namespaces
+        self.fanin_ids = fanin_ids
+
+    def to_dict(self) -> Dict[str, Any]:
+        """ Get the specification as a JSONable dict. """
+        return dict(vars(self))
+
+
+class Dataset:
+    """
+    A synthetic dataset generated from a :class:`DatasetSpec`. The same specification always
+    generates the same dataset.
+
+    :ivar spec: the specification.
+    :ivar namespaces: the namespace IDs. The first is the administrative namespace.
+    :ivar admin_ids: the IDs in the administrative namespace.
+    :ivar other_ids: the IDs in the other namespaces that are mapped to an administrative ID.
+    :ivar fanin_namespaces: the fan-in namespace IDs.
+    :ivar fanin_ids: the fan-in object IDs, each of which is the target of a mapping from each
+        fan-in namespace.
+    :ivar mappings: all the mappings as tuples of the primary and secondary object IDs.
+    """
+
+    def __init__(self, spec: DatasetSpec) -> None:
+        self.spec = spec
+        self._rand = random.Random(spec.seed)
+        self._used: Set[str] = set()
+        self.namespaces = [NamespaceID("bench_ns{}".format(i)) for i in range(spec.namespaces)]
+        self.admin_ids = [self.new_id() for _ in range(spec.ids)]
+        self.other_ids: List[ObjectID] = []
+        self.mappings: List[Tuple[ObjectID, ObjectID]] = []
+        for id_ in self.admin_ids:
+            for _ in range(spec.mappings_per_id):
+                other = ObjectID(self._rand.choice(self.namespaces[1:]), self.new_id())
+                self.other_ids.append(other)
+                self.mappings.append((ObjectID(self.admin_namespace, id_), other))
+        self.fanin_namespaces = [
+            NamespaceID("bench_fanin{}".format(i)) for i in range(spec.fanin_namespaces)]
+        self.fanin_ids = [ObjectID(self.namespaces[1], self.new_id())
+                          for _ in range(spec.fanin_ids if spec.fanin_namespaces else 0)]
+        for oid in self.fanin_ids:
+            for ns in self.fanin_namespaces:
+                self.mappings.append((ObjectID(ns, self.new_id()), oid))
+
+    @property
+    def admin_namespace(self) -> NamespaceID:
+        """ The administrative namespace. """
+        return self.namespaces[0]
+
+    def new_id(self) -> str:
+        """
+        Generate a new ID that is not used elsewhere in the dataset.
+        """
+        while True:
+            length = self._rand.randint(self.spec.id_length_min, self.spec.id_length_max)
+            id_ = "".join(self._rand.choices(_ID_CHARS, k=length))
+            if id_ not in self._used:
+                self._used.add(id_)
+                return id_
+
+    def sample(self, population: List, count: int) -> List:
+        """
+        Choose items from a list with replacement, using the dataset's random number generator.
+        """
+        return self._rand.choices(population, k=count)
+
+    def seed(self, storage: IDMappingStorage, chunk_size: int = 10000) -> int:
+        """
+        Create the dataset's namespaces and mappings in a storage system.
+
+        :param storage: the storage system, which should not contain the namespaces.
+        :param chunk_size: the number of mappings to write per call to the storage system.
+        :returns: the number of mappings created.
+        """
+        for ns in self.namespaces + self.fanin_namespaces:
+            storage.create_namespace(ns)
+        created = 0
+        for i in range(0, len(self.mappings), chunk_size):
+            created += storage.add_mappings(self.mappings[i:i + chunk_size])[0]
+        return created
@@ -4,11 +4,14 @@ from jgikbase.test.idmapping.user_lookup_test_module import FakeUserLookup
 from pytest import raises
 from jgikbase.test.idmapping.test_utils import assert_exception_correct
 from jgikbase.idmapping.core.user_lookup import LookupInitializationError
+from pymongo.read_preferences import PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from unittest.mock import Mock
+from jgikbase.idmapping.storage.sqlite.id_mapping_sqlite_storage import IDMappingSQLiteStorage
 
 # this tests the parts of the builder that don't require starting up mongoDB. Those
 # are tested in integration tests.
 
-# For now, that means the UserLookup loading code.
+# For now, that means the UserLookup loading code and read preference selection.
 
 TEST_MODULE = 'jgikbase.test.idmapping.user_lookup_test_module'
 
@@ -54,3 +57,33 @@ def fail_build_user_lookup(asid, module, cfg, expected):
     with raises(Exception) as got:
         IDMappingBuilder().build_user_lookup(asid, module, cfg)
     assert_exception_correct(got.value, expected)
+
+
+def test_get_read_preference():
+    b = IDMappingBuilder()
+    b.cfg = Mock()
+    b.cfg.mongo_max_staleness_sec = -1
+
+    assert b._get_read_preference('primary') is None
+    assert b._get_read_preference('primaryPreferred') == PrimaryPreferred()
+    assert b._get_read_preference('secondary') == Secondary()
+    assert b._get_read_preference('secondaryPreferred') == SecondaryPreferred()
+    assert b._get_read_preference('nearest') == Nearest()
+
+    b.cfg.mongo_max_staleness_sec = 120
+    assert b._get_read_preference('primary') is None
+    assert b._get_read_preference('secondaryPreferred') == SecondaryPreferred(
+        max_staleness=120)
+
+
+def test_build_sqlite_storage(tmp_path):
+    cfg = tmp_path / 'deploy.cfg'
+    cfg.write_text('[idmapping]\nstorage-type=sqlite\nsqlite-path={}\n'.format(
+        tmp_path / 'idmapping.db'))
+    b = IDMappingBuilder()
+
+    storage = b.build_storage(cfg)
+
+    assert isinstance(storage, IDMappingSQLiteStorage)
+    assert b.build_storage() is storage
+    assert (tmp_path / 'idmapping.db').is_file()
@@ -8,6 +8,10 @@ from pytest import raises
 from jgikbase.test.idmapping.test_utils import assert_exception_correct
 from jgikbase.idmapping.core.tokens import Token
 from jgikbase.idmapping.core.errors import UserExistsError, NoSuchUserError
+from jgikbase.idmapping.storage.id_mapping_storage import IDMappingStorage
+from jgikbase.idmapping.storage.errors import IDMappingStorageError
+from jgikbase.idmapping.core.object_id import NamespaceID, ObjectID
+import re
 
 # TODO CLI at some point, test usage and invalid args. Since argparse calls exit() when this
 # happens, it'll need exec() tests, or futzing with argparse.
@@ -40,7 +44,8 @@ def test_no_input():
 
     assert out.write.call_args_list == []
     assert err.write.call_args_list == [
-        (('Exactly one of --list-users or --user must be specified.\n',), {})]
+        (('Exactly one of --list-users, --user, --update-schema, --load-mappings, or ' +
+          '--rebuild-mapping-counts must be specified.\n',), {})]
 
 
 def test_too_much_input():
@@ -49,10 +54,13 @@ def test_too_much_input():
     err = Mock()
 
     assert IDMappingCLI(builder, ['--user', 'foo', '--list-users'], out, err).execute() == 1
+    assert IDMappingCLI(builder, ['--update-schema', '--list-users'], out, err).execute() == 1
 
     assert out.write.call_args_list == []
     assert err.write.call_args_list == [
-        (('Exactly one of --list-users or --user must be specified.\n',), {})]
+        (('Exactly one of --list-users, --user, --update-schema, --load-mappings, or ' +
+          '--rebuild-mapping-counts must be specified.\n',), {})
+    ] * 2
 
 
 def test_fail_build():
@@ -87,6 +95,188 @@ def test_fail_build_verbose():
     assert "IDMappingBuildException: I'm sorry" in err.write.call_args_list[1][0][0]
 
 
+def test_update_schema():
+    check_update_schema(True, 'Updated the database schema.\n')
+    check_update_schema(False, 'The database schema is already up to date.\n')
+    check_update_schema(True, 'Updated the database schema.\n', covered=False, sharded=True)
+
+
+def check_update_schema(updated, expected, covered=True, sharded=False):
+    builder = create_autospec(IDMappingBuilder, spec_set=True, instance=True)
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    out = Mock()
+    err = Mock()
+
+    builder.get_cfg.return_value.mongo_covered_index = covered
+    builder.get_cfg.return_value.mongo_sharded = sharded
+    builder.build_storage.return_value = storage
+    storage.update_schema.return_value = updated
+
+    assert IDMappingCLI(builder, ['--update-schema', '--config', 'c.cfg'], out, err
+                        ).execute() == 0
+
+    assert builder.get_cfg.call_args_list == [((Path('c.cfg'),), {})]
+    assert builder.build_storage.call_args_list == [((Path('c.cfg'),), {})]
+    assert storage.update_schema.call_args_list == [((), {})]
+    assert builder.build_local_user_lookup.call_args_list == []
+    assert out.write.call_args_list == [((expected,), {})]
+    assert err.write.call_args_list == []
+
+
+def test_update_schema_fail_not_enabled():
+    builder = create_autospec(IDMappingBuilder, spec_set=True, instance=True)
+    out = Mock()
+    err = Mock()
+
+    builder.get_cfg.return_value.mongo_covered_index = False
+    builder.get_cfg.return_value.mongo_sharded = False
+
+    assert IDMappingCLI(builder, ['--update-schema'], out, err).execute() == 1
+
+    assert builder.build_storage.call_args_list == []
+    assert out.write.call_args_list == []
+    assert err.write.call_args_list == [
+        (('No schema updates are enabled in the configuration.\n',), {})]
+
+
+def test_update_schema_fail():
+    builder = create_autospec(IDMappingBuilder, spec_set=True, instance=True)
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    out = Mock()
+    err = Mock()
+
+    builder.get_cfg.return_value.mongo_covered_index = True
+    builder.build_storage.return_value = storage
+    storage.update_schema.side_effect = IDMappingStorageError('oh noes')
+
+    assert IDMappingCLI(builder, ['--update-schema'], out, err).execute() == 1
+
+    assert out.write.call_args_list == []
+    assert err.write.call_args_list == [(('Error: oh noes\n',), {})]
+
+
+def test_load_mappings(tmp_path):
+    builder = create_autospec(IDMappingBuilder, spec_set=True, instance=True)
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    out = Mock()
+    err = Mock()
+
+    mfile = tmp_path / 'mappings.tsv'
+    mfile.write_bytes(b'skip\tme\nid1\tid2\nid3\tid4\nid5\tid6\n')
+    builder.build_storage.return_value = storage
+    storage.add_mappings.side_effect = [(2, 0), (0, 1)]
+
+    assert IDMappingCLI(builder, [
+        '--load-mappings', str(mfile), '--admin-ns', 'ans', '--other-ns', 'ns',
+        '--chunk-size', '2', '--writers', '2', '--start-offset', '8'], out, err).execute() == 0
+
+    assert builder.build_storage.call_args_list == [((Path('./deploy.cfg'),), {})]
+    assert storage.get_namespaces.call_args_list == [
+        (({NamespaceID('ans'), NamespaceID('ns')},), {})]
+    assert storage.add_mappings.call_args_list == [
+        (([(ObjectID(NamespaceID('ans'), 'id1'), ObjectID(NamespaceID('ns'), 'id2')),
+           (ObjectID(NamespaceID('ans'), 'id3'), ObjectID(NamespaceID('ns'), 'id4'))],), {}),
+        (([(ObjectID(NamespaceID('ans'), 'id5'), ObjectID(NamespaceID('ns'), 'id6'))],), {}),
+    ]
+    outs = [c[0][0] for c in out.write.call_args_list]
+    assert len(outs) == 3
+    assert re.match(r'^Processed 2 lines, 2 mappings created, 0 already existed, ' +
+                    r'\d+ lines/s, offset 24\n$', outs[0]) is not None
+    assert re.match(r'^Processed 3 lines, 2 mappings created, 1 already existed, ' +
+                    r'\d+ lines/s, offset 32\n$', outs[1]) is not None
+    assert outs[2] == 'Load complete. ' + outs[1]
+    assert err.write.call_args_list == []
+
+
+def test_load_mappings_fail_no_namespaces():
+    builder = create_autospec(IDMappingBuilder, spec_set=True, instance=True)
+    out = Mock()
+    err = Mock()
+
+    for args in [['--admin-ns', 'ans'], ['--other-ns', 'ns'], []]:
+        assert IDMappingCLI(builder, ['--load-mappings', 'f'] + args, out, err).execute() == 1
+
+    assert builder.build_storage.call_args_list == []
+    assert out.write.call_args_list == []
+    assert err.write.call_args_list == [
+        (('--admin-ns and --other-ns are required with --load-mappings.\n',), {})] * 3
+
+
+def test_load_mappings_fail_resume(tmp_path):
+    builder = create_autospec(IDMappingBuilder, spec_set=True, instance=True)
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    out = Mock()
+    err = Mock()
+
+    mfile = tmp_path / 'mappings.ndjson'
+    mfile.write_bytes(b'{"admin": "id1", "other": "id2"}\n{"admin": "id3", "other": "id4"}\n')
+    builder.build_storage.return_value = storage
+    storage.add_mappings.side_effect = [(1, 0), IDMappingStorageError('oh noes')]
+
+    assert IDMappingCLI(builder, [
+        '--load-mappings', str(mfile), '--admin-ns', 'ans', '--other-ns', 'ns',
+        '--format', 'ndjson', '--chunk-size', '1'], out, err).execute() == 1
+
+    assert len(out.write.call_args_list) == 1
+    assert err.write.call_args_list == [(('Error: oh noes\n',), {}),
+                                        (('Resume the load with --start-offset 33\n',), {})]
+
+
+def test_load_mappings_fail_no_file():
+    builder = create_autospec(IDMappingBuilder, spec_set=True, instance=True)
+    out = Mock()
+    err = Mock()
+
+    assert IDMappingCLI(builder, [
+        '--load-mappings', '/nonexistent/file', '--admin-ns', 'ans', '--other-ns', 'ns'],
+        out, err).execute() == 1
+
+    assert out.write.call_args_list == []
+    assert err.write.call_args_list == [
+        (("Error: [Errno 2] No such file or directory: '/nonexistent/file'\n",), {})]
+
+
+def test_rebuild_mapping_counts():
+    check_rebuild_mapping_counts([], 4)
+    check_rebuild_mapping_counts(['--workers', '16'], 16)
+
+
+def check_rebuild_mapping_counts(args, workers):
+    builder = create_autospec(IDMappingBuilder, spec_set=True, instance=True)
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    out = Mock()
+    err = Mock()
+
+    builder.build_storage.return_value = storage
+    storage.rebuild_mapping_counts.return_value = 42
+
+    assert IDMappingCLI(builder, ['--rebuild-mapping-counts', '--config', 'c.cfg'] + args,
+                        out, err).execute() == 0
+
+    assert builder.build_storage.call_args_list == [((Path('c.cfg'),), {})]
+    assert storage.rebuild_mapping_counts.call_args_list == [((workers,), {})]
+    assert builder.build_local_user_lookup.call_args_list == []
+    assert out.write.call_args_list == [
+        (('Rebuilt the mapping counts for 42 namespace pairs.\n',), {})]
+    assert err.write.call_args_list == []
+
+
+def test_rebuild_mapping_counts_fail():
+    builder = create_autospec(IDMappingBuilder, spec_set=True, instance=True)
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    out = Mock()
+    err = Mock()
+
+    builder.build_storage.return_value = storage
+    storage.rebuild_mapping_counts.side_effect = ValueError('workers must be at least 1')
+
+    assert IDMappingCLI(builder, ['--rebuild-mapping-counts', '--workers', '0'], out, err
+                        ).execute() == 1
+
+    assert out.write.call_args_list == []
+    assert err.write.call_args_list == [(('Error: workers must be at least 1\n',), {})]
+
+
 def test_list_users():
     builder = create_autospec(IDMappingBuilder, spec_set=True, instance=True)
     luh = create_autospec(LocalUserLookup, spec_set=True, instance=True)
@@ -52,6 +52,8 @@ def test_kb_config_minimal_config():
     p = mock_path_to_file('path', ['[idmapping]', 'mongo-host=foo', 'mongo-db=bar'])
     c = KBaseConfig(p)
 
+    assert c.storage_type == 'mongo'
+    assert c.sqlite_path is None
     assert c.mongo_host == 'foo'
     assert c.mongo_db == 'bar'
     assert c.mongo_user is None
@@ -60,18 +62,45 @@ def test_kb_config_minimal_config():
     assert c.auth_admin_enabled == set()
     assert c.ignore_ip_headers is False
     assert c.mongo_retrywrites is False
+    assert c.mongo_covered_index is False
+    assert c.mongo_sharded is False
+    assert c.mongo_read_preference_mappings == 'primary'
+    assert c.mongo_read_preference_namespaces == 'primary'
+    assert c.mongo_max_staleness_sec == -1
+    assert c.namespace_cache_ttl == 0
+    assert c.user_cache_negative_ttl == 0
+    assert c.user_cache_shared is False
+    assert c.local_user_refresh_interval == 0
+    assert c.profile_dir is None
+    assert c.profile_sample_rate == 0
+    assert c.profile_max_size_mb == 100
 
 
 def test_kb_config_minimal_config_whitespace():
     p = mock_path_to_file('path', ['[idmapping]',
+                                   'storage-type=  \t   ', 'sqlite-path=  \t   ',
                                    'mongo-host=foo', 'mongo-db=bar',
                                    'mongo-user=  \t   ', 'mongo-pwd=  \t   ',
                                    'dont-trust-x-ip-headers=   crap',
                                    'mongo-retrywrites=   another crap',
+                                   'mongo-covered-index=   more crap',
+                                   'mongo-sharded=   crap again',
+                                   'mongo-read-preference-mappings=  \t   ',
+                                   'mongo-read-preference-namespaces=  \t   ',
+                                   'mongo-max-staleness-sec=  \t   ',
                                    'authentication-enabled=    \t     ',
-                                   'authentication-admin-enabled=      \t     '])
+                                   'authentication-admin-enabled=      \t     ',
+                                   'namespace-cache-ttl=    \t    ',
+                                   'user-cache-negative-ttl=    \t    ',
+                                   'user-cache-shared=   yes please',
+                                   'local-user-refresh-interval=  \t   ',
+                                   'profile-dir=  \t   ',
+                                   'profile-sample-rate=  \t   ',
+                                   'profile-max-size-mb=  \t   '])
     c = KBaseConfig(p)
 
+    assert c.storage_type == 'mongo'
+    assert c.sqlite_path is None
     assert c.mongo_host == 'foo'
     assert c.mongo_db == 'bar'
     assert c.mongo_user is None
@@ -80,13 +109,39 @@ def test_kb_config_minimal_config_whitespace():
     assert c.auth_admin_enabled == set()
     assert c.ignore_ip_headers is False
     assert c.ignore_ip_headers is False
+    assert c.mongo_covered_index is False
+    assert c.mongo_sharded is False
+    assert c.mongo_read_preference_mappings == 'primary'
+    assert c.mongo_read_preference_namespaces == 'primary'
+    assert c.mongo_max_staleness_sec == -1
+    assert c.namespace_cache_ttl == 0
+    assert c.user_cache_negative_ttl == 0
+    assert c.user_cache_shared is False
+    assert c.local_user_refresh_interval == 0
+    assert c.profile_dir is None
+    assert c.profile_sample_rate == 0
+    assert c.profile_max_size_mb == 100
 
 
 def test_kb_config_maximal_config():
     p = mock_path_to_file('path', [
         '[idmapping]', 'mongo-host=foo', 'mongo-db=bar', 'mongo-user=u', 'mongo-pwd=p',
+        'storage-type=  mongo  ',
+        'sqlite-path=  /tmp/idmapping.db  ',
         'dont-trust-x-ip-headers=true',
         'mongo-retrywrites=true',
+        'mongo-covered-index=true',
+        'mongo-sharded=true',
+        'mongo-read-preference-mappings=  secondaryPreferred  ',
+        'mongo-read-preference-namespaces=  nearest  ',
+        'mongo-max-staleness-sec=  120  ',
+        'namespace-cache-ttl=   300  ',
+        'user-cache-negative-ttl=   10  ',
+        'user-cache-shared=   true  ',
+        'local-user-refresh-interval=  5  ',
+        'profile-dir=  /tmp/profiles  ',
+        'profile-sample-rate=  0.01  ',
+        'profile-max-size-mb=  20  ',
         'authentication-enabled=   authone,   auththree, \t  authtwo  , local ',
         'authentication-admin-enabled=   authone,   autha, \t  authbcd   ',
         'auth-source-authone-factory-module=  some.module  \t  ',
@@ -97,6 +152,8 @@ def test_kb_config_maximal_config():
         'auth-source-auththree-init-x=Y'])
     c = KBaseConfig(p)
 
+    assert c.storage_type == 'mongo'
+    assert c.sqlite_path is None
     assert c.mongo_host == 'foo'
     assert c.mongo_db == 'bar'
     assert c.mongo_user == 'u'
@@ -111,6 +168,39 @@ def test_kb_config_maximal_config():
                                 AuthsourceID('auththree'): ('some.other.other.module', {'x': 'Y'})}
     assert c.ignore_ip_headers is True
     assert c.mongo_retrywrites is True
+    assert c.mongo_covered_index is True
+    assert c.mongo_sharded is True
+    assert c.mongo_read_preference_mappings == 'secondaryPreferred'
+    assert c.mongo_read_preference_namespaces == 'nearest'
+    assert c.mongo_max_staleness_sec == 120
+    assert c.namespace_cache_ttl == 300
+    assert c.user_cache_negative_ttl == 10
+    assert c.user_cache_shared is True
+    assert c.local_user_refresh_interval == 5
+    assert c.profile_dir == Path('/tmp/profiles')
+    assert c.profile_sample_rate == 0.01
+    assert c.profile_max_size_mb == 20
+
+
+def test_kb_config_sqlite():
+    p = mock_path_to_file('path', [
+        '[idmapping]', 'storage-type=  sqlite  ', 'sqlite-path=  /tmp/idmapping.db  ',
+        'mongo-host=foo', 'user-cache-shared=false'])
+    c = KBaseConfig(p)
+
+    assert c.storage_type == 'sqlite'
+    assert c.sqlite_path == Path('/tmp/idmapping.db')
+    assert c.mongo_host == 'foo'
+    assert c.mongo_db is None
+    assert c.user_cache_shared is False
+
+
+def test_kb_config_max_staleness():
+    for staleness, expected in [('-1', -1), ('90', 90)]:
+        p = mock_path_to_file('path', [
+            '[idmapping]', 'mongo-host=foo', 'mongo-db=bar',
+            'mongo-max-staleness-sec=' + staleness])
+        assert KBaseConfig(p).mongo_max_staleness_sec == expected
 
 
 def test_kb_config_fail_not_file():
@@ -151,6 +241,31 @@ def test_kb_config_fail_no_mongo_db():
     fail_kb_config(mock_path_to_file('path/2/whee', contents, True), IDMappingConfigError(err))
 
 
+def test_kb_config_fail_storage_type():
+    err = ('Parameter storage-type in configuration file path, section idmapping, ' +
+           'must be one of mongo, sqlite: postgres')
+    contents = ['[idmapping]', 'mongo-host=foo', 'mongo-db=bar', 'storage-type=postgres']
+    fail_kb_config(mock_path_to_file('path', contents), IDMappingConfigError(err))
+
+
+def test_kb_config_fail_no_sqlite_path():
+    err = ('Required parameter sqlite-path not provided in configuration file path, ' +
+           'section idmapping')
+    contents = ['[idmapping]', 'storage-type=sqlite', 'mongo-host=foo', 'mongo-db=bar']
+    fail_kb_config(mock_path_to_file('path', contents), IDMappingConfigError(err))
+
+    contents = ['[idmapping]', 'storage-type=sqlite', 'sqlite-path=  \t   ']
+    fail_kb_config(mock_path_to_file('path', contents), IDMappingConfigError(err))
+
+
+def test_kb_config_fail_sqlite_shared_user_cache():
+    err = ('Parameter user-cache-shared in configuration file path, section idmapping, ' +
+           'cannot be enabled with the sqlite storage-type')
+    contents = ['[idmapping]', 'storage-type=sqlite', 'sqlite-path=idmapping.db',
+                'user-cache-shared=true']
+    fail_kb_config(mock_path_to_file('path', contents), IDMappingConfigError(err))
+
+
 def test_kb_config_fail_user_no_pwd():
     err = ('Must provide both mongo-user and mongo-pwd params in config file path/2/whee ' +
            'section idmapping if MongoDB authentication is to be used')
@@ -173,6 +288,81 @@ def test_kb_config_fail_pwd_no_user():
     fail_kb_config(mock_path_to_file('path/2/whee', contents, True), IDMappingConfigError(err))
 
 
+def test_kb_config_fail_namespace_cache_ttl_not_int():
+    err = ('Parameter namespace-cache-ttl in configuration file path/2/whee, ' +
+           'section idmapping, is not an integer: 30s')
+    contents = ['[idmapping]', 'mongo-host=foo', 'mongo-db=bar', 'namespace-cache-ttl=30s']
+    fail_kb_config(mock_path_to_file('path/2/whee', contents, True), IDMappingConfigError(err))
+
+
+def test_kb_config_fail_user_cache_negative_ttl_not_int():
+    err = ('Parameter user-cache-negative-ttl in configuration file path/2/whee, ' +
+           'section idmapping, is not an integer: 1.5')
+    contents = ['[idmapping]', 'mongo-host=foo', 'mongo-db=bar', 'user-cache-negative-ttl=1.5']
+    fail_kb_config(mock_path_to_file('path/2/whee', contents, True), IDMappingConfigError(err))
+
+
+def test_kb_config_fail_local_user_refresh_interval_not_int():
+    err = ('Parameter local-user-refresh-interval in configuration file path/2/whee, ' +
+           'section idmapping, is not an integer: foo')
+    contents = ['[idmapping]', 'mongo-host=foo', 'mongo-db=bar',
+                'local-user-refresh-interval=foo']
+    fail_kb_config(mock_path_to_file('path/2/whee', contents, True), IDMappingConfigError(err))
+
+
+def test_kb_config_fail_profile_sample_rate():
+    err = ('Parameter profile-sample-rate in configuration file path/2/whee, ' +
+           'section idmapping, is not a number: often')
+    contents = ['[idmapping]', 'mongo-host=foo', 'mongo-db=bar', 'profile-sample-rate=often']
+    fail_kb_config(mock_path_to_file('path/2/whee', contents, True), IDMappingConfigError(err))
+
+    for rate in ['-0.1', '1.5']:
+        err = ('Parameter profile-sample-rate in configuration file path/2/whee, ' +
+               'section idmapping, must be between 0 and 1: ' + str(float(rate)))
+        contents = ['[idmapping]', 'mongo-host=foo', 'mongo-db=bar',
+                    'profile-sample-rate=' + rate]
+        fail_kb_config(mock_path_to_file('path/2/whee', contents, True),
+                       IDMappingConfigError(err))
+
+
+def test_kb_config_fail_profile_max_size():
+    err = ('Parameter profile-max-size-mb in configuration file path/2/whee, ' +
+           'section idmapping, is not an integer: 1.5')
+    contents = ['[idmapping]', 'mongo-host=foo', 'mongo-db=bar', 'profile-max-size-mb=1.5']
+    fail_kb_config(mock_path_to_file('path/2/whee', contents, True), IDMappingConfigError(err))
+
+    err = ('Parameter profile-max-size-mb in configuration file path/2/whee, ' +
+           'section idmapping, must be at least 1: 0')
+    contents = ['[idmapping]', 'mongo-host=foo', 'mongo-db=bar', 'profile-max-size-mb=0']
+    fail_kb_config(mock_path_to_file('path/2/whee', contents, True), IDMappingConfigError(err))
+
+
+def test_kb_config_fail_read_preference():
+    for key in ['mongo-read-preference-mappings', 'mongo-read-preference-namespaces']:
+        err = ('Parameter ' + key + ' in configuration file path/2/whee, section idmapping, ' +
+               'must be one of primary, primaryPreferred, secondary, secondaryPreferred, ' +
+               'nearest: secondarypreferred')
+        contents = ['[idmapping]', 'mongo-host=foo', 'mongo-db=bar',
+                    key + '=secondarypreferred']
+        fail_kb_config(mock_path_to_file('path/2/whee', contents, True),
+                       IDMappingConfigError(err))
+
+
+def test_kb_config_fail_max_staleness():
+    err = ('Parameter mongo-max-staleness-sec in configuration file path/2/whee, ' +
+           'section idmapping, is not an integer: 1.5')
+    contents = ['[idmapping]', 'mongo-host=foo', 'mongo-db=bar', 'mongo-max-staleness-sec=1.5']
+    fail_kb_config(mock_path_to_file('path/2/whee', contents, True), IDMappingConfigError(err))
+
+    for staleness in ['-2', '-90', '0', '89']:
+        err = ('Parameter mongo-max-staleness-sec in configuration file path/2/whee, ' +
+               'section idmapping, must be -1 or at least 90: ' + staleness)
+        contents = ['[idmapping]', 'mongo-host=foo', 'mongo-db=bar',
+                    'mongo-max-staleness-sec=' + staleness]
+        fail_kb_config(mock_path_to_file('path/2/whee', contents, True),
+                       IDMappingConfigError(err))
+
+
 def test_kb_config_fail_illegal_authsource():
     err = ('Parameter authentication-enabled in configuration file path/2/whee, ' +
            'section idmapping, is invalid: 30001 Illegal input parameter: Illegal character ' +
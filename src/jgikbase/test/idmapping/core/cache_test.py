@@ -0,0 +1,51 @@
+from unittest.mock import create_autospec
+from jgikbase.idmapping.core.cache import InProcessCache
+from jgikbase.test.idmapping.test_utils import assert_exception_correct
+from pytest import raises
+import time
+
+
+def test_get_set():
+    timer = create_autospec(time.time, spec_set=True)
+    cache = InProcessCache(default_ttl=100, timer=timer)
+    timer.return_value = 0
+
+    assert cache.get("k1") is None
+
+    cache.set("k1", ["as", "user", True])
+    cache.set("k2", False, ttl=10)
+    assert cache.get("k1") == ["as", "user", True]
+    assert cache.get("k2") is False
+
+    timer.return_value = 9.9
+    assert cache.get("k2") is False
+    timer.return_value = 10
+    assert cache.get("k2") is None
+    timer.return_value = 99.9
+    assert cache.get("k1") == ["as", "user", True]
+    timer.return_value = 100
+    assert cache.get("k1") is None
+
+
+def test_max_size():
+    cache = InProcessCache(max_size=2)
+    cache.set("k1", 1)
+    cache.set("k2", 2)
+    assert cache.get("k1") == 1  # k2 is now least recently used
+    cache.set("k3", 3)
+
+    assert cache.get("k1") == 1
+    assert cache.get("k2") is None
+    assert cache.get("k3") == 3
+
+
+def test_get_set_fail_bad_input():
+    cache = InProcessCache()
+    for fn, args, err in [
+        (cache.get, [None], "key cannot be None"),
+        (cache.set, [None, "v"], "key cannot be None"),
+        (cache.set, ["k", None], "value cannot be None"),
+    ]:
+        with raises(Exception) as got:
+            fn(*args)
+        assert_exception_correct(got.value, TypeError(err))
@@ -0,0 +1,43 @@
+from jgikbase.idmapping.core import consistency
+
+
+def test_no_request():
+    consistency.stop_request()
+    assert consistency.get_read_token() is None
+    consistency.set_write_token('foo')  # does nothing
+    assert consistency.get_read_token() is None
+
+
+def test_request_no_read_token():
+    ctx = consistency.start_request()
+    try:
+        assert ctx.read_token is None
+        assert ctx.write_token is None
+        assert consistency.get_read_token() is None
+    finally:
+        consistency.stop_request()
+
+
+def test_request():
+    ctx = consistency.start_request('readtoken')
+    try:
+        assert consistency.get_read_token() == 'readtoken'
+        consistency.set_write_token('write1')
+        consistency.set_write_token('write2')
+        assert ctx.read_token == 'readtoken'
+        assert ctx.write_token == 'write2'
+    finally:
+        consistency.stop_request()
+    assert consistency.get_read_token() is None
+
+
+def test_start_request_replaces_context():
+    ctx1 = consistency.start_request('tok1')
+    ctx2 = consistency.start_request('tok2')
+    try:
+        consistency.set_write_token('w')
+        assert consistency.get_read_token() == 'tok2'
+        assert ctx1.write_token is None
+        assert ctx2.write_token == 'w'
+    finally:
+        consistency.stop_request()
@@ -1,12 +1,13 @@
 from unittest.mock import create_autospec
 from jgikbase.idmapping.storage.id_mapping_storage import IDMappingStorage
-from jgikbase.idmapping.core.mapper import IDMapper
+from jgikbase.idmapping.core.mapper import IDMapper, _prefix_end
 from jgikbase.idmapping.core.object_id import NamespaceID, Namespace, ObjectID
 from pytest import raises
 from jgikbase.test.idmapping.test_utils import assert_exception_correct, TerstFermerttr
 from jgikbase.idmapping.core.user_lookup import UserLookupSet
 from jgikbase.idmapping.core.user import AuthsourceID, Username, User
 from jgikbase.idmapping.core.errors import NoSuchUserError, UnauthorizedError, NoSuchNamespaceError
+from jgikbase.idmapping.core.errors import MissingParameterError, IllegalParameterError
 from jgikbase.idmapping.core.tokens import Token
 from pytest import fixture
 import logging
@@ -75,6 +76,72 @@ def test_create_namespace(log_collector):
     assert_logs_correct(log_collector, 'Admin as/foo created namespace baz')
 
 
+def test_namespace_cache_invalidated_on_change():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set([AuthsourceID('as')]), storage, namespace_cache_expiration=300)
+
+    handlers.get_user.return_value = (User(AuthsourceID('as'), Username('foo')), True)
+    handlers.is_valid_user.return_value = True
+    storage.get_namespace_version.return_value = 1
+    storage.get_namespaces.return_value = set([Namespace(NamespaceID('n'), False, set([
+        User(AuthsourceID('as'), Username('foo'))]))])
+
+    idm.get_namespace(NamespaceID('n'))
+    idm.get_namespace(NamespaceID('n'))
+    assert storage.get_namespaces.call_args_list == [((), {})]
+
+    idm.create_namespace(AuthsourceID('as'), Token('t'), NamespaceID('n2'))
+    idm.get_namespace(NamespaceID('n'))
+    assert storage.get_namespaces.call_args_list == [((), {})] * 2
+
+    idm.add_user_to_namespace(AuthsourceID('as'), Token('t'), NamespaceID('n'),
+                              User(AuthsourceID('as'), Username('bar')))
+    idm.get_namespace(NamespaceID('n'))
+    assert storage.get_namespaces.call_args_list == [((), {})] * 3
+
+    idm.remove_user_from_namespace(AuthsourceID('as'), Token('t'), NamespaceID('n'),
+                                   User(AuthsourceID('as'), Username('bar')))
+    idm.get_namespace(NamespaceID('n'))
+    assert storage.get_namespaces.call_args_list == [((), {})] * 4
+
+    idm.set_namespace_publicly_mappable(AuthsourceID('as'), Token('t'), NamespaceID('n'), True)
+    idm.get_namespace(NamespaceID('n'))
+    assert storage.get_namespaces.call_args_list == [((), {})] * 5
+    assert storage.get_namespace.call_args_list == []
+
+
+def test_is_sys_admin():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set([AuthsourceID('as')]), storage)
+
+    handlers.get_user.side_effect = [(User(AuthsourceID('as'), Username('foo')), True),
+                                     (User(AuthsourceID('as'), Username('bar')), False)]
+
+    assert idm.is_sys_admin(AuthsourceID('as'), Token('t')) is True
+    assert idm.is_sys_admin(AuthsourceID('as'), Token('t2')) is False
+    # the authsource isn't trusted to define admins
+    assert idm.is_sys_admin(AuthsourceID('bs'), Token('t3')) is False
+
+    assert handlers.get_user.call_args_list == [((AuthsourceID('as'), Token('t')), {}),
+                                                ((AuthsourceID('as'), Token('t2')), {})]
+
+
+def test_is_sys_admin_fail_None_input():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+    idm = IDMapper(handlers, set(), storage)
+
+    for as_, t, expected in [(None, Token('t'), TypeError('authsource_id cannot be None')),
+                             (AuthsourceID('as'), None, TypeError('token cannot be None'))]:
+        with raises(Exception) as got:
+            idm.is_sys_admin(as_, t)
+        assert_exception_correct(got.value, expected)
+
+
 def test_create_namespace_fail_None_input():
     storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
     handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
@@ -203,6 +270,84 @@ def fail_add_user_to_namespace(idmapper, authsource, token, namespace_id, user,
     assert_exception_correct(got.value, expected)
 
 
+def test_add_users_to_namespace(log_collector):
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set([AuthsourceID('astwo')]), storage)
+
+    u1 = User(AuthsourceID('asone'), Username('u1'))
+    u2 = User(AuthsourceID('astwo'), Username('u2'))
+    handlers.get_user.return_value = (User(AuthsourceID('astwo'), Username('foo')), True)
+    handlers.are_valid_users.return_value = {u1: True, u2: True}
+
+    idm.add_users_to_namespace(AuthsourceID('astwo'), Token('t'), NamespaceID('ns1'), {u1, u2})
+
+    assert handlers.get_user.call_args_list == [((AuthsourceID('astwo'), Token('t'),), {})]
+    assert handlers.are_valid_users.call_args_list == [(({u1, u2},), {})]
+    assert handlers.is_valid_user.call_args_list == []
+    assert storage.add_users_to_namespace.call_args_list == \
+        [((NamespaceID('ns1'), {u1, u2}), {})]
+
+    assert_logs_correct(log_collector,
+                        'Admin astwo/foo added users asone/u1, astwo/u2 to namespace ns1')
+
+
+def test_add_users_to_namespace_fail_None_input():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    as_ = AuthsourceID('a')
+    t = Token('t')
+    n = NamespaceID('n')
+    u = User(AuthsourceID('b'), Username('u'))
+
+    # authsource id is checked by the handler set
+    fail_add_users_to_namespace(idm, as_, None, n, {u}, TypeError('token cannot be None'))
+    fail_add_users_to_namespace(idm, as_, t, None, {u}, TypeError('namespace_id cannot be None'))
+    fail_add_users_to_namespace(idm, as_, t, n, None, TypeError('users cannot be None'))
+    fail_add_users_to_namespace(idm, as_, t, n, {u, None}, TypeError('None item in users'))
+
+
+def test_add_users_to_namespace_fail_not_admin():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set([AuthsourceID('as')]), storage)
+
+    handlers.get_user.return_value = (User(AuthsourceID('as'), Username('foo')), False)
+
+    fail_add_users_to_namespace(idm, AuthsourceID('as'), Token('t'), NamespaceID('n'),
+                                {User(AuthsourceID('as'), Username('u'))},
+                                UnauthorizedError('User as/foo is not a system administrator'))
+    assert handlers.are_valid_users.call_args_list == []
+
+
+def test_add_users_to_namespace_fail_no_such_user():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set([AuthsourceID('asone')]), storage)
+
+    u1 = User(AuthsourceID('asone'), Username('u1'))
+    u2 = User(AuthsourceID('asone'), Username('u2'))
+    u3 = User(AuthsourceID('astwo'), Username('u3'))
+    handlers.get_user.return_value = (User(AuthsourceID('asone'), Username('bar')), True)
+    handlers.are_valid_users.return_value = {u1: False, u2: True, u3: False}
+
+    fail_add_users_to_namespace(idm, AuthsourceID('asone'), Token('t'), NamespaceID('n'),
+                                {u1, u2, u3}, NoSuchUserError('asone/u1, astwo/u3'))
+    assert storage.add_users_to_namespace.call_args_list == []
+
+
+def fail_add_users_to_namespace(idmapper, authsource, token, namespace_id, users, expected):
+    with raises(Exception) as got:
+        idmapper.add_users_to_namespace(authsource, token, namespace_id, users)
+    assert_exception_correct(got.value, expected)
+
+
 def test_remove_user_from_namespace(log_collector):
     storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
     handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
@@ -438,7 +583,7 @@ def test_get_namespaces_empty():
     storage.get_namespaces.return_value = set()
 
     assert idm.get_namespaces() == (set(), set())
-    assert storage.get_namespaces.call_args_list == [((), {})]
+    assert storage.get_namespaces.call_args_list == [((None,), {'include_users': False})]
 
 
 def test_get_namespaces_only_public():
@@ -451,7 +596,7 @@ def test_get_namespaces_only_public():
                                                Namespace(NamespaceID('n2'), True)])
 
     assert idm.get_namespaces() == (set([NamespaceID('n1'), NamespaceID('n2')]), set())
-    assert storage.get_namespaces.call_args_list == [((), {})]
+    assert storage.get_namespaces.call_args_list == [((None,), {'include_users': False})]
 
 
 def test_get_namespaces_only_private():
@@ -464,7 +609,7 @@ def test_get_namespaces_only_private():
                                                Namespace(NamespaceID('n4'), False)])
 
     assert idm.get_namespaces() == (set(), set([NamespaceID('n3'), NamespaceID('n4')]))
-    assert storage.get_namespaces.call_args_list == [((), {})]
+    assert storage.get_namespaces.call_args_list == [((None,), {'include_users': False})]
 
 
 def test_get_namespaces_both():
@@ -480,7 +625,7 @@ def test_get_namespaces_both():
 
     assert idm.get_namespaces() == (set([NamespaceID('n1'), NamespaceID('n2')]),
                                     set([NamespaceID('n3'), NamespaceID('n4')]))
-    assert storage.get_namespaces.call_args_list == [((), {})]
+    assert storage.get_namespaces.call_args_list == [((None,), {'include_users': False})]
 
 
 def test_create_mapping_publicly_mappable(log_collector):
@@ -661,6 +806,196 @@ def fail_remove_mapping(idm, authsource_id, token, oid1, oid2, expected):
     assert_exception_correct(got.value, expected)
 
 
+def test_create_mappings_publicly_mappable(log_collector):
+    check_create_mappings(Namespace(NamespaceID('n2'), True), log_collector)
+
+
+def test_create_mappings_privately_mappable(log_collector):
+    check_create_mappings(Namespace(NamespaceID('n2'), False, set([
+            User(AuthsourceID('a'), Username('n')), User(AuthsourceID('b'), Username('n2'))])),
+        log_collector)
+
+
+def check_create_mappings(targetns: Namespace, log_collector):
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    handlers.get_user.return_value = (User(AuthsourceID('a'), Username('n')), False)
+    storage.get_namespace.side_effect = [
+        Namespace(NamespaceID('n1'), False, set([
+            User(AuthsourceID('a'), Username('n')), User(AuthsourceID('a'), Username('n2'))])),
+        targetns]
+    storage.add_mappings.return_value = (1, 1)
+
+    assert idm.create_mappings(AuthsourceID('a'), Token('t'), NamespaceID('n1'),
+                               NamespaceID('n2'), [('o1', 'o2'), ('o3', 'o4')]) == (1, 1)
+
+    assert handlers.get_user.call_args_list == [((AuthsourceID('a'), Token('t'),), {})]
+    assert storage.get_namespace.call_args_list == [((NamespaceID('n1'),), {}),
+                                                    ((NamespaceID('n2'),), {})]
+    assert storage.add_mappings.call_args_list == [(([
+        (ObjectID(NamespaceID('n1'), 'o1'), ObjectID(NamespaceID('n2'), 'o2')),
+        (ObjectID(NamespaceID('n1'), 'o3'), ObjectID(NamespaceID('n2'), 'o4'))],), {})]
+
+    assert_logs_correct(log_collector, 'User a/n created 1 mappings n1 <---> n2, 1 already existed')
+
+
+def test_create_mappings_fail_None_input():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    a = AuthsourceID('a')
+    t = Token('t')
+    n1 = NamespaceID('n1')
+    n2 = NamespaceID('n2')
+    p = [('o1', 'o2')]
+
+    # authsource id is checked by the handler set
+    fail_create_mappings(idm, a, None, n1, n2, p, TypeError('token cannot be None'))
+    fail_create_mappings(idm, a, t, None, n2, p,
+                         TypeError('administrative_namespace_id cannot be None'))
+    fail_create_mappings(idm, a, t, n1, None, p, TypeError('namespace_id cannot be None'))
+    fail_create_mappings(idm, a, t, n1, n2, None, TypeError('id_pairs cannot be None'))
+    fail_create_mappings(idm, a, t, n1, n2, [('o1', 'o2'), None],
+                         TypeError('None item in id_pairs'))
+    fail_create_mappings(idm, a, t, n1, n2, [('o1', 'o2'), ('  \t  ', 'o4')],
+                         MissingParameterError('data id'))
+
+    assert handlers.get_user.call_args_list == []
+    assert storage.add_mappings.call_args_list == []
+
+
+def test_create_mappings_fail_unauthed_for_admin_namespace():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    handlers.get_user.return_value = (User(AuthsourceID('a'), Username('n')), False)
+    storage.get_namespace.return_value = Namespace(NamespaceID('n1'), True, set([
+            User(AuthsourceID('a'), Username('n1')), User(AuthsourceID('a'), Username('n2'))]))
+
+    fail_create_mappings(idm, AuthsourceID('a'), Token('t'), NamespaceID('n1'),
+                         NamespaceID('n2'), [('o1', 'o2')],
+                         UnauthorizedError('User a/n may not administrate namespace n1'))
+    assert storage.add_mappings.call_args_list == []
+
+
+def test_create_mappings_fail_unauthed_for_other_namespace():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    handlers.get_user.return_value = (User(AuthsourceID('a'), Username('n')), False)
+    storage.get_namespace.side_effect = [
+        Namespace(NamespaceID('n1'), True, set([
+            User(AuthsourceID('a'), Username('n')), User(AuthsourceID('a'), Username('n2'))])),
+        Namespace(NamespaceID('n2'), False, set([
+            User(AuthsourceID('a'), Username('n2')), User(AuthsourceID('b'), Username('n2'))]))]
+
+    fail_create_mappings(idm, AuthsourceID('a'), Token('t'), NamespaceID('n1'),
+                         NamespaceID('n2'), [('o1', 'o2')],
+                         UnauthorizedError('User a/n may not administrate namespace n2'))
+    assert storage.add_mappings.call_args_list == []
+
+
+def fail_create_mappings(idm, authsource_id, token, ns1, ns2, pairs, expected):
+    with raises(Exception) as got:
+        idm.create_mappings(authsource_id, token, ns1, ns2, pairs)
+    assert_exception_correct(got.value, expected)
+
+
+def test_remove_mappings(log_collector):
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    handlers.get_user.return_value = (User(AuthsourceID('a'), Username('n')), False)
+    storage.get_namespace.side_effect = [
+        Namespace(NamespaceID('n1'), False, set([
+            User(AuthsourceID('a'), Username('n')), User(AuthsourceID('a'), Username('n2'))])),
+        Namespace(NamespaceID('n2'), False)]
+    storage.remove_mappings.return_value = 1
+
+    assert idm.remove_mappings(AuthsourceID('a'), Token('t'), NamespaceID('n1'),
+                               NamespaceID('n2'), [('o1', 'o2'), ('o3', 'o4')]) == 1
+
+    assert handlers.get_user.call_args_list == [((AuthsourceID('a'), Token('t'),), {})]
+    assert storage.get_namespace.call_args_list == [((NamespaceID('n1'),), {}),
+                                                    ((NamespaceID('n2'),), {})]
+    assert storage.remove_mappings.call_args_list == [(([
+        (ObjectID(NamespaceID('n1'), 'o1'), ObjectID(NamespaceID('n2'), 'o2')),
+        (ObjectID(NamespaceID('n1'), 'o3'), ObjectID(NamespaceID('n2'), 'o4'))],), {})]
+
+    assert_logs_correct(log_collector, 'User a/n removed 1 mappings n1 <---> n2')
+
+
+def test_remove_mappings_fail_None_input():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    a = AuthsourceID('a')
+    t = Token('t')
+    n1 = NamespaceID('n1')
+    n2 = NamespaceID('n2')
+    p = [('o1', 'o2')]
+
+    # authsource id is checked by the handler set
+    fail_remove_mappings(idm, a, None, n1, n2, p, TypeError('token cannot be None'))
+    fail_remove_mappings(idm, a, t, None, n2, p,
+                         TypeError('administrative_namespace_id cannot be None'))
+    fail_remove_mappings(idm, a, t, n1, None, p, TypeError('namespace_id cannot be None'))
+    fail_remove_mappings(idm, a, t, n1, n2, None, TypeError('id_pairs cannot be None'))
+    fail_remove_mappings(idm, a, t, n1, n2, [None], TypeError('None item in id_pairs'))
+
+
+def test_remove_mappings_fail_unauthed_for_admin_namespace():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    handlers.get_user.return_value = (User(AuthsourceID('a'), Username('n')), False)
+    storage.get_namespace.return_value = Namespace(NamespaceID('n1'), True, set([
+            User(AuthsourceID('a'), Username('n1')), User(AuthsourceID('a'), Username('n2'))]))
+
+    fail_remove_mappings(idm, AuthsourceID('a'), Token('t'), NamespaceID('n1'),
+                         NamespaceID('n2'), [('o1', 'o2')],
+                         UnauthorizedError('User a/n may not administrate namespace n1'))
+    assert storage.remove_mappings.call_args_list == []
+
+
+def test_remove_mappings_fail_no_such_other_namespace():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    handlers.get_user.return_value = (User(AuthsourceID('a'), Username('n')), False)
+    storage.get_namespace.side_effect = [
+        Namespace(NamespaceID('n1'), False, set([
+            User(AuthsourceID('a'), Username('n')), User(AuthsourceID('a'), Username('n2'))])),
+        NoSuchNamespaceError('n2')]
+
+    fail_remove_mappings(idm, AuthsourceID('a'), Token('t'), NamespaceID('n1'),
+                         NamespaceID('n2'), [('o1', 'o2')], NoSuchNamespaceError('n2'))
+    assert storage.remove_mappings.call_args_list == []
+
+
+def fail_remove_mappings(idm, authsource_id, token, ns1, ns2, pairs, expected):
+    with raises(Exception) as got:
+        idm.remove_mappings(authsource_id, token, ns1, ns2, pairs)
+    assert_exception_correct(got.value, expected)
+
+
 def test_get_mappings():
     storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
     handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
@@ -752,3 +1087,304 @@ def fail_get_mappings(idm, oid, filters, expected):
     with raises(Exception) as got:
         idm.get_mappings(oid, filters)
     assert_exception_correct(got.value, expected)
+
+
+def test_get_mappings_bulk():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    storage.get_namespaces.return_value = set([Namespace(NamespaceID('n'), False)])
+    storage.find_mappings_bulk.return_value = {
+        'o': (set([ObjectID(NamespaceID('n1'), 'o1')]), set([ObjectID(NamespaceID('n3'), 'o3')])),
+        'p': (set(), set())}
+
+    assert idm.get_mappings_bulk(NamespaceID('n'), ['o', 'p']) == {
+        'o': (set([ObjectID(NamespaceID('n1'), 'o1')]), set([ObjectID(NamespaceID('n3'), 'o3')])),
+        'p': (set(), set())}
+
+    assert storage.get_namespaces.call_args_list == [(([NamespaceID('n')],), {})]
+    assert storage.find_mappings_bulk.call_args_list == [((NamespaceID('n'), ['o', 'p']),
+                                                          {'ns_filter': None})]
+
+
+def test_get_mappings_bulk_with_filter():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    storage.get_namespaces.return_value = set([Namespace(NamespaceID('n'), False),
+                                               Namespace(NamespaceID('n1'), False)])
+    storage.find_mappings_bulk.return_value = {
+        'o': (set([ObjectID(NamespaceID('n1'), 'o1')]), set())}
+
+    assert idm.get_mappings_bulk(NamespaceID('n'), ['o'], [NamespaceID('n1')]) == {
+        'o': (set([ObjectID(NamespaceID('n1'), 'o1')]), set())}
+
+    assert storage.get_namespaces.call_args_list == [(([NamespaceID('n'),
+                                                        NamespaceID('n1')],), {})]
+    assert storage.find_mappings_bulk.call_args_list == [((NamespaceID('n'), ['o']),
+                                                          {'ns_filter': [NamespaceID('n1')]})]
+
+
+def test_get_mappings_bulk_fail_bad_inputs():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    n = NamespaceID('n')
+
+    fail_get_mappings_bulk(idm, None, ['o'], set([n]), TypeError('namespace_id cannot be None'))
+    fail_get_mappings_bulk(idm, n, None, set([n]), TypeError('ids cannot be None'))
+    fail_get_mappings_bulk(idm, n, ['o', None], set([n]), TypeError('None item in ids'))
+    fail_get_mappings_bulk(idm, n, ['o', '  \t '], set([n]), MissingParameterError('data id'))
+    fail_get_mappings_bulk(idm, n, ['o'], set([n, None]), TypeError('None item in ns_filter'))
+
+    assert storage.get_namespaces.call_args_list == []
+
+
+def test_get_mappings_bulk_fail_no_namespace():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    storage.get_namespaces.side_effect = NoSuchNamespaceError('n3')
+
+    fail_get_mappings_bulk(idm, NamespaceID('n'), ['o'], [NamespaceID('n3')],
+                           NoSuchNamespaceError('n3'))
+
+    assert storage.find_mappings_bulk.call_args_list == []
+
+
+def fail_get_mappings_bulk(idm, namespace_id, ids, filters, expected):
+    with raises(Exception) as got:
+        idm.get_mappings_bulk(namespace_id, ids, filters)
+    assert_exception_correct(got.value, expected)
+
+
+def test_prefix_end():
+    assert _prefix_end('a') == 'b'
+    assert _prefix_end('GCF_0015') == 'GCF_0016'
+    assert _prefix_end('ab.') == 'ab/'
+    assert _prefix_end('a\ud7ff') == 'a\ue000'
+    assert _prefix_end('a\U0010ffff') == 'b'
+    assert _prefix_end('a\U0010ffff\U0010ffff') == 'b'
+    assert _prefix_end('\U0010ffff') is None
+    assert _prefix_end('') is None
+
+
+def test_get_mappings_in_range():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    storage.get_namespaces.return_value = set([Namespace(NamespaceID('n'), False)])
+    storage.find_mappings_range.return_value = (
+        {'o': (set([ObjectID(NamespaceID('n1'), 'o1')]), set())}, True)
+
+    assert idm.get_mappings_in_range(NamespaceID('n'), 'a') == (
+        {'o': (set([ObjectID(NamespaceID('n1'), 'o1')]), set())}, True)
+    assert idm.get_mappings_in_range(
+        NamespaceID('n'), 'a', 'p', [NamespaceID('n1')], 1, 'b') == (
+        {'o': (set([ObjectID(NamespaceID('n1'), 'o1')]), set())}, True)
+
+    assert storage.get_namespaces.call_args_list == [
+        (([NamespaceID('n')],), {}), (([NamespaceID('n'), NamespaceID('n1')],), {})]
+    assert storage.find_mappings_range.call_args_list == [
+        ((NamespaceID('n'), 'a', None), {'ns_filter': None, 'limit': 100, 'after': None}),
+        ((NamespaceID('n'), 'a', 'p'),
+         {'ns_filter': [NamespaceID('n1')], 'limit': 1, 'after': 'b'}),
+    ]
+
+
+def test_get_mappings_with_prefix():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    storage.get_namespaces.return_value = set([Namespace(NamespaceID('n'), False)])
+    storage.find_mappings_range.return_value = ({}, False)
+
+    assert idm.get_mappings_with_prefix(NamespaceID('n'), 'GCF_0015') == ({}, False)
+    assert idm.get_mappings_with_prefix(
+        NamespaceID('n'), 'GCF_0015', [NamespaceID('n')], 10, 'GCF_00151') == ({}, False)
+
+    assert storage.find_mappings_range.call_args_list == [
+        ((NamespaceID('n'), 'GCF_0015', 'GCF_0016'),
+         {'ns_filter': None, 'limit': 100, 'after': None}),
+        ((NamespaceID('n'), 'GCF_0015', 'GCF_0016'),
+         {'ns_filter': [NamespaceID('n')], 'limit': 10, 'after': 'GCF_00151'}),
+    ]
+
+
+def test_get_mappings_range_fail_bad_inputs():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    n = NamespaceID('n')
+    long_ = 'b' * 1001
+
+    fail_get_mappings_in_range(idm, None, 'a', None, None, 1, None,
+                               TypeError('namespace_id cannot be None'))
+    fail_get_mappings_in_range(idm, n, None, None, None, 1, None,
+                               TypeError('start cannot be None'))
+    fail_get_mappings_in_range(idm, n, '  \t ', None, None, 1, None,
+                               MissingParameterError('data id'))
+    fail_get_mappings_in_range(idm, n, 'a', long_, None, 1, None, IllegalParameterError(
+        'data id ' + long_ + ' exceeds maximum length of 1000'))
+    fail_get_mappings_in_range(idm, n, 'a', None, None, 1, ' ',
+                               MissingParameterError('data id'))
+    fail_get_mappings_in_range(idm, n, 'a', None, [n, None], 1, None,
+                               TypeError('None item in ns_filter'))
+    for limit in [0, -1]:
+        fail_get_mappings_in_range(idm, n, 'a', None, None, limit, None,
+                                   IllegalParameterError('limit must be at least 1'))
+
+    with raises(Exception) as got:
+        idm.get_mappings_with_prefix(n, None)
+    assert_exception_correct(got.value, TypeError('prefix cannot be None'))
+
+    assert storage.get_namespaces.call_args_list == []
+
+
+def test_get_mappings_range_fail_no_namespace():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    storage.get_namespaces.side_effect = NoSuchNamespaceError('n3')
+
+    fail_get_mappings_in_range(idm, NamespaceID('n'), 'a', None, [NamespaceID('n3')], 1, None,
+                               NoSuchNamespaceError('n3'))
+
+    assert storage.find_mappings_range.call_args_list == []
+
+
+def fail_get_mappings_in_range(idm, namespace_id, start, end, filters, limit, after, expected):
+    with raises(Exception) as got:
+        idm.get_mappings_in_range(namespace_id, start, end, filters, limit, after)
+    assert_exception_correct(got.value, expected)
+
+
+def test_iter_mappings():
+    check_iter_mappings(None)
+    check_iter_mappings(('a', 'b'))
+
+
+def check_iter_mappings(after):
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    storage.get_namespaces.return_value = set([Namespace(NamespaceID('n1'), False),
+                                               Namespace(NamespaceID('n2'), False)])
+    storage.iter_mappings.return_value = iter([('a', 'c'), ('b', 'a')])
+
+    assert list(idm.iter_mappings(NamespaceID('n1'), NamespaceID('n2'), after)) == [
+        ('a', 'c'), ('b', 'a')]
+
+    assert storage.get_namespaces.call_args_list == [(({NamespaceID('n1'),
+                                                        NamespaceID('n2')},), {})]
+    assert storage.iter_mappings.call_args_list == [
+        ((NamespaceID('n1'), NamespaceID('n2'), after), {})]
+
+
+def test_iter_mappings_same_namespace():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    storage.get_namespaces.return_value = set([Namespace(NamespaceID('n'), False)])
+    storage.iter_mappings.return_value = iter([('a', 'b')])
+
+    assert list(idm.iter_mappings(NamespaceID('n'), NamespaceID('n'))) == [('a', 'b')]
+
+    assert storage.get_namespaces.call_args_list == [(({NamespaceID('n')},), {})]
+    assert storage.iter_mappings.call_args_list == [
+        ((NamespaceID('n'), NamespaceID('n'), None), {})]
+
+
+def test_iter_mappings_fail_bad_inputs():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    n = NamespaceID('n')
+
+    fail_iter_mappings(idm, None, n, None,
+                       TypeError('administrative_namespace_id cannot be None'))
+    fail_iter_mappings(idm, n, None, None, TypeError('namespace_id cannot be None'))
+    fail_iter_mappings(idm, n, n, ('a', None), TypeError('None item in after'))
+    fail_iter_mappings(idm, n, n, ('  \t ', 'b'), MissingParameterError('data id'))
+    fail_iter_mappings(idm, n, n, ('a', 'b' * 1001), IllegalParameterError(
+        'data id ' + 'b' * 1001 + ' exceeds maximum length of 1000'))
+
+    assert storage.get_namespaces.call_args_list == []
+
+
+def test_iter_mappings_fail_no_namespace():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    storage.get_namespaces.side_effect = NoSuchNamespaceError('n2')
+
+    fail_iter_mappings(idm, NamespaceID('n1'), NamespaceID('n2'), None,
+                       NoSuchNamespaceError('n2'))
+
+    assert storage.iter_mappings.call_args_list == []
+
+
+def fail_iter_mappings(idm, admin_ns, ns, after, expected):
+    with raises(Exception) as got:
+        idm.iter_mappings(admin_ns, ns, after)
+    assert_exception_correct(got.value, expected)
+
+
+def test_get_mapping_counts():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    storage.get_namespace.return_value = Namespace(NamespaceID('n1'), False)
+    storage.get_mapping_counts.return_value = ({NamespaceID('n2'): 3}, {NamespaceID('n3'): 1})
+
+    assert idm.get_mapping_counts(NamespaceID('n1')) == (
+        {NamespaceID('n2'): 3}, {NamespaceID('n3'): 1})
+
+    assert storage.get_namespace.call_args_list == [((NamespaceID('n1'),), {})]
+    assert storage.get_mapping_counts.call_args_list == [((NamespaceID('n1'),), {})]
+
+
+def test_get_mapping_counts_fail():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    handlers = create_autospec(UserLookupSet, spec_set=True, instance=True)
+
+    idm = IDMapper(handlers, set(), storage)
+
+    fail_get_mapping_counts(idm, None, TypeError('namespace_id cannot be None'))
+
+    storage.get_namespace.side_effect = NoSuchNamespaceError('n1')
+    fail_get_mapping_counts(idm, NamespaceID('n1'), NoSuchNamespaceError('n1'))
+
+    assert storage.get_mapping_counts.call_args_list == []
+
+
+def fail_get_mapping_counts(idm, namespace_id, expected):
+    with raises(Exception) as got:
+        idm.get_mapping_counts(namespace_id)
+    assert_exception_correct(got.value, expected)
@@ -0,0 +1,221 @@
+from unittest.mock import create_autospec
+from jgikbase.idmapping.storage.id_mapping_storage import IDMappingStorage
+from jgikbase.idmapping.core.mapping_loader import MappingLoader, LoadProgress
+from jgikbase.idmapping.core.object_id import NamespaceID, ObjectID
+from jgikbase.idmapping.core.errors import (
+    NoSuchNamespaceError,
+    IllegalParameterError,
+    MissingParameterError,
+)
+from jgikbase.idmapping.storage.errors import IDMappingStorageError
+from jgikbase.test.idmapping.test_utils import assert_exception_correct
+from pytest import raises
+from io import BytesIO
+import time
+
+
+def oids(admin_id, other_id):
+    return (ObjectID(NamespaceID('a'), admin_id), ObjectID(NamespaceID('o'), other_id))
+
+
+def test_init_fail():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+
+    fail_init(None, 1, 1, TypeError('storage cannot be None'))
+    fail_init(storage, 0, 1, ValueError('chunk_size must be at least 1'))
+    fail_init(storage, 1, 0, ValueError('writers must be at least 1'))
+
+
+def fail_init(storage, chunk_size, writers, expected):
+    with raises(Exception) as got:
+        MappingLoader(storage, chunk_size, writers)
+    assert_exception_correct(got.value, expected)
+
+
+def test_load_tsv():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    timer = create_autospec(time.time, spec_set=True)
+    timer.side_effect = [10, 11, 12, 13]
+    storage.add_mappings.side_effect = [(2, 0), (1, 1), (1, 0)]
+    progress = []
+
+    loader = MappingLoader(storage, chunk_size=2, timer=timer)
+    f = BytesIO(b'id1\tid2\nid3\tid4\n\n  id5\tid6  \r\nid7\tid8\nid9\tid10')
+
+    assert loader.load(f, NamespaceID('a'), NamespaceID('o'), progress=progress.append) == \
+        LoadProgress(6, 4, 1, 46, 3)
+
+    assert progress == [LoadProgress(2, 2, 0, 16, 1),
+                        LoadProgress(5, 3, 1, 38, 2),
+                        LoadProgress(6, 4, 1, 46, 3)]
+    assert storage.get_namespaces.call_args_list == [(({NamespaceID('a'), NamespaceID('o')},),
+                                                      {})]
+    assert storage.add_mappings.call_args_list == [
+        (([oids('id1', 'id2'), oids('id3', 'id4')],), {}),
+        (([oids('id5', 'id6'), oids('id7', 'id8')],), {}),
+        (([oids('id9', 'id10')],), {}),
+    ]
+
+
+def test_load_strips_ids():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    timer = create_autospec(time.time, spec_set=True)
+    timer.side_effect = [10, 11]
+    storage.add_mappings.return_value = (2, 0)
+
+    loader = MappingLoader(storage, timer=timer)
+    f = BytesIO(b'id1 \t id2\r\nid3\xc2\xa0\t id4\r\n')
+    assert loader.load(f, NamespaceID('a'), NamespaceID('o')) == LoadProgress(2, 2, 0, 23, 1)
+    assert storage.add_mappings.call_args_list == [
+        (([oids('id1', 'id2'), oids('id3', 'id4')],), {})]
+
+    storage.add_mappings.reset_mock()
+    storage.add_mappings.return_value = (1, 0)
+    timer.side_effect = [10, 11]
+    f = BytesIO(b'{"admin": " id1\\t", "other": "\\u00a0id2 "}\r\n')
+    assert loader.load(f, NamespaceID('a'), NamespaceID('o'), MappingLoader.NDJSON) == \
+        LoadProgress(1, 1, 0, 44, 1)
+    assert storage.add_mappings.call_args_list == [(([oids('id1', 'id2')],), {})]
+
+
+def test_load_ndjson_with_offset_and_writers():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    timer = create_autospec(time.time, spec_set=True)
+    timer.side_effect = [10, 11, 12]
+    storage.add_mappings.side_effect = [(1, 0), (1, 0)]
+    progress = []
+
+    loader = MappingLoader(storage, chunk_size=1, writers=3, timer=timer)
+    line1 = b'{"admin": "id1", "other": "id2"}\n'
+    f = BytesIO(line1 + b'{"admin": "id3", "other": "id4"}\n{"other": "id6", "admin": "id5"}\n')
+
+    assert loader.load(f, NamespaceID('a'), NamespaceID('o'), MappingLoader.NDJSON,
+                       len(line1), progress.append) == LoadProgress(2, 2, 0, 99, 2)
+
+    assert progress == [LoadProgress(1, 1, 0, 66, 1), LoadProgress(2, 2, 0, 99, 2)]
+    # writes may happen in any order
+    calls = storage.add_mappings.call_args_list
+    assert len(calls) == 2
+    assert (([oids('id3', 'id4')],), {}) in calls
+    assert (([oids('id5', 'id6')],), {}) in calls
+
+
+def test_load_same_namespace():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    timer = create_autospec(time.time, spec_set=True)
+    timer.side_effect = [10, 11]
+    storage.add_mappings.return_value = (2, 0)
+
+    loader = MappingLoader(storage, timer=timer)
+    f = BytesIO(b'id1\tid2\nid2\tid1\n')
+
+    assert loader.load(f, NamespaceID('a'), NamespaceID('a')) == LoadProgress(2, 2, 0, 16, 1)
+
+    assert storage.get_namespaces.call_args_list == [(({NamespaceID('a')},), {})]
+    a = NamespaceID('a')
+    assert storage.add_mappings.call_args_list == [
+        (([(ObjectID(a, 'id1'), ObjectID(a, 'id2')), (ObjectID(a, 'id2'), ObjectID(a, 'id1'))],),
+         {}),
+    ]
+
+
+def test_load_empty():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    timer = create_autospec(time.time, spec_set=True)
+    timer.return_value = 10
+
+    loader = MappingLoader(storage, timer=timer)
+
+    assert loader.load(BytesIO(b''), NamespaceID('a'), NamespaceID('o')) == \
+        LoadProgress(0, 0, 0, 0, 0)
+    assert storage.add_mappings.call_args_list == []
+
+
+def test_load_fail_bad_args():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    loader = MappingLoader(storage)
+    f = BytesIO(b'')
+    n = NamespaceID('n')
+
+    fail_load(loader, None, n, n, 'tsv', 0, TypeError('infile cannot be None'))
+    fail_load(loader, f, None, n, 'tsv', 0,
+              TypeError('administrative_namespace_id cannot be None'))
+    fail_load(loader, f, n, None, 'tsv', 0, TypeError('namespace_id cannot be None'))
+    fail_load(loader, f, n, n, 'csv', 0, ValueError('Unsupported file format: csv'))
+    fail_load(loader, f, n, n, 'tsv', -1, ValueError('start_offset must be at least 0'))
+
+    assert storage.get_namespaces.call_args_list == []
+
+
+def test_load_fail_no_namespace():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    storage.get_namespaces.side_effect = NoSuchNamespaceError('o')
+
+    fail_load(MappingLoader(storage), BytesIO(b'id1\tid2\n'), NamespaceID('a'),
+              NamespaceID('o'), 'tsv', 0, NoSuchNamespaceError('o'))
+    assert storage.add_mappings.call_args_list == []
+
+
+def test_load_fail_bad_lines():
+    fail_load_line(b'id1\tid2\tid3', 'tsv', IllegalParameterError,
+                   'Expected 2 tab separated IDs, got 3')
+    fail_load_line(b'id1', 'tsv', IllegalParameterError, 'Expected 2 tab separated IDs, got 1')
+    fail_load_line(b'id1\t   ', 'tsv', IllegalParameterError,
+                   'Expected 2 tab separated IDs, got 1')
+    fail_load_line(b'id1\t \tid2', 'tsv', IllegalParameterError,
+                   'Expected 2 tab separated IDs, got 3')
+    fail_load_line(b'\xc2\xa0\tid2', 'tsv', MissingParameterError,
+                   'Whitespace only administrative ID')
+    fail_load_line(b'id1\t' + b'i' * 1001, 'tsv', IllegalParameterError,
+                   'data id ' + 'i' * 1001 + ' exceeds maximum length of 1000')
+    fail_load_line(b'\xff\tid2', 'tsv', IllegalParameterError,
+                   "Invalid UTF-8: 'utf-8' codec can't decode byte 0xff in position 0: " +
+                   'invalid start byte')
+
+    fail_load_line(b'{"admin": "id1"', 'ndjson', IllegalParameterError,
+                   "Invalid JSON: Expecting ',' delimiter: line 1 column 16 (char 15)")
+    fail_load_line(b'["id1", "id2"]', 'ndjson', IllegalParameterError, 'Expected JSON object')
+    fail_load_line(b'{"admin": "id1", "other": 1}', 'ndjson', IllegalParameterError,
+                   'Expected string IDs at /admin and /other')
+    fail_load_line(b'{"other": "id1"}', 'ndjson', IllegalParameterError,
+                   'Expected string IDs at /admin and /other')
+    fail_load_line(b'{"admin": "id1", "other": "  "}', 'ndjson', MissingParameterError,
+                   'Whitespace only ID')
+    fail_load_line(b'{"admin": "\\t", "other": "id1"}', 'ndjson', MissingParameterError,
+                   'Whitespace only administrative ID')
+
+
+def fail_load_line(line, file_format, errclass, expected):
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    first = b'{"admin": "a", "other": "b"}\n' if file_format == 'ndjson' else b'a\tb\n'
+    f = BytesIO(first + line + b'\n')
+
+    loader = MappingLoader(storage, chunk_size=1)
+
+    with raises(Exception) as got:
+        loader.load(f, NamespaceID('a'), NamespaceID('o'), file_format)
+    assert_exception_correct(got.value, errclass(
+        'Line 2 at byte offset {}: {}'.format(len(first), expected)))
+
+
+def test_load_fail_storage():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    timer = create_autospec(time.time, spec_set=True)
+    timer.return_value = 10
+    storage.add_mappings.side_effect = [(1, 0), IDMappingStorageError('whoops')]
+    progress = []
+
+    loader = MappingLoader(storage, chunk_size=1, timer=timer)
+    f = BytesIO(b'id1\tid2\nid3\tid4\nid5\tid6\n')
+
+    with raises(Exception) as got:
+        loader.load(f, NamespaceID('a'), NamespaceID('o'), progress=progress.append)
+    assert_exception_correct(got.value, IDMappingStorageError('whoops'))
+
+    assert progress == [LoadProgress(1, 1, 0, 8, 0)]
+
+
+def fail_load(loader, infile, admin_ns, ns, file_format, start_offset, expected):
+    with raises(Exception) as got:
+        loader.load(infile, admin_ns, ns, file_format, start_offset)
+    assert_exception_correct(got.value, expected)
@@ -0,0 +1,52 @@
+from jgikbase.idmapping.core import metrics
+from jgikbase.idmapping.core.metrics import timed_storage_operation, generate_metrics
+from prometheus_client import REGISTRY
+from pytest import raises
+
+
+def latency_count(operation):
+    return REGISTRY.get_sample_value(
+        "idmapping_storage_operation_duration_seconds_count", {"operation": operation}) or 0
+
+
+def test_timed_storage_operation():
+    @timed_storage_operation
+    def metrics_test_op(a, b=1):
+        """ docs """
+        return a + b
+
+    before = latency_count("metrics_test_op")
+    assert metrics_test_op(2, b=3) == 5
+    assert metrics_test_op.__name__ == "metrics_test_op"
+    assert metrics_test_op.__doc__ == " docs "
+    assert latency_count("metrics_test_op") == before + 1
+
+
+def test_timed_storage_operation_fail():
+    @timed_storage_operation
+    def metrics_test_op_fail():
+        raise ValueError("whoops")
+
+    before = latency_count("metrics_test_op_fail")
+    with raises(ValueError):
+        metrics_test_op_fail()
+    assert latency_count("metrics_test_op_fail") == before + 1
+
+
+def test_generate_metrics():
+    metrics.MAPPING_BATCH_SIZE.labels("metrics_test").observe(3)
+
+    data, content_type = generate_metrics()
+
+    assert content_type.startswith("text/plain; version=0.0.4")
+    assert b'idmapping_mapping_batch_size_count{operation="metrics_test"} 1.0' in data
+
+
+def test_generate_metrics_multiprocess(monkeypatch, tmp_path):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+
+    data, content_type = generate_metrics()
+
+    # metrics created before the variable was set aren't written to the directory
+    assert content_type.startswith("text/plain; version=0.0.4")
+    assert data == b""
@@ -0,0 +1,199 @@
+from unittest.mock import create_autospec
+from jgikbase.idmapping.storage.id_mapping_storage import IDMappingStorage
+from jgikbase.idmapping.core.namespace_cache import NamespaceCache
+from jgikbase.idmapping.core.object_id import NamespaceID, Namespace
+from jgikbase.idmapping.core.errors import NoSuchNamespaceError
+from jgikbase.test.idmapping.test_utils import assert_exception_correct
+from pytest import raises
+import time
+
+
+def test_init_fail():
+    with raises(Exception) as got:
+        NamespaceCache(None)
+    assert_exception_correct(got.value, TypeError('storage cannot be None'))
+
+
+def test_no_cache():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    nc = NamespaceCache(storage)
+
+    storage.get_namespace.return_value = Namespace(NamespaceID('n'), True)
+    storage.get_namespaces.return_value = set([Namespace(NamespaceID('n'), True)])
+
+    assert nc.get_namespace(NamespaceID('n')) == Namespace(NamespaceID('n'), True)
+    assert nc.get_namespace(NamespaceID('n')) == Namespace(NamespaceID('n'), True)
+    assert nc.get_namespaces() == set([Namespace(NamespaceID('n'), True)])
+    assert nc.get_namespaces([NamespaceID('n')]) == set([Namespace(NamespaceID('n'), True)])
+
+    assert storage.get_namespace.call_args_list == [((NamespaceID('n'),), {}),
+                                                    ((NamespaceID('n'),), {})]
+    assert storage.get_namespaces.call_args_list == [((), {}), (([NamespaceID('n')],), {})]
+    assert storage.get_namespace_version.call_args_list == []
+
+
+def test_no_cache_without_users():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    nc = NamespaceCache(storage)
+
+    storage.get_namespaces.return_value = set([Namespace(NamespaceID('n'), True)])
+
+    assert nc.get_namespaces(include_users=False) == set([Namespace(NamespaceID('n'), True)])
+    assert nc.get_namespaces([NamespaceID('n')], include_users=False) == set(
+        [Namespace(NamespaceID('n'), True)])
+
+    assert storage.get_namespaces.call_args_list == [
+        ((None,), {'include_users': False}),
+        (([NamespaceID('n')],), {'include_users': False})]
+
+
+def test_cache_without_users():
+    storage, timer, nc = set_up_cache()
+    timer.return_value = 0
+
+    # cached namespaces are used regardless
+    assert nc.get_namespaces(include_users=False) == set([Namespace(NamespaceID('n1'), True),
+                                                          Namespace(NamespaceID('n2'), False)])
+    assert storage.get_namespaces.call_args_list == [((), {})]
+
+
+def set_up_cache(expiration=300, interval=1):
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    timer = create_autospec(time.time, spec_set=True)
+    nc = NamespaceCache(storage, cache_expiration=expiration, version_check_interval=interval,
+                        cache_timer=timer)
+    storage.get_namespace_version.return_value = 3
+    storage.get_namespaces.return_value = set([Namespace(NamespaceID('n1'), True),
+                                               Namespace(NamespaceID('n2'), False)])
+    return storage, timer, nc
+
+
+def test_cache():
+    storage, timer, nc = set_up_cache()
+
+    timer.return_value = 0
+    assert nc.get_namespace(NamespaceID('n1')) == Namespace(NamespaceID('n1'), True)
+    timer.return_value = 0.5
+    assert nc.get_namespace(NamespaceID('n2')) == Namespace(NamespaceID('n2'), False)
+    assert nc.get_namespaces() == set([Namespace(NamespaceID('n1'), True),
+                                       Namespace(NamespaceID('n2'), False)])
+    assert nc.get_namespaces([NamespaceID('n2')]) == set([Namespace(NamespaceID('n2'), False)])
+
+    assert storage.get_namespaces.call_args_list == [((), {})]
+    assert storage.get_namespace_version.call_args_list == [((), {})]
+    assert storage.get_namespace.call_args_list == []
+
+    # version check, no change
+    timer.return_value = 1
+    assert nc.get_namespace(NamespaceID('n1')) == Namespace(NamespaceID('n1'), True)
+    assert storage.get_namespaces.call_args_list == [((), {})]
+    assert storage.get_namespace_version.call_args_list == [((), {}), ((), {})]
+
+    # next check is relative to the last check
+    timer.return_value = 1.9
+    assert nc.get_namespace(NamespaceID('n1')) == Namespace(NamespaceID('n1'), True)
+    assert storage.get_namespace_version.call_args_list == [((), {}), ((), {})]
+
+
+def test_cache_version_change():
+    storage, timer, nc = set_up_cache()
+
+    timer.return_value = 0
+    assert nc.get_namespace(NamespaceID('n1')) == Namespace(NamespaceID('n1'), True)
+
+    storage.get_namespace_version.return_value = 4
+    storage.get_namespaces.return_value = set([Namespace(NamespaceID('n1'), False)])
+
+    timer.return_value = 0.9
+    assert nc.get_namespace(NamespaceID('n1')) == Namespace(NamespaceID('n1'), True)
+    timer.return_value = 1
+    assert nc.get_namespace(NamespaceID('n1')) == Namespace(NamespaceID('n1'), False)
+
+    assert storage.get_namespaces.call_args_list == [((), {}), ((), {})]
+    assert storage.get_namespace_version.call_args_list == [((), {}), ((), {})]
+
+
+def test_cache_expiration():
+    # version check interval is longer than the expiration to force expiration
+    storage, timer, nc = set_up_cache(expiration=10, interval=100)
+
+    timer.return_value = 0
+    assert nc.get_namespace(NamespaceID('n1')) == Namespace(NamespaceID('n1'), True)
+    timer.return_value = 9.9
+    assert nc.get_namespace(NamespaceID('n1')) == Namespace(NamespaceID('n1'), True)
+    assert storage.get_namespaces.call_args_list == [((), {})]
+
+    timer.return_value = 10
+    assert nc.get_namespace(NamespaceID('n1')) == Namespace(NamespaceID('n1'), True)
+    assert storage.get_namespaces.call_args_list == [((), {}), ((), {})]
+    assert storage.get_namespace_version.call_args_list == [((), {}), ((), {})]
+
+
+def test_invalidate():
+    storage, timer, nc = set_up_cache()
+
+    timer.return_value = 0
+    assert nc.get_namespace(NamespaceID('n1')) == Namespace(NamespaceID('n1'), True)
+    nc.invalidate()
+    assert nc.get_namespace(NamespaceID('n1')) == Namespace(NamespaceID('n1'), True)
+
+    assert storage.get_namespaces.call_args_list == [((), {}), ((), {})]
+
+
+def test_cache_miss():
+    storage, timer, nc = set_up_cache()
+    timer.return_value = 0
+
+    storage.get_namespace.return_value = Namespace(NamespaceID('n3'), True)
+    assert nc.get_namespace(NamespaceID('n3')) == Namespace(NamespaceID('n3'), True)
+    assert storage.get_namespace.call_args_list == [((NamespaceID('n3'),), {})]
+    assert storage.get_namespaces.call_args_list == [((), {})]
+
+    # the miss invalidates the cache, so the next request reloads
+    storage.get_namespaces.side_effect = [
+        set([Namespace(NamespaceID('n1'), True)]),
+        set([Namespace(NamespaceID('n1'), True), Namespace(NamespaceID('n3'), True)]),
+        set([Namespace(NamespaceID('n1'), True), Namespace(NamespaceID('n3'), True)])]
+    assert nc.get_namespaces([NamespaceID('n1'), NamespaceID('n3')]) == set([
+        Namespace(NamespaceID('n1'), True), Namespace(NamespaceID('n3'), True)])
+    assert storage.get_namespaces.call_args_list == [
+        ((), {}), ((), {}), (([NamespaceID('n1'), NamespaceID('n3')],), {})]
+
+    assert nc.get_namespace(NamespaceID('n3')) == Namespace(NamespaceID('n3'), True)
+    assert nc.get_namespace(NamespaceID('n1')) == Namespace(NamespaceID('n1'), True)
+    assert storage.get_namespaces.call_args_list == [
+        ((), {}), ((), {}), (([NamespaceID('n1'), NamespaceID('n3')],), {}), ((), {})]
+    assert storage.get_namespace.call_args_list == [((NamespaceID('n3'),), {})]
+
+
+def test_cache_miss_no_such_namespace():
+    storage, timer, nc = set_up_cache()
+    timer.return_value = 0
+
+    storage.get_namespace.side_effect = NoSuchNamespaceError('n3')
+    storage.get_namespaces.side_effect = [
+        set([Namespace(NamespaceID('n1'), True)]), NoSuchNamespaceError('n3')]
+
+    with raises(Exception) as got:
+        nc.get_namespace(NamespaceID('n3'))
+    assert_exception_correct(got.value, NoSuchNamespaceError('n3'))
+
+    with raises(Exception) as got:
+        nc.get_namespaces([NamespaceID('n1'), NamespaceID('n3')])
+    assert_exception_correct(got.value, NoSuchNamespaceError('n3'))
+
+
+def test_get_fail_None_input():
+    for expiration in [0, 300]:
+        storage, timer, nc = set_up_cache(expiration=expiration)
+        timer.return_value = 0
+
+        with raises(Exception) as got:
+            nc.get_namespace(None)
+        assert_exception_correct(got.value, TypeError('namespace_id cannot be None'))
+
+    storage, timer, nc = set_up_cache()
+    timer.return_value = 0
+    with raises(Exception) as got:
+        nc.get_namespaces([NamespaceID('n1'), None])
+    assert_exception_correct(got.value, TypeError('None item in nids'))
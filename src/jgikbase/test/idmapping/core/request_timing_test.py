@@ -0,0 +1,95 @@
+from unittest.mock import create_autospec
+from jgikbase.idmapping.core import request_timing
+from jgikbase.idmapping.core.request_timing import RequestTimer
+from jgikbase.test.idmapping.test_utils import assert_exception_correct
+from pytest import raises
+import time
+
+
+def empty_timing(total):
+    return {
+        "total_ms": total,
+        "auth_ms": 0,
+        "namespace_read_ms": 0,
+        "mapping_query_ms": 0,
+        "mapping_write_ms": 0,
+        "serialize_ms": 0,
+        "mongo_calls": 0,
+        "auth_calls": 0,
+    }
+
+
+def test_timer():
+    timer = create_autospec(time.perf_counter, spec_set=True)
+    timer.side_effect = [1, 2, 2.5, 3, 3.25, 3.5, 3.75, 10]
+
+    rt = RequestTimer(timer)
+    with rt.timed(request_timing.AUTH):
+        pass
+    with rt.timed(request_timing.MAPPING_QUERY):
+        pass
+    with rt.timed(request_timing.AUTH):
+        pass
+    rt.count(request_timing.MONGO_CALLS)
+    rt.count(request_timing.MONGO_CALLS, 3)
+
+    expected = empty_timing(9000)
+    expected.update({"auth_ms": 750, "mapping_query_ms": 250, "mongo_calls": 4})
+    assert rt.to_dict() == expected
+
+
+def test_timer_nested():
+    timer = create_autospec(time.perf_counter, spec_set=True)
+    # the inner block of the same category doesn't read the timer
+    timer.side_effect = [0, 1, 1.5, 2.5, 4, 5, 5, 6]
+
+    rt = RequestTimer(timer)
+    with rt.timed(request_timing.AUTH):
+        with rt.timed(request_timing.AUTH):
+            with rt.timed(request_timing.NAMESPACE_READ):
+                pass
+    try:
+        with rt.timed(request_timing.SERIALIZE):
+            raise ValueError()
+    except ValueError:
+        pass
+
+    expected = empty_timing(6000)
+    expected.update({"auth_ms": 3000, "namespace_read_ms": 1000})
+    assert rt.to_dict() == expected
+
+
+def test_timer_fail_bad_category():
+    rt = RequestTimer()
+    with raises(Exception) as got:
+        with rt.timed("foo"):
+            pass
+    assert_exception_correct(got.value, ValueError("Unknown timing category: foo"))
+
+    with raises(Exception) as got:
+        rt.count("bar")
+    assert_exception_correct(got.value, ValueError("Unknown call counter: bar"))
+
+
+def test_current_timer():
+    timer = create_autospec(time.perf_counter, spec_set=True)
+    timer.side_effect = [0, 1, 3, 4]
+
+    rt = request_timing.start_request_timer(timer)
+    try:
+        with request_timing.timed(request_timing.MAPPING_WRITE):
+            pass
+        with request_timing.timed(None):
+            pass
+        request_timing.count(request_timing.AUTH_CALLS)
+    finally:
+        request_timing.stop_request_timer()
+
+    # no timer, so nothing happens
+    with request_timing.timed(request_timing.MAPPING_WRITE):
+        pass
+    request_timing.count(request_timing.AUTH_CALLS)
+
+    expected = empty_timing(4000)
+    expected.update({"mapping_write_ms": 2000, "auth_calls": 1})
+    assert rt.to_dict() == expected
@@ -1,13 +1,18 @@
 from unittest.mock import create_autospec
 from jgikbase.idmapping.storage.id_mapping_storage import IDMappingStorage
 from jgikbase.idmapping.core.user_lookup import LocalUserLookup, UserLookupSet, UserLookup
+from jgikbase.idmapping.core.cache import Cache
 from jgikbase.idmapping.core.user import AuthsourceID, User, Username
 from jgikbase.idmapping.core.tokens import Token, HashedToken
 from jgikbase.test.idmapping.test_utils import assert_exception_correct
 from pytest import raises
+from prometheus_client import REGISTRY
 from jgikbase.test.idmapping.core.tokens_test import is_base64
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
-from jgikbase.idmapping.core.errors import NoSuchAuthsourceError
+from jgikbase.idmapping.core.errors import NoSuchAuthsourceError, InvalidTokenError
+from jgikbase.idmapping.storage.errors import IDMappingStorageError
 
 
 def test_set_init_fail():
@@ -396,6 +401,321 @@ def fail_set_is_valid_user(hset, user, expected):
     assert_exception_correct(got.value, expected)
 
 
+def test_set_get_user_negative_cache():
+    handler = create_autospec(UserLookup, spec_set=True, instance=True)
+    timer = create_autospec(time.time, spec_set=True)
+    handler.get_authsource_id.return_value = AuthsourceID('as')
+
+    hset = UserLookupSet(set([handler]), timer, cache_negative_expiration=10)
+
+    handler.get_user.side_effect = InvalidTokenError('bad token')
+    timer.return_value = 0
+    fail_set_get_user(hset, AuthsourceID('as'), Token('t'), InvalidTokenError('bad token'))
+
+    # the error is now cached
+    timer.return_value = 9
+    fail_set_get_user(hset, AuthsourceID('as'), Token('t'), InvalidTokenError('bad token'))
+    assert handler.get_user.call_args_list == [((Token('t'),), {})]
+
+    # and now expired
+    handler.get_user.side_effect = None
+    handler.get_user.return_value = (User(AuthsourceID('as'), Username('u')), False, None, None)
+    timer.return_value = 10
+    assert hset.get_user(AuthsourceID('as'), Token('t')) == \
+        (User(AuthsourceID('as'), Username('u')), False)
+    assert handler.get_user.call_args_list == [((Token('t'),), {}), ((Token('t'),), {})]
+
+
+def test_set_get_user_no_negative_cache():
+    handler = create_autospec(UserLookup, spec_set=True, instance=True)
+    timer = create_autospec(time.time, spec_set=True)
+    handler.get_authsource_id.return_value = AuthsourceID('as')
+
+    hset = UserLookupSet(set([handler]), timer)
+
+    handler.get_user.side_effect = InvalidTokenError()
+    timer.return_value = 0
+    fail_set_get_user(hset, AuthsourceID('as'), Token('t'), InvalidTokenError())
+    fail_set_get_user(hset, AuthsourceID('as'), Token('t'), InvalidTokenError())
+    assert handler.get_user.call_args_list == [((Token('t'),), {}), ((Token('t'),), {})]
+
+
+def test_set_is_valid_user_negative_cache():
+    handler = create_autospec(UserLookup, spec_set=True, instance=True)
+    timer = create_autospec(time.time, spec_set=True)
+    handler.get_authsource_id.return_value = AuthsourceID('as')
+
+    hset = UserLookupSet(set([handler]), timer, cache_negative_expiration=5)
+    u = User(AuthsourceID('as'), Username('u'))
+
+    handler.is_valid_user.return_value = (False, None, None)
+    timer.return_value = 0
+    assert hset.is_valid_user(u) is False
+    timer.return_value = 4
+    assert hset.is_valid_user(u) is False
+    assert hset.are_valid_users([u]) == {u: False}
+    assert handler.is_valid_user.call_args_list == [((Username('u'),), {})]
+    assert handler.are_valid_users.call_args_list == []
+
+    handler.is_valid_user.return_value = (True, None, None)
+    timer.return_value = 5
+    assert hset.is_valid_user(u) is True
+    assert handler.is_valid_user.call_args_list == [((Username('u'),), {}),
+                                                    ((Username('u'),), {})]
+
+    # negative results from the bulk lookup are cached as well
+    u2 = User(AuthsourceID('as'), Username('u2'))
+    handler.are_valid_users.return_value = ({Username('u2'): False}, None, None)
+    assert hset.are_valid_users([u, u2]) == {u: True, u2: False}
+    assert hset.is_valid_user(u2) is False
+    assert handler.are_valid_users.call_args_list == [(({Username('u2')},), {})]
+    assert len(handler.is_valid_user.call_args_list) == 2
+
+
+def test_set_custom_caches():
+    handler = create_autospec(UserLookup, spec_set=True, instance=True)
+    handler.get_authsource_id.return_value = AuthsourceID('as')
+    user_cache = create_autospec(Cache, spec_set=True, instance=True)
+    valid_cache = create_autospec(Cache, spec_set=True, instance=True)
+
+    hset = UserLookupSet(set([handler]), cache_negative_expiration=7, user_cache=user_cache,
+                         valid_cache=valid_cache)
+    tkey = 't:as:' + Token('t').get_hashed_token().token_hash
+
+    # misses
+    user_cache.get.return_value = None
+    valid_cache.get.return_value = None
+    handler.get_user.return_value = (User(AuthsourceID('as'), Username('u')), True, None, 20)
+    handler.is_valid_user.return_value = (False, None, 30)
+
+    assert hset.get_user(AuthsourceID('as'), Token('t')) == \
+        (User(AuthsourceID('as'), Username('u')), True)
+    assert hset.is_valid_user(User(AuthsourceID('as'), Username('u'))) is False
+
+    # the cache is checked again after waiting for any in flight lookup
+    assert user_cache.get.call_args_list == [((tkey,), {}), ((tkey,), {})]
+    assert user_cache.set.call_args_list == [((tkey, ['as', 'u', True]), {'ttl': 20})]
+    assert valid_cache.get.call_args_list == [(('u:as:u',), {}), (('u:as:u',), {})]
+    assert valid_cache.set.call_args_list == [(('u:as:u', False), {'ttl': 7})]
+
+    # hits
+    user_cache.get.return_value = ['as', 'u2', False]
+    valid_cache.get.return_value = True
+    assert hset.get_user(AuthsourceID('as'), Token('t')) == \
+        (User(AuthsourceID('as'), Username('u2')), False)
+    assert hset.is_valid_user(User(AuthsourceID('as'), Username('u'))) is True
+
+    user_cache.get.return_value = 'bad token'
+    fail_set_get_user(hset, AuthsourceID('as'), Token('t'), InvalidTokenError('bad token'))
+
+    assert len(handler.get_user.call_args_list) == 1
+    assert len(handler.is_valid_user.call_args_list) == 1
+
+
+def cache_count(authsource, cache, result):
+    return REGISTRY.get_sample_value('idmapping_user_lookup_cache_total', {
+        'authsource': authsource, 'cache': cache, 'result': result}) or 0
+
+
+def lookup_count(authsource, operation):
+    return REGISTRY.get_sample_value('idmapping_user_lookup_duration_seconds_count', {
+        'authsource': authsource, 'operation': operation}) or 0
+
+
+def test_set_metrics():
+    handler = create_autospec(UserLookup, spec_set=True, instance=True)
+    timer = create_autospec(time.time, spec_set=True)
+    handler.get_authsource_id.return_value = AuthsourceID('metrics')
+    timer.return_value = 0
+    hset = UserLookupSet(set([handler]), timer)
+    u = User(AuthsourceID('metrics'), Username('u'))
+    u2 = User(AuthsourceID('metrics'), Username('u2'))
+    handler.get_user.return_value = (u, False, None, None)
+    handler.is_valid_user.return_value = (True, None, None)
+    handler.are_valid_users.return_value = ({Username('u2'): True}, None, None)
+    counts = {(c, r): cache_count('metrics', c, r)
+              for c in ['token', 'user'] for r in ['hit', 'miss']}
+    lookups = {o: lookup_count('metrics', o)
+               for o in ['get_user', 'is_valid_user', 'are_valid_users']}
+
+    hset.get_user(AuthsourceID('metrics'), Token('t'))
+    hset.get_user(AuthsourceID('metrics'), Token('t'))
+    hset.is_valid_user(u)
+    hset.are_valid_users([u, u2])
+
+    assert cache_count('metrics', 'token', 'miss') == counts[('token', 'miss')] + 1
+    assert cache_count('metrics', 'token', 'hit') == counts[('token', 'hit')] + 1
+    assert cache_count('metrics', 'user', 'miss') == counts[('user', 'miss')] + 2
+    assert cache_count('metrics', 'user', 'hit') == counts[('user', 'hit')] + 1
+    for o in lookups:
+        assert lookup_count('metrics', o) == lookups[o] + 1
+
+
+def run_concurrent_get_user(hset, count):
+    """
+    Starts count concurrent lookups of the same token. Returns the futures for the lookups.
+    """
+    ex = ThreadPoolExecutor(max_workers=count)
+    futs = [ex.submit(hset.get_user, AuthsourceID('as'), Token('t')) for _ in range(count)]
+    ex.shutdown(wait=False)
+    return futs
+
+
+def set_up_blocking_handler(result):
+    handler = create_autospec(UserLookup, spec_set=True, instance=True)
+    handler.get_authsource_id.return_value = AuthsourceID('as')
+    called = threading.Event()
+    release = threading.Event()
+
+    def get_user(token):
+        called.set()
+        release.wait(5)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    handler.get_user.side_effect = get_user
+    return handler, called, release
+
+
+def test_set_get_user_single_flight():
+    res = (User(AuthsourceID('as'), Username('u')), True, None, None)
+    handler, called, release = set_up_blocking_handler(res)
+    hset = UserLookupSet(set([handler]))
+
+    futs = run_concurrent_get_user(hset, 5)
+    called.wait(5)
+    time.sleep(0.1)  # let the other lookups reach the wait for the in flight call
+    release.set()
+
+    for f in futs:
+        assert f.result(5) == (User(AuthsourceID('as'), Username('u')), True)
+    assert handler.get_user.call_args_list == [((Token('t'),), {})]
+    assert hset._in_flight == {}
+
+
+def test_set_get_user_single_flight_error():
+    # the error is shared by the waiting lookups even without negative caching
+    handler, called, release = set_up_blocking_handler(InvalidTokenError('whoops'))
+    hset = UserLookupSet(set([handler]))
+
+    futs = run_concurrent_get_user(hset, 5)
+    called.wait(5)
+    time.sleep(0.1)  # let the other lookups reach the wait for the in flight call
+    release.set()
+
+    errs = [f.exception(5) for f in futs]
+    for e in errs:
+        assert_exception_correct(e, InvalidTokenError('whoops'))
+        assert e.message == 'whoops'
+    # the waiting lookups raise their own copy of the error, chained to the original
+    assert len({id(e) for e in errs}) == 5
+    original = [e for e in errs if e.__cause__ is None]
+    assert len(original) == 1
+    for e in errs:
+        if e is not original[0]:
+            assert e.__cause__ is original[0]
+    assert handler.get_user.call_args_list == [((Token('t'),), {})]
+    assert hset._in_flight == {}
+
+    # not cached
+    release.set()
+    fail_set_get_user(hset, AuthsourceID('as'), Token('t'), InvalidTokenError('whoops'))
+    assert handler.get_user.call_args_list == [((Token('t'),), {}), ((Token('t'),), {})]
+
+
+def test_set_get_user_single_flight_os_error():
+    handler, called, release = set_up_blocking_handler(ConnectionRefusedError(111, 'refused'))
+    hset = UserLookupSet(set([handler]))
+
+    futs = run_concurrent_get_user(hset, 3)
+    called.wait(5)
+    time.sleep(0.1)
+    release.set()
+
+    errs = [f.exception(5) for f in futs]
+    assert len({id(e) for e in errs}) == 3
+    for e in errs:
+        assert type(e) is ConnectionRefusedError
+        assert e.errno == 111
+        assert str(e) == '[Errno 111] refused'
+    assert handler.get_user.call_args_list == [((Token('t'),), {})]
+
+
+def test_set_get_user_no_single_flight():
+    handler, called, release = set_up_blocking_handler(InvalidTokenError('whoops'))
+    hset = UserLookupSet(set([handler]), single_flight=False)
+
+    futs = run_concurrent_get_user(hset, 3)
+    called.wait(5)
+    time.sleep(0.1)
+    release.set()
+
+    for f in futs:
+        assert_exception_correct(f.exception(5), InvalidTokenError('whoops'))
+    assert len(handler.get_user.call_args_list) == 3
+
+
+def test_set_are_valid_users():
+    handler1 = create_autospec(UserLookup, spec_set=True, instance=True)
+    handler2 = create_autospec(UserLookup, spec_set=True, instance=True)
+    timer = create_autospec(time.time, spec_set=True)
+    handler1.get_authsource_id.return_value = AuthsourceID('asa')
+    handler2.get_authsource_id.return_value = AuthsourceID('asb')
+
+    hset = UserLookupSet(set([handler1, handler2]), timer)
+    timer.return_value = 0
+
+    handler1.are_valid_users.return_value = (
+        {Username('u1'): True, Username('u2'): False}, None, 100)
+    handler2.are_valid_users.return_value = ({Username('u1'): True}, None, None)
+
+    u1 = User(AuthsourceID('asa'), Username('u1'))
+    u2 = User(AuthsourceID('asa'), Username('u2'))
+    u3 = User(AuthsourceID('asb'), Username('u1'))
+
+    assert hset.are_valid_users([u1, u2, u3]) == {u1: True, u2: False, u3: True}
+    assert handler1.are_valid_users.call_args_list == [(({Username('u1'), Username('u2')},), {})]
+    assert handler2.are_valid_users.call_args_list == [(({Username('u1')},), {})]
+
+    # valid users are cached, invalid users are not
+    handler1.are_valid_users.return_value = ({Username('u2'): True}, None, None)
+    timer.return_value = 99
+    assert hset.are_valid_users([u1, u2, u3]) == {u1: True, u2: True, u3: True}
+    assert hset.is_valid_user(u2) is True
+    assert handler1.are_valid_users.call_args_list == [(({Username('u1'), Username('u2')},), {}),
+                                                       (({Username('u2')},), {})]
+    assert handler2.are_valid_users.call_args_list == [(({Username('u1')},), {})]
+    assert handler1.is_valid_user.call_args_list == []
+
+    # the handler's ttl applies
+    handler1.are_valid_users.return_value = ({Username('u1'): True}, None, None)
+    timer.return_value = 100
+    assert hset.are_valid_users([u1, u3]) == {u1: True, u3: True}
+    assert handler1.are_valid_users.call_args_list[2] == (({Username('u1')},), {})
+    assert len(handler2.are_valid_users.call_args_list) == 1
+
+
+def test_set_are_valid_users_fail():
+    handler = create_autospec(UserLookup, spec_set=True, instance=True)
+    handler.get_authsource_id.return_value = AuthsourceID('as')
+    hset = UserLookupSet(set([handler]))
+
+    fail_set_are_valid_users(hset, None, TypeError('users cannot be None'))
+    fail_set_are_valid_users(hset, [User(AuthsourceID('as'), Username('n')), None],
+                             TypeError('None item in users'))
+    fail_set_are_valid_users(hset, [User(AuthsourceID('as'), Username('n')),
+                                    User(AuthsourceID('bs'), Username('n'))],
+                             NoSuchAuthsourceError('bs'))
+    assert handler.are_valid_users.call_args_list == []
+
+
+def fail_set_are_valid_users(hset, users, expected):
+    with raises(Exception) as got:
+        hset.are_valid_users(users)
+    assert_exception_correct(got.value, expected)
+
+
 def test_local_init_fail():
     with raises(Exception) as got:
         LocalUserLookup(None)
@@ -430,6 +750,124 @@ def test_local_get_user_fail():
     assert_exception_correct(got.value, TypeError('token cannot be None'))
 
 
+def set_up_local_index():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    timer = create_autospec(time.time, spec_set=True)
+    storage.get_users_version.return_value = 3
+    storage.get_users_by_token.return_value = {
+        Token('foo').get_hashed_token(): (Username('bar'), True),
+        Token('baz').get_hashed_token(): (Username('bat'), False)}
+    timer.return_value = 0
+    return storage, timer, LocalUserLookup(storage, refresh_interval=5, timer=timer)
+
+
+def test_local_index_loaded_on_init():
+    storage, _, _ = set_up_local_index()
+
+    assert storage.get_users_version.call_args_list == [((), {})]
+    assert storage.get_users_by_token.call_args_list == [((), {})]
+
+    # no index without a refresh interval
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    LocalUserLookup(storage)
+    assert storage.get_users_version.call_args_list == []
+    assert storage.get_users_by_token.call_args_list == []
+
+
+def test_local_get_user_with_index():
+    storage, timer, luh = set_up_local_index()
+
+    assert luh.get_user(Token('foo')) == (User(AuthsourceID('local'), Username('bar')), True,
+                                          None, 5)
+    timer.return_value = 4.9
+    assert luh.get_user(Token('baz')) == (User(AuthsourceID('local'), Username('bat')), False,
+                                          None, 5)
+    assert luh.is_valid_user(Username('bat')) == (True, None, 3600)
+
+    assert storage.get_users_by_token.call_args_list == [((), {})]
+    assert storage.get_users_version.call_args_list == [((), {})]
+    assert storage.get_user.call_args_list == []
+    assert storage.user_exists.call_args_list == []
+
+    # version check, no change
+    timer.return_value = 5
+    assert luh.get_user(Token('foo')) == (User(AuthsourceID('local'), Username('bar')), True,
+                                          None, 5)
+    assert storage.get_users_by_token.call_args_list == [((), {})]
+    assert storage.get_users_version.call_args_list == [((), {}), ((), {})]
+
+    # version change, token for bar replaced
+    storage.get_users_version.return_value = 4
+    storage.get_users_by_token.return_value = {
+        Token('foo2').get_hashed_token(): (Username('bar'), True)}
+    storage.get_user.side_effect = InvalidTokenError()
+    timer.return_value = 10
+    with raises(Exception) as got:
+        luh.get_user(Token('foo'))
+    assert_exception_correct(got.value, InvalidTokenError())
+    assert luh.get_user(Token('foo2')) == (User(AuthsourceID('local'), Username('bar')), True,
+                                           None, 5)
+
+    assert storage.get_users_by_token.call_args_list == [((), {}), ((), {})]
+    assert storage.get_users_version.call_args_list == [((), {}), ((), {}), ((), {})]
+    # unknown tokens fall back to the storage system
+    assert storage.get_user.call_args_list == [((Token('foo').get_hashed_token(),), {})]
+
+
+def test_local_get_user_with_index_concurrent_refresh():
+    storage, timer, luh = set_up_local_index()
+    storage.get_users_version.return_value = 4
+    storage.get_users_by_token.return_value = {
+        Token('foo2').get_hashed_token(): (Username('bar'), True)}
+    timer.return_value = 10
+
+    # another request is refreshing the index, so the current index is used
+    luh._refresh_lock.acquire()
+    try:
+        assert luh.get_user(Token('foo')) == (
+            User(AuthsourceID('local'), Username('bar')), True, None, 5)
+    finally:
+        luh._refresh_lock.release()
+    assert storage.get_users_version.call_args_list == [((), {})]
+    assert storage.get_users_by_token.call_args_list == [((), {})]
+
+    assert luh.get_user(Token('foo2')) == (
+        User(AuthsourceID('local'), Username('bar')), True, None, 5)
+    assert storage.get_users_version.call_args_list == [((), {}), ((), {})]
+    assert storage.get_users_by_token.call_args_list == [((), {}), ((), {})]
+
+
+def test_local_get_user_with_index_refresh_fail():
+    storage, timer, luh = set_up_local_index()
+    storage.get_users_version.side_effect = IDMappingStorageError('oops')
+    timer.return_value = 10
+
+    with raises(Exception) as got:
+        luh.get_user(Token('foo'))
+    assert_exception_correct(got.value, IDMappingStorageError('oops'))
+
+    # the lock is released for the next request
+    storage.get_users_version.side_effect = None
+    storage.get_users_version.return_value = 3
+    assert luh.get_user(Token('foo')) == (
+        User(AuthsourceID('local'), Username('bar')), True, None, 5)
+    assert storage.get_users_by_token.call_args_list == [((), {})]
+
+
+def test_local_get_user_with_index_not_in_index():
+    storage, timer, luh = set_up_local_index()
+    storage.get_user.return_value = (Username('new'), False)
+    storage.user_exists.return_value = True
+
+    assert luh.get_user(Token('new')) == (User(AuthsourceID('local'), Username('new')), False,
+                                          None, 5)
+    assert luh.is_valid_user(Username('new')) == (True, None, 3600)
+
+    assert storage.get_user.call_args_list == [((Token('new').get_hashed_token(),), {})]
+    assert storage.user_exists.call_args_list == [((Username('new'),), {})]
+    assert storage.get_users_by_token.call_args_list == [((), {})]
+
+
 def test_local_is_valid_user():
     storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
     storage.user_exists.return_value = True
@@ -454,6 +892,27 @@ def test_local_is_valid_user_fail():
     assert_exception_correct(got.value, TypeError('username cannot be None'))
 
 
+def test_local_are_valid_users():
+    # tests the default implementation in the UserLookup interface
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    storage.user_exists.side_effect = lambda u: u == Username('foo')
+
+    luh = LocalUserLookup(storage)
+
+    assert luh.are_valid_users({Username('foo'), Username('bar')}) == (
+        {Username('foo'): True, Username('bar'): False}, None, 3600)
+    assert luh.are_valid_users(set()) == ({}, None, None)
+
+
+def test_local_are_valid_users_fail():
+    storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
+    luh = LocalUserLookup(storage)
+    for users, err in [(None, 'usernames cannot be None'), ([None], 'None item in usernames')]:
+        with raises(Exception) as got:
+            luh.are_valid_users(users)
+        assert_exception_correct(got.value, TypeError(err))
+
+
 def test_local_create_user():
     storage = create_autospec(IDMappingStorage, spec_set=True, instance=True)
 
@@ -0,0 +1,53 @@
+from pytest import raises
+from json.decoder import JSONDecodeError
+from jgikbase.idmapping.service.json_provider import (
+    StdlibJSONProvider,
+    OrjsonJSONProvider,
+    available_providers,
+    get_json_provider,
+)
+import json
+
+PROVIDERS = [StdlibJSONProvider(), OrjsonJSONProvider()]
+
+
+def test_available_providers():
+    assert [p.name for p in available_providers()] == ["orjson", "stdlib"]
+    assert get_json_provider().name == "orjson"
+
+
+def test_loads():
+    for p in PROVIDERS:
+        for data in [b'{"a": ["b", 1, null]}', '{"a": ["b", 1, null]}']:
+            assert p.loads(data) == {"a": ["b", 1, None]}
+        assert p.loads(b'"\\u00e9\xc3\xa9"') == "\u00e9\u00e9"
+
+
+def test_loads_stdlib_only_input():
+    # orjson rejects these, but the result is the same as the standard library's
+    for p in PROVIDERS:
+        assert p.loads(b"[184467440737095516160]") == [184467440737095516160]
+
+
+def test_loads_fail():
+    for p in PROVIDERS:
+        fail_loads(p, b"", "Expecting value: line 1 column 1 (char 0)")
+        fail_loads(p, b'{"foo": ["bar", "baz"}]',
+                   "Expecting ',' delimiter: line 1 column 22 (char 21)")
+
+
+def fail_loads(provider, data, expected):
+    with raises(Exception) as got:
+        provider.loads(data)
+    assert type(got.value) is JSONDecodeError
+    assert str(got.value) == expected
+
+
+def test_dumps():
+    obj = {"a": ["b", 1, None, 1.5, True], "c": {"\u00e9": "d"}}
+    for p in PROVIDERS:
+        b = p.dumps(obj)
+        assert isinstance(b, bytes)
+        assert b" " not in b
+        assert json.loads(b) == obj
+        assert p.dumps([184467440737095516160]) == b"[184467440737095516160]"
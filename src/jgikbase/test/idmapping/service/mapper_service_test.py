@@ -13,11 +13,20 @@ from jgikbase.idmapping.core.errors import (
 )
 import re
 from jgikbase.idmapping.service import mapper_service
+from jgikbase.idmapping.service.json_provider import available_providers
 from logging import LogRecord
 import json
 from flask.app import Flask
 from flask import g
 from typing import IO, Optional
+from pytest import raises
+from prometheus_client import REGISTRY
+from jgikbase.idmapping.core import request_timing
+from jgikbase.idmapping.core import consistency
+import time
+import pstats
+import msgpack
+from jgikbase.idmapping.storage.errors import IDMappingStorageError
 from jgikbase.test.idmapping.test_utils import (
     assert_ms_epoch_close_to_now,
     CALLID_PATTERN,
@@ -28,15 +37,25 @@ VERSION = "0.1.2"
 WERKZEUG = "werkzeug/2.0.3"
 
 
-def build_app(ignore_ip_headers=False, logstream: Optional[IO[str]] = None):
+def build_app(
+    ignore_ip_headers=False,
+    logstream: Optional[IO[str]] = None,
+    profile_dir=None,
+    profile_sample_rate=0,
+    profile_max_size_mb=100,
+    json_provider=None,
+):
     builder = create_autospec(IDMappingBuilder, spec_set=True, instance=True)
     mapper = create_autospec(IDMapper, spec_set=True, instance=True)
     cfg = Mock()
     builder.build_id_mapping_system.return_value = mapper
     builder.get_cfg.return_value = cfg
     cfg.ignore_ip_headers = ignore_ip_headers
+    cfg.profile_dir = profile_dir
+    cfg.profile_sample_rate = profile_sample_rate
+    cfg.profile_max_size_mb = profile_max_size_mb
 
-    app = create_app(builder, logstream)
+    app = create_app(builder, logstream, json_provider)
     cli = app.test_client()
 
     return cli, mapper
@@ -357,6 +376,8 @@ def test_root_and_logging():
     del logjson["time"]
     callid = logjson["callid"]
     del logjson["callid"]
+    check_timing(logjson["timing"])
+    del logjson["timing"]
 
     assert logjson == {
         "service": "IDMappingService",
@@ -370,6 +391,24 @@ def test_root_and_logging():
     assert CALLID_PATTERN.match(callid) is not None
 
 
+def check_timing(timing, mongo_calls=0, auth_calls=0):
+    assert set(timing) == {
+        "total_ms",
+        "auth_ms",
+        "namespace_read_ms",
+        "mapping_query_ms",
+        "mapping_write_ms",
+        "serialize_ms",
+        "mongo_calls",
+        "auth_calls",
+    }
+    for k in timing:
+        if k.endswith("_ms"):
+            assert 0 <= timing[k] <= timing["total_ms"]
+    assert timing["mongo_calls"] == mongo_calls
+    assert timing["auth_calls"] == auth_calls
+
+
 def test_root_and_logging_with_xff_and_real_headers():
     logstream = Mock()
     cli, _ = build_app(logstream=logstream)
@@ -391,6 +430,7 @@ def test_root_and_logging_with_xff_and_real_headers():
     del respjson["time"]
     del ipjson["callid"]
     del respjson["callid"]
+    del respjson["timing"]
 
     assert ipjson == {
         "service": "IDMappingService",
@@ -429,6 +469,7 @@ def test_root_and_logging_with_xff_and_real_headers_ignored():
     # don't check these again, checked above.
     del respjson["time"]
     del respjson["callid"]
+    del respjson["timing"]
 
     assert respjson == {
         "service": "IDMappingService",
@@ -440,6 +481,133 @@ def test_root_and_logging_with_xff_and_real_headers_ignored():
     }
 
 
+def sample(name, labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_metrics():
+    cli, _ = build_app()
+    labels = {"method": "GET", "route": "/", "status": "200"}
+    notfound = {"method": "GET", "route": "<unmatched>", "status": "404"}
+    before = sample("idmapping_request_duration_seconds_count", labels)
+    before_nf = sample("idmapping_request_duration_seconds_count", notfound)
+
+    cli.get("/")
+    cli.get("/foo")
+    resp = cli.get("/metrics")
+
+    assert resp.status_code == 200
+    assert resp.content_type.startswith("text/plain; version=0.0.4")
+    text = resp.get_data(as_text=True)
+    assert "idmapping_request_duration_seconds_bucket{" in text
+    assert sample("idmapping_request_duration_seconds_count", labels) == before + 1
+    assert sample("idmapping_request_duration_seconds_count", notfound) == before_nf + 1
+
+
+def test_metrics_mapping_batch_size():
+    labels = {"operation": "get"}
+    count = sample("idmapping_mapping_batch_size_count", labels)
+    total = sample("idmapping_mapping_batch_size_sum", labels)
+
+    check_get_mappings(
+        [(set(), set()), (set(), set())],
+        {"id1": {"mappings": []}, "id2": {"mappings": []}},
+    )
+
+    assert sample("idmapping_mapping_batch_size_count", labels) == count + 1
+    assert sample("idmapping_mapping_batch_size_sum", labels) == total + 2
+    route = {"method": "GET", "route": "/api/v1/mapping/<ns>/", "status": "200"}
+    assert sample("idmapping_request_duration_seconds_count", route) > 0
+
+
+def test_timing_logging():
+    logstream = Mock()
+    cli, mapper = build_app(logstream=logstream)
+
+    def get_mappings_bulk(*args):
+        with request_timing.timed(request_timing.MAPPING_QUERY):
+            request_timing.count(request_timing.MONGO_CALLS, 2)
+            time.sleep(0.01)
+        return {"id1": (set(), set())}
+
+    mapper.get_mappings_bulk.side_effect = get_mappings_bulk
+
+    resp = cli.get("/api/v1/mapping/ns", json={"ids": ["id1"]})
+
+    assert resp.status_code == 200
+    assert len(logstream.write.call_args_list) == 1
+    timing = json.loads(logstream.write.call_args_list[0][0][0])["timing"]
+    check_timing(timing, mongo_calls=2)
+    assert timing["mapping_query_ms"] >= 10
+    assert timing["serialize_ms"] > 0
+
+
+def test_profile_sampled(tmp_path):
+    logstream = Mock()
+    cli, _ = build_app(logstream=logstream, profile_dir=tmp_path, profile_sample_rate=1)
+
+    cli.get("/")
+
+    files = list(tmp_path.iterdir())
+    assert len(files) == 1
+    callid = json.loads(logstream.write.call_args_list[0][0][0])["callid"]
+    assert re.match(r"^\d+-" + callid + r"\.prof$", files[0].name) is not None
+    assert len(logstream.write.call_args_list) == 2
+    logjson = json.loads(logstream.write.call_args_list[1][0][0])
+    assert logjson["msg"] == "Wrote profile to " + str(files[0])
+    assert pstats.Stats(str(files[0])).total_calls > 0
+
+
+def test_profile_header(tmp_path):
+    cli, mapper = build_app(profile_dir=tmp_path)
+    mapper.is_sys_admin.return_value = True
+
+    cli.get("/")  # no header
+    assert list(tmp_path.iterdir()) == []
+
+    cli.get("/", headers={"X-IDMapping-Profile": "true", "Authorization": "as t"})
+    assert len(list(tmp_path.iterdir())) == 1
+
+    mapper.is_sys_admin.return_value = False
+    cli.get("/", headers={"X-IDMapping-Profile": "true", "Authorization": "as t2"})
+    cli.get("/", headers={"X-IDMapping-Profile": "true"})  # no token
+    mapper.is_sys_admin.side_effect = InvalidTokenError()
+    cli.get("/", headers={"X-IDMapping-Profile": "true", "Authorization": "as t3"})
+    assert len(list(tmp_path.iterdir())) == 1
+
+    assert mapper.is_sys_admin.call_args_list == [
+        ((AuthsourceID("as"), Token("t")), {}),
+        ((AuthsourceID("as"), Token("t2")), {}),
+        ((AuthsourceID("as"), Token("t3")), {}),
+    ]
+
+
+def test_profile_header_admin_check_fails(tmp_path):
+    logstream = Mock()
+    cli, mapper = build_app(logstream=logstream, profile_dir=tmp_path)
+    mapper.get_namespace.return_value = Namespace(NamespaceID("foo"), False)
+
+    for err in [IOError("auth down"), IDMappingStorageError("db down")]:
+        logstream.reset_mock()
+        mapper.is_sys_admin.side_effect = err
+
+        resp = cli.get("/api/v1/namespace/foo",
+                       headers={"X-IDMapping-Profile": "true", "Authorization": "as t"})
+
+        assert resp.status_code == 200
+        assert list(tmp_path.iterdir()) == []
+        logjson = json.loads(logstream.write.call_args_list[0][0][0])
+        assert logjson["msg"] == "Not profiling request, admin check failed: " + str(err)
+
+
+def test_profile_disabled():
+    cli, mapper = build_app()
+
+    cli.get("/", headers={"X-IDMapping-Profile": "true", "Authorization": "as t"})
+
+    assert mapper.is_sys_admin.call_args_list == []
+
+
 def test_get_namespace_no_auth():
     cli, mapper = build_app()
     mapper.get_namespace.return_value = Namespace(NamespaceID("foo"), False)
@@ -559,6 +727,8 @@ def check_error_logging(logstream_mock, method, url, code, stackstring):
     del respjson["time"]
     respcallid = respjson["callid"]
     del respjson["callid"]
+    check_timing(respjson["timing"])
+    del respjson["timing"]
 
     stack = errjson["msg"]
     del errjson["msg"]
@@ -913,6 +1083,79 @@ def test_add_user_to_namespace_fail_illegal_ns_id():
     fail_illegal_ns_id_put("/api/v1/namespace/foo*bar/user/bar/baz")
 
 
+def test_add_users_to_namespace():
+    cli, mapper = build_app()
+
+    resp = cli.put(
+        "/api/v1/namespace/foo/users",
+        headers={"Authorization": "source tokey"},
+        json={"users": ["bar/baz", " bar / bat ", "whee/baz", "bar/baz"]},
+    )
+
+    assert resp.data == b""
+    assert resp.status_code == 204
+
+    assert mapper.add_users_to_namespace.call_args_list == [
+        (
+            (
+                AuthsourceID("source"),
+                Token("tokey"),
+                NamespaceID("foo"),
+                {
+                    User(AuthsourceID("bar"), Username("baz")),
+                    User(AuthsourceID("bar"), Username("bat")),
+                    User(AuthsourceID("whee"), Username("baz")),
+                },
+            ),
+            {},
+        )
+    ]
+
+
+def test_add_users_to_namespace_fail_no_token():
+    fail_no_token_put("/api/v1/namespace/foo/users")
+
+
+def test_add_users_to_namespace_fail_munged_auth():
+    fail_munged_auth_put("/api/v1/namespace/foo/users")
+
+
+def test_add_users_to_namespace_fail_illegal_ns_id():
+    fail_illegal_ns_id_put("/api/v1/namespace/foo*bar/users", json={"users": ["a/b"]})
+
+
+def test_add_users_to_namespace_fail_bad_input():
+    err = "30001 Illegal input parameter: "
+    fail_add_users_to_namespace(["a/b"], 30001, err + "Expected JSON mapping in request body")
+    fail_add_users_to_namespace({"user": ["a/b"]}, 30001,
+                                err + "Expected list at /users in request body")
+    fail_add_users_to_namespace({"users": "a/b"}, 30001,
+                                err + "Expected list at /users in request body")
+    fail_add_users_to_namespace({"users": []}, 30000,
+                                "30000 Missing input parameter: No users supplied")
+    for u in ["a", "a/b/c", 1, None]:
+        fail_add_users_to_namespace(
+            {"users": ["a/b", u]}, 30001,
+            err + "Expected user in the format <authsource>/<username>: " + str(u))
+    fail_add_users_to_namespace({"users": ["a/b", "a/B"]}, 30010,
+                                "30010 Illegal user name: Illegal character in username B: B")
+    fail_add_users_to_namespace({"users": ["a/" + str(x) for x in range(1001)]}, 30001,
+                                err + "A maximum of 1000 users are allowed")
+
+
+def fail_add_users_to_namespace(json, appcode, message):
+    cli, mapper = build_app()
+    resp = cli.put(
+        "/api/v1/namespace/foo/users", headers={"Authorization": "source tokey"}, json=json
+    )
+    err = resp.get_json()["error"]
+    assert err["httpcode"] == 400
+    assert err["appcode"] == appcode
+    assert err["message"] == message
+    assert resp.status_code == 400
+    assert mapper.add_users_to_namespace.call_args_list == []
+
+
 def test_remove_user_from_namespace():
     cli, mapper = build_app()
 
@@ -1029,6 +1272,52 @@ def test_set_namespace_publicly_mappable_fail_illegal_ns_id():
     fail_illegal_ns_id_put("/api/v1/namespace/foo*bar/set?publicly_mappable=true")
 
 
+def test_get_namespace_stats():
+    cli, mapper = build_app()
+    mapper.get_mapping_counts.return_value = (
+        {NamespaceID("zed"): 4, NamespaceID("bar"): 1000000},
+        {NamespaceID("foo"): 2},
+    )
+
+    resp = cli.get("/api/v1/namespace/ns/stats")
+
+    assert resp.status_code == 200
+    assert resp.data == (
+        b'{"namespace":"ns","admin":{"bar":1000000,"zed":4},"other":{"foo":2}}\n')
+    assert mapper.get_mapping_counts.call_args_list == [((NamespaceID("ns"),), {})]
+
+
+def test_get_namespace_stats_empty():
+    cli, mapper = build_app()
+    mapper.get_mapping_counts.return_value = ({}, {})
+
+    resp = cli.get("/api/v1/namespace/ns/stats")
+
+    assert resp.status_code == 200
+    assert resp.get_json() == {"namespace": "ns", "admin": {}, "other": {}}
+
+
+def test_get_namespace_stats_fail_no_namespace():
+    cli, mapper = build_app()
+    mapper.get_mapping_counts.side_effect = NoSuchNamespaceError("ns")
+
+    resp = cli.get("/api/v1/namespace/ns/stats")
+
+    assert_json_error_correct(
+        resp.get_json(),
+        {
+            "error": {
+                "httpcode": 404,
+                "httpstatus": "Not Found",
+                "appcode": 50010,
+                "apperror": "No such namespace",
+                "message": "50010 No such namespace: ns",
+            }
+        },
+    )
+    assert resp.status_code == 404
+
+
 def test_get_namespaces_empty():
     check_get_namespaces(
         (set(), set()), {"publicly_mappable": [], "privately_mappable": []}
@@ -1098,29 +1387,96 @@ def test_create_mapping_post():
     check_create_mapping(resp, mapper)
 
 
+def test_create_mapping_all_json_providers():
+    for provider in available_providers():
+        cli, mapper = build_app(json_provider=provider)
+        resp = cli.put(
+            "/api/v1/mapping/ans/ns",
+            headers={"Authorization": "source tokey"},
+            data='{"    aid1    \\t   ": "id1", "id2": "    \\t   id2   "}',
+        )
+        check_create_mapping(resp, mapper)
+
+        resp = cli.put("/api/v1/mapping/ans/ns", headers={"Authorization": "source tokey"})
+        check_mapping_fail_no_body(resp)
+
+        resp = cli.put(
+            "/api/v1/mapping/ans/ns",
+            headers={"Authorization": "source tokey"},
+            data='{"foo": ["bar", "baz"}]',
+        )
+        check_mapping_fail_bad_json(resp)
+
+
+def test_create_mapping_consistency_token():
+    cli, mapper = build_app()
+    tokens = []
+
+    def create_mappings(*args):
+        tokens.append(consistency.get_read_token())
+        consistency.set_write_token("writetoken")
+
+    mapper.create_mappings.side_effect = create_mappings
+
+    resp = cli.put(
+        "/api/v1/mapping/ans/ns",
+        headers={"Authorization": "source tokey",
+                 "X-IDMapping-Consistency-Token": "   readtoken   "},
+        data='{"aid1": "id1", "id2": "id2"}',
+    )
+
+    assert resp.status_code == 204
+    assert resp.headers["X-IDMapping-Consistency-Token"] == "writetoken"
+    assert tokens == ["readtoken"]
+    assert consistency.get_read_token() is None
+
+    # no write token
+    mapper.create_mappings.side_effect = None
+    resp = cli.put(
+        "/api/v1/mapping/ans/ns",
+        headers={"Authorization": "source tokey"},
+        data='{"aid1": "id1"}',
+    )
+
+    assert resp.status_code == 204
+    assert "X-IDMapping-Consistency-Token" not in resp.headers
+
+
+def test_get_mappings_consistency_token():
+    cli, mapper = build_app()
+    tokens = []
+
+    def get_mappings_bulk(*args):
+        tokens.append(consistency.get_read_token())
+        return {"id1": (set(), set())}
+
+    mapper.get_mappings_bulk.side_effect = get_mappings_bulk
+
+    for token in ["  readtoken  ", "   \t   ", None]:
+        headers = {"X-IDMapping-Consistency-Token": token} if token is not None else {}
+        resp = cli.get("/api/v1/mapping/ns", json={"ids": ["id1"]}, headers=headers)
+
+        assert resp.status_code == 200
+        assert "X-IDMapping-Consistency-Token" not in resp.headers
+
+    assert tokens == ["readtoken", None, None]
+
+
 def check_create_mapping(resp, mapper):
     assert resp.data == b""
     assert resp.status_code == 204
 
-    assert mapper.create_mapping.call_args_list == [
+    assert mapper.create_mappings.call_args_list == [
         (
             (
                 AuthsourceID("source"),
                 Token("tokey"),
-                ObjectID(NamespaceID("ans"), "aid1"),
-                ObjectID(NamespaceID("ns"), "id1"),
+                NamespaceID("ans"),
+                NamespaceID("ns"),
+                [("aid1", "id1"), ("id2", "id2")],
             ),
             {},
-        ),
-        (
-            (
-                AuthsourceID("source"),
-                Token("tokey"),
-                ObjectID(NamespaceID("ans"), "id2"),
-                ObjectID(NamespaceID("ns"), "id2"),
-            ),
-            {},
-        ),
+        )
     ]
 
 
@@ -1390,25 +1746,17 @@ def test_remove_mapping():
     assert resp.data == b""
     assert resp.status_code == 204
 
-    assert mapper.remove_mapping.call_args_list == [
-        (
-            (
-                AuthsourceID("source"),
-                Token("tokey"),
-                ObjectID(NamespaceID("ans"), "some id"),
-                ObjectID(NamespaceID("ns"), "aid"),
-            ),
-            {},
-        ),
+    assert mapper.remove_mappings.call_args_list == [
         (
             (
                 AuthsourceID("source"),
                 Token("tokey"),
-                ObjectID(NamespaceID("ans"), "other_id"),
-                ObjectID(NamespaceID("ns"), "id"),
+                NamespaceID("ans"),
+                NamespaceID("ns"),
+                [("some id", "aid"), ("other_id", "id")],
             ),
             {},
-        ),
+        )
     ]
 
 
@@ -1738,6 +2086,22 @@ def test_get_mappings_with_empty_filter():
     )
 
 
+def test_get_mappings_all_json_providers():
+    for provider in available_providers():
+        check_get_mappings(
+            [(set([to_oid("ns3", "id1")]), {to_oid("ns1", "id2")}), (set(), set())],
+            {
+                "id1": {
+                    "admin": [{"ns": "ns3", "id": "id1"}],
+                    "other": [{"ns": "ns1", "id": "id2"}],
+                },
+                "id2": {"admin": [], "other": []},
+            },
+            query="?separate",
+            json_provider=provider,
+        )
+
+
 def test_get_mappings_with_filter():
     check_get_mappings(
         [(set([to_oid("ns3", "id1")]), set()), (set(), set())],
@@ -1757,9 +2121,11 @@ def test_get_mappings_with_filter():
     )
 
 
-def check_get_mappings(returned, expected, query="", ns_filter_expected=[]):
-    cli, mapper = build_app()
-    mapper.get_mappings.side_effect = returned
+def check_get_mappings(
+    returned, expected, query="", ns_filter_expected=[], json_provider=None
+):
+    cli, mapper = build_app(json_provider=json_provider)
+    mapper.get_mappings_bulk.return_value = dict(zip(["id1", "id2"], returned))
 
     resp = cli.get("/api/v1/mapping/ns" + query, json={"ids": ["   id1   \t", "id2"]})
 
@@ -1767,11 +2133,237 @@ def check_get_mappings(returned, expected, query="", ns_filter_expected=[]):
 
     assert resp.status_code == 200
 
-    assert mapper.get_mappings.call_args_list == [
-        ((ObjectID(NamespaceID("ns"), "id1"), ns_filter_expected), {}),
-        ((ObjectID(NamespaceID("ns"), "id2"), ns_filter_expected), {}),
+    assert mapper.get_mappings_bulk.call_args_list == [
+        ((NamespaceID("ns"), ["id1", "id2"], ns_filter_expected), {})
+    ]
+    assert resp.headers["Content-Type"] == "application/json"
+    assert resp.headers["Vary"] == "Accept"
+
+
+COLUMNAR_MAPPINGS = {
+    "id1": (
+        {to_oid("ns3", "id1"), to_oid("ns1", "id3"), to_oid("ns1", "id1")},
+        {to_oid("ns2", "x")},
+    ),
+    "id2": (set(), set()),
+}
+
+
+def test_get_mappings_columnar_json():
+    check_get_mappings_columnar(
+        "application/vnd.kbase.idmapping.columnar+json",
+        "application/vnd.kbase.idmapping.columnar+json",
+        json.loads,
+    )
+
+
+def test_get_mappings_msgpack():
+    check_get_mappings_columnar("application/msgpack", "application/msgpack", msgpack.unpackb)
+    check_get_mappings_columnar(
+        "application/x-msgpack", "application/x-msgpack", msgpack.unpackb)
+    check_get_mappings_columnar(
+        "application/json;q=0.5, application/msgpack", "application/msgpack", msgpack.unpackb)
+
+
+def check_get_mappings_columnar(accept, content_type, decode):
+    cli, mapper = build_app()
+    mapper.get_mappings_bulk.return_value = COLUMNAR_MAPPINGS
+
+    resp = cli.get(
+        "/api/v1/mapping/ns?sort",
+        json={"ids": ["id1", " id2 ", "id1"]},
+        headers={"Accept": accept},
+    )
+
+    assert resp.status_code == 200
+    assert resp.headers["Content-Type"] == content_type
+    assert resp.headers["Vary"] == "Accept"
+    assert decode(resp.data) == {
+        "ids": ["id1", "id2"],
+        "namespaces": ["ns1", "ns2", "ns3"],
+        "mappings": {
+            "index": [0, 0, 0, 0],
+            "ns": [0, 0, 1, 2],
+            "id": ["id1", "id3", "x", "id1"],
+        },
+    }
+    assert mapper.get_mappings_bulk.call_args_list == [
+        ((NamespaceID("ns"), ["id1", "id2", "id1"], []), {})
+    ]
+
+
+def test_get_mappings_msgpack_separate_with_filter():
+    cli, mapper = build_app()
+    mapper.get_mappings_bulk.return_value = COLUMNAR_MAPPINGS
+
+    resp = cli.get(
+        "/api/v1/mapping/ns?separate&sort&namespace_filter=ns1,ns2",
+        json={"ids": ["id2", "id1"]},
+        headers={"Accept": "application/msgpack"},
+    )
+
+    assert resp.status_code == 200
+    assert msgpack.unpackb(resp.data) == {
+        "ids": ["id2", "id1"],
+        "namespaces": ["ns1", "ns3", "ns2"],
+        "admin": {"index": [1, 1, 1], "ns": [0, 0, 1], "id": ["id1", "id3", "id1"]},
+        "other": {"index": [1], "ns": [2], "id": ["x"]},
+    }
+    assert mapper.get_mappings_bulk.call_args_list == [
+        ((NamespaceID("ns"), ["id2", "id1"], [NamespaceID("ns1"), NamespaceID("ns2")]), {})
+    ]
+
+
+def test_get_mappings_msgpack_unsorted():
+    cli, mapper = build_app()
+    mapper.get_mappings_bulk.return_value = COLUMNAR_MAPPINGS
+
+    resp = cli.get(
+        "/api/v1/mapping/ns",
+        json={"ids": ["id1", "id2"]},
+        headers={"Accept": "application/msgpack"},
+    )
+
+    assert resp.status_code == 200
+    got = msgpack.unpackb(resp.data)
+    assert got["ids"] == ["id1", "id2"]
+    cols = got["mappings"]
+    assert cols["index"] == [0, 0, 0, 0]
+    assert sorted((got["namespaces"][n], id_) for n, id_ in zip(cols["ns"], cols["id"])) == [
+        ("ns1", "id1"), ("ns1", "id3"), ("ns2", "x"), ("ns3", "id1")]
+
+
+def test_get_mappings_prefix():
+    cli, mapper = build_app()
+    mapper.get_mappings_with_prefix.return_value = (
+        {
+            "GCF_00151": ({to_oid("ns3", "id1")}, {to_oid("ns1", "id2")}),
+            "GCF_00152.1": (set(), {to_oid("ns1", "id3")}),
+        },
+        False,
+    )
+
+    resp = cli.get("/api/v1/mapping/ns?prefix=%20GCF_0015%20&separate")
+
+    assert resp.status_code == 200
+    assert resp.get_json() == {
+        "GCF_00151": {
+            "admin": [{"ns": "ns3", "id": "id1"}],
+            "other": [{"ns": "ns1", "id": "id2"}],
+        },
+        "GCF_00152.1": {"admin": [], "other": [{"ns": "ns1", "id": "id3"}]},
+    }
+    # the response is in id order
+    assert list(json.loads(resp.data)) == ["GCF_00151", "GCF_00152.1"]
+    assert "X-IDMapping-Next-After" not in resp.headers
+    assert mapper.get_mappings_with_prefix.call_args_list == [
+        ((NamespaceID("ns"), "GCF_0015", [], 100, None), {})
+    ]
+    assert mapper.get_mappings_bulk.call_args_list == []
+
+
+def test_get_mappings_prefix_more_results():
+    cli, mapper = build_app()
+    mapper.get_mappings_with_prefix.return_value = (
+        {"a": ({to_oid("ns3", "id1")}, set()), "a/é b": ({to_oid("ns3", "id2")}, set())},
+        True,
+    )
+
+    resp = cli.get(
+        "/api/v1/mapping/ns?prefix=a&limit=%202%20&after=%20a%20&namespace_filter=ns3")
+
+    assert resp.status_code == 200
+    assert resp.get_json() == {
+        "a": {"mappings": [{"ns": "ns3", "id": "id1"}]},
+        "a/é b": {"mappings": [{"ns": "ns3", "id": "id2"}]},
+    }
+    assert resp.headers["X-IDMapping-Next-After"] == "a%2F%C3%A9%20b"
+    assert mapper.get_mappings_with_prefix.call_args_list == [
+        ((NamespaceID("ns"), "a", [NamespaceID("ns3")], 2, "a"), {})
+    ]
+
+
+def test_get_mappings_range():
+    cli, mapper = build_app()
+    mapper.get_mappings_in_range.return_value = (
+        {"b": ({to_oid("ns3", "id1")}, set())}, True)
+
+    resp = cli.get("/api/v1/mapping/ns?start=b&end=c&limit=1")
+
+    assert resp.status_code == 200
+    assert resp.get_json() == {"b": {"mappings": [{"ns": "ns3", "id": "id1"}]}}
+    assert resp.headers["X-IDMapping-Next-After"] == "b"
+    assert mapper.get_mappings_in_range.call_args_list == [
+        ((NamespaceID("ns"), "b", "c", [], 1, None), {})
     ]
 
+    # unbounded range
+    mapper.get_mappings_in_range.return_value = ({}, False)
+    resp = cli.get("/api/v1/mapping/ns?start=b&after=b")
+
+    assert resp.status_code == 200
+    assert resp.get_json() == {}
+    assert "X-IDMapping-Next-After" not in resp.headers
+    assert mapper.get_mappings_in_range.call_args_list[1] == (
+        (NamespaceID("ns"), "b", None, [], 100, "b"), {})
+
+
+def test_get_mappings_range_columnar():
+    cli, mapper = build_app()
+    mapper.get_mappings_in_range.return_value = (COLUMNAR_MAPPINGS, True)
+
+    resp = cli.get(
+        "/api/v1/mapping/ns?start=id&sort&limit=2",
+        headers={"Accept": "application/msgpack"},
+    )
+
+    assert resp.status_code == 200
+    assert resp.headers["X-IDMapping-Next-After"] == "id2"
+    assert msgpack.unpackb(resp.data) == {
+        "ids": ["id1", "id2"],
+        "namespaces": ["ns1", "ns2", "ns3"],
+        "mappings": {
+            "index": [0, 0, 0, 0],
+            "ns": [0, 0, 1, 2],
+            "id": ["id1", "id3", "x", "id1"],
+        },
+    }
+
+
+def test_get_mappings_range_fail_bad_params():
+    err = "30001 Illegal input parameter: "
+    fail_get_mappings_range("prefix=a&start=b",
+                            err + "Only one of prefix and start may be provided")
+    fail_get_mappings_range("prefix=a&end=b", err + "end may only be provided with start")
+    fail_get_mappings_range("prefix=a&limit=ten", err + "limit must be an integer")
+    fail_get_mappings_range("start=a&limit=1.5", err + "limit must be an integer")
+    fail_get_mappings_range("start=a&limit=1001", err + "A maximum of 1000 ids are allowed")
+
+
+def fail_get_mappings_range(query, message):
+    cli, mapper = build_app()
+    resp = cli.get("/api/v1/mapping/ns?" + query)
+    err = resp.get_json()["error"]
+    assert err["httpcode"] == 400
+    assert err["appcode"] == 30001
+    assert err["message"] == message
+    assert resp.status_code == 400
+    assert mapper.get_mappings_with_prefix.call_args_list == []
+    assert mapper.get_mappings_in_range.call_args_list == []
+
+
+def test_get_mappings_unsupported_accept_returns_json():
+    cli, mapper = build_app()
+    mapper.get_mappings_bulk.return_value = {"id2": (set(), set())}
+
+    resp = cli.get(
+        "/api/v1/mapping/ns", json={"ids": ["id2"]}, headers={"Accept": "text/html, */*;q=0.1"}
+    )
+
+    assert resp.status_code == 200
+    assert resp.headers["Content-Type"] == "application/json"
+    assert resp.get_json() == {"id2": {"mappings": []}}
+
 
 def test_get_mappings_fail_no_body():
     cli, _ = build_app()
@@ -1905,3 +2497,114 @@ def test_get_mappings_fail_illegal_ns_id():
     fail_illegal_ns_id_get(
         "/api/v1/mapping/foobar?namespace_filter=foo*bar", json={"ids": ["id"]}
     )
+
+
+def test_export_mappings():
+    check_export_mappings("", None)
+    check_export_mappings("?after_admin=%20a%20&after_other=b", ("a", "b"))
+
+
+def check_export_mappings(query, after_expected):
+    cli, mapper = build_app()
+    mapper.iter_mappings.return_value = iter([("a", "c"), ("b", "a"), ("b", "b")])
+
+    resp = cli.get("/api/v1/mapping/ans/ns" + query)
+
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/x-ndjson"
+    assert [json.loads(line) for line in resp.get_data(as_text=True).splitlines()] == [
+        {"admin": "a", "other": "c"},
+        {"admin": "b", "other": "a"},
+        {"admin": "b", "other": "b"},
+    ]
+
+    assert mapper.iter_mappings.call_args_list == [
+        ((NamespaceID("ans"), NamespaceID("ns"), after_expected), {})
+    ]
+
+
+def test_export_mappings_chunked(monkeypatch):
+    monkeypatch.setattr(mapper_service, "_EXPORT_CHUNK_SIZE", 2)
+    mappings = [("a", "c"), ("b", "a"), ("b", "b"), ("c", "d"), ("e", "f")]
+    for provider in available_providers():
+        chunks = list(mapper_service._export_mappings_ndjson(iter(mappings), provider))
+
+        assert len(chunks) == 3
+        assert [json.loads(line) for line in b"".join(chunks).splitlines()] == [
+            {"admin": a, "other": o} for a, o in mappings
+        ]
+        assert list(mapper_service._export_mappings_ndjson(iter([]), provider)) == []
+
+
+def test_export_mappings_fail_after():
+    cli, _ = build_app()
+
+    for query in ["?after_admin=a", "?after_other=b", "?after_admin=&after_other=b"]:
+        resp = cli.get("/api/v1/mapping/ans/ns" + query)
+
+        assert_json_error_correct(
+            resp.get_json(),
+            {
+                "error": {
+                    "httpcode": 400,
+                    "httpstatus": "Bad Request",
+                    "appcode": 30000,
+                    "apperror": "Missing input parameter",
+                    "message": (
+                        "30000 Missing input parameter: "
+                        + "Both or neither of after_admin and after_other must be provided"
+                    ),
+                }
+            },
+        )
+        assert resp.status_code == 400
+
+
+def test_export_mappings_fail_no_namespace():
+    logstream = Mock()
+    cli, mapper = build_app(logstream=logstream)
+    mapper.iter_mappings.side_effect = NoSuchNamespaceError("ns")
+
+    resp = cli.get("/api/v1/mapping/ans/ns")
+
+    assert_json_error_correct(
+        resp.get_json(),
+        {
+            "error": {
+                "httpcode": 404,
+                "httpstatus": "Not Found",
+                "appcode": 50010,
+                "apperror": "No such namespace",
+                "message": "50010 No such namespace: ns",
+            }
+        },
+    )
+    assert resp.status_code == 404
+
+    check_error_logging(
+        logstream,
+        "GET",
+        "/api/v1/mapping/ans/ns",
+        404,
+        "NoSuchNamespaceError: 50010 No such namespace: ns",
+    )
+
+
+def test_export_mappings_fail_during_stream():
+    logstream = Mock()
+    cli, mapper = build_app(logstream=logstream)
+
+    def mappings():
+        yield ("a", "b")
+        raise IDMappingStorageError("Connection to database failed: oops")
+
+    mapper.iter_mappings.return_value = mappings()
+
+    with raises(IDMappingStorageError):
+        cli.get("/api/v1/mapping/ans/ns").get_data()
+
+    # the response log happens before the body is streamed
+    errjson = json.loads(logstream.write.call_args_list[-1][0][0])
+    assert errjson["level"] == "ERROR"
+    assert errjson["method"] == "GET"
+    assert "IDMappingStorageError: Connection to database failed: oops" in errjson["msg"]
@@ -0,0 +1,105 @@
+from pytest import raises
+from jgikbase.idmapping.core.object_id import NamespaceID, ObjectID
+from jgikbase.idmapping.service import mapping_formats
+from jgikbase.test.idmapping.test_utils import assert_exception_correct
+import json
+import msgpack
+
+
+def oid(ns, id_):
+    return ObjectID(NamespaceID(ns), id_)
+
+
+MAPPINGS = {
+    "id1": ({oid("ns2", "b"), oid("ns1", "c"), oid("ns2", "a")}, {oid("ns3", "x")}),
+    "id2": (set(), set()),
+    "id3": (set(), {oid("ns1", "y"), oid("ns3", "z")}),
+}
+
+
+def check_columns(columnar, key, expected):
+    # expected is a list of (id index, namespace, id) tuples. The order is arbitrary unless
+    # sorted.
+    cols = columnar[key]
+    assert len(cols["index"]) == len(cols["ns"]) == len(cols["id"])
+    got = [
+        (i, columnar["namespaces"][n], id_)
+        for i, n, id_ in zip(cols["index"], cols["ns"], cols["id"])
+    ]
+    assert sorted(got) == expected
+    return got
+
+
+def test_to_columnar():
+    c = mapping_formats.to_columnar(["id1", "id2", "id3"], MAPPINGS)
+
+    assert set(c.keys()) == {"ids", "namespaces", "mappings"}
+    assert c["ids"] == ["id1", "id2", "id3"]
+    assert sorted(c["namespaces"]) == ["ns1", "ns2", "ns3"]
+    got = check_columns(c, "mappings", [
+        (0, "ns1", "c"), (0, "ns2", "a"), (0, "ns2", "b"), (0, "ns3", "x"),
+        (2, "ns1", "y"), (2, "ns3", "z"),
+    ])
+    # mappings are grouped by requested ID
+    assert [g[0] for g in got] == [0, 0, 0, 0, 2, 2]
+    # the input is not modified
+    assert MAPPINGS["id1"][0] == {oid("ns2", "b"), oid("ns1", "c"), oid("ns2", "a")}
+
+
+def test_to_columnar_sorted():
+    c = mapping_formats.to_columnar(["id3", "id1"], MAPPINGS, sort=True)
+
+    assert c == {
+        "ids": ["id3", "id1"],
+        "namespaces": ["ns1", "ns3", "ns2"],
+        "mappings": {
+            "index": [0, 0, 1, 1, 1, 1],
+            "ns": [0, 1, 0, 2, 2, 1],
+            "id": ["y", "z", "c", "a", "b", "x"],
+        },
+    }
+
+
+def test_to_columnar_separate():
+    c = mapping_formats.to_columnar(["id1", "id2", "id3"], MAPPINGS, separate=True)
+
+    assert set(c.keys()) == {"ids", "namespaces", "admin", "other"}
+    assert sorted(c["namespaces"]) == ["ns1", "ns2", "ns3"]
+    check_columns(c, "admin", [(0, "ns1", "c"), (0, "ns2", "a"), (0, "ns2", "b")])
+    check_columns(c, "other", [(0, "ns3", "x"), (2, "ns1", "y"), (2, "ns3", "z")])
+
+    c = mapping_formats.to_columnar(["id1"], MAPPINGS, separate=True, sort=True)
+    assert c == {
+        "ids": ["id1"],
+        "namespaces": ["ns1", "ns2", "ns3"],
+        "admin": {"index": [0, 0, 0], "ns": [0, 1, 1], "id": ["c", "a", "b"]},
+        "other": {"index": [0], "ns": [2], "id": ["x"]},
+    }
+
+
+def test_to_columnar_empty():
+    assert mapping_formats.to_columnar([], {}) == {
+        "ids": [],
+        "namespaces": [],
+        "mappings": {"index": [], "ns": [], "id": []},
+    }
+    assert mapping_formats.to_columnar(["id2"], MAPPINGS, separate=True) == {
+        "ids": ["id2"],
+        "namespaces": [],
+        "admin": {"index": [], "ns": [], "id": []},
+        "other": {"index": [], "ns": [], "id": []},
+    }
+
+
+def test_encode():
+    obj = {"ids": ["id1"], "namespaces": ["ns1"], "mappings": {"index": [0]}}
+    for mt in [mapping_formats.JSON, mapping_formats.COLUMNAR_JSON]:
+        assert json.loads(mapping_formats.encode(obj, mt)) == obj
+    for mt in [mapping_formats.MSGPACK, mapping_formats.MSGPACK_LEGACY]:
+        assert msgpack.unpackb(mapping_formats.encode(obj, mt)) == obj
+
+
+def test_encode_fail():
+    with raises(Exception) as got:
+        mapping_formats.encode({}, "text/plain")
+    assert_exception_correct(got.value, ValueError("Unsupported media type: text/plain"))
@@ -0,0 +1,102 @@
+from unittest.mock import create_autospec
+from jgikbase.idmapping.service.profiler import RequestProfiler
+from jgikbase.test.idmapping.test_utils import assert_exception_correct
+from pytest import raises
+import pstats
+import random
+import time
+
+
+def test_init_fail(tmp_path):
+    fail_init(None, 0, 1, TypeError('directory cannot be None'))
+    fail_init(tmp_path, -0.1, 1, ValueError('sample_rate must be between 0 and 1'))
+    fail_init(tmp_path, 1.1, 1, ValueError('sample_rate must be between 0 and 1'))
+    fail_init(tmp_path, 0, 0, ValueError('max_size must be at least 1'))
+
+
+def fail_init(directory, sample_rate, max_size, expected):
+    with raises(Exception) as got:
+        RequestProfiler(directory, sample_rate, max_size)
+    assert_exception_correct(got.value, expected)
+
+
+def test_creates_directory(tmp_path):
+    RequestProfiler(tmp_path / 'a' / 'b')
+    assert (tmp_path / 'a' / 'b').is_dir()
+
+
+def test_sample(tmp_path):
+    rand = create_autospec(random.random, spec_set=True)
+    rand.side_effect = [0.1, 0.25, 0.3]
+
+    p = RequestProfiler(tmp_path, 0.25, rand=rand)
+    assert [p.sample(), p.sample(), p.sample()] == [True, False, False]
+
+    # never calls the random function when sampling is disabled
+    assert RequestProfiler(tmp_path, rand=rand).sample() is False
+    assert len(rand.call_args_list) == 3
+
+
+def test_profile(tmp_path):
+    timer = create_autospec(time.time, spec_set=True)
+    timer.return_value = 1500.0001
+
+    p = RequestProfiler(tmp_path, timer=timer)
+    prof = p.start()
+    sorted([3, 2, 1])
+    path = p.finish(prof, '1234')
+
+    assert path == tmp_path / '1500000-1234.prof'
+    assert list(tmp_path.iterdir()) == [path]
+    funcs = [f[2] for f in pstats.Stats(str(path)).stats]  # type: ignore
+    assert "<built-in method builtins.sorted>" in funcs
+
+
+def test_one_profile_at_a_time(tmp_path):
+    p = RequestProfiler(tmp_path)
+    prof = p.start()
+    assert p.start() is None
+    p.finish(prof, '1')
+
+    prof = p.start()
+    assert prof is not None
+    p.finish(prof, '2')
+
+
+def test_rotate(tmp_path):
+    timer = create_autospec(time.time, spec_set=True)
+    timer.return_value = 3
+    p = RequestProfiler(tmp_path, max_size=1000000, timer=timer)
+    (tmp_path / 'other.txt').write_text('not a profile')
+    (tmp_path / '0001-a.prof').write_bytes(b'a' * 999990)
+    (tmp_path / '0002-b.prof').write_bytes(b'b' * 10)
+
+    p.finish(p.start(), '3')  # type: ignore
+
+    assert sorted(f.name for f in tmp_path.iterdir()) == [
+        '0002-b.prof', '3000-3.prof', 'other.txt']
+
+
+def test_rotate_keeps_newest(tmp_path):
+    timer = create_autospec(time.time, spec_set=True)
+    timer.return_value = 1
+    p = RequestProfiler(tmp_path, max_size=1, timer=timer)
+    (tmp_path / '0999-old.prof').write_text('old')
+
+    p.finish(p.start(), '1')  # type: ignore
+
+    # the newest profile is kept even though it's too big
+    assert sorted(f.name for f in tmp_path.iterdir()) == ['1000-1.prof']
+
+
+def test_finish_fail(tmp_path):
+    p = RequestProfiler(tmp_path)
+    prof = p.start()
+    try:
+        for pr, c, expected in [(None, '1', TypeError('profile cannot be None')),
+                                (prof, None, TypeError('callid cannot be None'))]:
+            with raises(Exception) as got:
+                p.finish(pr, c)
+            assert_exception_correct(got.value, expected)
+    finally:
+        prof.disable()  # type: ignore
@@ -3,12 +3,23 @@ from jgikbase.test.idmapping.mongo_controller import MongoController
 from jgikbase.test.idmapping import test_utils
 from jgikbase.idmapping.storage.mongo.id_mapping_mongo_storage import (
     IDMappingMongoStorage,
+    MongoCommandCounter,
 )
+from jgikbase.idmapping.storage.mongo import id_mapping_mongo_storage
+from jgikbase.idmapping.core import request_timing
+from pymongo.mongo_client import MongoClient
+from pymongo.monitoring import CommandListener
 from jgikbase.idmapping.core.user import User, AuthsourceID, Username
 from jgikbase.idmapping.core.tokens import HashedToken
 from jgikbase.test.idmapping.test_utils import assert_exception_correct
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from unittest.mock import MagicMock
+from bson.son import SON
+from bson.timestamp import Timestamp
+from pymongo.read_preferences import Primary, SecondaryPreferred, Nearest
+from jgikbase.idmapping.core import consistency
 from jgikbase.idmapping.core.errors import (
+    IllegalParameterError,
     NoSuchUserError,
     UserExistsError,
     InvalidTokenError,
@@ -20,6 +31,9 @@ from jgikbase.idmapping.storage.errors import (
     StorageInitException,
 )
 import re
+import time
+import base64
+import bson
 from jgikbase.idmapping.core.object_id import NamespaceID, Namespace, ObjectID
 
 TEST_DB_NAME = "test_id_mapping"
@@ -51,6 +65,21 @@ def idstorage(mongo):
     return IDMappingMongoStorage(mongo.client[TEST_DB_NAME])
 
 
+@fixture
+def idstorage_covered(mongo):
+    mongo.clear_database(TEST_DB_NAME, drop_indexes=True)
+    return IDMappingMongoStorage(mongo.client[TEST_DB_NAME], covered_index=True)
+
+
+@fixture
+def idstorage_sharded(mongo, monkeypatch):
+    # the test MongoDB instance isn't a sharded cluster. The sharding commands are tested
+    # separately.
+    monkeypatch.setattr(IDMappingMongoStorage, "_shard_collections", lambda self: None)
+    mongo.clear_database(TEST_DB_NAME, drop_indexes=True)
+    return IDMappingMongoStorage(mongo.client[TEST_DB_NAME], sharded=True)
+
+
 def test_fail_startup():
     with raises(Exception) as got:
         IDMappingMongoStorage(None)
@@ -65,7 +94,15 @@ def test_fail_startup():
 
 def test_collection_names(idstorage, mongo):
     names = mongo.client[TEST_DB_NAME].list_collection_names()
-    expected = set(["users", "config", "ns", "map"])
+    expected = set(["users", "config", "ns", "map", "mapcount"])
+    if mongo.includes_system_indexes:
+        expected.add("system.indexes")
+    assert set(names) == expected
+
+
+def test_collection_names_sharded(idstorage_sharded, mongo):
+    names = mongo.client[TEST_DB_NAME].list_collection_names()
+    expected = set(["users", "config", "ns", "map", "revmap", "mapcount"])
     if mongo.includes_system_indexes:
         expected.add("system.indexes")
     assert set(names) == expected
@@ -86,6 +123,25 @@ def test_index_config(idstorage, mongo):
     assert indexes == expected
 
 
+def test_index_mapping_counts(idstorage, mongo):
+    v = mongo.index_version
+    indexes = mongo.client[TEST_DB_NAME]["mapcount"].index_information()
+    test_utils.remove_ns_from_index_info(indexes)
+    expected = {
+        "_id_": {"v": v, "key": [("_id", 1)]},
+        "pnsid_1_snsid_1": {
+            "v": v,
+            "unique": True,
+            "key": [("pnsid", 1), ("snsid", 1)],
+        },
+        "snsid_1_pnsid_1": {
+            "v": v,
+            "key": [("snsid", 1), ("pnsid", 1)],
+        },
+    }
+    assert indexes == expected
+
+
 def test_index_user(idstorage, mongo):
     v = mongo.index_version
     indexes = mongo.client[TEST_DB_NAME]["users"].index_information()
@@ -136,6 +192,33 @@ def test_index_mappings(idstorage, mongo):
             "v": v,
             "key": [("snsid", 1), ("sid", 1)],
         },
+        "pnsid_1_snsid_1_pid_1_sid_1": {
+            "v": v,
+            "key": [("pnsid", 1), ("snsid", 1), ("pid", 1), ("sid", 1)],
+        },
+    }
+    assert indexes == expected
+
+
+def test_index_mappings_covered(idstorage_covered, mongo):
+    v = mongo.index_version
+    indexes = mongo.client[TEST_DB_NAME]["map"].index_information()
+    test_utils.remove_ns_from_index_info(indexes)
+    expected = {
+        "_id_": {"v": v, "key": [("_id", 1)]},
+        "pnsid_1_pid_1_snsid_1_sid_1": {
+            "v": v,
+            "unique": True,
+            "key": [("pnsid", 1), ("pid", 1), ("snsid", 1), ("sid", 1)],
+        },
+        "snsid_1_sid_1_pnsid_1_pid_1": {
+            "v": v,
+            "key": [("snsid", 1), ("sid", 1), ("pnsid", 1), ("pid", 1)],
+        },
+        "pnsid_1_snsid_1_pid_1_sid_1": {
+            "v": v,
+            "key": [("pnsid", 1), ("snsid", 1), ("pid", 1), ("sid", 1)],
+        },
     }
     assert indexes == expected
 
@@ -154,6 +237,21 @@ def test_startup_and_check_config_doc(idstorage, mongo):
     assert idmap.get_user(HashedToken("t")) == (Username("foo"), False)
 
 
+def test_startup_and_check_config_doc_covered(idstorage_covered, mongo):
+    col = mongo.client[TEST_DB_NAME]["config"]
+    assert len(list(col.find({}))) == 1  # only one config doc
+    cfgdoc = col.find_one()
+    assert cfgdoc["schema"] == "schema"
+    assert cfgdoc["schemaver"] == 2
+    assert cfgdoc["inupdate"] is False
+
+    # v2 databases work with servers that don't have the covering index enabled
+    idmap = IDMappingMongoStorage(mongo.client[TEST_DB_NAME])
+    idmap.create_local_user(Username("foo"), HashedToken("t"))
+    assert idmap.get_user(HashedToken("t")) == (Username("foo"), False)
+    assert len(mongo.client[TEST_DB_NAME]["map"].index_information()) == 4
+
+
 def test_startup_with_2_config_docs(mongo):
     col = mongo.client[TEST_DB_NAME]["config"]
     col.drop()  # clear db independently of creating a idmapping mongo instance
@@ -198,21 +296,434 @@ def test_startup_with_bad_schema_version(mongo):
     col.drop()  # clear db independently of creating a idmapping mongo instance
     col.insert_one({"schema": "schema", "schemaver": 4, "inupdate": False})
 
-    fail_startup(mongo, "Incompatible database schema. Server is v1, DB is v4")
+    fail_startup(mongo, "Incompatible database schema. Server is v2, DB is v4")
 
 
 def test_startup_in_update(mongo):
     col = mongo.client[TEST_DB_NAME]["config"]
     col.drop()  # clear db independently of creating a idmapping mongo instance
-    col.insert_one({"schema": "schema", "schemaver": 1, "inupdate": True})
+    col.insert_one({"schema": "schema", "schemaver": 2, "inupdate": True})
 
     fail_startup(
         mongo,
-        "The database is in the middle of an update from v1 of the "
+        "The database is in the middle of an update from v2 of the "
         + "schema. Aborting startup.",
     )
 
 
+def test_startup_in_online_update(mongo):
+    mongo.clear_database(TEST_DB_NAME, drop_indexes=True)
+    col = mongo.client[TEST_DB_NAME]["config"]
+    col.insert_one({"schema": "schema", "schemaver": 1, "inupdate": True})
+
+    # the update from v1 to v2 only adds an index, so servers can keep running
+    idmap = IDMappingMongoStorage(mongo.client[TEST_DB_NAME])
+    idmap.create_local_user(Username("foo"), HashedToken("t"))
+    assert idmap.get_user(HashedToken("t")) == (Username("foo"), False)
+
+
+def test_update_schema(idstorage, mongo):
+    idstorage.add_mapping(
+        ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bat")
+    )
+    # storage instances without the covering index enabled don't update
+    assert idstorage.update_schema() is False
+    assert mongo.client[TEST_DB_NAME]["config"].find_one()["schemaver"] == 1
+
+    idmap = IDMappingMongoStorage(mongo.client[TEST_DB_NAME], covered_index=True)
+    assert idmap.update_schema() is True
+
+    cfgdoc = mongo.client[TEST_DB_NAME]["config"].find_one()
+    assert cfgdoc["schemaver"] == 2
+    assert cfgdoc["inupdate"] is False
+    indexes = mongo.client[TEST_DB_NAME]["map"].index_information()
+    assert set(indexes) == {"_id_", "pnsid_1_pid_1_snsid_1_sid_1", "pnsid_1_snsid_1_pid_1_sid_1",
+                            "snsid_1_sid_1_pnsid_1_pid_1"}
+
+    assert idmap.update_schema() is False
+    assert idmap.find_mappings(ObjectID(NamespaceID("baz"), "bat")) == (
+        set(),
+        {ObjectID(NamespaceID("foo"), "bar")},
+    )
+
+
+def test_update_schema_resume(idstorage, mongo):
+    # simulate an update that failed after setting the update flag
+    mongo.client[TEST_DB_NAME]["config"].update_one({}, {"$set": {"inupdate": True}})
+
+    idmap = IDMappingMongoStorage(mongo.client[TEST_DB_NAME], covered_index=True)
+    assert idmap.update_schema() is True
+
+    cfgdoc = mongo.client[TEST_DB_NAME]["config"].find_one()
+    assert cfgdoc["schemaver"] == 2
+    assert cfgdoc["inupdate"] is False
+
+    # simulate an update that failed before dropping the old index
+    mongo.client[TEST_DB_NAME]["map"].create_index([("snsid", 1), ("sid", 1)])
+    assert idmap.update_schema() is False
+    indexes = mongo.client[TEST_DB_NAME]["map"].index_information()
+    assert set(indexes) == {"_id_", "pnsid_1_pid_1_snsid_1_sid_1", "pnsid_1_snsid_1_pid_1_sid_1",
+                            "snsid_1_sid_1_pnsid_1_pid_1"}
+
+
+def test_index_reverse_mappings_sharded(idstorage_sharded, mongo):
+    v = mongo.index_version
+    indexes = mongo.client[TEST_DB_NAME]["revmap"].index_information()
+    test_utils.remove_ns_from_index_info(indexes)
+    expected = {
+        "_id_": {"v": v, "key": [("_id", 1)]},
+        "snsid_1_sid_1_pnsid_1_pid_1": {
+            "v": v,
+            "unique": True,
+            "key": [("snsid", 1), ("sid", 1), ("pnsid", 1), ("pid", 1)],
+        },
+    }
+    assert indexes == expected
+    # new databases use the reverse mapping collection immediately
+    assert mongo.client[TEST_DB_NAME]["config"].find_one()["revmap"] is True
+
+
+def test_startup_sharded_fail_not_sharded_cluster(mongo):
+    mongo.clear_database(TEST_DB_NAME, drop_indexes=True)
+    with raises(Exception) as got:
+        IDMappingMongoStorage(mongo.client[TEST_DB_NAME], sharded=True)
+    assert_exception_correct(got.value, StorageInitException(
+        "Sharding is enabled but the database is not a sharded cluster"))
+
+
+def test_startup_unsharded_fail_with_reverse_collection(idstorage_sharded, mongo):
+    fail_startup(mongo, "The database uses a reverse mapping collection for a sharded "
+                 + "cluster, but sharding is not enabled")
+
+
+def mapping_docs(mongo, collection):
+    return sorted((d["pnsid"], d["pid"], d["snsid"], d["sid"])
+                  for d in mongo.client[TEST_DB_NAME][collection].find())
+
+
+def test_mappings_sharded(idstorage_sharded, mongo):
+    ids = idstorage_sharded
+    ids.add_mapping(ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bat"))
+    ids.add_mapping(ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bat"))
+    assert ids.add_mappings([
+        (ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bat")),
+        (ObjectID(NamespaceID("foo"), "bar1"), ObjectID(NamespaceID("baz"), "bat")),
+        (ObjectID(NamespaceID("foo2"), "bar"), ObjectID(NamespaceID("baz"), "bat")),
+    ]) == (2, 1)
+
+    expected = [("foo", "bar", "baz", "bat"), ("foo", "bar1", "baz", "bat"),
+                ("foo2", "bar", "baz", "bat")]
+    assert mapping_docs(mongo, "map") == expected
+    assert mapping_docs(mongo, "revmap") == expected
+
+    # reverse lookups are served from the reverse mapping collection
+    mongo.client[TEST_DB_NAME]["map"].delete_one({"pnsid": "foo2"})
+    assert ids.find_mappings(ObjectID(NamespaceID("baz"), "bat")) == (set(), {
+        ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("foo"), "bar1"),
+        ObjectID(NamespaceID("foo2"), "bar")})
+    assert ids.find_mappings(ObjectID(NamespaceID("baz"), "bat"), [NamespaceID("foo2")]) == (
+        set(), {ObjectID(NamespaceID("foo2"), "bar")})
+    assert ids.find_mappings_bulk(NamespaceID("baz"), ["bat", "bag"], [NamespaceID("foo")]) == {
+        "bat": (set(), {ObjectID(NamespaceID("foo"), "bar"),
+                        ObjectID(NamespaceID("foo"), "bar1")}),
+        "bag": (set(), set())}
+    assert ids.find_mappings(ObjectID(NamespaceID("foo"), "bar")) == (
+        {ObjectID(NamespaceID("baz"), "bat")}, set())
+    # removing the mapping repairs the reverse mapping collection
+    assert ids.remove_mappings([
+        (ObjectID(NamespaceID("foo2"), "bar"), ObjectID(NamespaceID("baz"), "bat")),
+        (ObjectID(NamespaceID("foo"), "bar1"), ObjectID(NamespaceID("baz"), "bat")),
+    ]) == 1
+    assert ids.remove_mapping(
+        ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bat")) is True
+
+    assert mapping_docs(mongo, "map") == []
+    assert mapping_docs(mongo, "revmap") == []
+    assert ids.find_mappings(ObjectID(NamespaceID("baz"), "bat")) == (set(), set())
+
+
+def test_update_schema_sharded(idstorage, mongo, monkeypatch):
+    monkeypatch.setattr(IDMappingMongoStorage, "_shard_collections", lambda self: None)
+    idstorage.add_mapping(
+        ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bat"))
+
+    idmap = IDMappingMongoStorage(mongo.client[TEST_DB_NAME], sharded=True)
+    assert mongo.client[TEST_DB_NAME]["config"].find_one().get("revmap") is None
+    idmap.add_mapping(ObjectID(NamespaceID("foo"), "bar2"), ObjectID(NamespaceID("baz"), "bat"))
+    # the reverse mapping collection isn't complete, so reverse lookups use the mapping
+    # collection
+    assert mapping_docs(mongo, "revmap") == [("foo", "bar2", "baz", "bat")]
+    expected = (set(), {ObjectID(NamespaceID("foo"), "bar"),
+                        ObjectID(NamespaceID("foo"), "bar2")})
+    assert idmap.find_mappings(ObjectID(NamespaceID("baz"), "bat")) == expected
+
+    assert idmap.update_schema() is True
+
+    assert mongo.client[TEST_DB_NAME]["config"].find_one()["revmap"] is True
+    assert mongo.client[TEST_DB_NAME]["config"].find_one()["schemaver"] == 1
+    assert mapping_docs(mongo, "revmap") == mapping_docs(mongo, "map")
+    assert idmap.update_schema() is False
+
+    idmap = IDMappingMongoStorage(mongo.client[TEST_DB_NAME], sharded=True)
+    mongo.client[TEST_DB_NAME]["map"].delete_many({})
+    assert idmap.find_mappings(ObjectID(NamespaceID("baz"), "bat")) == expected
+
+
+def shard_storage(ismaster, collections):
+    db = MagicMock()
+    db.name = "idm"
+    db.client.admin.command.return_value = ismaster
+    db.client["config"]["collections"].find_one.side_effect = collections
+    # the other startup steps are tested against the test MongoDB instance
+    storage = IDMappingMongoStorage.__new__(IDMappingMongoStorage)
+    storage._db = db
+    return storage, db
+
+
+def test_shard_collections():
+    storage, db = shard_storage(
+        {"msg": "isdbgrid"},
+        [None, {"_id": "idm.revmap", "key": {"snsid": 1, "sid": 1}}])
+
+    storage._shard_collections()
+
+    assert db.client.admin.command.call_args_list == [
+        (("ismaster",), {}),
+        (("enableSharding", "idm"), {}),
+        (("shardCollection", "idm.map"), {"key": SON([("pnsid", 1), ("pid", 1)])}),
+    ]
+    assert db.client["config"]["collections"].find_one.call_args_list == [
+        (({"_id": "idm.map"},), {}), (({"_id": "idm.revmap"},), {})]
+
+    # dropped collections are sharded again
+    storage, db = shard_storage(
+        {"msg": "isdbgrid"},
+        [{"_id": "idm.map", "key": {"pnsid": 1, "pid": 1}},
+         {"_id": "idm.revmap", "key": {"snsid": 1}, "dropped": True}])
+
+    storage._shard_collections()
+
+    assert db.client.admin.command.call_args_list == [
+        (("ismaster",), {}),
+        (("enableSharding", "idm"), {}),
+        (("shardCollection", "idm.revmap"), {"key": SON([("snsid", 1), ("sid", 1)])}),
+    ]
+
+
+def test_shard_collections_fail():
+    storage, _ = shard_storage({"ismaster": True}, [])
+    fail_shard_collections(storage, "Sharding is enabled but the database is not a sharded "
+                           + "cluster")
+
+    storage, _ = shard_storage({"msg": "isdbgrid"}, [
+        {"_id": "idm.map", "key": {"pnsid": 1, "pid": 1}},
+        {"_id": "idm.revmap", "key": {"snsid": "hashed"}}])
+    fail_shard_collections(storage, "Collection idm.revmap is sharded on {'snsid': 'hashed'} "
+                           + "but the shard key must be {'snsid': 1, 'sid': 1}")
+
+
+def fail_shard_collections(storage, expected):
+    with raises(Exception) as got:
+        storage._shard_collections()
+    assert_exception_correct(got.value, StorageInitException(expected))
+
+
+def test_read_preferences(mongo):
+    mongo.clear_database(TEST_DB_NAME, drop_indexes=True)
+    idmap = IDMappingMongoStorage(mongo.client[TEST_DB_NAME])
+    assert idmap._mapping_db.read_preference == Primary()
+    assert idmap._namespace_db.read_preference == Primary()
+    assert idmap._causal is False
+
+    idmap = IDMappingMongoStorage(
+        mongo.client[TEST_DB_NAME],
+        mapping_read_preference=SecondaryPreferred(max_staleness=90),
+        namespace_read_preference=Nearest())
+    assert idmap._db.read_preference == Primary()
+    assert idmap._mapping_db.read_preference == SecondaryPreferred(max_staleness=90)
+    assert idmap._namespace_db.read_preference == Nearest()
+    assert idmap._causal is True
+
+    # the test MongoDB instance is a standalone server, so no consistency tokens are recorded
+    ctx = consistency.start_request("not a token")
+    try:
+        idmap.create_namespace(NamespaceID("foo"))
+        idmap.add_mapping(ObjectID(NamespaceID("foo"), "bar"),
+                          ObjectID(NamespaceID("baz"), "bat"))
+        assert ctx.write_token is None
+        consistency.start_request()
+        assert idmap.find_mappings(ObjectID(NamespaceID("foo"), "bar")) == (
+            {ObjectID(NamespaceID("baz"), "bat")}, set())
+        assert idmap.get_namespaces(include_users=False) == {
+            Namespace(NamespaceID("foo"), False)}
+    finally:
+        consistency.stop_request()
+
+
+def causal_storage():
+    db = MagicMock()
+    session = db.client.start_session.return_value.__enter__.return_value
+    # the other startup steps are tested against the test MongoDB instance
+    storage = IDMappingMongoStorage.__new__(IDMappingMongoStorage)
+    storage._db = db
+    storage._causal = True
+    return storage, db, session
+
+
+def test_write_session():
+    storage, db, session = causal_storage()
+    session.operation_time = Timestamp(1700000000, 3)
+    session.cluster_time = {"clusterTime": Timestamp(1700000000, 4), "signature": {"k": 1}}
+
+    ctx = consistency.start_request()
+    try:
+        with storage._write_session() as s:
+            assert s is session
+    finally:
+        consistency.stop_request()
+
+    assert db.client.start_session.call_args_list == [((), {"causal_consistency": True})]
+    # the cluster time is not included in the token
+    assert bson.decode(base64.urlsafe_b64decode(ctx.write_token)) == {
+        "op": Timestamp(1700000000, 3)}
+    assert IDMappingMongoStorage._from_consistency_token(ctx.write_token) == Timestamp(
+        1700000000, 3)
+
+
+def test_write_session_no_operation_time():
+    storage, db, session = causal_storage()
+    session.operation_time = None
+
+    ctx = consistency.start_request()
+    try:
+        with storage._write_session() as s:
+            assert s is session
+    finally:
+        consistency.stop_request()
+    assert ctx.write_token is None
+
+
+def test_write_session_not_causal():
+    storage, db, _ = causal_storage()
+    storage._causal = False
+
+    ctx = consistency.start_request()
+    try:
+        with storage._write_session() as s:
+            assert s is None
+    finally:
+        consistency.stop_request()
+    assert ctx.write_token is None
+    assert db.client.start_session.call_args_list == []
+
+
+def test_read_session():
+    storage, db, session = causal_storage()
+    session.operation_time = Timestamp(1700000000, 3)
+    token = IDMappingMongoStorage._to_consistency_token(session)
+    session.reset_mock()
+
+    consistency.start_request(token)
+    try:
+        with storage._read_session() as s:
+            assert s is session
+    finally:
+        consistency.stop_request()
+
+    assert db.client.start_session.call_args_list == [((), {"causal_consistency": True})]
+    assert session.advance_cluster_time.call_args_list == []
+    assert session.advance_operation_time.call_args_list == [
+        ((Timestamp(1700000000, 3),), {})]
+
+
+def test_read_session_ignores_cluster_time():
+    # the cluster time in tokens from earlier versions is not authenticated, so it's ignored
+    storage, db, session = causal_storage()
+    token = base64.urlsafe_b64encode(bson.encode({
+        "op": Timestamp(1700000000, 3),
+        "ct": {"clusterTime": Timestamp(2000000000, 4), "signature": {"k": 1}}})).decode()
+
+    consistency.start_request(token)
+    try:
+        with storage._read_session() as s:
+            assert s is session
+    finally:
+        consistency.stop_request()
+
+    assert session.advance_cluster_time.call_args_list == []
+    assert session.advance_operation_time.call_args_list == [
+        ((Timestamp(1700000000, 3),), {})]
+
+
+def test_read_session_fail_rejected_token():
+    storage, db, session = causal_storage()
+    session.operation_time = Timestamp(1700000000, 3)
+    token = IDMappingMongoStorage._to_consistency_token(session)
+
+    consistency.start_request(token)
+    try:
+        with raises(Exception) as got:
+            with storage._read_session():
+                raise OperationFailure("afterClusterTime is in the future", 72)
+        assert_exception_correct(got.value, IllegalParameterError(
+            "Consistency token rejected by the database"))
+
+        # other errors are not the token's fault
+        err = OperationFailure("oops", 2)
+        with raises(Exception) as got:
+            with storage._read_session():
+                raise err
+        assert got.value is err
+    finally:
+        consistency.stop_request()
+
+
+def test_read_session_no_session():
+    storage, db, _ = causal_storage()
+    # no request
+    with storage._read_session() as s:
+        assert s is None
+
+    # no token
+    consistency.start_request()
+    try:
+        with storage._read_session() as s:
+            assert s is None
+    finally:
+        consistency.stop_request()
+
+    # not causal
+    storage._causal = False
+    consistency.start_request("whee")
+    try:
+        with storage._read_session() as s:
+            assert s is None
+    finally:
+        consistency.stop_request()
+
+    assert db.client.start_session.call_args_list == []
+
+
+def test_read_session_fail_invalid_token():
+    storage, _, session = causal_storage()
+    session.operation_time = "not a timestamp"
+    bad_op = IDMappingMongoStorage._to_consistency_token(session)
+    session.operation_time = Timestamp(int(time.time()) + 120, 1)
+    future_op = IDMappingMongoStorage._to_consistency_token(session)
+    no_op = base64.urlsafe_b64encode(bson.encode({"ct": Timestamp(1, 1)})).decode()
+
+    for token in ["not base64!", "Zm9v", bad_op, future_op, no_op]:
+        consistency.start_request(token)
+        try:
+            with raises(Exception) as got:
+                with storage._read_session():
+                    pass
+            assert_exception_correct(
+                got.value, IllegalParameterError("Invalid consistency token"))
+        finally:
+            consistency.stop_request()
+
+
 def fail_startup(mongo, expected_msg):
     with raises(Exception) as got:
         IDMappingMongoStorage(mongo.client[TEST_DB_NAME])
@@ -378,6 +889,48 @@ def test_get_users(idstorage):
     }
 
 
+def test_get_users_by_token(idstorage):
+    assert idstorage.get_users_by_token() == {}
+
+    idstorage.create_local_user(Username("foo"), HashedToken("t1"))
+    idstorage.create_local_user(Username("bar"), HashedToken("t2"))
+    idstorage.update_local_user_token(Username("bar"), HashedToken("t3"))
+    idstorage.set_local_user_as_admin(Username("foo"), True)
+
+    assert idstorage.get_users_by_token() == {
+        HashedToken("t1"): (Username("foo"), True),
+        HashedToken("t3"): (Username("bar"), False),
+    }
+
+
+def test_users_version(idstorage):
+    assert idstorage.get_users_version() == 0
+
+    idstorage.create_local_user(Username("foo"), HashedToken("t1"))
+    assert idstorage.get_users_version() == 1
+
+    # failed changes don't increment the version
+    with raises(UserExistsError):
+        idstorage.create_local_user(Username("foo"), HashedToken("t2"))
+    assert idstorage.get_users_version() == 1
+
+    idstorage.update_local_user_token(Username("foo"), HashedToken("t2"))
+    assert idstorage.get_users_version() == 2
+    with raises(NoSuchUserError):
+        idstorage.update_local_user_token(Username("bar"), HashedToken("t3"))
+    assert idstorage.get_users_version() == 2
+
+    idstorage.set_local_user_as_admin(Username("foo"), True)
+    assert idstorage.get_users_version() == 3
+    idstorage.set_local_user_as_admin(Username("foo"), True)  # no change
+    assert idstorage.get_users_version() == 3
+
+    # namespace changes don't affect the user version and vice versa
+    idstorage.create_namespace(NamespaceID("foo"))
+    assert idstorage.get_users_version() == 3
+    assert idstorage.get_namespace_version() == 1
+
+
 def test_user_exists(idstorage):
     idstorage.create_local_user(Username("foo"), HashedToken("t1"))
 
@@ -517,6 +1070,44 @@ def test_add_user_to_namespace_fail_duplicate(idstorage):
     )
 
 
+def test_add_users_to_namespace(idstorage):
+    nsid = NamespaceID("foo")
+    idstorage.create_namespace(nsid)
+    idstorage.add_user_to_namespace(nsid, User(AuthsourceID("asone"), Username("u1")))
+    ver = idstorage.get_namespace_version()
+
+    users = {
+        User(AuthsourceID("asone"), Username("u1")),
+        User(AuthsourceID("asone"), Username("u2")),
+        User(AuthsourceID("astwo"), Username("u1")),
+    }
+    idstorage.add_users_to_namespace(nsid, users)
+    assert idstorage.get_namespace(nsid) == Namespace(NamespaceID("foo"), False, users)
+    assert idstorage.get_namespace_version() == ver + 1
+
+    # no changes, so no version increment
+    idstorage.add_users_to_namespace(nsid, set(list(users)[:2]))
+    idstorage.add_users_to_namespace(nsid, set())
+    assert idstorage.get_namespace(nsid) == Namespace(NamespaceID("foo"), False, users)
+    assert idstorage.get_namespace_version() == ver + 1
+
+
+def test_add_users_to_namespace_fail(idstorage):
+    idstorage.create_namespace(NamespaceID("foo"))
+    u = User(AuthsourceID("as"), Username("u"))
+    n = NamespaceID("foo")
+    for nsid, users, expected in [
+        (None, {u}, TypeError("namespace_id cannot be None")),
+        (n, None, TypeError("admin_users cannot be None")),
+        (n, {u, None}, TypeError("None item in admin_users")),
+        (NamespaceID("bar"), {u}, NoSuchNamespaceError("bar")),
+    ]:
+        with raises(Exception) as got:
+            idstorage.add_users_to_namespace(nsid, users)
+        assert_exception_correct(got.value, expected)
+    assert idstorage.get_namespace(n) == Namespace(n, False)
+
+
 def test_remove_user_from_namespace_fail_no_such_user(idstorage):
     idstorage.create_namespace(NamespaceID("foo"))
     idstorage.add_user_to_namespace(
@@ -588,6 +1179,36 @@ def fail_set_namespace_publicly_mappable(idstorage, namespace_id, expected):
     assert_exception_correct(got.value, expected)
 
 
+def test_namespace_version(idstorage):
+    assert idstorage.get_namespace_version() == 0
+
+    idstorage.create_namespace(NamespaceID("foo"))
+    assert idstorage.get_namespace_version() == 1
+
+    # failed changes don't increment the version
+    with raises(NamespaceExistsError):
+        idstorage.create_namespace(NamespaceID("foo"))
+    assert idstorage.get_namespace_version() == 1
+
+    u = User(AuthsourceID("as"), Username("u"))
+    idstorage.add_user_to_namespace(NamespaceID("foo"), u)
+    assert idstorage.get_namespace_version() == 2
+    with raises(UserExistsError):
+        idstorage.add_user_to_namespace(NamespaceID("foo"), u)
+    assert idstorage.get_namespace_version() == 2
+
+    idstorage.set_namespace_publicly_mappable(NamespaceID("foo"), True)
+    assert idstorage.get_namespace_version() == 3
+    idstorage.set_namespace_publicly_mappable(NamespaceID("foo"), True)  # no change
+    assert idstorage.get_namespace_version() == 3
+
+    idstorage.remove_user_from_namespace(NamespaceID("foo"), u)
+    assert idstorage.get_namespace_version() == 4
+    with raises(NoSuchUserError):
+        idstorage.remove_user_from_namespace(NamespaceID("foo"), u)
+    assert idstorage.get_namespace_version() == 4
+
+
 def set_up_data_for_get_namespaces(idstorage):
     idstorage.create_namespace(NamespaceID("ns1"))
     idstorage.set_namespace_publicly_mappable(NamespaceID("ns1"), True)
@@ -634,6 +1255,22 @@ def test_get_namespaces(idstorage):
     assert idstorage.get_namespaces(nids=None) == expected
 
 
+def test_get_namespaces_without_users(idstorage):
+    assert idstorage.get_namespaces(include_users=False) == set()
+
+    set_up_data_for_get_namespaces(idstorage)
+
+    expected = {
+        Namespace(NamespaceID("ns1"), True),
+        Namespace(NamespaceID("ns2"), False),
+        Namespace(NamespaceID("ns3"), False),
+    }
+    assert idstorage.get_namespaces(include_users=False) == expected
+    assert idstorage.get_namespaces(
+        [NamespaceID("ns1"), NamespaceID("ns3")], include_users=False) == {
+            Namespace(NamespaceID("ns1"), True), Namespace(NamespaceID("ns3"), False)}
+
+
 def test_get_namespaces_with_nids(idstorage):
     assert idstorage.get_namespaces() == set()
 
@@ -649,6 +1286,17 @@ def test_get_namespaces_with_nids(idstorage):
     assert idstorage.get_namespaces(nids=nids) == set([expected[1], expected[2]])
 
 
+def test_get_namespaces_with_duplicate_nids(idstorage):
+    expected = set_up_data_for_get_namespaces(idstorage)
+
+    assert idstorage.get_namespaces([NamespaceID("ns1"), NamespaceID("ns1")]) == {expected[0]}
+    assert idstorage.get_namespaces(
+        [NamespaceID("ns2"), NamespaceID("ns3"), NamespaceID("ns2")], include_users=False) == {
+            Namespace(NamespaceID("ns2"), False), Namespace(NamespaceID("ns3"), False)}
+    fail_get_namespaces(idstorage, [NamespaceID("ns1"), NamespaceID("zoo"), NamespaceID("ns1")],
+                        NoSuchNamespaceError("['zoo']"))
+
+
 def test_get_namespaces_fail_None_input(idstorage):
     fail_get_namespaces(
         idstorage, {NamespaceID("foo"), None}, TypeError("None item in nids")
@@ -766,6 +1414,51 @@ def test_remove_mapping(idstorage):
     )
 
 
+def test_add_and_remove_mappings_bulk(idstorage):
+    idstorage.add_mapping(
+        ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bat")
+    )
+
+    assert idstorage.add_mappings([]) == (0, 0)
+    assert idstorage.add_mappings(
+        [
+            (ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bat")),
+            (ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bag")),
+            (ObjectID(NamespaceID("foo"), "arg"), ObjectID(NamespaceID("baz"), "bat")),
+            # duplicate in the same batch
+            (ObjectID(NamespaceID("foo"), "arg"), ObjectID(NamespaceID("baz"), "bat")),
+        ]
+    ) == (2, 2)
+
+    assert idstorage.find_mappings(ObjectID(NamespaceID("foo"), "bar")) == (
+        set([ObjectID(NamespaceID("baz"), "bat"), ObjectID(NamespaceID("baz"), "bag")]),
+        set(),
+    )
+    assert idstorage.find_mappings(ObjectID(NamespaceID("baz"), "bat")) == (
+        set(),
+        set([ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("foo"), "arg")]),
+    )
+
+    assert idstorage.remove_mappings([]) == 0
+    assert (
+        idstorage.remove_mappings(
+            [
+                (ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bat")),
+                (ObjectID(NamespaceID("foo"), "arg"), ObjectID(NamespaceID("baz"), "bat")),
+                # doesn't exist
+                (ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("bat"), "bat")),
+            ]
+        )
+        == 2
+    )
+
+    assert idstorage.find_mappings(ObjectID(NamespaceID("foo"), "bar")) == (
+        set([ObjectID(NamespaceID("baz"), "bag")]),
+        set(),
+    )
+    assert idstorage.find_mappings(ObjectID(NamespaceID("baz"), "bat")) == (set(), set())
+
+
 def test_find_no_mappings(idstorage):
     idstorage.add_mapping(
         ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bat")
@@ -829,6 +1522,56 @@ def test_filter_mappings(idstorage):
     )
 
 
+def test_find_mappings_bulk(idstorage):
+    idstorage.add_mappings(
+        [
+            (ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bat")),
+            (ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("bar"), "bag")),
+            (ObjectID(NamespaceID("foo"), "arg"), ObjectID(NamespaceID("baz"), "bat")),
+            (ObjectID(NamespaceID("bag"), "arg"), ObjectID(NamespaceID("foo"), "bar")),
+            (ObjectID(NamespaceID("bla"), "urg"), ObjectID(NamespaceID("foo"), "arg")),
+            (ObjectID(NamespaceID("bla"), "urg"), ObjectID(NamespaceID("fob"), "bar")),
+        ]
+    )
+
+    assert idstorage.find_mappings_bulk(NamespaceID("foo"), []) == {}
+    assert idstorage.find_mappings_bulk(NamespaceID("foo"), ["bar", "arg", "none"]) == {
+        "bar": (
+            set([ObjectID(NamespaceID("baz"), "bat"), ObjectID(NamespaceID("bar"), "bag")]),
+            set([ObjectID(NamespaceID("bag"), "arg")]),
+        ),
+        "arg": (
+            set([ObjectID(NamespaceID("baz"), "bat")]),
+            set([ObjectID(NamespaceID("bla"), "urg")]),
+        ),
+        "none": (set(), set()),
+    }
+
+    assert idstorage.find_mappings_bulk(
+        NamespaceID("foo"), ["bar", "arg"], ns_filter=[NamespaceID("baz"), NamespaceID("bla")]
+    ) == {
+        "bar": (set([ObjectID(NamespaceID("baz"), "bat")]), set()),
+        "arg": (
+            set([ObjectID(NamespaceID("baz"), "bat")]),
+            set([ObjectID(NamespaceID("bla"), "urg")]),
+        ),
+    }
+
+
+def test_find_mappings_bulk_fail_input_None(idstorage):
+    n = NamespaceID("foo")
+    fail_find_mappings_bulk(idstorage, None, ["i"], None, TypeError("namespace_id cannot be None"))
+    fail_find_mappings_bulk(idstorage, n, None, None, TypeError("ids cannot be None"))
+    fail_find_mappings_bulk(idstorage, n, ["i", None], None, TypeError("None item in ids"))
+    fail_find_mappings_bulk(idstorage, n, ["i"], [n, None], TypeError("None item in ns_filter"))
+
+
+def fail_find_mappings_bulk(idstorage, namespace_id, ids, ns_filter, expected):
+    with raises(Exception) as got:
+        idstorage.find_mappings_bulk(namespace_id, ids, ns_filter)
+    assert_exception_correct(got.value, expected)
+
+
 def test_add_mapping_fail_input_None(idstorage):
     oid = ObjectID(NamespaceID("foo"), "bar")
     fail_add_mapping(idstorage, None, oid, TypeError("primary_OID cannot be None"))
@@ -853,6 +1596,35 @@ def fail_remove_mapping(idstorage, pOID, sOID, expected):
     assert_exception_correct(got.value, expected)
 
 
+def test_add_mappings_fail_input_None(idstorage):
+    fail_add_mappings(idstorage, None, TypeError("mappings cannot be None"))
+    check_mappings_fail_input_None(idstorage, fail_add_mappings)
+
+
+def fail_add_mappings(idstorage, mappings, expected):
+    with raises(Exception) as got:
+        idstorage.add_mappings(mappings)
+    assert_exception_correct(got.value, expected)
+
+
+def test_remove_mappings_fail_input_None(idstorage):
+    fail_remove_mappings(idstorage, None, TypeError("mappings cannot be None"))
+    check_mappings_fail_input_None(idstorage, fail_remove_mappings)
+
+
+def fail_remove_mappings(idstorage, mappings, expected):
+    with raises(Exception) as got:
+        idstorage.remove_mappings(mappings)
+    assert_exception_correct(got.value, expected)
+
+
+def check_mappings_fail_input_None(idstorage, fail_func):
+    oid = ObjectID(NamespaceID("foo"), "bar")
+    fail_func(idstorage, [(oid, oid), None], TypeError("mapping cannot be None"))
+    fail_func(idstorage, [(oid, oid), (None, oid)], TypeError("primary_OID cannot be None"))
+    fail_func(idstorage, [(oid, oid), (oid, None)], TypeError("secondary_OID cannot be None"))
+
+
 def test_find_mappings_fail_input_None(idstorage):
     oid = ObjectID(NamespaceID("foo"), "bar")
     f = set([NamespaceID("foo")])
@@ -869,3 +1641,510 @@ def fail_find_mappings(idstorage, oid, ns_filter, expected):
     with raises(Exception) as got:
         idstorage.find_mappings(oid, ns_filter)
     assert_exception_correct(got.value, expected)
+
+
+def test_find_mappings_covered(idstorage_covered, mongo):
+    idstorage_covered.add_mapping(
+        ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bat")
+    )
+    assert idstorage_covered.find_mappings(ObjectID(NamespaceID("foo"), "bar")) == (
+        {ObjectID(NamespaceID("baz"), "bat")},
+        set(),
+    )
+    col = mongo.client[TEST_DB_NAME]["map"]
+    # the queries and projections used by find_mappings
+    for query, proj in [
+        ({"pnsid": "foo", "pid": "bar"}, {"_id": 0, "snsid": 1, "sid": 1}),
+        ({"snsid": "baz", "sid": "bat"}, {"_id": 0, "pnsid": 1, "pid": 1}),
+        ({"pnsid": "foo", "pid": "bar", "snsid": {"$in": ["baz"]}},
+         {"_id": 0, "snsid": 1, "sid": 1}),
+        ({"snsid": "baz", "sid": "bat", "pnsid": {"$in": ["foo"]}},
+         {"_id": 0, "pnsid": 1, "pid": 1}),
+    ]:
+        stats = col.find(query, proj).explain()["executionStats"]
+        assert stats["nReturned"] == 1
+        assert stats["totalDocsExamined"] == 0
+
+
+def test_filter_mappings_covered(idstorage_covered):
+    idstorage_covered.add_mappings([
+        (ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("baz"), "bat")),
+        (ObjectID(NamespaceID("foo"), "bar"), ObjectID(NamespaceID("bar"), "bag")),
+        (ObjectID(NamespaceID("bag"), "arg"), ObjectID(NamespaceID("foo"), "bar")),
+        (ObjectID(NamespaceID("bla"), "urg"), ObjectID(NamespaceID("foo"), "bar")),
+    ])
+
+    ns_filter = set([NamespaceID("baz"), NamespaceID("bag")])
+    assert idstorage_covered.find_mappings(
+        ObjectID(NamespaceID("foo"), "bar"), ns_filter=ns_filter) == (
+        set([ObjectID(NamespaceID("baz"), "bat")]),
+        set([ObjectID(NamespaceID("bag"), "arg")]),
+    )
+    assert idstorage_covered.find_mappings_bulk(
+        NamespaceID("foo"), ["bar", "arg"], ns_filter=ns_filter) == {
+        "bar": (
+            set([ObjectID(NamespaceID("baz"), "bat")]),
+            set([ObjectID(NamespaceID("bag"), "arg")]),
+        ),
+        "arg": (set(), set()),
+    }
+
+
+class FindCommandRecorder(CommandListener):
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        if event.command_name == "find":
+            self.commands.append(event.command)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def test_filtered_lookups_read_only_matching_mappings(mongo):
+    mongo.clear_database(TEST_DB_NAME, drop_indexes=True)
+    recorder = FindCommandRecorder()
+    client = MongoClient("localhost", mongo.port, event_listeners=[recorder])
+    try:
+        storage = IDMappingMongoStorage(client[TEST_DB_NAME], covered_index=True)
+        # an ID mapped from many namespaces
+        hub = ObjectID(NamespaceID("hub"), "id")
+        storage.add_mappings(
+            [(ObjectID(NamespaceID("ns{}".format(i)), "id"), hub) for i in range(50)]
+            + [(hub, ObjectID(NamespaceID("ns{}".format(i)), "id")) for i in range(50)]
+        )
+        recorder.commands.clear()
+
+        assert storage.find_mappings(hub, ns_filter=[NamespaceID("ns7")]) == (
+            {ObjectID(NamespaceID("ns7"), "id")}, {ObjectID(NamespaceID("ns7"), "id")})
+
+        forwards, backwards = recorder.commands
+        assert forwards["hint"] == {"pnsid": 1, "pid": 1, "snsid": 1, "sid": 1}
+        assert backwards["hint"] == {"snsid": 1, "sid": 1, "pnsid": 1, "pid": 1}
+        col = client[TEST_DB_NAME]["map"]
+        for cmd in [forwards, backwards]:
+            stats = col.find(cmd["filter"], cmd["projection"]).hint(
+                list(cmd["hint"].items())).explain()["executionStats"]
+            assert stats["nReturned"] == 1
+            # the key after the match may be examined to find the end of the range
+            assert stats["totalKeysExamined"] <= 2
+            assert stats["totalDocsExamined"] == 0
+    finally:
+        client.close()
+
+
+def test_filtered_lookups_v1_schema(mongo):
+    # the v1 reverse index doesn't include the primary namespace and may be dropped by a schema
+    # update, so it isn't hinted.
+    mongo.clear_database(TEST_DB_NAME, drop_indexes=True)
+    recorder = FindCommandRecorder()
+    client = MongoClient("localhost", mongo.port, event_listeners=[recorder])
+    try:
+        storage = IDMappingMongoStorage(client[TEST_DB_NAME])
+        recorder.commands.clear()
+        storage.find_mappings(ObjectID(NamespaceID("hub"), "id"), [NamespaceID("ns7")])
+        storage.find_mappings(ObjectID(NamespaceID("hub"), "id"))
+
+        hints = [c.get("hint") for c in recorder.commands]
+        assert hints == [{"pnsid": 1, "pid": 1, "snsid": 1, "sid": 1}, None, None, None]
+    finally:
+        client.close()
+
+
+def set_up_data_for_range(storage):
+    storage.add_mappings([
+        (oid("gcf", "GCF_0014"), oid("rs", "r")),
+        (oid("gcf", "GCF_00150"), oid("rs", "r0")),
+        (oid("gcf", "GCF_00151"), oid("rs", "r1")),
+        (oid("gcf", "GCF_00151"), oid("rs", "r1b")),
+        (oid("gcf", "GCF_00152.1"), oid("rs", "r2")),
+        (oid("gcf", "GCF_0016"), oid("rs", "r6")),
+        (oid("ks", "k1"), oid("gcf", "GCF_00151")),
+        (oid("ks", "k2"), oid("gcf", "GCF_00153")),
+        # IDs in the range but in other namespaces
+        (oid("rs", "GCF_00150"), oid("gcf", "GCF_0014")),
+        (oid("gcf2", "GCF_00150"), oid("rs", "r0")),
+    ])
+
+
+def test_find_mappings_range(idstorage):
+    check_find_mappings_range(idstorage)
+
+
+def test_find_mappings_range_covered(idstorage_covered):
+    check_find_mappings_range(idstorage_covered)
+
+
+def test_find_mappings_range_sharded(idstorage_sharded):
+    check_find_mappings_range(idstorage_sharded)
+
+
+def check_find_mappings_range(storage):
+    gcf = NamespaceID("gcf")
+    assert storage.find_mappings_range(gcf, "GCF_0015", "GCF_0016") == ({}, False)
+
+    set_up_data_for_range(storage)
+
+    r150 = (gcf, "GCF_00150")
+    expected = {
+        "GCF_00150": ({oid("rs", "r0")}, set()),
+        "GCF_00151": ({oid("rs", "r1"), oid("rs", "r1b")}, {oid("ks", "k1")}),
+        "GCF_00152.1": ({oid("rs", "r2")}, set()),
+        "GCF_00153": (set(), {oid("ks", "k2")}),
+    }
+
+    res, more = storage.find_mappings_range(gcf, "GCF_0015", "GCF_0016")
+    assert (res, more) == (expected, False)
+    assert list(res) == ["GCF_00150", "GCF_00151", "GCF_00152.1", "GCF_00153"]
+
+    # keyset continuation
+    assert storage.find_mappings_range(gcf, "GCF_0015", "GCF_0016", limit=2) == (
+        {k: expected[k] for k in ["GCF_00150", "GCF_00151"]}, True)
+    assert storage.find_mappings_range(
+        gcf, "GCF_0015", "GCF_0016", limit=2, after="GCF_00151") == (
+        {k: expected[k] for k in ["GCF_00152.1", "GCF_00153"]}, False)
+    # all the forward IDs are returned, but there are more reverse IDs
+    assert storage.find_mappings_range(gcf, "GCF_0015", "GCF_0016", limit=3) == (
+        {k: expected[k] for k in ["GCF_00150", "GCF_00151", "GCF_00152.1"]}, True)
+    assert storage.find_mappings_range(*r150, limit=1) == (
+        {"GCF_00150": expected["GCF_00150"]}, True)
+    # after before the start of the range
+    assert storage.find_mappings_range(
+        gcf, "GCF_0015", "GCF_0016", limit=1, after="GCF_0014") == (
+        {"GCF_00150": expected["GCF_00150"]}, True)
+
+    # unbounded range
+    assert storage.find_mappings_range(gcf, "GCF_00152") == (
+        {
+            "GCF_00152.1": expected["GCF_00152.1"],
+            "GCF_00153": expected["GCF_00153"],
+            "GCF_0016": ({oid("rs", "r6")}, set()),
+        },
+        False,
+    )
+
+    # namespace filter
+    assert storage.find_mappings_range(
+        gcf, "GCF_0015", "GCF_0016", ns_filter=[NamespaceID("ks")]) == (
+        {"GCF_00151": (set(), {oid("ks", "k1")}), "GCF_00153": expected["GCF_00153"]}, False)
+    assert storage.find_mappings_range(
+        gcf, "GCF_0015", "GCF_0016", ns_filter=[NamespaceID("ks")], limit=1) == (
+        {"GCF_00151": (set(), {oid("ks", "k1")})}, True)
+
+    assert storage.find_mappings_range(gcf, "GCF_0016", "GCF_0016") == ({}, False)
+    assert storage.find_mappings_range(NamespaceID("nope"), "GCF_0015") == ({}, False)
+
+
+def test_find_mappings_range_fail_bad_input(idstorage):
+    n = NamespaceID("n")
+    fail_find_mappings_range(idstorage, None, "a", None, 1, TypeError(
+        "namespace_id cannot be None"))
+    fail_find_mappings_range(idstorage, n, None, None, 1, TypeError("start cannot be None"))
+    fail_find_mappings_range(idstorage, n, "a", [n, None], 1, TypeError(
+        "None item in ns_filter"))
+    for limit in [0, -1]:
+        fail_find_mappings_range(idstorage, n, "a", None, limit, ValueError(
+            "limit must be at least 1"))
+
+
+def fail_find_mappings_range(storage, namespace_id, start, ns_filter, limit, expected):
+    with raises(Exception) as got:
+        storage.find_mappings_range(namespace_id, start, ns_filter=ns_filter, limit=limit)
+    assert_exception_correct(got.value, expected)
+
+
+def get_plan_stages(plan):
+    # returns all the stages in an explain plan, wherever they are nested
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan)
+        for v in plan.values():
+            stages.extend(get_plan_stages(v))
+    elif isinstance(plan, list):
+        for v in plan:
+            stages.extend(get_plan_stages(v))
+    return stages
+
+
+def test_find_mappings_range_uses_index_range_scans(mongo):
+    mongo.clear_database(TEST_DB_NAME, drop_indexes=True)
+    recorder = FindCommandRecorder()
+    client = MongoClient("localhost", mongo.port, event_listeners=[recorder])
+    try:
+        storage = IDMappingMongoStorage(client[TEST_DB_NAME], covered_index=True)
+        set_up_data_for_range(storage)
+        # lots of IDs outside the range on both sides
+        storage.add_mappings(
+            [(oid("gcf", "GCF_0001{:03}".format(i)), oid("rs", "x")) for i in range(100)]
+            + [(oid("rs", "x"), oid("gcf", "GCF_0001{:03}".format(i))) for i in range(100)]
+            + [(oid("gcf", "GCF_9{:04}".format(i)), oid("rs", "x")) for i in range(100)]
+            + [(oid("rs", "x"), oid("gcf", "GCF_9{:04}".format(i))) for i in range(100)]
+        )
+        recorder.commands.clear()
+
+        res, _ = storage.find_mappings_range(NamespaceID("gcf"), "GCF_0015", "GCF_0016")
+        assert len(res) == 4
+
+        forwards, backwards = recorder.commands
+        assert forwards["hint"] == {"pnsid": 1, "pid": 1, "snsid": 1, "sid": 1}
+        assert backwards["hint"] == {"snsid": 1, "sid": 1, "pnsid": 1, "pid": 1}
+        col = client[TEST_DB_NAME]["map"]
+        for cmd, idfield, expected_docs in [(forwards, "pid", 4), (backwards, "sid", 2)]:
+            explain = col.find(cmd["filter"], cmd["projection"]).sort(
+                list(cmd["sort"].items())).hint(list(cmd["hint"].items())).explain()
+            stages = get_plan_stages(explain["queryPlanner"]["winningPlan"])
+            assert "COLLSCAN" not in {s["stage"] for s in stages}
+            assert "SORT" not in {s["stage"] for s in stages}
+            ixscans = [s for s in stages if s["stage"] == "IXSCAN"]
+            assert len(ixscans) == 1
+            # the range is anchored at both ends
+            assert ixscans[0]["indexBounds"][idfield] == ['["GCF_0015", "GCF_0016")']
+            stats = explain["executionStats"]
+            assert stats["nReturned"] == expected_docs
+            # the key after the range may be examined to find the end of the range
+            assert stats["totalKeysExamined"] <= expected_docs + 1
+            assert stats["totalDocsExamined"] == 0
+    finally:
+        client.close()
+
+
+def test_iter_mappings(idstorage):
+    def oid(ns, id_):
+        return ObjectID(NamespaceID(ns), id_)
+
+    idstorage.add_mappings([
+        (oid("foo", "b"), oid("bar", "x")),
+        (oid("foo", "a"), oid("bar", "z")),
+        (oid("foo", "b"), oid("bar", "w")),
+        (oid("foo", "a"), oid("bar", "y")),
+        (oid("foo", "c"), oid("bar", "x")),
+        (oid("foo", "a"), oid("baz", "y")),  # other secondary namespace
+        (oid("bar", "a"), oid("foo", "y")),  # wrong direction
+    ])
+
+    assert list(idstorage.iter_mappings(NamespaceID("foo"), NamespaceID("bar"))) == [
+        ("a", "y"), ("a", "z"), ("b", "w"), ("b", "x"), ("c", "x")]
+    assert list(idstorage.iter_mappings(NamespaceID("bar"), NamespaceID("foo"))) == [
+        ("a", "y")]
+    assert list(idstorage.iter_mappings(NamespaceID("foo"), NamespaceID("bat"))) == []
+
+    it = idstorage.iter_mappings(NamespaceID("foo"), NamespaceID("bar"), after=("a", "y"))
+    assert list(it) == [("a", "z"), ("b", "w"), ("b", "x"), ("c", "x")]
+    it = idstorage.iter_mappings(NamespaceID("foo"), NamespaceID("bar"), after=("a", "z"))
+    assert list(it) == [("b", "w"), ("b", "x"), ("c", "x")]
+    # after doesn't need to be an existing mapping
+    it = idstorage.iter_mappings(NamespaceID("foo"), NamespaceID("bar"), after=("aa", "a"))
+    assert list(it) == [("b", "w"), ("b", "x"), ("c", "x")]
+    it = idstorage.iter_mappings(NamespaceID("foo"), NamespaceID("bar"), after=("c", "x"))
+    assert list(it) == []
+
+
+def test_iter_mappings_reads_only_namespace_pair(mongo):
+    mongo.clear_database(TEST_DB_NAME, drop_indexes=True)
+    recorder = FindCommandRecorder()
+    client = MongoClient("localhost", mongo.port, event_listeners=[recorder])
+    try:
+        storage = IDMappingMongoStorage(client[TEST_DB_NAME])
+        storage.add_mappings(
+            [(oid("foo", "id{:03}".format(i)), oid("bar", "x")) for i in range(5)]
+            # lots of mappings from the primary namespace to other namespaces
+            + [(oid("foo", "id{:03}".format(i)), oid("baz", "x")) for i in range(100)]
+            + [(oid("foo", "id{:03}".format(i)), oid("bat", "x")) for i in range(100)]
+        )
+        recorder.commands.clear()
+
+        assert len(list(storage.iter_mappings(NamespaceID("foo"), NamespaceID("bar")))) == 5
+
+        cmd, = recorder.commands
+        assert cmd["hint"] == {"pnsid": 1, "snsid": 1, "pid": 1, "sid": 1}
+        explain = client[TEST_DB_NAME]["map"].find(cmd["filter"], cmd["projection"]).sort(
+            list(cmd["sort"].items())).hint(list(cmd["hint"].items())).explain()
+        stages = get_plan_stages(explain["queryPlanner"]["winningPlan"])
+        assert "SORT" not in {s["stage"] for s in stages}
+        stats = explain["executionStats"]
+        assert stats["nReturned"] == 5
+        assert stats["totalKeysExamined"] <= 6
+        assert stats["totalDocsExamined"] == 0
+    finally:
+        client.close()
+
+
+def test_iter_mappings_fail_None_input(idstorage):
+    ns = NamespaceID("foo")
+    fail_iter_mappings(idstorage, None, ns, None, TypeError("primary_namespace_id cannot be None"))
+    fail_iter_mappings(
+        idstorage, ns, None, None, TypeError("secondary_namespace_id cannot be None"))
+    fail_iter_mappings(idstorage, ns, ns, ("a", None), TypeError("None item in after"))
+
+
+def fail_iter_mappings(idstorage, pns, sns, after, expected):
+    with raises(Exception) as got:
+        idstorage.iter_mappings(pns, sns, after)
+    assert_exception_correct(got.value, expected)
+
+
+def oid(ns, id_):
+    return ObjectID(NamespaceID(ns), id_)
+
+
+def test_mapping_counts(idstorage):
+    assert idstorage.get_mapping_counts(NamespaceID("foo")) == ({}, {})
+
+    idstorage.add_mapping(oid("foo", "a"), oid("bar", "a"))
+    idstorage.add_mapping(oid("foo", "a"), oid("bar", "a"))  # duplicate
+    idstorage.add_mapping(oid("baz", "a"), oid("foo", "b"))
+    assert idstorage.add_mappings([
+        (oid("foo", "b"), oid("bar", "b")),
+        (oid("foo", "a"), oid("bar", "a")),  # duplicate
+        (oid("foo", "c"), oid("baz", "c")),
+        (oid("foo", "c"), oid("baz", "c")),  # duplicate in the same batch
+        (oid("baz", "b"), oid("foo", "b")),
+    ]) == (3, 2)
+
+    assert idstorage.get_mapping_counts(NamespaceID("foo")) == (
+        {NamespaceID("bar"): 2, NamespaceID("baz"): 1}, {NamespaceID("baz"): 2})
+    assert idstorage.get_mapping_counts(NamespaceID("bar")) == ({}, {NamespaceID("foo"): 2})
+    assert idstorage.get_mapping_counts(NamespaceID("baz")) == (
+        {NamespaceID("foo"): 2}, {NamespaceID("foo"): 1})
+    assert idstorage.get_mapping_counts(NamespaceID("bat")) == ({}, {})
+
+    assert idstorage.remove_mapping(oid("foo", "a"), oid("bar", "a")) is True
+    assert idstorage.remove_mapping(oid("foo", "a"), oid("bar", "a")) is False
+    assert idstorage.remove_mappings([
+        (oid("foo", "c"), oid("baz", "c")),
+        (oid("baz", "a"), oid("foo", "b")),
+        (oid("foo", "b"), oid("bar", "x")),  # doesn't exist
+    ]) == 2
+
+    # namespace pairs with no mappings are omitted
+    assert idstorage.get_mapping_counts(NamespaceID("foo")) == (
+        {NamespaceID("bar"): 1}, {NamespaceID("baz"): 1})
+    assert idstorage.get_mapping_counts(NamespaceID("baz")) == ({NamespaceID("foo"): 1}, {})
+
+
+def test_mapping_counts_sharded(idstorage_sharded):
+    idstorage_sharded.add_mapping(oid("foo", "a"), oid("bar", "a"))
+    assert idstorage_sharded.add_mappings([
+        (oid("foo", "a"), oid("bar", "a")), (oid("foo", "b"), oid("bar", "b"))]) == (1, 1)
+    assert idstorage_sharded.remove_mappings([(oid("foo", "a"), oid("bar", "a"))]) == 1
+
+    assert idstorage_sharded.get_mapping_counts(NamespaceID("foo")) == (
+        {NamespaceID("bar"): 1}, {})
+    assert idstorage_sharded.get_mapping_counts(NamespaceID("bar")) == (
+        {}, {NamespaceID("foo"): 1})
+
+
+def test_get_mapping_counts_fail_None_input(idstorage):
+    with raises(Exception) as got:
+        idstorage.get_mapping_counts(None)
+    assert_exception_correct(got.value, TypeError("namespace_id cannot be None"))
+
+
+def test_rebuild_mapping_counts(idstorage, mongo, monkeypatch):
+    monkeypatch.setattr(id_mapping_mongo_storage, "_COUNT_REBUILD_DRAIN_SEC", 0)
+    assert idstorage.rebuild_mapping_counts() == 0
+    assert idstorage.get_mapping_counts(NamespaceID("foo")) == ({}, {})
+
+    idstorage.add_mappings([
+        (oid("foo", "a"), oid("bar", "a")),
+        (oid("foo", "b"), oid("bar", "b")),
+        (oid("foo", "c"), oid("baz", "c")),
+        (oid("baz", "a"), oid("foo", "a")),
+        (oid("bat", "a"), oid("bat", "b")),
+    ])
+    col = mongo.client[TEST_DB_NAME]["mapcount"]
+    # simulate drift, mappings from before the counts were maintained, and a stale count
+    col.update_one({"pnsid": "foo", "snsid": "bar"}, {"$inc": {"count": 5}})
+    col.delete_one({"pnsid": "baz", "snsid": "foo"})
+    col.update_one({"pnsid": "foo", "snsid": "baz"}, {"$set": {"count": -1}})
+    col.insert_one({"pnsid": "whee", "snsid": "whoo", "count": 2})
+
+    for workers in [1, 3]:
+        assert idstorage.rebuild_mapping_counts(workers) == 4
+
+        assert idstorage.get_mapping_counts(NamespaceID("foo")) == (
+            {NamespaceID("bar"): 2, NamespaceID("baz"): 1}, {NamespaceID("baz"): 1})
+        assert idstorage.get_mapping_counts(NamespaceID("bat")) == (
+            {NamespaceID("bat"): 1}, {NamespaceID("bat"): 1})
+        assert idstorage.get_mapping_counts(NamespaceID("whee")) == ({}, {})
+        assert col.count_documents({}) == 4
+
+    # writes are allowed again after the rebuild
+    idstorage.remove_mappings([(oid("bat", "a"), oid("bat", "b"))])
+    assert idstorage.rebuild_mapping_counts(2) == 3
+    assert col.count_documents({}) == 3
+
+
+def test_rebuild_mapping_counts_refuses_writes(idstorage, mongo, monkeypatch):
+    idstorage.add_mappings([(oid("foo", "a"), oid("bar", "a"))])
+    sleeps = []
+
+    def sleep(secs):
+        # mapping writes that start after the rebuild must fail
+        sleeps.append(secs)
+        fail_mapping_writes(idstorage)
+
+    monkeypatch.setattr(id_mapping_mongo_storage.time, "sleep", sleep)
+    assert idstorage.rebuild_mapping_counts() == 1
+    assert sleeps == [30]
+    assert idstorage.get_mapping_counts(NamespaceID("foo")) == ({NamespaceID("bar"): 1}, {})
+
+    # a rebuild that was interrupted leaves writes disabled until a rebuild completes
+    mongo.client[TEST_DB_NAME]["config"].update_one(
+        {"schema": "schema"}, {"$set": {"countrebuild": True}})
+    fail_mapping_writes(idstorage)
+    monkeypatch.setattr(id_mapping_mongo_storage.time, "sleep", lambda secs: None)
+    assert idstorage.rebuild_mapping_counts() == 1
+    idstorage.add_mapping(oid("foo", "b"), oid("bar", "b"))
+    assert idstorage.get_mapping_counts(NamespaceID("foo")) == ({NamespaceID("bar"): 2}, {})
+
+
+def fail_mapping_writes(idstorage):
+    err = IDMappingStorageError(
+        "Mapping writes are disabled while the mapping counts are rebuilt. If no rebuild is "
+        + "running, a rebuild was interrupted and must be run again")
+    m = (oid("foo", "x"), oid("bar", "x"))
+    for write in [lambda: idstorage.add_mapping(*m),
+                  lambda: idstorage.remove_mapping(*m),
+                  lambda: idstorage.add_mappings([m]),
+                  lambda: idstorage.remove_mappings([m])]:
+        with raises(Exception) as got:
+            write()
+        assert_exception_correct(got.value, err)
+    assert idstorage.find_mappings(m[0]) == (set(), set())
+
+
+def test_rebuild_mapping_counts_fail_workers(idstorage):
+    for workers in [0, -1]:
+        with raises(Exception) as got:
+            idstorage.rebuild_mapping_counts(workers)
+        assert_exception_correct(got.value, ValueError("workers must be at least 1"))
+
+
+def test_command_counter(mongo):
+    mongo.clear_database(TEST_DB_NAME, drop_indexes=True)
+    client = MongoClient("localhost", mongo.port, event_listeners=[MongoCommandCounter()])
+    try:
+        storage = IDMappingMongoStorage(client[TEST_DB_NAME])
+        storage.add_mapping(
+            ObjectID(NamespaceID("ns1"), "id1"), ObjectID(NamespaceID("ns2"), "id2")
+        )
+
+        rt = request_timing.start_request_timer()
+        try:
+            storage.find_mappings(ObjectID(NamespaceID("ns1"), "id1"))
+            storage.find_mappings_bulk(NamespaceID("ns1"), ["id1", "id2"])
+        finally:
+            request_timing.stop_request_timer()
+
+        # one query per mapping direction
+        timing = rt.to_dict()
+        assert timing["mongo_calls"] == 4
+        assert timing["mapping_query_ms"] > 0
+    finally:
+        client.close()
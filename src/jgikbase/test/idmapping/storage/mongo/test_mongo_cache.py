@@ -0,0 +1,103 @@
+from pytest import raises, fixture
+from unittest.mock import create_autospec
+from jgikbase.test.idmapping.mongo_controller import MongoController
+from jgikbase.test.idmapping import test_utils
+from jgikbase.idmapping.storage.mongo.mongo_cache import MongoCache
+from jgikbase.test.idmapping.test_utils import assert_exception_correct
+import time
+
+TEST_DB_NAME = "test_id_mapping_cache"
+TEST_COL_NAME = "cache"
+
+
+@fixture(scope="module")
+def mongo():
+    mongoexe = test_utils.get_mongo_exe()
+    tempdir = test_utils.get_temp_dir()
+    wt = test_utils.get_use_wired_tiger()
+    mongo = MongoController(mongoexe, tempdir, wt)
+    print(
+        "running mongo {}{} on port {} in dir {}".format(
+            mongo.db_version,
+            " with WiredTiger" if wt else "",
+            mongo.port,
+            mongo.temp_dir,
+        )
+    )
+    yield mongo
+    del_temp = test_utils.get_delete_temp_files()
+    print("shutting down mongo, delete_temp_files={}".format(del_temp))
+    mongo.destroy(del_temp)
+
+
+@fixture
+def col(mongo):
+    mongo.clear_database(TEST_DB_NAME, drop_indexes=True)
+    return mongo.client[TEST_DB_NAME][TEST_COL_NAME]
+
+
+def test_init_fail():
+    with raises(Exception) as got:
+        MongoCache(None)
+    assert_exception_correct(got.value, TypeError("collection cannot be None"))
+
+
+def test_index(col):
+    MongoCache(col)
+    indexes = col.index_information()
+    assert indexes["exp_1"]["key"] == [("exp", 1)]
+    assert indexes["exp_1"]["expireAfterSeconds"] == 0
+
+
+def test_get_set(col):
+    timer = create_autospec(time.time, spec_set=True)
+    cache = MongoCache(col, 100, timer)
+    # the TTL monitor uses the real time, so the fake time must not be in the past
+    now = time.time() + 3600
+    timer.return_value = now
+
+    assert cache.get("k1") is None
+
+    cache.set("k1", ["as", "user", True])
+    cache.set("k2", False, ttl=10)
+    cache.set("k3", "invalid token", ttl=200)
+    assert cache.get("k1") == ["as", "user", True]
+    assert cache.get("k2") is False
+    assert cache.get("k3") == "invalid token"
+
+    # replace
+    cache.set("k2", True, ttl=10)
+    assert cache.get("k2") is True
+    assert col.count_documents({}) == 3
+
+    # expiration
+    timer.return_value = now + 9.9
+    assert cache.get("k2") is True
+    timer.return_value = now + 10
+    assert cache.get("k2") is None
+    timer.return_value = now + 99.9
+    assert cache.get("k1") == ["as", "user", True]
+    timer.return_value = now + 100
+    assert cache.get("k1") is None
+    assert cache.get("k3") == "invalid token"
+
+
+def test_shared(col):
+    # two caches on the same collection, as in two server processes
+    cache1 = MongoCache(col)
+    cache2 = MongoCache(col)
+
+    cache1.set("k", {"foo": "bar"})
+    assert cache2.get("k") == {"foo": "bar"}
+
+
+def test_get_set_fail_bad_input(col):
+    cache = MongoCache(col)
+    for fn, args, err in [
+        (cache.get, [None], "key cannot be None"),
+        (cache.set, [None, "v"], "key cannot be None"),
+        (cache.set, ["k", None], "value cannot be None"),
+    ]:
+        with raises(Exception) as got:
+            fn(*args)
+        assert_exception_correct(got.value, TypeError(err))
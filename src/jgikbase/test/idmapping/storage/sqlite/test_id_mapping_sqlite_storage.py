@@ -0,0 +1,364 @@
+from pytest import raises, fixture
+from jgikbase.idmapping.storage.sqlite import id_mapping_sqlite_storage
+from jgikbase.idmapping.storage.sqlite.id_mapping_sqlite_storage import (
+    IDMappingSQLiteStorage,
+    _mapping_query,
+    _ID_EQUALS,
+    _ID_IN_LIST,
+)
+from jgikbase.idmapping.core.user import Username
+from jgikbase.idmapping.core.tokens import HashedToken
+from jgikbase.idmapping.core.object_id import NamespaceID, ObjectID
+from jgikbase.idmapping.storage.errors import (
+    IDMappingStorageError,
+    StorageInitException,
+)
+from jgikbase.test.idmapping.test_utils import assert_exception_correct
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import time
+
+# The tests of the storage system interface are shared with the MongoDB storage system and run
+# here against a SQLite database with the idstorage fixture below.
+from jgikbase.test.idmapping.storage.mongo.test_id_mapping_mongo_storage import (  # noqa: F401
+    oid,
+    test_create_update_and_get_user,
+    test_create_user_fail_input_None,
+    test_create_user_fail_duplicate_user,
+    test_create_user_fail_duplicate_token,
+    test_update_user_token_fail_input_None,
+    test_update_user_token_fail_duplicate_token,
+    test_update_user_token_fail_no_such_user,
+    test_get_user_fail_input_None,
+    test_get_user_fail_no_such_token,
+    test_set_user_as_admin,
+    test_set_local_user_as_admin_fail_None_input,
+    test_set_local_user_as_admin_fail_no_such_user,
+    test_get_users,
+    test_get_users_by_token,
+    test_users_version,
+    test_user_exists,
+    test_user_exists_fail,
+    test_create_and_get_namespace,
+    test_create_namespace_fail_input_None,
+    test_create_namespace_fail_namespace_exists,
+    test_get_namespace_fail_input_None,
+    test_get_namespace_fail_no_such_namespace,
+    test_add_and_remove_namespace_users,
+    test_add_user_to_namespace_fail_inputs_None,
+    test_remove_user_from_namespace_fail_inputs_None,
+    test_add_user_to_namespace_fail_no_such_namespace,
+    test_remove_user_from_namespace_fail_no_such_namespace,
+    test_add_user_to_namespace_fail_duplicate,
+    test_add_users_to_namespace,
+    test_add_users_to_namespace_fail,
+    test_remove_user_from_namespace_fail_no_such_user,
+    test_set_namespace_publicly_mappable,
+    test_set_namespace_publicly_mappable_input_None,
+    test_set_namespace_publicly_mappable_no_such_namespace,
+    test_namespace_version,
+    test_get_namespaces,
+    test_get_namespaces_without_users,
+    test_get_namespaces_with_nids,
+    test_get_namespaces_with_duplicate_nids,
+    test_get_namespaces_fail_None_input,
+    test_get_namespaces_fail_no_such_namepsace,
+    test_add_and_get_mapping,
+    test_remove_mapping,
+    test_add_and_remove_mappings_bulk,
+    test_find_no_mappings,
+    test_find_multiple_mappings,
+    test_filter_mappings,
+    test_find_mappings_bulk,
+    test_find_mappings_bulk_fail_input_None,
+    test_add_mapping_fail_input_None,
+    test_remove_mapping_fail_input_None,
+    test_add_mappings_fail_input_None,
+    test_remove_mappings_fail_input_None,
+    test_find_mappings_fail_input_None,
+    test_find_mappings_range,
+    test_find_mappings_range_fail_bad_input,
+    test_iter_mappings,
+    test_iter_mappings_fail_None_input,
+    test_mapping_counts,
+    test_get_mapping_counts_fail_None_input,
+    test_rebuild_mapping_counts_fail_workers,
+)
+
+DB_FILE = "idmapping.db"
+
+
+@fixture
+def dbpath(tmp_path):
+    return tmp_path / DB_FILE
+
+
+@fixture
+def idstorage(dbpath):
+    return IDMappingSQLiteStorage(dbpath)
+
+
+@fixture
+def db(idstorage, dbpath):
+    # a separate connection to the database for checking and altering its contents
+    conn = sqlite3.connect(str(dbpath), isolation_level=None)
+    yield conn
+    conn.close()
+
+
+def test_fail_startup():
+    with raises(Exception) as got:
+        IDMappingSQLiteStorage(None)
+    assert_exception_correct(got.value, TypeError("path cannot be None"))
+
+
+def test_fail_startup_bad_lock_timeout(dbpath):
+    with raises(Exception) as got:
+        IDMappingSQLiteStorage(dbpath, -0.1)
+    assert_exception_correct(got.value, ValueError("lock_timeout_sec cannot be negative"))
+
+
+def test_fail_startup_bad_path(tmp_path):
+    path = tmp_path / "nodir" / DB_FILE
+    fail_startup(path, "Failed to initialize database {}: unable to open database file".format(
+        path))
+
+
+def test_fail_startup_old_sqlite(dbpath, monkeypatch):
+    monkeypatch.setattr(id_mapping_sqlite_storage.sqlite3, "sqlite_version_info", (3, 23, 1))
+    monkeypatch.setattr(id_mapping_sqlite_storage.sqlite3, "sqlite_version", "3.23.1")
+    fail_startup(dbpath, "SQLite version 3.24.0 is required, found 3.23.1")
+
+
+def fail_startup(path, expected_msg):
+    with raises(Exception) as got:
+        IDMappingSQLiteStorage(path)
+    assert_exception_correct(got.value, StorageInitException(expected_msg))
+
+
+def test_schema(db):
+    assert db.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    tables = db.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name").fetchall()
+    assert tables == [("config",), ("map",), ("mapcount",), ("ns",), ("nsusers",), ("users",)]
+    indexes = db.execute(
+        "SELECT tbl_name, name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+        + "ORDER BY name").fetchall()
+    assert indexes == [("map", "map_reverse"), ("mapcount", "mapcount_reverse")]
+    assert [r[2] for r in db.execute("PRAGMA index_info(map_reverse)")] == [
+        "snsid", "sid", "pnsid", "pid"]
+    assert [r[2] for r in db.execute("PRAGMA index_info(mapcount_reverse)")] == [
+        "snsid", "pnsid", "count"]
+
+
+def test_startup_and_check_config(idstorage, db, dbpath):
+    assert db.execute("SELECT schema, schemaver, inupdate FROM config").fetchall() == [
+        ("schema", 1, 0)]
+
+    # check startup works with the config row in place and the data is kept
+    idstorage.create_local_user(Username("foo"), HashedToken("t"))
+    idmap = IDMappingSQLiteStorage(dbpath)
+    assert idmap.get_user(HashedToken("t")) == (Username("foo"), False)
+    assert idmap.get_users_version() == 1
+    assert db.execute("SELECT COUNT(*) FROM config").fetchone() == (1,)
+
+
+def test_startup_with_bad_schema_version(db, dbpath):
+    db.execute("UPDATE config SET schemaver = 4")
+    fail_startup(dbpath, "Incompatible database schema. Server is v1, DB is v4")
+
+
+def test_startup_in_update(db, dbpath):
+    db.execute("UPDATE config SET inupdate = 1")
+    fail_startup(
+        dbpath,
+        "The database is in the middle of an update from v1 of the schema. Aborting startup.")
+
+
+def test_update_schema(idstorage):
+    assert idstorage.update_schema() is False
+
+
+def test_multiple_instances(idstorage, dbpath):
+    # e.g. servers in different processes
+    idstorage2 = IDMappingSQLiteStorage(dbpath)
+    idstorage.create_namespace(NamespaceID("foo"))
+    idstorage2.add_mapping(oid("foo", "a"), oid("bar", "b"))
+
+    assert idstorage2.get_namespace_version() == 1
+    assert idstorage.find_mappings(oid("foo", "a")) == ({oid("bar", "b")}, set())
+    assert idstorage.get_mapping_counts(NamespaceID("foo")) == ({NamespaceID("bar"): 1}, {})
+
+
+def test_database_locked(idstorage, db, dbpath):
+    # e.g. the CLI loading mappings in another process
+    idstorage2 = IDMappingSQLiteStorage(dbpath, lock_timeout_sec=0.1)
+    assert db.execute("PRAGMA busy_timeout").fetchone() == (5000,)  # the sqlite3 default
+    assert idstorage2._conn.execute("PRAGMA busy_timeout").fetchone() == (100,)
+    assert idstorage._conn.execute("PRAGMA busy_timeout").fetchone() == (1000,)
+    idstorage.add_mapping(oid("foo", "a"), oid("bar", "a"))
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("INSERT INTO map VALUES ('foo', 'b', 'bar', 'b')")
+        start = time.perf_counter()
+        with raises(Exception) as got:
+            idstorage2.add_mapping(oid("foo", "c"), oid("bar", "c"))
+        assert time.perf_counter() - start < 1
+        assert_exception_correct(got.value, IDMappingStorageError(
+            "Database operation failed: database is locked"))
+        # readers are not blocked by the writer
+        assert idstorage2.find_mappings(oid("foo", "a")) == ({oid("bar", "a")}, set())
+        assert idstorage2.find_mappings(oid("foo", "b")) == (set(), set())
+    finally:
+        db.execute("COMMIT")
+
+    idstorage2.add_mapping(oid("foo", "c"), oid("bar", "c"))
+    assert idstorage.find_mappings_bulk(NamespaceID("foo"), ["b", "c"]) == {
+        "b": ({oid("bar", "b")}, set()), "c": ({oid("bar", "c")}, set())}
+
+
+def test_concurrent_writes(idstorage):
+    def add(i):
+        return idstorage.add_mappings([(oid("foo", "{}_{}".format(i, j)), oid("bar", "x"))
+                                       for j in range(50)])
+
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        assert list(ex.map(add, range(16))) == [(50, 0)] * 16
+
+    assert idstorage.get_mapping_counts(NamespaceID("bar")) == ({}, {NamespaceID("foo"): 800})
+    assert len(idstorage.find_mappings(oid("bar", "x"))[1]) == 800
+
+
+def test_failed_bulk_write_is_rolled_back(idstorage, monkeypatch):
+    idstorage.add_mapping(oid("foo", "a"), oid("bar", "a"))
+    monkeypatch.setattr(
+        id_mapping_sqlite_storage, "_INC_MAPPING_COUNT", "INSERT INTO nope VALUES (?, ?, ?)")
+
+    with raises(Exception) as got:
+        idstorage.add_mappings([(oid("foo", "b"), oid("bar", "b")),
+                                (oid("foo", "c"), oid("baz", "c"))])
+    assert_exception_correct(got.value, IDMappingStorageError(
+        "Database operation failed: no such table: nope"))
+    with raises(IDMappingStorageError):
+        idstorage.remove_mapping(oid("foo", "a"), oid("bar", "a"))
+
+    assert idstorage.find_mappings_bulk(NamespaceID("foo"), ["a", "b", "c"]) == {
+        "a": ({oid("bar", "a")}, set()), "b": (set(), set()), "c": (set(), set())}
+    # the storage system is still usable
+    monkeypatch.undo()
+    assert idstorage.add_mappings([(oid("foo", "b"), oid("bar", "b"))]) == (1, 0)
+    assert idstorage.get_mapping_counts(NamespaceID("foo")) == ({NamespaceID("bar"): 2}, {})
+
+
+def test_database_error(idstorage, db):
+    db.execute("DROP TABLE map")
+    with raises(Exception) as got:
+        idstorage.find_mappings(oid("foo", "a"))
+    assert_exception_correct(got.value, IDMappingStorageError(
+        "Database operation failed: no such table: map"))
+
+
+def get_plan(db, sql):
+    return [r[3] for r in db.execute("EXPLAIN QUERY PLAN " + sql, [""] * sql.count("?"))]
+
+
+def test_mapping_queries_are_covered(db):
+    # the queries used by find_mappings, find_mappings_bulk, and find_mappings_range
+    for id_condition, ordered in [
+        (_ID_EQUALS, False),
+        (_ID_IN_LIST, False),
+        ("{id} >= ? AND {id} < ?", True),
+        ("{id} > ?", True),
+    ]:
+        for filtered in [False, True]:
+            fwd = get_plan(db, _mapping_query(True, id_condition, filtered, ordered))
+            rev = get_plan(db, _mapping_query(False, id_condition, filtered, ordered))
+            assert fwd[0].startswith("SEARCH map USING PRIMARY KEY (pnsid=? AND pid")
+            assert rev[0].startswith(
+                "SEARCH map USING COVERING INDEX map_reverse (snsid=? AND sid")
+            if filtered and not ordered:
+                # the filter narrows the index bounds
+                assert "snsid=?)" in fwd[0]
+                assert "pnsid=?)" in rev[0]
+            for plan in [fwd, rev]:
+                assert not [p for p in plan if p.startswith("SCAN map")]
+                assert not [p for p in plan if "TEMP B-TREE" in p]
+
+
+def test_iter_mappings_paged(idstorage, monkeypatch):
+    monkeypatch.setattr(id_mapping_sqlite_storage, "_ITER_PAGE_SIZE", 2)
+    idstorage.add_mappings([
+        (oid("foo", "a"), oid("bar", "x")),
+        (oid("foo", "a"), oid("bar", "y")),
+        (oid("foo", "a"), oid("bar", "z")),
+        (oid("foo", "a"), oid("baz", "a")),  # other secondary namespace
+        (oid("foo", "b"), oid("bar", "w")),
+        (oid("foo", "c"), oid("bar", "x")),
+    ])
+    expected = [("a", "x"), ("a", "y"), ("a", "z"), ("b", "w"), ("c", "x")]
+
+    assert list(idstorage.iter_mappings(NamespaceID("foo"), NamespaceID("bar"))) == expected
+    assert list(idstorage.iter_mappings(
+        NamespaceID("foo"), NamespaceID("bar"), ("a", "x"))) == expected[1:]
+    it = idstorage.iter_mappings(NamespaceID("foo"), NamespaceID("bar"), ("a", "z"))
+    assert list(it) == expected[3:]
+
+
+def test_rebuild_mapping_counts(idstorage, db):
+    assert idstorage.rebuild_mapping_counts() == 0
+    assert idstorage.get_mapping_counts(NamespaceID("foo")) == ({}, {})
+
+    idstorage.add_mappings([
+        (oid("foo", "a"), oid("bar", "a")),
+        (oid("foo", "b"), oid("bar", "b")),
+        (oid("foo", "c"), oid("baz", "c")),
+        (oid("baz", "a"), oid("foo", "a")),
+        (oid("bat", "a"), oid("bat", "b")),
+    ])
+    # simulate mappings from outside the storage system and a stale count
+    db.execute("UPDATE mapcount SET count = count + 5 WHERE pnsid = 'foo' AND snsid = 'bar'")
+    db.execute("DELETE FROM mapcount WHERE pnsid = 'baz' AND snsid = 'foo'")
+    db.execute("UPDATE mapcount SET count = -1 WHERE pnsid = 'foo' AND snsid = 'baz'")
+    db.execute("INSERT INTO mapcount VALUES ('whee', 'whoo', 2)")
+
+    for workers in [1, 3]:
+        assert idstorage.rebuild_mapping_counts(workers) == 4
+
+        assert idstorage.get_mapping_counts(NamespaceID("foo")) == (
+            {NamespaceID("bar"): 2, NamespaceID("baz"): 1}, {NamespaceID("baz"): 1})
+        assert idstorage.get_mapping_counts(NamespaceID("bat")) == (
+            {NamespaceID("bat"): 1}, {NamespaceID("bat"): 1})
+        assert idstorage.get_mapping_counts(NamespaceID("whee")) == ({}, {})
+        assert db.execute("SELECT COUNT(*) FROM mapcount").fetchone() == (4,)
+
+    idstorage.remove_mappings([(oid("bat", "a"), oid("bat", "b"))])
+    assert idstorage.rebuild_mapping_counts(2) == 3
+    assert db.execute("SELECT COUNT(*) FROM mapcount").fetchone() == (3,)
+
+
+def test_rebuild_mapping_counts_single_transaction(idstorage):
+    idstorage.add_mappings([(oid("foo", "a"), oid("bar", "a"))])
+    statements = []
+    idstorage._conn.set_trace_callback(statements.append)
+    try:
+        assert idstorage.rebuild_mapping_counts(4) == 1
+    finally:
+        idstorage._conn.set_trace_callback(None)
+
+    # the counts must be calculated in the write transaction, or concurrent writes are lost
+    assert [s.split()[0] for s in statements] == ["BEGIN", "DELETE", "INSERT", "COMMIT"]
+    assert statements[0] == "BEGIN IMMEDIATE"
+    assert "FROM map GROUP BY" in statements[2]
+
+
+def test_mapping_ids_order_by_code_point(idstorage):
+    # SQLite compares UTF-8 bytes, which order the same as the code points Python compares
+    ids = ["z", "é", "\U0001F600", "￿", "a"]
+    idstorage.add_mappings([(oid("foo", i), oid("bar", "x")) for i in ids])
+
+    assert list(idstorage.find_mappings_range(NamespaceID("foo"), "")[0]) == sorted(ids)
+    assert [m[0] for m in idstorage.iter_mappings(
+        NamespaceID("foo"), NamespaceID("bar"))] == sorted(ids)
+    assert ObjectID(NamespaceID("foo"), "￿") in idstorage.find_mappings(
+        oid("bar", "x"))[1]
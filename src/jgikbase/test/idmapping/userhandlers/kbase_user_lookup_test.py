@@ -60,6 +60,22 @@ def test_init_with_builder():
         # one for builder. Outweights the bad practice here
         assert kbuh._token == Token('foo')
         assert kbuh._kbase_system_admin == 'admin'
+        assert kbuh._timeout == (5, 30)
+
+
+def test_init_with_builder_with_timeouts():
+    with requests_mock.Mocker() as m:
+        m.get('http://whee.com/',
+              request_headers={'Accept': 'application/json'},
+              json={'version': '0.1.2', 'gitcommithash': 'hashyhash', 'servertime': 3})
+        kbuh = build_lookup({'url': 'http://whee.com', 'token': 'foo', 'admin-role': 'admin',
+                             'connect-timeout': '2.5', 'read-timeout': '10'})
+        assert kbuh._timeout == (2.5, 10)
+        assert m.request_history[0].timeout == (2.5, 10)
+
+        kbuh = build_lookup({'url': 'http://whee.com', 'token': 'foo', 'admin-role': 'admin',
+                             'connect-timeout': '   ', 'read-timeout': '7'})
+        assert kbuh._timeout == (5, 7)
 
 
 def test_init_with_builder_fail_missing_input():
@@ -80,6 +96,16 @@ def test_init_with_builder_fail_missing_input():
         'kbase user lookup handler requires admin-role configuration item'))
 
 
+def test_init_with_builder_fail_bad_timeouts():
+    ok = {'token': 't', 'admin-role': 'foo', 'url': 'http://foobar.com'}
+    err = 'kbase user lookup handler {} configuration item must be a number > 0'
+    for key in ['connect-timeout', 'read-timeout']:
+        for val in ['foo', '0', '-1']:
+            notok = copy.copy(ok)
+            notok[key] = val
+            fail_init_with_builder(notok, LookupInitializationError(err.format(key)))
+
+
 def fail_init_with_builder(cfg, expected):
     with raises(Exception) as got:
         build_lookup(cfg)
@@ -92,6 +118,13 @@ def test_init_fail_None_input():
     fail_init('url', Token('foo'), None, TypeError('kbase_system_admin cannot be None'))
 
 
+def test_init_fail_bad_timeouts():
+    for c, r, err in [(0, 1, 'connect_timeout'), (1, -1, 'read_timeout')]:
+        with raises(Exception) as got:
+            KBaseUserLookup('url', Token('foo'), 'admin', c, r)
+        assert_exception_correct(got.value, ValueError(err + ' must be > 0'))
+
+
 def test_init_fail_not_json(log_collector):
     html = '<html><body>Sorry mylittleponypron.com has been shut down</body></html>'
     with requests_mock.Mocker() as m:
@@ -183,6 +216,24 @@ def check_get_user(isadmin, customroles):
             (User(AuthsourceID('kbase'), Username('u1')), isadmin, 4, 5)
 
 
+def test_get_user_with_timeouts():
+    with requests_mock.Mocker() as m:
+        m.get('http://url.com/', json={'version': '0.1.2', 'gitcommithash': 'hashyhash',
+                                       'servertime': 3})
+        m.get('http://url.com/api/V2/token', json={'user': 'u1', 'expires': 4800,
+                                                   'cachefor': 5600})
+        m.get('http://url.com/api/V2/me', json={'customroles': []})
+
+        kbuh = KBaseUserLookup('http://url.com', Token('foo'), 'admin', 1, 2)
+
+        assert kbuh.get_user(Token('bar')) == \
+            (User(AuthsourceID('kbase'), Username('u1')), False, 4, 5)
+
+        assert len(m.request_history) == 3
+        for req in m.request_history:
+            assert req.timeout == (1, 2)
+
+
 def test_get_user_fail_None_input():
     kbuh = get_user_handler('http://my1stauthservice.com/api', Token('foo'), 'admin')
     fail_get_user(kbuh, None, TypeError('token cannot be None'))
@@ -368,3 +419,61 @@ def fail_is_valid_user(kbuh, username, expected):
     with raises(Exception) as got:
         kbuh.is_valid_user(username)
     assert_exception_correct(got.value, expected)
+
+
+def test_are_valid_users():
+    with requests_mock.Mocker() as m:
+        m.get('http://my1stauthservice.com/api/api/V2/users/?list=u1,u2,u3',
+              request_headers={'Authorization': 'foo'},
+              json={'u1': 'user 1', 'u3': 'user 3'})
+
+        kbuh = get_user_handler('http://my1stauthservice.com/api/', Token('foo'), 'admin')
+
+        assert kbuh.are_valid_users({Username('u3'), Username('u1'), Username('u2')}) == (
+            {Username('u1'): True, Username('u2'): False, Username('u3'): True}, None, 3600)
+        assert len(m.request_history) == 1
+
+        assert kbuh.are_valid_users(set()) == ({}, None, 3600)
+        assert len(m.request_history) == 1
+
+
+def test_are_valid_users_chunked():
+    names = ['u{:03}'.format(i) for i in range(250)]
+    with requests_mock.Mocker() as m:
+        for i in range(0, 250, 100):
+            m.get('http://my1stauthservice.com/api/api/V2/users/?list=' +
+                  ','.join(names[i:i + 100]),
+                  complete_qs=True,
+                  request_headers={'Authorization': 'foo'},
+                  json={n: 'user' for n in names[i:i + 100] if n != 'u150'})
+
+        kbuh = get_user_handler('http://my1stauthservice.com/api/', Token('foo'), 'admin')
+
+        expected = {Username(n): n != 'u150' for n in names}
+        assert kbuh.are_valid_users(set(expected)) == (expected, None, 3600)
+        assert len(m.request_history) == 3
+
+
+def test_are_valid_users_fail_None_input():
+    kbuh = get_user_handler('http://my1stauthservice.com/api', Token('foo'), 'admin')
+    fail_are_valid_users(kbuh, None, TypeError('usernames cannot be None'))
+    fail_are_valid_users(kbuh, {Username('u'), None}, TypeError('None item in usernames'))
+
+
+def test_are_valid_users_fail_invalid_token():
+    with requests_mock.Mocker() as m:
+        m.get('http://my1stauthservice.com/api/api/V2/users/?list=u1,u2',
+              request_headers={'Authorization': 'foo'},
+              status_code=401,
+              json={'error': {'apperror': 'Invalid token', 'message': '10020 Invalid token'}})
+
+        kbuh = get_user_handler('http://my1stauthservice.com/api', Token('foo'), 'admin')
+
+        fail_are_valid_users(kbuh, {Username('u1'), Username('u2')}, InvalidTokenError(
+            'KBase auth server reported token is invalid.'))
+
+
+def fail_are_valid_users(kbuh, usernames, expected):
+    with raises(Exception) as got:
+        kbuh.are_valid_users(usernames)
+    assert_exception_correct(got.value, expected)